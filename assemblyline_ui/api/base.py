@@ -3,6 +3,7 @@ from urllib.parse import quote
 import elasticapm
 import functools
 import hashlib
+import json
 import jwt
 
 from flask import current_app, Blueprint, jsonify, make_response, request, session as flsk_session, Response, abort
@@ -12,8 +13,9 @@ from traceback import format_tb
 from assemblyline_ui.security.apikey_auth import validate_apikey
 from assemblyline_ui.security.authenticator import BaseSecurityRenderer
 from assemblyline_ui.security.oauth_auth import validate_oauth_token
-from assemblyline_ui.config import LOGGER, QUOTA_TRACKER, STORAGE, SECRET_KEY, VERSION, CLASSIFICATION, \
-    DAILY_QUOTA_TRACKER
+from assemblyline_ui.config import LOGGER, API_QUOTA_TRACKER, STORAGE, SECRET_KEY, VERSION, CLASSIFICATION
+from assemblyline_ui.helper.ai.base import DONE, TOKEN
+from assemblyline_ui.helper.quota import QUOTA_CONCURRENT_EXCEEDED, QUOTA_DAILY_EXCEEDED
 from assemblyline_ui.helper.user import login
 from assemblyline_ui.http_exceptions import AuthenticationException
 from assemblyline_ui.config import config
@@ -52,10 +54,6 @@ class api_login(BaseSecurityRenderer):
             ip = request.headers.get("X-Forwarded-For", request.remote_addr)
             with elasticapm.capture_span(name="auto_auth_check", span_type="authentication"):
                 try:
-                    # TODO: apikey_handler is slow to verify the password (bcrypt's fault)
-                    #       We could fix this by saving the hash of the combinaison of the
-                    #       APIkey and the username in an ExpiringSet and looking it up for
-                    #       sub-sequent calls...
                     validated_user, roles_limit = validate_apikey(uname, apikey, STORAGE)
                 except AuthenticationException as ae:
                     LOGGER.warning(f"Authentication failure. (U:{uname} - IP:{ip}) [{str(ae)}]")
@@ -206,31 +204,36 @@ class api_login(BaseSecurityRenderer):
                                                 user_id=user.get('uname', None))
 
                 if config.ui.enforce_quota:
-                    # Prepare session for quotas
                     quota_user = user['uname']
-                    flsk_session['quota_user'] = quota_user
-                    flsk_session['quota_set'] = True
 
-                    # Check current user quota
+                    # Load current user quotas
                     quota = user.get('api_quota')
                     if quota is None:
                         quota = config.ui.default_quotas.concurrent_api_calls
-                    if quota != 0 and not QUOTA_TRACKER.begin(quota_user, quota):
+                    daily_quota = user.get('api_daily_quota')
+                    if daily_quota is None:
+                        daily_quota = config.ui.default_quotas.daily_api_calls
+
+                    # Check both quotas at once, calls that don't count toward quota skip the daily quota
+                    quota_status, current_daily_quota = API_QUOTA_TRACKER.begin(
+                        quota_user, quota, daily_quota if self.count_toward_quota else 0)
+                    if quota_status == QUOTA_CONCURRENT_EXCEEDED:
                         LOGGER.info(f"User {quota_user} was prevented from using the api due to exceeded quota.")
                         return make_api_response(
                             "", f"You've exceeded your maximum concurrent API calls quota of {quota}", 503)
 
-                    # Check daily quota
-                    daily_quota = user.get('api_daily_quota')
-                    if daily_quota is None:
-                        daily_quota = config.ui.default_quotas.daily_api_calls
-                    if daily_quota != 0 and self.count_toward_quota:
-                        current_daily_quota = DAILY_QUOTA_TRACKER.increment_api(quota_user)
+                    if current_daily_quota is not None:
                         flsk_session['remaining_quota_api'] = max(daily_quota - current_daily_quota, 0)
-                        if current_daily_quota > daily_quota:
-                            LOGGER.info(f"User {quota_user} was prevented from using the api due to exceeded quota.")
-                            return make_api_response(
-                                "", f"You've exceeded your daily maximum API calls quota of {daily_quota}", 503)
+
+                    if quota_status == QUOTA_DAILY_EXCEEDED:
+                        LOGGER.info(f"User {quota_user} was prevented from using the api due to exceeded quota.")
+                        return make_api_response(
+                            "", f"You've exceeded your daily maximum API calls quota of {daily_quota}", 503)
+
+                    # Prepare session for quotas, a concurrent call slot was reserved for the user
+                    if quota != 0:
+                        flsk_session['quota_user'] = quota_user
+                        flsk_session['quota_set'] = True
 
             return func(*args, **kwargs)
         base.protected = True
@@ -262,7 +265,7 @@ def make_api_response(data, err="", status_code=200, cookies=None) -> Response:
     quota_user = flsk_session.pop("quota_user", None)
     quota_set = flsk_session.pop("quota_set", False)
     if quota_user and quota_set:
-        QUOTA_TRACKER.end(quota_user)
+        API_QUOTA_TRACKER.end(quota_user)
 
     if type(err) is Exception:
         trace = exc_info()[2]
@@ -290,7 +293,7 @@ def make_file_response(data, name, size, status_code=200, content_type="applicat
     quota_user = flsk_session.pop("quota_user", None)
     quota_set = flsk_session.pop("quota_set", False)
     if quota_user and quota_set:
-        QUOTA_TRACKER.end(quota_user)
+        API_QUOTA_TRACKER.end(quota_user)
 
     filename = f"UTF-8''{quote(safe_str(name), safe='')}"
 
@@ -305,39 +308,76 @@ def make_file_response(data, name, size, status_code=200, content_type="applicat
     return response
 
 
-def stream_file_response(reader, name, size, status_code=200):
+def stream_file_response(reader, name, size, status_code=200, accept_ranges=False):
     quota_user = flsk_session.pop("quota_user", None)
     quota_set = flsk_session.pop("quota_set", False)
     if quota_user and quota_set:
-        QUOTA_TRACKER.end(quota_user)
+        API_QUOTA_TRACKER.end(quota_user)
 
     chunk_size = 65535
+    filename = f"UTF-8''{quote(safe_str(name), safe='')}"
+    headers = {"Content-Type": 'application/octet-stream',
+               "Content-Disposition": f"attachment; filename=file.bin; filename*={filename}"}
+
+    start, end = 0, size
+    if accept_ranges:
+        headers["Accept-Ranges"] = "bytes"
+        if request.range is not None:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                reader.close()
+                headers = {"Content-Range": f"bytes */{size}"}
+                headers.update(get_response_headers())
+                return Response(status=416, headers=headers)
+
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    headers["Content-Length"] = end - start
 
     def generate():
-        reader.seek(0)
-        while True:
-            data = reader.read(chunk_size)
-            if not data:
-                break
-            yield data
-        reader.close()
+        try:
+            reader.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = reader.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            reader.close()
+
+    # Add extra headers
+    headers.update(get_response_headers())
+
+    return Response(generate(), status=status_code, headers=headers)
+
+
+def stream_file_chunks_response(chunks, name, status_code=200):
+    quota_user = flsk_session.pop("quota_user", None)
+    quota_set = flsk_session.pop("quota_set", False)
+    if quota_user and quota_set:
+        API_QUOTA_TRACKER.end(quota_user)
 
     filename = f"UTF-8''{quote(safe_str(name), safe='')}"
 
-    headers = {"Content-Type": 'application/octet-stream', "Content-Length": size,
+    # The size is not known in advance so the response is chunked
+    headers = {"Content-Type": 'application/octet-stream',
                "Content-Disposition": f"attachment; filename=file.bin; filename*={filename}"}
 
     # Add extra headers
     headers.update(get_response_headers())
 
-    return Response(generate(), status=status_code, headers=headers)
+    return Response(chunks, status=status_code, headers=headers)
 
 
 def make_binary_response(data, size, status_code=200):
     quota_user = flsk_session.pop("quota_user", None)
     quota_set = flsk_session.pop("quota_set", False)
     if quota_user and quota_set:
-        QUOTA_TRACKER.end(quota_user)
+        API_QUOTA_TRACKER.end(quota_user)
 
     response = make_response(data, status_code)
     response.headers["Content-Type"] = 'application/octet-stream'
@@ -353,7 +393,7 @@ def stream_binary_response(reader, status_code=200):
     quota_user = flsk_session.pop("quota_user", None)
     quota_set = flsk_session.pop("quota_set", False)
     if quota_user and quota_set:
-        QUOTA_TRACKER.end(quota_user)
+        API_QUOTA_TRACKER.end(quota_user)
 
     chunk_size = 4096
 
@@ -371,6 +411,109 @@ def stream_binary_response(reader, status_code=200):
     return Response(generate(), status=status_code, mimetype='application/octet-stream', headers=headers)
 
 
+def stream_api_response(json_items, status_code=200):
+    """Stream a standard API response whose api_response is a list produced as serialized JSON items.
+
+    Each chunk is one or more serialized items separated by commas. If producing the items fails once the headers
+    are sent, the list is closed and the error is reported in the api_error_message and api_status_code of the body.
+    """
+    quota_user = flsk_session.pop("quota_user", None)
+    quota_set = flsk_session.pop("quota_set", False)
+    if quota_user and quota_set:
+        API_QUOTA_TRACKER.end(quota_user)
+
+    # noinspection PyBroadException
+    def generate():
+        yield '{"api_response":['
+        error, code = "", status_code
+        separator = ''
+        try:
+            for item in json_items:
+                if item:
+                    yield separator + item
+                    separator = ','
+        except Exception as e:
+            LOGGER.exception("Error while streaming API response")
+            error, code = str(e), 500
+        yield f'],"api_error_message":{json.dumps(error)},"api_server_version":{json.dumps(VERSION)},' \
+              f'"api_status_code":{code}}}'
+
+    # Add extra headers
+    headers = get_response_headers() or None
+
+    return Response(generate(), status=status_code, mimetype='application/json', headers=headers)
+
+
+def stream_ndjson_response(items, status_code=200, name=None):
+    """Stream items as newline delimited JSON, as a file download when a name is given"""
+    quota_user = flsk_session.pop("quota_user", None)
+    quota_set = flsk_session.pop("quota_set", False)
+    if quota_user and quota_set:
+        API_QUOTA_TRACKER.end(quota_user)
+
+    lines_per_chunk = 100
+
+    # noinspection PyBroadException
+    def generate():
+        buffer = []
+        try:
+            for item in items:
+                buffer.append(json.dumps(item, indent=None, separators=(',', ':')))
+                if len(buffer) >= lines_per_chunk:
+                    yield '\n'.join(buffer) + '\n'
+                    buffer = []
+        except Exception as e:
+            # Headers are already sent, the error is reported as the last line of the stream
+            LOGGER.exception("Error while streaming NDJSON response")
+            buffer.append(json.dumps({"api_error_message": str(e)}))
+
+        if buffer:
+            yield '\n'.join(buffer) + '\n'
+
+    # Add extra headers
+    headers = get_response_headers()
+    if name is not None:
+        filename = f"UTF-8''{quote(safe_str(name), safe='')}"
+        headers["Content-Disposition"] = f"attachment; filename=file.bin; filename*={filename}"
+
+    return Response(generate(), status=status_code, mimetype='application/x-ndjson', headers=headers or None)
+
+
+def stream_ai_response(events, on_result=None):
+    """Stream the answer of the AI as server-sent events.
+
+    Each token is sent as a `token` event as soon as it is received, the complete result is then sent as a `done`
+    event and given to on_result. Errors are sent as an `error` event since the headers are already sent.
+    """
+    quota_user = flsk_session.pop("quota_user", None)
+    quota_set = flsk_session.pop("quota_set", False)
+    if quota_user and quota_set:
+        API_QUOTA_TRACKER.end(quota_user)
+
+    def format_event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+    # noinspection PyBroadException
+    def generate():
+        try:
+            for event in events:
+                if event['type'] == TOKEN:
+                    yield format_event("token", {"content": event['content']})
+                elif event['type'] == DONE:
+                    if on_result is not None:
+                        on_result(event['result'])
+                    yield format_event("done", event['result'])
+        except Exception as e:
+            LOGGER.warning(f"Error while streaming AI response: {e}")
+            yield format_event("error", {"api_error_message": str(e)})
+
+    # Add extra headers, proxies should not buffer the events
+    headers = get_response_headers()
+    headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return Response(generate(), status=200, mimetype='text/event-stream', headers=headers)
+
+
 #####################################
 # API list API (API inception)
 @api.route("/")
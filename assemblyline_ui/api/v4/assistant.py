@@ -1,5 +1,5 @@
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ai_response
 from assemblyline_ui.config import AUDIT_LOG, AI_AGENT
 from flask import request
 
@@ -20,6 +20,7 @@ def assistant_conversation(**kwargs):
 
     Arguments:
     lang           => Which language do you want the AI to respond in?
+    stream         => Stream the answer as server-sent events while it is generated
 
     Data Block:
     [
@@ -51,9 +52,17 @@ def assistant_conversation(**kwargs):
         "content": "Hello! How can I assist you today?"
       }
     ]
+
+    Streamed result example:
+    event: token
+    data: {"content": "Hello! How can"}
+
+    event: done
+    data: {"trace": [<The conversation including the answer>], "truncated": false}
     """
     user = kwargs['user']
     lang = request.args.get('lang', 'english')
+    stream = request.args.get('stream', 'false').lower() in ['true', '']
     messages = request.json
 
     if not isinstance(messages, list):
@@ -70,4 +79,7 @@ def assistant_conversation(**kwargs):
                 f"{user['uname']} [{user['classification']}] :: assistant_conversation(content={message['content']})")
             break
 
+    if stream:
+        return stream_ai_response(AI_AGENT.continued_ai_conversation(messages, lang=lang, stream=True))
+
     return make_api_response(AI_AGENT.continued_ai_conversation(messages, lang=lang))
@@ -33,9 +33,15 @@ from assemblyline_ui.config import (
     get_token_store,
 )
 from assemblyline_ui.helper.oauth import fetch_avatar, parse_profile
-from assemblyline_ui.helper.user import API_PRIV_MAP, get_default_user_quotas, get_dynamic_classification
+from assemblyline_ui.helper.user import (
+    API_PRIV_MAP,
+    get_default_user_quotas,
+    get_dynamic_classification,
+    notify_user_change,
+)
 from assemblyline_ui.http_exceptions import AuthenticationException
-from assemblyline_ui.security.authenticator import default_authenticator
+from assemblyline_ui.security.apikey_auth import APIKEY_CACHE
+from assemblyline_ui.security.authenticator import SESSION_STORE, default_authenticator
 from assemblyline_ui.security.saml_auth import get_attribute, get_roles, get_types
 from authlib.integrations.base_client import OAuthError
 from authlib.integrations.requests_client import OAuth2Session
@@ -109,6 +115,7 @@ def add_apikey(name, priv, **kwargs):
         "roles": roles
     }
     STORAGE.user.save(user['uname'], user_data)
+    notify_user_change(user['uname'])
 
     return make_api_response({"acl": priv_map, "apikey": f"{name}:{random_pass}", "name": name,  "roles": roles})
 
@@ -137,10 +144,36 @@ def delete_apikey(name, **kwargs):
     user_data = STORAGE.user.get(user['uname'], as_obj=False)
     user_data['apikeys'].pop(name)
     STORAGE.user.save(user['uname'], user_data)
+    APIKEY_CACHE.invalidate(user['uname'], name)
+    notify_user_change(user['uname'])
 
     return make_api_response({"success": True})
 
 
+@auth_api.route("/apikey_cache/", methods=["GET"])
+@api_login(audit=False, require_role=[ROLES.administration], count_toward_quota=False)
+def get_apikey_cache_stats(**_):
+    """
+    Get the hit/miss counters of the verified API keys cache
+
+    Variables:
+    None
+
+    Arguments:
+    None
+
+    Data Block:
+    None
+
+    Result example:
+    {
+     "hits": 1000,      # Number of API key validations served from the cache
+     "misses": 10       # Number of API key validations that needed a full verification
+    }
+    """
+    return make_api_response(APIKEY_CACHE.get_stats())
+
+
 @auth_api.route("/obo_token/<token_id>/", methods=["DELETE"])
 @api_login(audit=False, require_role=[ROLES.obo_access], count_toward_quota=False)
 def delete_obo_token(token_id, **kwargs):
@@ -167,6 +200,7 @@ def delete_obo_token(token_id, **kwargs):
 
     user_data['apps'].pop(token_id)
     STORAGE.user.save(uname, user_data)
+    notify_user_change(uname)
     return make_api_response({"success": True})
 
 
@@ -195,6 +229,7 @@ def disable_otp(**kwargs):
     user_data['otp_sk'] = None
     user_data['security_tokens'] = {}
     STORAGE.user.save(uname, user_data)
+    notify_user_change(uname)
     return make_api_response({"success": True})
 
 
@@ -279,6 +314,7 @@ def get_obo_token(**kwargs):
         token_id = get_random_id()
         user_data['apps'][token_id] = token_data
         STORAGE.user.save(uname, user_data)
+        notify_user_change(uname)
 
     token = jwt.encode(token_data, hashlib.sha256(f"{SECRET_KEY}_{token_id}".encode()).hexdigest(),
                        algorithm="HS256", headers={'token_id': token_id, 'user': uname})
@@ -473,7 +509,7 @@ def logout(**_):
     try:
         session_id = flsk_session.get('session_id', None)
         if session_id:
-            KV_SESSION.pop(session_id)
+            SESSION_STORE.drop(session_id)
         flsk_session.clear()
         res = make_api_response({"success": True})
         res.set_cookie('XSRF-TOKEN', '', max_age=0)
@@ -597,6 +633,7 @@ def saml_acs(**_):
             # Save the updated user
             cur_user.update(data)
             STORAGE.user.save(username, cur_user)
+            notify_user_change(username)
 
         else:
             # User does not exists and auto_create is OFF, redirect to the UI with the error
@@ -803,6 +840,7 @@ def oauth_validate(**_):
 
                         # Save updated user
                         STORAGE.user.save(username, get_default_user_quotas(cur_user))
+                        notify_user_change(username)
 
                     if cur_user:
                         if avatar is None:
@@ -892,6 +930,7 @@ def reset_pwd(**_):
                     user = res['items'][0]
                     user.password = get_password_hash(password)
                     STORAGE.user.save(user.uname, user)
+                    notify_user_change(user.uname)
                     return make_api_response({"success": True})
 
         except Exception as e:
@@ -1136,6 +1175,7 @@ def validate_otp(token, **kwargs):
     if secret_key and get_totp_token(secret_key) == token:
         user_data['otp_sk'] = secret_key
         STORAGE.user.save(uname, user_data)
+        notify_user_change(uname)
         return make_api_response({'success': True})
     else:
         flsk_session['temp_otp_sk'] = secret_key
@@ -9,7 +9,10 @@ from assemblyline.common.isotime import now_as_iso
 from assemblyline.datastore.exceptions import VersionConflictException
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
-from assemblyline_ui.config import CLASSIFICATION, LOGGER, STORAGE
+from assemblyline_ui.config import CLASSIFICATION, LOGGER, SIMILARITY_INDEX_MAX_ITEMS, STORAGE, redis
+from assemblyline_ui.helper.membership import ListMembershipFilter, bulk_check
+from assemblyline_ui.helper.similarity import SSDEEP_DEFAULT_THRESHOLD, TLSH_DEFAULT_THRESHOLD, SimilarityIndex, \
+    get_similar_items
 from assemblyline_core.badlist_client import BadlistClient, InvalidBadhash
 
 SUB_API = 'badlist'
@@ -19,6 +22,10 @@ badlist_api._doc = "Perform operations on badlisted hashes"
 ATTRIBUTION_TYPES = ['actor', 'campaign', 'category', 'exploit', 'implant', 'family', 'network']
 
 CLIENT = BadlistClient(datastore=STORAGE)
+BADLIST_FILTER = ListMembershipFilter(STORAGE.badlist, redis)
+BADLIST_SIMILARITY_INDEX = SimilarityIndex(STORAGE.badlist, 'hashes.tlsh', 'hashes.ssdeep', 'updated',
+                                           SIMILARITY_INDEX_MAX_ITEMS)
+MAX_SIMILAR_ROWS = 1000
 
 
 @badlist_api.route("/", methods=["POST", "PUT"])
@@ -88,6 +95,8 @@ def add_or_update_hash(**kwargs):
 
     try:
         qhash, op = CLIENT.add_update(data, user)
+        file_hashes = data.get('hashes', None) or {}
+        BADLIST_FILTER.add(qhash, *[v for k, v in file_hashes.items() if k in ['md5', 'sha1'] and v])
         return make_api_response({'success': True, "op": op, 'hash': qhash})
     except PermissionError as e:
         return make_api_response(None, str(e), 403)
@@ -307,17 +316,19 @@ def find_similar_tlsh(qhash, **kwargs):
     qhash       => TLSH hash to query for
 
     Arguments:
-    None
+    threshold   => Maximum TLSH distance of the similar hashes (Default: 50)
+    rows        => Maximum number of similar hashes to return, most similar first (Default: 25)
 
     Data Block:
     None
 
     API call example:
-    GET /api/v1/badlist/tlsh/123456...654321/
+    GET /api/v1/badlist/tlsh/123456...654321/?threshold=50
 
     Result example:
     [
       {
+        "distance": 12,               # TLSH distance between the queried hash and this one
         "classification": "TLP:C",    # Classification of the bad hash (Computed for the mix of sources) - Optional
         "enabled": true,              # Is the bad hash enabled or not
         "attribution": {              # Attributions associated to the hash  (Optional section)
@@ -362,8 +373,25 @@ def find_similar_tlsh(qhash, **kwargs):
     ...]
     """
     user = kwargs['user']
-    return make_api_response(STORAGE.badlist.search(
-        f"hashes.tlsh:{qhash}", fl="*", as_obj=False, access_control=user['access_control'])['items'])
+    try:
+        threshold = int(request.args.get('threshold', TLSH_DEFAULT_THRESHOLD))
+        rows = min(int(request.args.get('rows', 25)), MAX_SIMILAR_ROWS)
+    except ValueError:
+        return make_api_response(None, "Threshold and rows must be integers", 400)
+
+    try:
+        matches = BADLIST_SIMILARITY_INDEX.search_tlsh(qhash, threshold=threshold, rows=rows)
+    except ValueError:
+        # Hashes that can't be parsed are not in the similarity index
+        matches = None
+
+    if matches is None:
+        # The similarity index can't be used, only look for the exact hash
+        return make_api_response(STORAGE.badlist.search(
+            f"hashes.tlsh:{qhash}", fl="*", as_obj=False, access_control=user['access_control'])['items'])
+
+    return make_api_response(get_similar_items(STORAGE.badlist, matches, CLASSIFICATION, user['classification'],
+                                               'distance'))
 
 
 @badlist_api.route("/ssdeep/<path:qhash>/", methods=["GET"])
@@ -376,17 +404,19 @@ def find_similar_ssdeep(qhash, **kwargs):
     qhash       => SSDEEP hash to query for
 
     Arguments:
-    None
+    threshold   => Minimum SSDEEP score (0-100) of the similar hashes (Default: 50)
+    rows        => Maximum number of similar hashes to return, most similar first (Default: 25)
 
     Data Block:
     None
 
     API call example:
-    GET /api/v1/badlist/ssdeep/123:ABCDEFG:ABDC/
+    GET /api/v1/badlist/ssdeep/123:ABCDEFG:ABDC/?threshold=50
 
     Result example:
     [
       {
+        "score": 85,                  # SSDEEP score (0-100) between the queried hash and this one
         "classification": "TLP:C",    # Classification of the bad hash (Computed for the mix of sources) - Optional
         "enabled": true,              # Is the bad hash enabled or not
         "attribution": {              # Attributions associated to the hash  (Optional section)
@@ -435,9 +465,74 @@ def find_similar_ssdeep(qhash, **kwargs):
         _, long, _ = qhash.replace('/', '\\/').split(":")
     except ValueError:
         return make_api_response(None, f"Invalid SSDEEP hash provided: {qhash}", 400)
-    return make_api_response(STORAGE.badlist.search(
-        f"hashes.ssdeep:{long}~", fl="*", access_control=user['access_control'],
-        as_obj=False)['items'])
+
+    try:
+        threshold = int(request.args.get('threshold', SSDEEP_DEFAULT_THRESHOLD))
+        rows = min(int(request.args.get('rows', 25)), MAX_SIMILAR_ROWS)
+    except ValueError:
+        return make_api_response(None, "Threshold and rows must be integers", 400)
+
+    try:
+        matches = BADLIST_SIMILARITY_INDEX.search_ssdeep(qhash, threshold=threshold, rows=rows)
+    except ValueError:
+        # Hashes that can't be parsed are not in the similarity index
+        matches = None
+
+    if matches is None:
+        # The similarity index can't be used, fallback on a fuzzy search of the datastore
+        return make_api_response(STORAGE.badlist.search(
+            f"hashes.ssdeep:{long}~", fl="*", access_control=user['access_control'],
+            as_obj=False)['items'])
+
+    return make_api_response(get_similar_items(STORAGE.badlist, matches, CLASSIFICATION, user['classification'],
+                                               'score'))
+
+
+@badlist_api.route("/check/", methods=["POST"])
+@api_login(require_role=[ROLES.badlist_view])
+def check_many(**kwargs):
+    """
+    Check if a list of hashes and tags exist in the badlist in a single call.
+    Items that are not badlisted are not part of the result.
+
+    Variables:
+    None
+
+    Arguments:
+    None
+
+    Data Block:
+    {
+     "hashes": [                  # List of hashes to check (either md5, sha1 or sha256)
+       "123456...654321"
+     ],
+     "tags": [                    # List of tags to check
+       {"type": "network.static.ip", "value": "1.1.1.1"}
+     ]
+    }
+
+    API call example:
+    POST /api/v4/badlist/check/
+
+    Result example:
+    {
+     "hashes": {                  # Badlisted hashes with the same content as the badlist hash API
+       "123456...654321": {...}
+     },
+     "tags": {                    # Badlisted tags per tag type
+       "network.static.ip": {
+         "1.1.1.1": {...}
+       }
+     }
+    }
+    """
+    data = request.json or {}
+    try:
+        return make_api_response(bulk_check(STORAGE.badlist, BADLIST_FILTER, CLASSIFICATION,
+                                            kwargs['user']['classification'], hashes=data.get('hashes', None),
+                                            tags=data.get('tags', None)))
+    except ValueError as e:
+        return make_api_response(None, str(e), 400)
 
 
 @badlist_api.route("/enable/<qhash>/", methods=["PUT"])
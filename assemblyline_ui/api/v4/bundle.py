@@ -1,18 +1,18 @@
-import base64
-import binascii
+import io
 import os
 
-from cart import is_cart
 from flask import request
 
-from assemblyline.common.bundling import create_bundle as bundle_create, import_bundle as bundle_import,\
-    SubmissionNotFound, BundlingException, SubmissionAlreadyExist, IncompleteBundle, BUNDLE_MAGIC
+from assemblyline.common.bundling import import_bundle as bundle_import, SubmissionNotFound, BundlingException, \
+    SubmissionAlreadyExist, IncompleteBundle
 from assemblyline.common.classification import InvalidClassification
 from assemblyline.common.uid import get_random_id
 from assemblyline.odm.models.user import ROLES
 from assemblyline_core.submission_client import SubmissionException
-from assemblyline_ui.api.base import api_login, make_api_response, stream_file_response, make_subapi_blueprint
-from assemblyline_ui.config import BUNDLING_DIR, CLASSIFICATION as Classification, STORAGE, IDENTIFY
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_file_chunks_response
+from assemblyline_ui.config import ARCHIVESTORE, BUNDLING_DIR, CLASSIFICATION as Classification, FILESTORE, STORAGE, \
+    IDENTIFY
+from assemblyline_ui.helper.bundling import get_bundle_data, iter_bundle_stream, save_bundle_body
 
 
 SUB_API = 'bundle'
@@ -51,23 +51,22 @@ def create_bundle(sid, **kwargs):
         data = STORAGE.submission.get(sid, as_obj=False)
 
     if user and data and Classification.is_accessible(user['classification'], data['classification']):
-        temp_target_file = None
         try:
-            temp_target_file = bundle_create(sid, working_dir=BUNDLING_DIR, use_alert=use_alert)
-            f_size = os.path.getsize(temp_target_file)
-            return stream_file_response(open(temp_target_file, 'rb'), "%s.al_bundle" % sid, f_size)
+            bundle_data, sha256s, bundle_sid = get_bundle_data(sid, use_alert=use_alert)
         except SubmissionNotFound as snf:
             return make_api_response("", "Submission %s does not exist. [%s]" % (sid, str(snf)), 404)
         except BundlingException as be:
             return make_api_response("",
                                      "An error occured while bundling submission %s. [%s]" % (sid, str(be)),
                                      404)
-        finally:
-            try:
-                if temp_target_file:
-                    os.remove(temp_target_file)
-            except Exception:
-                pass
+
+        filestores = [FILESTORE]
+        if ARCHIVESTORE is not None and ARCHIVESTORE != FILESTORE and ROLES.archive_download in user['roles']:
+            filestores.append(ARCHIVESTORE)
+
+        # The bundle is built and CaRTed on the fly while it is sent
+        return stream_file_chunks_response(iter_bundle_stream(bundle_data, sha256s, bundle_sid, filestores),
+                                           "%s.al_bundle" % sid)
     else:
         return make_api_response(
             "", f"You are not allowed create a bundle for this {'alert' if use_alert else 'submission'}...", 403)
@@ -104,14 +103,14 @@ def import_bundle(**_):
 
     current_bundle = os.path.join(BUNDLING_DIR, f"{get_random_id()}.bundle")
 
-    with open(current_bundle, 'wb') as fh:
-        if request.data[:3] == BUNDLE_MAGIC or is_cart(request.data[:256]):
-            fh.write(request.data)
-        else:
-            try:
-                fh.write(base64.b64decode(request.data))
-            except binascii.Error:
-                fh.write(request.data)
+    # The body is saved one block at a time instead of being loaded in memory
+    try:
+        if not save_bundle_body(request.stream, current_bundle) and request.content_length:
+            # The stream was already consumed by the audit looking for JSON parameters, it kept a copy of the body
+            save_bundle_body(io.BytesIO(request.get_data()), current_bundle)
+    except BundlingException as b:
+        os.unlink(current_bundle)
+        return make_api_response({'success': False}, err=str(b), status_code=400)
 
     try:
         bundle_import(current_bundle, working_dir=BUNDLING_DIR, min_classification=min_classification,
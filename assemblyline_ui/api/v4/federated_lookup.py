@@ -5,8 +5,8 @@ Lookup related data from external systems.
 * Provide endpoints to query systems and return links to those results.
 * Provide endpoints to query other systems to enable enrichment of AL data.
 """
-import concurrent.futures
-import os
+import functools
+import time
 import uuid
 
 from typing import TypedDict
@@ -15,16 +15,22 @@ from urllib import parse as ul
 from flask import request
 from requests import Session, exceptions
 
-from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
-from assemblyline_ui.config import config, CLASSIFICATION as Classification, LOGGER
+from assemblyline_ui.config import config, CLASSIFICATION as Classification, EXTERNAL_LOOKUP_CACHE, LOGGER, \
+    LOOKUP_ENGINE, STORAGE
+from assemblyline_ui.helper.external_lookup import ERROR, FOUND, MIN_REQUEST_TIMEOUT, NOT_FOUND, ExternalSessionPool
+from assemblyline_ui.helper.fanout import SourceFailure
+from assemblyline_ui.helper.submission import get_or_create_summary
 
 
 SUB_API = "federated_lookup"
 federated_lookup_api = make_subapi_blueprint(SUB_API, api_version=4)
 federated_lookup_api._doc = "Lookup related data through configured external data sources/systems."
 
+# Number of tags sent to an external source in a single batch lookup
+BATCH_SIZE = 500
+
 
 class _Tags():
     """Locally cache supported tags."""
@@ -80,6 +86,8 @@ class _Tags():
 
 # Set global local cache for supported tags
 all_supported_tags = _Tags().all_supported_tags
+# Keep-alive sessions to each external source
+SESSIONS = ExternalSessionPool(lambda: Session())
 
 
 def filtered_tag_names(user):
@@ -135,6 +143,69 @@ def log_error(msg, err=None, status_code=None):
     return err_id
 
 
+def _cache_key(query_type: str, tag_name: str, tag: str, tag_classification: str, limit: int) -> tuple:
+    """Key parts of a lookup in the cache, shared by the lookups of a single tag and the batch lookups."""
+    return ("tag", query_type, tag_name, ul.quote(tag, safe=""), tag_classification, limit)
+
+
+def _fetch_external(source, query_type: str, tag_name: str, tag: str, limit: int, timeout: float):
+    """Query the external source, the items returned are not filtered on the user's classification."""
+    result = {
+        "error": "",
+        "items": [],
+    }
+    headers = {
+        "accept": "application/json",
+    }
+    params = {
+        "limit": limit,
+        "max_timeout": timeout,
+    }
+    if query_type != "details":
+        params["nodata"] = True
+
+    # the tag is double URL encoded in the path of the request, like the requests made to this API
+    url = f"{source.url}/{query_type}/{tag_name}/{ul.quote(ul.quote(tag, safe=''), safe='')}/"
+    rsp = SESSIONS.get(source).get(url, params=params, headers=headers, timeout=max(timeout, MIN_REQUEST_TIMEOUT))
+
+    status_code = rsp.status_code
+    if status_code == 404 or status_code == 422:
+        result["error"] = "Not Found"
+        return NOT_FOUND, result
+    elif status_code != 200:
+        try:
+            err_msg = rsp.json()["api_error_message"]
+        except exceptions.JSONDecodeError:
+            err_msg = f"{source.name}-proxy experienced an unknown error"
+        err_id = log_error(f"Error from {source.name}", err_msg, status_code)
+        result["error"] = f"{err_msg}. Error ID: {err_id}"
+        return ERROR, result
+
+    try:
+        api_response = rsp.json()["api_response"]
+        # handle case of 200 OK for not found.
+        if not api_response:
+            result["error"] = "Not Found"
+            return NOT_FOUND, result
+
+        if isinstance(api_response, dict):
+            api_response = [api_response]
+        for data in api_response:
+            # items are filtered for each user after the lookup, make sure they can be
+            if "classification" not in data:
+                raise KeyError("classification")
+            result["items"].append(data)
+    # noinspection PyBroadException
+    except Exception as err:
+        err_msg = f"{source.name}-proxy did not return a response in the expected format"
+        err_id = log_error(err_msg, err)
+        result["error"] = f"{err_msg}. Error ID: {err_id}"
+        result["items"] = []
+        return ERROR, result
+
+    return FOUND, result
+
+
 def query_external(
     query_type,
     user,
@@ -149,21 +220,39 @@ def query_external(
     if tag_name not in all_supported_tags.get(source.name, {}):
         return
 
-    result = {
-        "error": "",
-        "items": [],
-    }
     # check query against the max supported classification of the external system
     # if this is not supported, we should let the user know.
     if not Classification.is_accessible(
         source.max_classification or Classification.UNRESTRICTED,
         tag_classification
     ):
-        result["error"] = f"Tag classification exceeds max classification of source: {source.name}."
-        return result
+        return {
+            "error": f"Tag classification exceeds max classification of source: {source.name}.",
+            "items": [],
+        }
+
+    # perform the lookup, or reuse the answer of a previous one, ensuring access controls are applied
+    status, result = EXTERNAL_LOOKUP_CACHE.lookup(
+        source.name,
+        _cache_key(query_type, tag_name, tag, tag_classification, limit),
+        functools.partial(_fetch_external, source, query_type, tag_name, tag, limit, timeout),
+        timeout=timeout,
+    )
+    output = {
+        "error": result["error"],
+        "items": [
+            data for data in result["items"]
+            if user and Classification.is_accessible(user["classification"], data["classification"])
+        ],
+    }
+    if status == ERROR:
+        raise SourceFailure(output)
+    return output
 
-    # perform the lookup, ensuring access controls are applied
-    session = Session()
+
+def _fetch_external_batch(source, tags: list[tuple[str, str]], limit: int, timeout: float) -> dict:
+    """Query the external source for many tags at once, the items returned are not filtered on the user's
+    classification. Raises SourceFailure with the error of all the tags if the source failed."""
     headers = {
         "accept": "application/json",
     }
@@ -171,41 +260,102 @@ def query_external(
         "limit": limit,
         "max_timeout": timeout,
     }
-    if query_type != "details":
-        params["nodata"] = True
+    data = {"tags": [{"tag_name": tag_name, "tag": tag} for tag_name, tag in tags]}
 
-    url = f"{source.url}/{query_type}/{tag_name}/{tag}/"
-    rsp = session.get(url, params=params, headers=headers)
+    rsp = SESSIONS.get(source).post(f"{source.url}/details/batch/", params=params, headers=headers, json=data,
+                                    timeout=max(timeout, MIN_REQUEST_TIMEOUT))
 
     status_code = rsp.status_code
-    if status_code == 404 or status_code == 422:
-        result["error"] = "Not Found"
+    if status_code == 404 or status_code == 405:
+        error = {"error": f"{source.name}-proxy does not support batch lookups.", "items": []}
+        return {key: (ERROR, error) for key in tags}
     elif status_code != 200:
         try:
             err_msg = rsp.json()["api_error_message"]
         except exceptions.JSONDecodeError:
             err_msg = f"{source.name}-proxy experienced an unknown error"
         err_id = log_error(f"Error from {source.name}", err_msg, status_code)
-        result["error"] = f"{err_msg}. Error ID: {err_id}"
-    else:
-        try:
-            api_response = rsp.json()["api_response"]
-            # handle case of 200 OK for not found.
-            if not api_response:
-                result["error"] = "Not Found"
+        raise SourceFailure({"error": f"{err_msg}. Error ID: {err_id}", "items": []})
+
+    output = {}
+    try:
+        for entry in rsp.json()["api_response"]:
+            key = (entry["tag_name"], entry["tag"])
+            if entry["error"]:
+                output[key] = (ERROR, {"error": entry["error"], "items": []})
+            elif not entry["items"]:
+                output[key] = (NOT_FOUND, {"error": "Not Found", "items": []})
             else:
-                if isinstance(api_response, dict):
-                    api_response = [api_response]
-                for data in api_response:
-                    if user and Classification.is_accessible(user["classification"], data["classification"]):
-                        result["items"].append(data)
-        # noinspection PyBroadException
-        except Exception as err:
-            err_msg = f"{source.name}-proxy did not return a response in the expected format"
-            err_id = log_error(err_msg, err)
-            result["error"] = f"{err_msg}. Error ID: {err_id}"
+                # items are filtered for each user after the lookup, make sure they can be
+                if not all("classification" in data for data in entry["items"]):
+                    raise KeyError("classification")
+                output[key] = (FOUND, {"error": "", "items": entry["items"]})
+    # noinspection PyBroadException
+    except Exception as err:
+        err_msg = f"{source.name}-proxy did not return a response in the expected format"
+        err_id = log_error(err_msg, err)
+        raise SourceFailure({"error": f"{err_msg}. Error ID: {err_id}", "items": []})
+
+    return output
+
+
+def enrich_tags_external(user, source, tags: dict[tuple[str, str], str], limit: int, timeout: float):
+    """Enrich many tags through the external source, in as few requests as possible.
+
+    Tags maps each (tag name, tag value) to the classification of the tag. Tags the source does not support are
+    left out.
+    """
+    deadline = time.monotonic() + timeout
+    supported_tags = all_supported_tags.get(source.name, {})
+    max_classification = source.max_classification or Classification.UNRESTRICTED
+
+    items = []
+    lookups = {}
+    for (tag_name, tag), tag_classification in tags.items():
+        if tag_name not in supported_tags or \
+                not Classification.is_accessible(user["classification"], supported_tags[tag_name]):
+            continue
 
-    return result
+        if not Classification.is_accessible(max_classification, tag_classification):
+            items.append({
+                "tag_name": tag_name,
+                "tag": tag,
+                "error": f"Tag classification exceeds max classification of source: {source.name}.",
+                "items": [],
+            })
+            continue
+
+        # use the same cache keys as the lookups of a single tag
+        lookups[(tag_name, tag)] = _cache_key("details", tag_name, tag, tag_classification, limit)
+
+    failures = []
+
+    def fetch_many(keys):
+        output = {}
+        for x in range(0, len(keys), BATCH_SIZE):
+            batch = keys[x:x + BATCH_SIZE]
+            try:
+                output.update(_fetch_external_batch(source, batch, limit, max(0.0, deadline - time.monotonic())))
+            except SourceFailure as e:
+                failures.append(e)
+                output.update({key: (ERROR, e.result) for key in batch})
+        return output
+
+    for (tag_name, tag), (_, result) in EXTERNAL_LOOKUP_CACHE.lookup_many(source.name, lookups, fetch_many).items():
+        items.append({
+            "tag_name": tag_name,
+            "tag": tag,
+            "error": result["error"],
+            "items": [
+                data for data in result["items"]
+                if Classification.is_accessible(user["classification"], data["classification"])
+            ],
+        })
+
+    if failures:
+        # the tags that were answered are still returned
+        raise SourceFailure({"error": "", "items": items})
+    return {"error": "", "items": items}
 
 
 @federated_lookup_api.route("/tags/", methods=["GET"])
@@ -285,8 +435,8 @@ def enrich_tags(tag_name: str, tag: str, **kwargs):
         ...,
     }
     """
-    # re-encode the tag after being decoded going through flask/wsgi route
-    tag = ul.quote(tag, safe="")
+    # decode what is left of the double URL encoding after going through flask/wsgi route
+    tag = ul.unquote(tag)
     user = kwargs["user"]
     qp = parse_qp(request=request)
     query_sources = qp["query_sources"]
@@ -299,10 +449,10 @@ def enrich_tags(tag_name: str, tag: str, **kwargs):
         if Classification.is_accessible(user["classification"], x.classification)
     ]
 
-    with APMAwareThreadPoolExecutor(min(len(available_sources) + 1, os.cpu_count() + 4)) as executor:
-        # create searches for external sources
-        future_searches = {
-            executor.submit(
+    # results = {src: {"error": str, "items": list}}, sources that did not answer in time are reported as errors
+    results = LOOKUP_ENGINE.run(
+        {
+            source.name: functools.partial(
                 query_external,
                 query_type="details",
                 user=user,
@@ -312,26 +462,147 @@ def enrich_tags(tag_name: str, tag: str, **kwargs):
                 tag_classification=qp["tag_classification"],
                 limit=qp["limit"],
                 timeout=qp["max_timeout"]
-            ): source.name
+            )
             for source in available_sources
             if not query_sources or source.name in query_sources
-        }
+        },
+        timeout=qp["max_timeout"],
+    )
 
-        # results = {src: {"error": str, "items": list}}
-        try:
-            results = {
-                future_searches[future]: future.result()
-                for future in concurrent.futures.as_completed(future_searches, timeout=qp["max_timeout"])
-                if future.result() is not None
-            }
-        except concurrent.futures.TimeoutError:
-            # TimeoutError is raised after set time, not after the task is finished.
-            # This means tasks that have not completed are still running, they are not killed due to timeout.
+    return make_api_response(results)
+
+
+@federated_lookup_api.route("/submission/<sid>/", methods=["GET"])
+@api_login(require_role=[ROLES.external_query])
+def enrich_submission(sid: str, **kwargs):
+    """Search other services for additional information on all the tags of a submission at once.
+
+    Safelisted tags are not looked up. The tags are sent to each source in batches and answers already cached
+    by previous lookups are reused.
+
+    Variables:
+    sid => Submission ID to enrich the tags of
+
+    Arguments: (optional)
+    sources         => | separated list of data sources. If empty, all configured sources are used.
+    max_timeout     => Maximum execution time for the call in seconds [Default: 30]
+    limit           => limit the amount of returned results counted per tag and per source
+
+    Data Block:
+    None
+
+    API call examples:
+    /api/v4/federated_lookup/submission/1234567890abcdef/
+    /api/v4/federated_lookup/submission/1234567890abcdef/?sources=vt|malware_bazaar
+
+    Result example:
+    {                           # Dictionary of data source queried
+        "vt": {
+            "error": null,          # Error message returned by data source
+            "items": [              # List of the tags looked up in the source
+                {
+                    "tag_name": "network.static.domain",    # Name of the tag
+                    "tag": "malicious.domain",              # Value of the tag
+                    "error": "",                            # Error of the lookup of this tag, Not Found if no items
+                    "items": [...],                         # Same results as the enrichment of a single tag
+                },
+                ...,
+            ],
+        },
+        ...,
+    }
+    """
+    user = kwargs["user"]
+    # the tags of the submission are returned with their enrichment
+    if ROLES.submission_view not in user["roles"]:
+        return make_api_response("", "Enriching a submission requires the submission_view role", 403)
+
+    qp = parse_qp(request=request, timeout=30.0)
+    query_sources = qp["query_sources"]
+
+    submission = STORAGE.submission.get(sid, as_obj=False)
+    if submission is None:
+        return make_api_response("", f"Submission ID {sid} does not exists.", 404)
+    if not Classification.is_accessible(user["classification"], submission["classification"]):
+        return make_api_response("", "You are not allowed to view the data of this submission", 403)
 
-            # save results for anything that has finished
-            results = {}
-            for f, name in future_searches.items():
-                if f.done:
-                    results[name] = f.result()
+    summary = get_or_create_summary(sid, submission["results"], user["classification"],
+                                    submission["state"] == "completed")
+
+    # a tag found multiple times is known at its lowest classification
+    tags = {}
+    for t in summary["tags"]:
+        if t["safelisted"] or t["value"] == "":
+            continue
+        key = (t["type"], str(t["value"]))
+        if key in tags:
+            tags[key] = Classification.min_classification(tags[key], t["classification"])
+        else:
+            tags[key] = t["classification"]
+
+    available_sources = [
+        x for x in getattr(config.ui, "external_sources", [])
+        if Classification.is_accessible(user["classification"], x.classification)
+    ]
+
+    results = LOOKUP_ENGINE.run(
+        {
+            source.name: functools.partial(
+                enrich_tags_external,
+                user=user,
+                source=source,
+                tags=tags,
+                limit=qp["limit"],
+                timeout=qp["max_timeout"],
+            )
+            for source in available_sources
+            if not query_sources or source.name in query_sources
+        },
+        timeout=qp["max_timeout"],
+    )
 
     return make_api_response(results)
+
+
+@federated_lookup_api.route("/stats/", methods=["GET"])
+@api_login(require_role=[ROLES.external_query])
+def get_lookup_stats(**kwargs):
+    """Return the statistics of the cache and of the lookups of the current worker for each external source.
+
+    Data Block:
+    None
+
+    API call examples:
+    /api/v4/federated_lookup/stats/
+
+    Result example:
+    {                           # Dictionary of:
+        <source_name>: {
+            "hits": 120,              # Lookups answered from the cache
+            "not_found_hits": 30,     # Lookups answered from the cache of not found answers
+            "misses": 50,             # Lookups sent to the source
+            "coalesced": 12,          # Lookups that waited for an identical lookup running at the same time
+            "errors": 2,              # Lookups that failed
+            "hit_ratio": 0.75,        # Ratio of the lookups answered from the cache
+            "ttl": 900,               # Number of seconds answers are cached
+            "not_found_ttl": 300,     # Number of seconds not found answers are cached
+            "calls": 48,              # Lookups sent to the source by this worker
+            "timeouts": 1,            # Lookups that did not answer in time
+            "failures": 0,            # Lookups that raised an error
+            "rejected": 0,            # Lookups not sent because the source was busy or its circuit was open
+            "avg_latency": 0.42,      # Average time taken by the source to answer, in seconds
+            "max_latency": 2.1,       # Longest time taken by the source to answer, in seconds
+            "circuit": "closed",      # State of the source's circuit breaker: closed, open or half_open
+        },
+        ...,
+    }
+    """
+    user = kwargs["user"]
+    source_names = [
+        x.name for x in getattr(config.ui, "external_sources", [])
+        if Classification.is_accessible(user["classification"], x.classification)
+    ]
+    stats = EXTERNAL_LOOKUP_CACHE.get_stats(source_names)
+    for name, metrics in LOOKUP_ENGINE.get_metrics(source_names).items():
+        stats[name].update(metrics)
+    return make_api_response(stats)
@@ -7,18 +7,21 @@ import tempfile
 from flask import request
 
 from assemblyline.odm.models.user_settings import ENCODINGS as FILE_DOWNLOAD_ENCODINGS
-from assemblyline.common.codec import encode_file
 from assemblyline.common.dict_utils import unflatten
 from assemblyline.common.hexdump import dump, hexdump
 from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.common.str_utils import safe_str
 from assemblyline.filestore import FileStoreException
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_file_response
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ai_response, \
+    stream_file_chunks_response, stream_file_response
 from assemblyline_ui.config import CACHE, ALLOW_ZIP_DOWNLOADS, ALLOW_RAW_DOWNLOADS, FILESTORE, STORAGE, config, \
-    CLASSIFICATION as Classification, ARCHIVESTORE, AI_AGENT
-from assemblyline_ui.helper.ai.base import APIException, EmptyAIResponse
+    CLASSIFICATION as Classification, ARCHIVESTORE, AI_AGENT, SIMILARITY_INDEX_MAX_ITEMS
+from assemblyline_ui.helper.ai.base import APIException, EmptyAIResponse, result_events
+from assemblyline_ui.helper.download import is_cart_stream, iter_cart_stream, open_file_stream
 from assemblyline_ui.helper.result import format_result
+from assemblyline_ui.helper.similarity import SSDEEP_DEFAULT_THRESHOLD, TLSH_DEFAULT_THRESHOLD, SimilarityIndex, \
+    get_similar_items
 from assemblyline_ui.helper.user import load_user_settings
 from assemblyline.datastore.collection import Index
 
@@ -33,6 +36,12 @@ file_api._doc = "Perform operations on files"
 
 API_MAX_SIZE = 10 * 1024 * 1024
 
+# The hashes of a file never change, only new files are fetched on refresh. seen.last changes all the time.
+FILE_SIMILARITY_INDEX = SimilarityIndex(STORAGE.file, 'tlsh', 'ssdeep', 'seen.first', SIMILARITY_INDEX_MAX_ITEMS,
+                                        recent_only=True)
+# Number of closest files considered before access control is applied on them
+SIMILAR_FILES_CANDIDATES = 100
+
 
 @file_api.route("/ascii/<sha256>/", methods=["GET"])
 @api_login(require_role=[ROLES.file_detail])
@@ -159,44 +168,42 @@ def download_file(sha256, **kwargs):
             elif not password:
                 return make_api_response({}, "No password given or retrieved from user's settings.", 403)
 
-        download_dir = None
-        target_path = None
+        filestores = [FILESTORE]
+        if ARCHIVESTORE is not None and ARCHIVESTORE != FILESTORE and ROLES.archive_download in user['roles']:
+            filestores.append(ARCHIVESTORE)
 
-        # Create a temporary download location
-        if encoding == 'zip':
-            download_dir = tempfile.mkdtemp()
-            download_path = os.path.join(download_dir, name)
-        else:
-            _, download_path = tempfile.mkstemp()
+        if encoding != 'zip':
+            # Raw and CaRT downloads are streamed straight from the filestore without intermediate copies
+            reader = open_file_stream(sha256, filestores)
+            if reader is None:
+                return make_api_response({}, "The file was not found in the system.", 404)
 
-        try:
-            try:
-                downloaded_from = FILESTORE.download(sha256, download_path)
-            except FileStoreException:
-                downloaded_from = None
+            if encoding == 'raw' or is_cart_stream(reader):
+                return stream_file_response(reader, name, os.fstat(reader.fileno()).st_size, accept_ranges=True)
 
-            # Try to download from archive
-            if not downloaded_from and \
-                    ARCHIVESTORE is not None and \
-                    ARCHIVESTORE != FILESTORE and \
-                    ROLES.archive_download in user['roles']:
+            file_metadata['name'] = name
+            return stream_file_chunks_response(iter_cart_stream(reader, file_metadata), f"{name}.cart")
+
+        download_dir = tempfile.mkdtemp()
+        download_path = os.path.join(download_dir, name)
+        target_path = None
+
+        try:
+            downloaded_from = None
+            for filestore in filestores:
                 try:
-                    downloaded_from = ARCHIVESTORE.download(sha256, download_path)
+                    downloaded_from = filestore.download(sha256, download_path)
+                    break
                 except FileStoreException:
-                    downloaded_from = None
+                    pass
 
             if not downloaded_from:
                 return make_api_response({}, "The file was not found in the system.", 404)
 
             # Encode file
-            if encoding == 'raw':
-                target_path = download_path
-            elif encoding == 'zip':
-                name += '.zip'
-                target_path = os.path.join(download_dir, name)
-                subprocess.run(['zip', '-j', '--password', password, target_path, download_path], capture_output=True)
-            else:
-                target_path, name = encode_file(download_path, name, file_metadata)
+            name += '.zip'
+            target_path = os.path.join(download_dir, name)
+            subprocess.run(['zip', '-j', '--password', password, target_path, download_path], capture_output=True)
 
             return stream_file_response(open(target_path, 'rb'), name, os.path.getsize(target_path))
 
@@ -263,6 +270,7 @@ def summarized_results(sha256, **kwargs):
     no_cache       => Caching for the output of this API will be disabled
     with_trace     => Should the AI call return the full trace of the conversation?
     lang           => Which language do you want the AI to respond in?
+    stream         => Stream the summary as server-sent events while it is generated
 
     Data Block:
     None
@@ -275,6 +283,13 @@ def summarized_results(sha256, **kwargs):
       "content": <AI summary of the AL results>,
       "truncated": false
     }
+
+    Streamed result example:
+    event: token
+    data: {"content": <Next part of the AI summary>}
+
+    event: done
+    data: {"content": <AI summary of the AL results>, "truncated": false}
     """
     if not AI_AGENT.has_backends():
         return make_api_response({}, "AI Support is disabled on this system.", 400)
@@ -283,6 +298,7 @@ def summarized_results(sha256, **kwargs):
     no_cache = request.args.get('no_cache', 'false').lower() in ['true', '']
     lang = request.args.get('lang', 'english')
     with_trace = request.args.get('with_trace', 'false').lower() in ['true', '']
+    stream = request.args.get('stream', 'false').lower() in ['true', '']
 
     index_type = None
     if archive_only:
@@ -302,6 +318,9 @@ def summarized_results(sha256, **kwargs):
         # Get the summary from cache
         ai_summary = CACHE.get(cache_key)
 
+    if ai_summary and stream:
+        return stream_ai_response(result_events(ai_summary))
+
     if not ai_summary:
         data = STORAGE.get_ai_formatted_file_results_data(
             sha256, user_classification=user['classification'],
@@ -309,6 +328,10 @@ def summarized_results(sha256, **kwargs):
         if data is None:
             return make_api_response("", "The file was not found in the system.", 404)
 
+        if stream:
+            events = AI_AGENT.summarized_al_submission(data, lang=lang, with_trace=with_trace, stream=True)
+            return stream_ai_response(events, on_result=lambda result: CACHE.set(cache_key, result))
+
         try:
             ai_summary = AI_AGENT.summarized_al_submission(data, lang=lang, with_trace=with_trace)
 
@@ -927,6 +950,8 @@ def find_similar_files(sha256, **kwargs):
     Arguments:
     use_archive             => Also find similar file in archive
     archive_only            => Only find similar in the malware archive
+    tlsh_threshold          => Maximum TLSH distance of the similar files (Default: 50)
+    ssdeep_threshold        => Minimum SSDEEP score (0-100) of the similar files (Default: 50)
 
     Data Block:
     None
@@ -937,13 +962,19 @@ def find_similar_files(sha256, **kwargs):
     Result example:
     [   # List of files related
       {
-            "items": []            # List of files hash
+            "items": []            # List of files hash, with their TLSH distance or SSDEEP score when
+                                   # found by the similarity index
             "total": 201,          # Total files through this relation type
             "type": 'tlsh'         # Type of relationship used to finds thoses files
             "value": 'T123...123'  # Value used to do the relation
       },
       ...
     ]
+
+    Similar TLSH and SSDEEP hashes of the files in the hot index are found by the similarity index. It returns a
+    single 'ssdeep' relation whose value is the full SSDEEP hash instead of one relation per chunk of the hash. When
+    the similarity index only covers the most recently seen files, the files seen before it are still searched in the
+    datastore and returned as separate 'tlsh' and per chunk 'ssdeep' relations.
     """
     user = kwargs['user']
     use_archive = request.args.get('use_archive', 'false').lower() in ['true', '']
@@ -967,7 +998,39 @@ def find_similar_files(sha256, **kwargs):
     if not user or not Classification.is_accessible(user['classification'], file_obj['classification']):
         return make_api_response({"success": False}, "You are not allowed to view this file", 403)
 
-    def _do_search(data_type, value):
+    try:
+        tlsh_threshold = int(request.args.get('tlsh_threshold', TLSH_DEFAULT_THRESHOLD))
+        ssdeep_threshold = int(request.args.get('ssdeep_threshold', SSDEEP_DEFAULT_THRESHOLD))
+    except ValueError:
+        return make_api_response({"success": False}, "Thresholds must be integers", 400)
+
+    def _do_index_search(data_type, value):
+        # The similarity index only covers the hot index, returns None when it can't be used
+        if index_type != Index.HOT:
+            return None
+
+        try:
+            if data_type == "tlsh":
+                matches = FILE_SIMILARITY_INDEX.search_tlsh(value, threshold=tlsh_threshold,
+                                                            rows=SIMILAR_FILES_CANDIDATES + 1)
+            else:
+                matches = FILE_SIMILARITY_INDEX.search_ssdeep(value, threshold=ssdeep_threshold,
+                                                              rows=SIMILAR_FILES_CANDIDATES + 1)
+        except ValueError:
+            # Hashes that can't be parsed are not in the similarity index
+            return None
+
+        if matches is None:
+            return None
+
+        items = get_similar_items(STORAGE.file, [m for m in matches if m[0] != sha256], Classification,
+                                  user['classification'], 'distance' if data_type == "tlsh" else 'score',
+                                  fl='type,sha256,seen.last')
+        if items:
+            return [{'items': items[:10], 'total': len(items), 'type': data_type, 'value': value}]
+        return []
+
+    def _do_search(data_type, value, filters):
         if value:
             if data_type == "tlsh":
                 query = f'tlsh:"{value}"'
@@ -975,7 +1038,8 @@ def find_similar_files(sha256, **kwargs):
                 query = f'ssdeep:"{value}"~'
 
             res = STORAGE.file.search(query, rows=10, sort='seen.last desc', fl='type,sha256,seen.last',
-                                      filters=[f'NOT(sha256:"{sha256}")'], access_control=user['access_control'],
+                                      filters=[f'NOT(sha256:"{sha256}")'] + filters,
+                                      access_control=user['access_control'],
                                       as_obj=False, index_type=index_type)
             if res['total'] > 0:
                 # Remove unimportant fields
@@ -989,21 +1053,39 @@ def find_similar_files(sha256, **kwargs):
                 return [res]
         return []
 
+    def _datastore_filters(index_res):
+        # Filters of the datastore searches still needed after an index search, None if there are none
+        if index_res is None:
+            return []
+        if indexed_from:
+            return [f'seen.first:[* TO "{indexed_from}"]']
+        return None
+
     output = []
 
-    # Look for similar TLSH and SSDEEPS
+    # Look for similar TLSH and SSDEEPS, using the similarity index when it is available
+    indexed_from = FILE_SIMILARITY_INDEX.indexed_from
     tlsh = file_obj.get('tlsh', '')
+    tlsh_res = _do_index_search('tlsh', tlsh) if tlsh else []
+    ssdeep_res = _do_index_search('ssdeep', file_obj['ssdeep']) if file_obj.get('ssdeep', None) else []
     ssdeep = file_obj.get('ssdeep', '::').split(':')
+    tlsh_filters = _datastore_filters(tlsh_res)
+    ssdeep_filters = _datastore_filters(ssdeep_res)
 
     with APMAwareThreadPoolExecutor(3) as executor:
-        tlsh_future = executor.submit(_do_search, 'tlsh', tlsh)
-        ssdeep1_future = executor.submit(_do_search, 'ssdeep', ssdeep[1])
-        ssdeep2_future = executor.submit(_do_search, 'ssdeep', ssdeep[2])
+        tlsh_future = executor.submit(_do_search, 'tlsh', tlsh, tlsh_filters) if tlsh_filters is not None else None
+        if ssdeep_filters is not None:
+            ssdeep1_future = executor.submit(_do_search, 'ssdeep', ssdeep[1], ssdeep_filters)
+            ssdeep2_future = executor.submit(_do_search, 'ssdeep', ssdeep[2], ssdeep_filters)
 
     # Adding outputs for all hashes
-    output.extend(tlsh_future.result())
-    output.extend(ssdeep1_future.result())
-    output.extend(ssdeep2_future.result())
+    output.extend(tlsh_res or [])
+    if tlsh_future:
+        output.extend(tlsh_future.result())
+    output.extend(ssdeep_res or [])
+    if ssdeep_filters is not None:
+        output.extend(ssdeep1_future.result())
+        output.extend(ssdeep2_future.result())
 
     # Find all possible vectors from this file
     vectors = set()
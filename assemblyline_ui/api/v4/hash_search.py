@@ -1,6 +1,6 @@
-import concurrent.futures
-import os
+import functools
 import re
+import threading
 
 from urllib import parse as ul
 
@@ -8,13 +8,15 @@ from flask import request
 from requests import Session
 
 from assemblyline.common.importing import load_module_by_path
-from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.odm.models.user import ROLES
 from assemblyline.odm import base
 from assemblyline.datasource.common import hash_type
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
 from assemblyline_ui.api.v4.federated_lookup import all_supported_tags, log_error
-from assemblyline_ui.config import LOGGER, config, CLASSIFICATION as Classification
+from assemblyline_ui.config import LOGGER, config, CLASSIFICATION as Classification, EXTERNAL_LOOKUP_CACHE, \
+    LOOKUP_ENGINE
+from assemblyline_ui.helper.external_lookup import ERROR, FOUND, MIN_REQUEST_TIMEOUT, NOT_FOUND, ExternalSessionPool
+from assemblyline_ui.helper.fanout import SourceFailure
 
 SUB_API = 'hash_search'
 hash_search_api = make_subapi_blueprint(SUB_API, api_version=4)
@@ -46,36 +48,98 @@ def create_query_datasource(ds):
 
 
 external_sources = getattr(config.ui, "external_sources", [])
-sources = {}
-# noinspection PyBroadException
-try:
-    for name, settings in config.datasources.items():
-        name = name.lower()
-        classpath = 'unknown'
-        # noinspection PyBroadException
-        try:
-            classpath = settings.classpath
-            cfg = settings.config
-            if isinstance(cfg, str):
-                # TODO: this needs testing that can only be done when a service datasource is available.
-                path = cfg
-                cfg = config
-                for point in path.split('.'):
-                    if 'enabled' in cfg:
-                        if not cfg['enabled']:
-                            raise SkipDatasource()
-                    cfg = cfg.get(point)
-            cls = load_module_by_path(classpath)
-            obj = cls(LOGGER, **cfg)
-            sources[name] = create_query_datasource(obj)
-        except SkipDatasource:
-            continue
-        except Exception:
-            LOGGER.exception(
-                "Problem creating %s datasource (%s)", name, classpath
-            )
-except Exception:
-    LOGGER.exception("No datasources")
+# Keep-alive sessions to each external source
+SESSIONS = ExternalSessionPool(lambda: Session())
+_sources = None
+_sources_lock = threading.Lock()
+
+
+def _load_datasources():
+    sources = {}
+    # noinspection PyBroadException
+    try:
+        for name, settings in config.datasources.items():
+            name = name.lower()
+            classpath = 'unknown'
+            # noinspection PyBroadException
+            try:
+                classpath = settings.classpath
+                cfg = settings.config
+                if isinstance(cfg, str):
+                    # TODO: this needs testing that can only be done when a service datasource is available.
+                    path = cfg
+                    cfg = config
+                    for point in path.split('.'):
+                        if 'enabled' in cfg:
+                            if not cfg['enabled']:
+                                raise SkipDatasource()
+                        cfg = cfg.get(point)
+                cls = load_module_by_path(classpath)
+                obj = cls(LOGGER, **cfg)
+                sources[name] = create_query_datasource(obj)
+            except SkipDatasource:
+                continue
+            except Exception:
+                LOGGER.exception(
+                    "Problem creating %s datasource (%s)", name, classpath
+                )
+    except Exception:
+        LOGGER.exception("No datasources")
+    return sources
+
+
+def get_datasources():
+    """Return the configured datasources, they are loaded by the first search instead of when the API is imported"""
+    global _sources
+    if _sources is None:
+        with _sources_lock:
+            if _sources is None:
+                _sources = _load_datasources()
+    return _sources
+
+
+def _fetch_external_details(source, file_hash: str, hash_type: str, limit: int, timeout: float):
+    """Query the external source, the items returned are not filtered on the user's classification."""
+    sname = f"x.{source.name}"
+    result = {"error": None, "items": []}
+    headers = {
+        "accept": "application/json",
+    }
+    params = {
+        "limit": limit,
+        "max_timeout": timeout,
+    }
+
+    encoded = ul.quote(ul.quote(file_hash, safe=""), safe="")
+    url = f"{source.url}/details/{hash_type}/{encoded}/"
+    rsp = SESSIONS.get(source).get(url, params=params, headers=headers, timeout=max(timeout, MIN_REQUEST_TIMEOUT))
+
+    status_code = rsp.status_code
+    if status_code == 404 or status_code == 422:
+        # continue searching configured sources if not found or invliad tag.
+        result["error"] = HNF
+        return NOT_FOUND, result
+    elif status_code != 200:
+        # as we query across multiple sources, just log errors.
+        err_msg = rsp.json()["api_error_message"]
+        err_id = log_error(f"Error from {sname}", err_msg, status_code)
+        result["error"] = f"{err_msg}. Error ID: {err_id}"
+        return ERROR, result
+
+    try:
+        for data in rsp.json()["api_response"]:
+            # items are filtered for each user after the lookup, make sure they can be
+            if "classification" not in data:
+                raise KeyError("classification")
+            result["items"].append(data)
+    # noinspection PyBroadException
+    except Exception as err:
+        err_msg = f"{sname}-proxy did not return a response in the expected format"
+        err_id = log_error(err_msg, err)
+        result["error"] = f"{err_msg}. Error ID: {err_id}"
+        result["items"] = []
+        return ERROR, result
+    return FOUND, result
 
 
 def get_external_details(
@@ -102,7 +166,6 @@ def get_external_details(
             ]
     }
     """
-    sname = f"x.{source.name}"
     result = {"error": None, "items": []}
     if hash_type not in all_supported_tags.get(source.name, {}):
         result["error"] = NOT_SUPPORTED
@@ -113,45 +176,26 @@ def get_external_details(
         result["error"] = NOT_SUPPORTED
         return result
 
-    session = Session()
-    headers = {
-        "accept": "application/json",
-    }
-    params = {
-        "limit": limit,
-        "max_timeout": timeout,
-    }
-
     # check query against the max supported classification of the external system
     # if this is not supported, we should let the user know.
     if not Classification.is_accessible(source.max_classification or Classification.UNRESTRICTED, hash_classification):
         result["error"] = "File hash classification exceeds max classification."
         return result
 
-    # perform the lookup, ensuring access controls are applied
-    encoded = ul.quote(ul.quote(file_hash, safe=""), safe="")
-    url = f"{source.url}/details/{hash_type}/{encoded}/"
-    rsp = session.get(url, params=params, headers=headers)
-
-    status_code = rsp.status_code
-    if status_code == 404 or status_code == 422:
-        # continue searching configured sources if not found or invliad tag.
-        result["error"] = HNF
-    elif status_code != 200:
-        # as we query across multiple sources, just log errors.
-        err_msg = rsp.json()["api_error_message"]
-        err_id = log_error(f"Error from {sname}", err_msg, status_code)
-        result["error"] = f"{err_msg}. Error ID: {err_id}"
-    else:
-        try:
-            for data in rsp.json()["api_response"]:
-                if user and Classification.is_accessible(user["classification"], data["classification"]):
-                    result["items"].append(data)
-        # noinspection PyBroadException
-        except Exception as err:
-            err_msg = f"{sname}-proxy did not return a response in the expected format"
-            err_id = log_error(err_msg, err)
-            result["error"] = f"{err_msg}. Error ID: {err_id}"
+    # perform the lookup, or reuse the answer of a previous one, ensuring access controls are applied
+    status, cached = EXTERNAL_LOOKUP_CACHE.lookup(
+        source.name,
+        ("hash", hash_type, file_hash, hash_classification, limit),
+        functools.partial(_fetch_external_details, source, file_hash, hash_type, limit, timeout),
+        timeout=timeout,
+    )
+    result["error"] = cached["error"]
+    result["items"] = [
+        data for data in cached["items"]
+        if user and Classification.is_accessible(user["classification"], data["classification"])
+    ]
+    if status == ERROR:
+        raise SourceFailure(result)
     return result
 
 
@@ -226,6 +270,7 @@ def search_hash(file_hash, *args, **kwargs):
     except Exception:
         max_timeout = 3.0
 
+    sources = get_datasources()
     db_list = []
     ext_list = []
     db = request.args.get('db', None)
@@ -249,32 +294,25 @@ def search_hash(file_hash, *args, **kwargs):
         if f"x.{s.name}" in ext_list and Classification.is_accessible(user["classification"], s.classification)
     ]
 
-    total_sources = len(ext) + len(db_list)
-    with APMAwareThreadPoolExecutor(min(total_sources + 1, os.cpu_count() + 4)) as executor:
-        # create searches for external sources
-        future_searches = {
-            executor.submit(
-                get_external_details,
-                user=user,
-                source=source,
-                hash_type=submitted_hash_type,
-                file_hash=file_hash,
-                hash_classification=hash_classification,
-                timeout=max(0, max_timeout - 0.5),
-                limit=limit,
-            ): f"x.{source.name}"
-            for source in ext
-        }
-
-        # create searches for internal sources
-        future_searches.update({
-            executor.submit(sources[db], file_hash.lower(), user): db for db in db_list
-        })
+    # create searches for external sources
+    tasks = {
+        f"x.{source.name}": functools.partial(
+            get_external_details,
+            user=user,
+            source=source,
+            hash_type=submitted_hash_type,
+            file_hash=file_hash,
+            hash_classification=hash_classification,
+            timeout=max(0, max_timeout - 0.5),
+            limit=limit,
+        )
+        for source in ext
+    }
+    # create searches for internal sources
+    tasks.update({db: functools.partial(sources[db], file_hash.lower(), user) for db in db_list})
 
-        results = {
-            future_searches[future]: future.result()
-            for future in concurrent.futures.as_completed(future_searches, timeout=max_timeout)
-        }
+    # sources that did not answer in time are reported as errors
+    results = LOOKUP_ENGINE.run(tasks, timeout=max_timeout, source_names={f"x.{s.name}": s.name for s in ext})
 
     status_code = 200
     error = None
@@ -321,5 +359,5 @@ def list_data_sources(*args, **kwargs):
     [ <list of sources> ]
     """
     src = [f"x.{s.name}" for s in external_sources]
-    src.extend(sources.keys())
+    src.extend(get_datasources().keys())
     return make_api_response(sorted(src))
@@ -1,6 +1,7 @@
 
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
-from assemblyline_ui.config import STORAGE, CLASSIFICATION as Classification
+from assemblyline_ui.config import STORAGE, CLASSIFICATION as Classification, redis
+from assemblyline_ui.helper.live import drain_watch_queues, parse_watch_message
 from assemblyline.remote.datatypes.queues.named import NamedQueue
 from assemblyline.odm.models.user import ROLES
 from assemblyline_core.dispatching.client import DispatchClient
@@ -40,17 +41,8 @@ def get_message(wq_id, **_):
 
     if msg is None:
         response = {'type': 'timeout', 'err_msg': 'Timeout waiting for a message.', 'status_code': 408, 'msg': None}
-    elif msg['status'] == 'STOP':
-        response = {'type': 'stop', 'err_msg': None, 'status_code': 200,
-                    'msg': "All messages received, closing queue..."}
-    elif msg['status'] == 'START':
-        response = {'type': 'start', 'err_msg': None, 'status_code': 200, 'msg': "Start listening..."}
-    elif msg['status'] == 'OK':
-        response = {'type': 'cachekey', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
-    elif msg['status'] == 'FAIL':
-        response = {'type': 'cachekeyerr', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
     else:
-        response = {'type': 'error', 'err_msg': "Unknown message", 'status_code': 400, 'msg': msg}
+        response = parse_watch_message(msg)
 
     return make_api_response(response)
 
@@ -76,27 +68,7 @@ def get_messages(wq_id, **_):
     Result example:
     []            # List of messages
     """
-    resp_list = []
-    u = NamedQueue(wq_id)
-
-    while True:
-        msg = u.pop(blocking=False)
-        if msg is None:
-            break
-
-        elif msg['status'] == 'STOP':
-            response = {'type': 'stop', 'err_msg': None, 'status_code': 200,
-                        'msg': "All messages received, closing queue..."}
-        elif msg['status'] == 'START':
-            response = {'type': 'start', 'err_msg': None, 'status_code': 200, 'msg': "Start listening..."}
-        elif msg['status'] == 'OK':
-            response = {'type': 'cachekey', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
-        elif msg['status'] == 'FAIL':
-            response = {'type': 'cachekeyerr', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
-        else:
-            response = {'type': 'error', 'err_msg': "Unknown message", 'status_code': 400, 'msg': msg}
-
-        resp_list.append(response)
+    resp_list = [parse_watch_message(msg) for msg in drain_watch_queues(redis, [wq_id])[wq_id]]
 
     return make_api_response(resp_list)
 
@@ -1,82 +1,189 @@
 import json
 
+from concurrent.futures import FIRST_COMPLETED, wait
 from flask import request
-from io import StringIO
 
 from assemblyline.common.dict_utils import recursive_update
-from assemblyline.datastore.exceptions import MultiKeyError
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
+from assemblyline.datastore.exceptions import MultiKeyError, SearchException
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.api.base import api_login, make_api_response, make_file_response, make_subapi_blueprint
-from assemblyline_ui.config import ARCHIVESTORE, STORAGE, LOGGER, FILESTORE, CLASSIFICATION as Classification, config
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ndjson_response
+from assemblyline_ui.config import ARCHIVESTORE, STORAGE, LOGGER, FILESTORE, CLASSIFICATION as Classification, config, \
+    ONTOLOGY_EXPORT_MAX_SUBMISSIONS, ONTOLOGY_EXPORT_MAX_WORKERS
 
 SUB_API = 'ontology'
 ontology_api = make_subapi_blueprint(SUB_API, api_version=4)
 ontology_api._doc = "Download ontology results from the system"
 
+# Number of submissions loaded at once by the bulk export
+SUBMISSION_BATCH_SIZE = 100
 
-def generate_ontology_file(results, user, updates={}, fnames={}):
-    # Load ontology files
-    sio = StringIO()
 
+def get_ontology_jobs(results, updates={}, fnames={}):
+    """List the ontology supplementary files of the results with what is needed to build their record"""
     # Compute files' score based on results
     file_scores = {}
     for r in results:
         file_scores.setdefault(r['sha256'], 0)
         file_scores[r['sha256']] += r["result"]["score"]
 
-    # Start downloading all ontology files
     for r in results:
         for supp in r.get('response', {}).get('supplementary', {}):
             if supp['name'].endswith('.ontology'):
+                yield r, supp, updates, fnames, file_scores
 
-                # get ontology data
-                ontology_data = FILESTORE.get(supp['sha256'])
-                # Try to download from archive
-                if not ontology_data and \
-                        ARCHIVESTORE is not None and \
-                        ARCHIVESTORE != FILESTORE and \
-                        ROLES.archive_download in user['roles']:
-                    ontology_data = ARCHIVESTORE.get(supp['sha256'])
 
-                if not ontology_data:
-                    # Could not download the ontology supplementary file
-                    LOGGER.warning(f"Ontology file was not found filestores: {supp['name']} [{supp['sha256']}]")
-                    continue
+def load_ontology_record(job, user):
+    r, supp, updates, fnames, file_scores = job
 
-                try:
-                    # Parse the ontology file
-                    ontology = json.loads(ontology_data)
-                    sha256 = ontology['file']['sha256']
-                    c12n = ontology['classification']
-                    if sha256 == r['sha256'] and Classification.is_accessible(user['classification'], c12n):
-                        # Recursively update the ontology with the live values
-                        ontology = recursive_update(ontology, updates)
+    # get ontology data
+    ontology_data = FILESTORE.get(supp['sha256'])
+    # Try to download from archive
+    if not ontology_data and \
+            ARCHIVESTORE is not None and \
+            ARCHIVESTORE != FILESTORE and \
+            ROLES.archive_download in user['roles']:
+        ontology_data = ARCHIVESTORE.get(supp['sha256'])
 
-                        # Set filenames if any
-                        if sha256 in fnames:
-                            ontology['file']['names'] = fnames[sha256]
-                        elif 'names' in ontology['file']:
-                            del ontology['file']['names']
+    if not ontology_data:
+        # Could not download the ontology supplementary file
+        LOGGER.warning(f"Ontology file was not found filestores: {supp['name']} [{supp['sha256']}]")
+        return None
 
-                        # Make sure parent is not equal to current hash
-                        if 'parent' in ontology['file'] and ontology['file']['parent'] == sha256:
-                            del ontology['file']['parent']
+    try:
+        # Parse the ontology file
+        ontology = json.loads(ontology_data)
+        sha256 = ontology['file']['sha256']
+        c12n = ontology['classification']
+        if sha256 != r['sha256'] or not Classification.is_accessible(user['classification'], c12n):
+            return None
+
+        # Recursively update the ontology with the live values
+        ontology = recursive_update(ontology, updates)
+
+        # Set filenames if any
+        if sha256 in fnames:
+            ontology['file']['names'] = fnames[sha256]
+        elif 'names' in ontology['file']:
+            del ontology['file']['names']
+
+        # Make sure parent is not equal to current hash
+        if 'parent' in ontology['file'] and ontology['file']['parent'] == sha256:
+            del ontology['file']['parent']
+
+        # Ensure SHA256 is set in final output
+        ontology['file']['sha256'] = sha256
+
+        # Aggregated file score related to the results
+        ontology.setdefault('results', {})
+        ontology['results']['score'] = file_scores[sha256]
+
+        return ontology
+    except Exception as e:
+        LOGGER.warning(f"An error occured while parsing ontology files: {str(e)}")
+        return None
+
+
+def iter_ontology_records(jobs, user):
+    """Download the ontology files of the jobs concurrently and yield each record as soon as it is ready.
+
+    Only a bounded number of downloads are in flight at a time so the records are sent to the client as they are
+    produced instead of being accumulated in memory.
+    """
+    executor = APMAwareThreadPoolExecutor(ONTOLOGY_EXPORT_MAX_WORKERS)
+    max_pending = ONTOLOGY_EXPORT_MAX_WORKERS * 2
+    pending = set()
+    try:
+        for job in jobs:
+            pending.add(executor.submit(load_ontology_record, job, user))
+            if len(pending) < max_pending:
+                continue
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if (record := future.result()) is not None:
+                    yield record
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if (record := future.result()) is not None:
+                    yield record
+    finally:
+        # The downloads not started yet are dropped if the client went away
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_result_keys(submission, sha256s=None, services=None):
+    # Get all the results keys
+    keys = [k for k in submission['results'] if not k.endswith(".e")]
 
-                        # Ensure SHA256 is set in final output
-                        ontology['file']['sha256'] = sha256
+    # Only use keys matching theses sha256s
+    if sha256s:
+        tmp_keys = []
+        for sha256 in sha256s:
+            tmp_keys.extend([k for k in keys if k.startswith(sha256)])
+        keys = tmp_keys
 
-                        # Aggregated file score related to the results
-                        ontology.setdefault('results', {})
-                        ontology['results']['score'] = file_scores[sha256]
+    # Only use keys matching theses services
+    if services:
+        tmp_keys = []
+        for service in services:
+            tmp_keys.extend([k for k in keys if f".{service}." in k])
+        keys = tmp_keys
 
-                        sio.write(json.dumps(ontology, indent=None, separators=(',', ':')) + '\n')
-                except Exception as e:
-                    LOGGER.warning(f"An error occured while parsing ontology files: {str(e)}")
+    return keys
 
-    # Flush and reset buffer
-    sio.flush()
 
-    return sio
+def get_results(keys):
+    # Pull the results for the keys
+    try:
+        return STORAGE.result.multiget(keys, as_dictionary=False, as_obj=False)
+    except MultiKeyError as e:
+        return e.partial_output
+
+
+def get_submission_updates(submission, parent=None, metadata=None, date=None):
+    # Compile information to be added to the ontology
+    return {
+        'file': {
+            'parent': parent or submission['files'][0]['sha256'],
+        },
+        'submission': {
+            'metadata': submission.get('metadata', {}) if metadata is None else metadata,
+            'date': date or submission['times']['submitted'],
+            'source_system': config.ui.fqdn,
+            'sid': submission['sid'],
+            'classification': submission['classification'],
+            'submitter': submission['params']['submitter'],
+            'groups': submission['params']['groups'],
+            'max_score': submission['max_score']
+        }
+
+    }
+
+
+def get_file_names(submission):
+    # Set the list of file names
+    return {x['sha256']: [x['name']] for x in submission['files']}
+
+
+def get_submissions_jobs(sids, user, sha256s=None, services=None):
+    """List the ontology files of many submissions, loading the submissions and their results in batches"""
+    for i in range(0, len(sids), SUBMISSION_BATCH_SIZE):
+        try:
+            submissions = STORAGE.submission.multiget(sids[i:i + SUBMISSION_BATCH_SIZE],
+                                                      as_dictionary=False, as_obj=False)
+        except MultiKeyError as e:
+            submissions = e.partial_output
+
+        for submission in submissions:
+            if not Classification.is_accessible(user['classification'], submission['classification']):
+                continue
+
+            results = get_results(get_result_keys(submission, sha256s, services))
+            yield from get_ontology_jobs(results, updates=get_submission_updates(submission),
+                                         fnames=get_file_names(submission))
 
 
 @ontology_api.route("/alert/<alert_id>/", methods=["GET"])
@@ -123,54 +230,13 @@ def get_ontology_for_alert(alert_id, **kwargs):
         return make_api_response(
             "", f"Your are not allowed get ontology files for the submission related to this alert: {alert_id}", 403)
 
-    # Get all the results keys
-    keys = [k for k in submission['results'] if not k.endswith(".e")]
+    results = get_results(get_result_keys(submission, sha256s, services))
+    updates = get_submission_updates(submission, parent=alert['file']['sha256'], metadata=alert.get('metadata', {}),
+                                     date=alert['ts'])
 
-    # Only use keys matching theses sha256s
-    if sha256s:
-        tmp_keys = []
-        for sha256 in sha256s:
-            tmp_keys.extend([k for k in keys if k.startswith(sha256)])
-        keys = tmp_keys
-
-    # Only use keys matching theses services
-    if services:
-        tmp_keys = []
-        for service in services:
-            tmp_keys.extend([k for k in keys if f".{service}." in k])
-        keys = tmp_keys
-
-    # Pull the results for the keys
-    try:
-        results = STORAGE.result.multiget(keys, as_dictionary=False, as_obj=False)
-    except MultiKeyError as e:
-        results = e.partial_output
-
-    # Compile information to be added to the ontology
-    updates = {
-        'file': {
-            'parent': alert['file']['sha256']
-        },
-        'submission': {
-            'metadata': alert.get('metadata', {}),
-            'date': alert['ts'],
-            'source_system': config.ui.fqdn,
-            'sid': submission['sid'],
-            'classification': submission['classification'],
-            'submitter': submission['params']['submitter'],
-            'groups': submission['params']['groups'],
-            'max_score': submission['max_score']
-        }
-
-    }
-
-    # Set the list of file names
-    fnames = {x['sha256']: [x['name']] for x in submission['files']}
-
-    # Generate ontology files based of the results
-    sio = generate_ontology_file(results, user, updates=updates, fnames=fnames)
-    data = sio.getvalue()
-    return make_file_response(data, f"alert_{alert_id}.ontology", len(data))
+    # Stream the ontology records of the results as they are downloaded
+    jobs = get_ontology_jobs(results, updates=updates, fnames=get_file_names(submission))
+    return stream_ndjson_response(iter_ontology_records(jobs, user), name=f"alert_{alert_id}.ontology")
 
 
 @ontology_api.route("/submission/<sid>/", methods=["GET"])
@@ -209,54 +275,12 @@ def get_ontology_for_submission(sid, **kwargs):
     if not Classification.is_accessible(user['classification'], submission['classification']):
         return make_api_response("", f"Your are not allowed get ontology files for this submission: {sid}", 403)
 
-    # Get all the results keys
-    keys = [k for k in submission['results'] if not k.endswith(".e")]
-
-    # Only use keys matching theses sha256s
-    if sha256s:
-        tmp_keys = []
-        for sha256 in sha256s:
-            tmp_keys.extend([k for k in keys if k.startswith(sha256)])
-        keys = tmp_keys
-
-    # Only use keys matching theses services
-    if services:
-        tmp_keys = []
-        for service in services:
-            tmp_keys.extend([k for k in keys if f".{service}." in k])
-        keys = tmp_keys
-
-    # Pull the results for the keys
-    try:
-        results = STORAGE.result.multiget(keys, as_dictionary=False, as_obj=False)
-    except MultiKeyError as e:
-        results = e.partial_output
-
-    # Compile information to be added to the ontology
-    updates = {
-        'file': {
-            'parent': submission['files'][0]['sha256'],
-        },
-        'submission': {
-            'metadata': submission.get('metadata', {}),
-            'date': submission['times']['submitted'],
-            'source_system': config.ui.fqdn,
-            'sid': sid,
-            'classification': submission['classification'],
-            'submitter': submission['params']['submitter'],
-            'groups': submission['params']['groups'],
-            'max_score': submission['max_score']
-        }
-
-    }
-
-    # Set the list of file names
-    fnames = {x['sha256']: [x['name']] for x in submission['files']}
+    results = get_results(get_result_keys(submission, sha256s, services))
+    updates = get_submission_updates(submission)
 
-    # Generate ontology files based of the results
-    sio = generate_ontology_file(results, user, updates=updates, fnames=fnames)
-    data = sio.getvalue()
-    return make_file_response(data, f"submission_{sid}.ontology", len(data))
+    # Stream the ontology records of the results as they are downloaded
+    jobs = get_ontology_jobs(results, updates=updates, fnames=get_file_names(submission))
+    return stream_ndjson_response(iter_ontology_records(jobs, user), name=f"submission_{sid}.ontology")
 
 
 @ontology_api.route("/file/<sha256>/", methods=["GET"])
@@ -315,11 +339,7 @@ def get_ontology_for_file(sha256, **kwargs):
 
         keys = [k for service in service_resp['items'] for k in service['items'][0].values()]
 
-    # Pull the results for the keys
-    try:
-        results = STORAGE.result.multiget(keys, as_dictionary=False, as_obj=False)
-    except MultiKeyError as e:
-        results = e.partial_output
+    results = get_results(keys)
 
     # Compile information to be added to the ontology
     updates = {
@@ -330,7 +350,88 @@ def get_ontology_for_file(sha256, **kwargs):
         }
     }
 
-    # Generate ontology files based of the results
-    sio = generate_ontology_file(results, user, updates=updates)
-    data = sio.getvalue()
-    return make_file_response(data, f"file_{sha256}.ontology", len(data))
+    # Stream the ontology records of the results as they are downloaded
+    jobs = get_ontology_jobs(results, updates=updates)
+    return stream_ndjson_response(iter_ontology_records(jobs, user), name=f"file_{sha256}.ontology")
+
+
+@ontology_api.route("/submissions/", methods=["GET", "POST"])
+@api_login(require_role=[ROLES.submission_view])
+def get_ontology_for_submissions(**kwargs):
+    """
+    WARNING:
+        This APIs output is considered stable but the ontology model itself is still in its
+        alpha state. Do not use the results of this API in a production system just yet.
+
+    Get all ontology files of many submissions, selected by ID and/or by a submission search query. The records are
+    streamed as newline delimited JSON as soon as they are downloaded.
+
+    Variables:
+    None
+
+    Arguments:
+    sid         => Get ontology files for this submission, multiple values allowed (optional)
+    query       => Get ontology files for the submissions matching this query (optional)
+    filters     => Additional filter queries for the submissions, multiple values allowed (optional)
+    rows        => Maximum number of submissions matched by the query (optional)
+    sha256      => Only get ontology files for this file, multiple values allowed (optional)
+    service     => Only get ontology files for this service, multiple values allowed (optional)
+
+    Data Block (POST only):
+    {
+     "sid": ["sid1", "sid2"],           # Same as the arguments
+     "query": "max_score:>=1000",
+     "filters": [],
+     "rows": 1000,
+     "sha256": [],
+     "service": []
+    }
+
+    API call example:
+    /api/v4/ontology/submissions/?query=times.submitted:[now-1d TO now]
+
+    Result example:      (File where each line is a result ontology record)
+    {"header":{"md5":"5fa76...submitter":"admin"}}
+    {"header":{"md5":"6c3af...submitter":"admin"}}
+    {"header":{"md5":"c8e69...submitter":"admin"}}
+    """
+    user = kwargs['user']
+
+    if request.method == "POST":
+        req_data = request.json or {}
+        sids = req_data.get('sid', None) or []
+        filters = req_data.get('filters', None) or []
+        sha256s = req_data.get('sha256', None)
+        services = req_data.get('service', None)
+    else:
+        req_data = request.args
+        sids = req_data.getlist('sid', None)
+        filters = req_data.getlist('filters', None)
+        sha256s = req_data.getlist('sha256', None)
+        services = req_data.getlist('service', None)
+    query = req_data.get('query', None)
+
+    if not sids and not query:
+        return make_api_response("", "You need to provide submission IDs or a query.", 400)
+
+    try:
+        max_rows = min(int(req_data.get('rows', ONTOLOGY_EXPORT_MAX_SUBMISSIONS)), ONTOLOGY_EXPORT_MAX_SUBMISSIONS)
+    except ValueError:
+        return make_api_response("", "Rows should be an integer.", 400)
+
+    # Only the IDs are gathered up front so invalid queries are reported before the streaming starts
+    sids = dict.fromkeys(sids)
+    if query:
+        try:
+            matched = 0
+            for item in STORAGE.submission.stream_search(query, fl="sid", filters=filters,
+                                                         access_control=user['access_control'], as_obj=False):
+                if matched >= max_rows:
+                    break
+                sids[item['sid']] = None
+                matched += 1
+        except SearchException as e:
+            return make_api_response("", f"SearchException: {e}", 400)
+
+    jobs = get_submissions_jobs(list(sids), user, sha256s=sha256s, services=services)
+    return stream_ndjson_response(iter_ontology_records(jobs, user), name="submissions.ontology")
@@ -1,4 +1,5 @@
 import typing
+from itertools import chain
 
 from assemblyline.common.isotime import now_as_iso
 from assemblyline.common.forge import get_hauntedhouse_client
@@ -6,8 +7,9 @@ from assemblyline.common.forge import get_hauntedhouse_client
 from assemblyline.datastore.collection import Index
 from assemblyline.datastore.exceptions import SearchException
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ndjson_response
 from assemblyline_ui.config import CLASSIFICATION, STORAGE, config, LOGGER
+from assemblyline_ui.helper.retrohunt import RetrohuntHitCache, facet_hits, search_hits, stream_hits
 from flask import request, Response
 
 SUB_API = 'retrohunt'
@@ -17,6 +19,7 @@ retrohunt_api._doc = "Run yara signatures over all files."
 SECONDS_PER_DAY = 24 * 60 * 60
 
 haunted_house_client = get_hauntedhouse_client(config)
+HIT_CACHE = RetrohuntHitCache(STORAGE.retrohunt_hit)
 
 
 @retrohunt_api.route("/", methods=["PUT"])
@@ -311,6 +314,7 @@ def get_retrohunt_job_hits(id, **kwargs):
         filters                 =>  List of additional filter queries limit the data
         sort                    =>  How to sort the results (not available in deep paging)
         fl                      =>  List of fields to return
+        stream                  =>  Stream all the matching files as newline delimited JSON instead of a page
 
     Data Block (POST ONLY):
     {
@@ -320,6 +324,7 @@ def get_retrohunt_job_hits(id, **kwargs):
         "filters": "0",         =>  List of additional filter queries limit the data
         "sort": "0",            =>  How to sort the results (not available in deep paging)
         "fl": "0",              =>  List of fields to return
+        "stream": False,        =>  Stream all the matching files as newline delimited JSON instead of a page
         "filters": ['fq']
     }
 
@@ -373,18 +378,7 @@ def get_retrohunt_job_hits(id, **kwargs):
         return make_api_response({}, err="Access denied.", status_code=403)
 
     try:
-        params = {
-            'query': f"search:{id}",
-            'offset': 0,
-            'rows': 10000,
-            'fl': 'sha256',
-            'as_obj': False,
-            'index_type': Index.HOT_AND_ARCHIVE,
-            'track_total_hits': True
-        }
-
-        hits = STORAGE.retrohunt_hit.search(**params)
-        key_space = [item['sha256'] for item in hits['items']]
+        key_space = HIT_CACHE.get(id, doc['finished'])
 
         params = {
             'query': '*',
@@ -392,24 +386,34 @@ def get_retrohunt_job_hits(id, **kwargs):
             'rows': 10,
             'sort': 'seen.last desc',
             'access_control': user['access_control'],
-            'as_obj': False,
             'index_type': Index.HOT_AND_ARCHIVE,
             'track_total_hits': True,
-            'key_space': key_space
         }
 
         multi_fields = ['filters']
         if request.method == "POST":
             req_data = request.json
             params.update({k: req_data.get(k, None) for k in multi_fields if req_data.get(k, None) is not None})
+            stream = bool(req_data.get('stream', False))
         else:
             req_data = request.args
             params.update({k: req_data.getlist(k, None) for k in multi_fields if req_data.get(k, None) is not None})
+            stream = req_data.get('stream', 'false').lower() in ['true', '']
 
         fields = ["query", "offset", "rows", "sort", "fl", 'track_total_hits']
         params.update({k: req_data.get(k, None) for k in fields if req_data.get(k, None) is not None})
 
-        return make_api_response(STORAGE.file.search(**params))
+        if stream:
+            items = stream_hits(STORAGE.file, key_space, query=params['query'], fl=params.get('fl', None),
+                                filters=params.get('filters', None), access_control=params['access_control'],
+                                index_type=params['index_type'])
+            # Fetch the first item right away so invalid queries are reported before the streaming starts
+            first = next(items, None)
+            if first is None:
+                return stream_ndjson_response([])
+            return stream_ndjson_response(chain([first], items))
+
+        return make_api_response(search_hits(STORAGE.file, key_space, **params))
     except SearchException as e:
         return make_api_response("", f"SearchException: {e}", 400)
 
@@ -545,24 +549,12 @@ def get_retrohunt_job_types(id, **kwargs):
         return make_api_response({}, err="Access denied.", status_code=403)
 
     try:
-        params = {
-            'query': f"search:{id}",
-            'offset': 0,
-            'rows': 10000,
-            'fl': 'sha256',
-            'as_obj': False,
-            'index_type': Index.HOT_AND_ARCHIVE,
-            'track_total_hits': True
-        }
-
-        hits = STORAGE.retrohunt_hit.search(**params)
-        key_space = [item['sha256'] for item in hits['items']]
+        key_space = HIT_CACHE.get(id, doc['finished'])
 
         params = {
             'query': '*',
             'access_control': user['access_control'],
             'index_type': Index.HOT_AND_ARCHIVE,
-            'key_space': key_space,
             'mincount': 1
         }
 
@@ -577,6 +569,6 @@ def get_retrohunt_job_types(id, **kwargs):
         fields = ["query", "mincount"]
         params.update({k: req_data.get(k, None) for k in fields if req_data.get(k, None) is not None})
 
-        return make_api_response(STORAGE.file.facet('type', **params))
+        return make_api_response(facet_hits(STORAGE.file, key_space, 'type', **params))
     except SearchException as e:
         return make_api_response("", f"SearchException: {e}", 400)
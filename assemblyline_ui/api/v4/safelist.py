@@ -9,7 +9,8 @@ from assemblyline.common.isotime import now_as_iso
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
 from assemblyline.datastore.exceptions import VersionConflictException
-from assemblyline_ui.config import CLASSIFICATION, LOGGER, STORAGE
+from assemblyline_ui.config import CLASSIFICATION, LOGGER, STORAGE, redis
+from assemblyline_ui.helper.membership import ListMembershipFilter, bulk_check
 from assemblyline_core.safelist_client import SafelistClient, InvalidSafehash
 
 SUB_API = 'safelist'
@@ -17,6 +18,7 @@ safelist_api = make_subapi_blueprint(SUB_API, api_version=4)
 safelist_api._doc = "Perform operations on safelisted hashes"
 
 CLIENT = SafelistClient(datastore=STORAGE)
+SAFELIST_FILTER = ListMembershipFilter(STORAGE.safelist, redis)
 
 
 @safelist_api.route("/", methods=["POST", "PUT"])
@@ -78,6 +80,8 @@ def add_or_update_hash(**kwargs):
 
     try:
         qhash, op = CLIENT.add_update(data, user)
+        file_hashes = data.get('hashes', None) or {}
+        SAFELIST_FILTER.add(qhash, *[v for k, v in file_hashes.items() if k in ['md5', 'sha1'] and v])
         return make_api_response({'success': True, "op": op, 'hash': qhash})
     except PermissionError as e:
         return make_api_response(None, str(e), 403)
@@ -325,6 +329,59 @@ def check_tag_exists(tag_type, tag_value, **kwargs):
     return make_api_response(None, "The hash was not found in the safelist.", 404)
 
 
+@safelist_api.route("/check/", methods=["POST"])
+@api_login(require_role=[ROLES.safelist_view])
+def check_many(**kwargs):
+    """
+    Check if a list of hashes and tags exist in the safelist in a single call.
+    Items that are not safelisted are not part of the result.
+
+    Variables:
+    None
+
+    Arguments:
+    None
+
+    Data Block:
+    {
+     "hashes": [                  # List of hashes to check (either md5, sha1 or sha256)
+       "123456...654321"
+     ],
+     "tags": [                    # List of tags to check
+       {"type": "network.static.ip", "value": "1.1.1.1"}
+     ],
+     "signatures": [              # List of signature names to check
+       "sig_name"
+     ]
+    }
+
+    API call example:
+    POST /api/v4/safelist/check/
+
+    Result example:
+    {
+     "hashes": {                  # Safelisted hashes with the same content as the safelist hash API
+       "123456...654321": {...}
+     },
+     "tags": {                    # Safelisted tags per tag type
+       "network.static.ip": {
+         "1.1.1.1": {...}
+       }
+     },
+     "signatures": {              # Safelisted signatures
+       "sig_name": {...}
+     }
+    }
+    """
+    data = request.json or {}
+    try:
+        return make_api_response(bulk_check(STORAGE.safelist, SAFELIST_FILTER, CLASSIFICATION,
+                                            kwargs['user']['classification'], hashes=data.get('hashes', None),
+                                            tags=data.get('tags', None), signatures=data.get('signatures', None)))
+    except ValueError as e:
+        return make_api_response(None, str(e), 400)
+
+
 @safelist_api.route("/enable/<qhash>/", methods=["PUT"])
 @api_login(allow_readonly=False, require_role=[ROLES.safelist_manage])
 def set_hash_status(qhash, **_):
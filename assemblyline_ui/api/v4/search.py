@@ -1,17 +1,30 @@
 
+import json
+
+from itertools import chain, islice
+
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.datastore.collection import Index
 from flask import abort, request
 
 from assemblyline.datastore.exceptions import SearchException
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
-from assemblyline_ui.config import STORAGE
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ndjson_response
+from assemblyline_ui.config import CACHE, SEARCH_STREAM_MAX_ROWS, STORAGE
 from assemblyline_ui.helper.search import get_collection, get_default_sort, has_access_control, list_all_fields
 
 SUB_API = 'search'
 search_api = make_subapi_blueprint(SUB_API, api_version=4)
 search_api._doc = "Perform search queries"
 
+# Number of items fetched from the datastore at once while streaming search results
+STREAM_BUFFER_SIZE = 1000
+
+# Analytics requests limits and caching
+ANALYTICS_MAX_SPECS = 50
+ANALYTICS_MAX_WORKERS = 10
+ANALYTICS_CACHE_TTL = 60
+
 ROLE_INDEX_MAP = {
     "alert": ROLES.alert_view,
     "badlist": ROLES.badlist_view,
@@ -26,6 +39,22 @@ ROLE_INDEX_MAP = {
 }
 
 
+def get_histogram_defaults(field_info):
+    if field_info['type'] == "integer":
+        return {
+            'start': 0,
+            'end': 2000,
+            'gap': 100
+        }
+    elif field_info['type'] == "date":
+        return {
+            'start': f"{STORAGE.ds.now}-1{STORAGE.ds.day}",
+            'end': f"{STORAGE.ds.now}",
+            'gap': f"+1{STORAGE.ds.hour}"
+        }
+    return None
+
+
 def check_role_for_index(index, user):
     required_role = ROLE_INDEX_MAP.get(index, 'administration')
     if required_role not in user['roles']:
@@ -56,6 +85,9 @@ def search(index, **kwargs):
     timeout        =>   Maximum execution time (ms)
     use_archive    =>   Allow access to the malware archive (Default: False)
     archive_only   =>   Only access the Malware archive (Default: False)
+    stream         =>   Stream all matching results as NDJSON (Default: False)
+                        In stream mode, rows is the maximum number of results to stream
+                        and offset, sort, timeout and deep_paging_id are ignored.
 
     Data Block (POST ONLY):
     {"query": "query",     # Query to search for
@@ -64,6 +96,7 @@ def search(index, **kwargs):
      "sort": "field asc",  # How to sort the results
      "fl": "id,score",     # List of fields to return
      "timeout": 1000,      # Maximum execution time (ms)
+     "stream": false,      # Stream all matching results as NDJSON
      "filters": ['fq']}    # List of additional filter queries limit the data
 
 
@@ -73,6 +106,11 @@ def search(index, **kwargs):
      "rows": 100,                           # Number of results returned
      "next_deep_paging_id": "asX3f...342",  # ID to pass back for the next page during deep paging
      "items": []}                           # List of results
+
+    Result example (stream mode):
+    {"id": "...", "score": 0}   # One result per line
+    {"id": "...", "score": 10}
+    ...
     """
     user = kwargs['user']
     check_role_for_index(index, user)
@@ -83,7 +121,7 @@ def search(index, **kwargs):
 
     fields = ["offset", "rows", "sort", "fl", "timeout", "deep_paging_id", 'track_total_hits']
     multi_fields = ['filters']
-    boolean_fields = ['use_archive', 'archive_only']
+    boolean_fields = ['use_archive', 'archive_only', 'stream']
 
     if request.method == "POST":
         req_data = request.json
@@ -119,12 +157,39 @@ def search(index, **kwargs):
     if not query:
         return make_api_response("", "There was no search query.", 400)
 
+    if params.pop('stream', False):
+        return stream_search_results(collection, query, params)
+
     try:
         return make_api_response(collection.search(query, **params))
     except SearchException as e:
         return make_api_response("", f"SearchException: {e}", 400)
 
 
+def stream_search_results(collection, query, params):
+    try:
+        max_rows = min(int(params.get('rows', SEARCH_STREAM_MAX_ROWS)), SEARCH_STREAM_MAX_ROWS)
+    except ValueError:
+        return make_api_response("", "Rows should be an integer.", 400)
+
+    items = collection.stream_search(query, fl=params.get('fl', None), filters=params.get('filters', None),
+                                     access_control=params.get('access_control', None),
+                                     item_buffer_size=STREAM_BUFFER_SIZE, as_obj=False,
+                                     index_type=params['index_type'])
+
+    # Fetch the first item right away so invalid queries are reported before the streaming starts. The rest of the
+    # items are only pulled from the datastore as the client reads the response.
+    try:
+        first = next(items, None)
+    except SearchException as e:
+        return make_api_response("", f"SearchException: {e}", 400)
+
+    if first is None or max_rows <= 0:
+        return stream_ndjson_response([])
+
+    return stream_ndjson_response(islice(chain([first], items), max_rows))
+
+
 @search_api.route("/grouped/<index>/<group_field>/", methods=["GET", "POST"])
 @api_login(require_role=["alert_view", "heuristic_view",  "safelist_view", "signature_view", "submission_view",
                          "workflow_view", "retrohunt_view", "badlist_view"])
@@ -397,19 +462,9 @@ def histogram(index, field, **kwargs):
     field_info = collection.fields().get(field, None)
     if field_info is None:
         return make_api_response("", f"Field '{field}' is not a valid field in index: {index}", 400)
-    elif field_info['type'] == "integer":
-        params = {
-            'start': 0,
-            'end': 2000,
-            'gap': 100
-        }
-    elif field_info['type'] == "date":
-        params = {
-            'start': f"{STORAGE.ds.now}-1{STORAGE.ds.day}",
-            'end': f"{STORAGE.ds.now}",
-            'gap': f"+1{STORAGE.ds.hour}"
-        }
-    else:
+
+    params = get_histogram_defaults(field_info)
+    if params is None:
         err_msg = f"Field '{field}' is of type '{field_info['type']}'. Only 'integer' or 'date' are acceptable."
         return make_api_response("", err_msg, 400)
 
@@ -529,3 +584,134 @@ def stats(index, int_field, **kwargs):
         return make_api_response(collection.stats(int_field, **params))
     except SearchException as e:
         return make_api_response("", f"SearchException: {e}", 400)
+
+
+@search_api.route("/analytics/<index>/", methods=["POST"])
+@api_login(require_role=["alert_view", "heuristic_view",  "safelist_view", "signature_view", "submission_view",
+                         "workflow_view", "retrohunt_view", "badlist_view"])
+def analytics(index, **kwargs):
+    """
+    Perform multiple facet, histogram and stats analysis on the same query in a single call.
+    All the analysis are executed concurrently and the results are cached for a short period of time.
+
+    Variables:
+    index          =>   Index to search in (alert, submission,...)
+
+    Arguments:
+    None
+
+    Data Block:
+    {"query": "id:*",                   # Query to search for
+     "filters": ['fq'],                 # Additional query to limit to output
+     "timeout": 1000,                   # Maximum execution time (ms) of each analysis
+     "use_archive": False,              # Allow access to the malware archive
+     "archive_only": False,             # Only access the Malware archive
+     "facets": [                        # List of facets to perform
+        {"field": "status",               # Field to analyse
+         "name": "status",                # (Optional) Name of the result, defaults to the field
+         "mincount": 1}                   # Minimum item count for the fieldvalue to be returned
+     ],
+     "histograms": [                    # List of histograms to generate
+        {"field": "ts",                   # Integer or date field to generate the histogram from
+         "start": "now-1d",               # Value at which to start creating the histogram
+         "end": "now",                    # Value at which to end the histogram
+         "gap": "+1h",                    # Size of each step in the histogram
+         "mincount": 0}                   # Minimum item count for the step to be returned
+     ],
+     "stats": [                         # List of numeric fields to get statistics for
+        {"field": "al.score"}             # Numeric field to analyse
+     ]}
+
+    Each analysis of the same type must have a distinct name, give a name to the analysis of the same field.
+
+    Result example:
+    {"facets": {                        # Facetting results per name
+        "status": {"value_0": 2, ...}},
+     "histograms": {                    # Histogram results per name
+        "ts": {"step_0": 2, ...}},
+     "stats": {                         # Stats results per name
+        "al.score": {"count": 1, "min": 1, "max": 1, "avg": 1, "sum": 1}}}
+    """
+    user = kwargs['user']
+    check_role_for_index(index, user)
+    collection = get_collection(index, user)
+    if collection is None:
+        return make_api_response("", f"Not a valid index to search in: {index}", 400)
+
+    req_data = request.json or {}
+    params = {k: req_data[k] for k in ["query", "filters", "timeout"] if req_data.get(k, None) is not None}
+
+    use_archive = str(req_data.get('use_archive', 'false')).lower() in ['true', '']
+    archive_only = str(req_data.get('archive_only', 'false')).lower() in ['true', '']
+    if archive_only:
+        params['index_type'] = Index.ARCHIVE
+    elif use_archive:
+        params['index_type'] = Index.HOT_AND_ARCHIVE
+    else:
+        params['index_type'] = Index.HOT
+
+    if (use_archive or archive_only) and ROLES.archive_view not in user['roles']:
+        return make_api_response({}, "User is not allowed to view the archive", 403)
+
+    if has_access_control(index):
+        params.update({'access_control': user['access_control']})
+
+    # Validate all the analysis specs before running any of them
+    field_map = collection.fields()
+    specs = {'facets': [], 'histograms': [], 'stats': []}
+    for spec_type in specs:
+        for spec in req_data.get(spec_type, None) or []:
+            field = spec.get('field', None) if isinstance(spec, dict) else None
+            field_info = field_map.get(field, None)
+            if field_info is None:
+                return make_api_response("", f"Field '{field}' is not a valid field in index: {index}", 400)
+
+            name = spec.get('name', None) or field
+            if not isinstance(name, str) or name in (n for n, _, _ in specs[spec_type]):
+                return make_api_response("", f"Analysis name '{name}' is used more than once in {spec_type}, "
+                                             "give a distinct name to each of them.", 400)
+
+            if spec_type == 'facets':
+                spec_params = {k: spec[k] for k in ['mincount'] if spec.get(k, None) is not None}
+            elif spec_type == 'histograms':
+                spec_params = get_histogram_defaults(field_info)
+                if spec_params is None:
+                    err_msg = f"Field '{field}' is of type '{field_info['type']}'. " \
+                        "Only 'integer' or 'date' are acceptable."
+                    return make_api_response("", err_msg, 400)
+                spec_params.update({k: spec[k] for k in ['start', 'end', 'gap', 'mincount']
+                                    if spec.get(k, None) is not None})
+            else:
+                if field_info['type'] not in ["integer", "float"]:
+                    return make_api_response("", f"Field '{field}' is not a numeric field.", 400)
+                spec_params = {}
+
+            specs[spec_type].append((name, field, spec_params))
+
+    total_specs = sum(len(v) for v in specs.values())
+    if total_specs == 0:
+        return make_api_response("", "There was no analysis requested.", 400)
+    elif total_specs > ANALYTICS_MAX_SPECS:
+        return make_api_response("", f"Too many analysis requested, the maximum is {ANALYTICS_MAX_SPECS}.", 400)
+
+    # Results are cached per query, analysis and access control so users never share results they can't see
+    cache_key = CACHE.create_key('search_analytics', index,
+                                 json.dumps([params, specs], sort_keys=True, default=str))
+    cached = CACHE.get(cache_key, reset=False)
+    if cached is not None:
+        return make_api_response(cached)
+
+    methods = {'facets': collection.facet, 'histograms': collection.histogram, 'stats': collection.stats}
+    try:
+        with APMAwareThreadPoolExecutor(min(total_specs, ANALYTICS_MAX_WORKERS)) as executor:
+            futures = {spec_type: {name: executor.submit(methods[spec_type], field, **params, **spec_params)
+                                   for name, field, spec_params in spec_list}
+                       for spec_type, spec_list in specs.items()}
+
+        output = {spec_type: {name: future.result() for name, future in spec_futures.items()}
+                  for spec_type, spec_futures in futures.items()}
+    except SearchException as e:
+        return make_api_response("", f"SearchException: {e}", 400)
+
+    CACHE.set(cache_key, output, ttl=ANALYTICS_CACHE_TTL)
+    return make_api_response(output)
@@ -1,6 +1,8 @@
 
 import json
 import re
+import threading
+import time
 import yaml
 
 from flask import request
@@ -8,18 +10,19 @@ from math import floor
 from packaging.version import parse
 
 from assemblyline.common.dict_utils import get_recursive_delta
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.common.version import FRAMEWORK_VERSION, SYSTEM_VERSION
 from assemblyline.odm.models.error import ERROR_TYPES
 from assemblyline.odm.models.heuristic import Heuristic
 from assemblyline.odm.models.service import Service
 from assemblyline.odm.models.user import ROLES
 from assemblyline.odm.messages.changes import Operation
-from assemblyline.remote.datatypes import get_client
+from assemblyline.remote.datatypes import get_client, retry_call
 from assemblyline.remote.datatypes.events import EventSender
 from assemblyline.remote.datatypes.hash import Hash
 from assemblyline_core.updater.helper import get_latest_tag_for_service
-from assemblyline_ui.api.base import api_login, make_api_response, make_file_response, make_subapi_blueprint
-from assemblyline_ui.config import LOGGER, STORAGE, config, CLASSIFICATION as Classification
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_file_chunks_response
+from assemblyline_ui.config import CACHE, LOGGER, STORAGE, config, redis, CLASSIFICATION as Classification
 from assemblyline_ui.helper.signature import append_source_status
 
 SUB_API = 'service'
@@ -52,6 +55,16 @@ root_event_sender = EventSender('changes',
                                 host=config.core.redis.nonpersistent.host,
                                 port=config.core.redis.nonpersistent.port)
 
+# Number of services whose documents are fetched together while building a backup
+SERVICE_BACKUP_BATCH_SIZE = 20
+SERVICE_STATS_MAX_WORKERS = 6
+SERVICE_STATS_ROLLUP_WORKERS = 4
+# The stats of the current version of every service are precomputed by a background job at this interval
+SERVICE_STATS_ROLLUP_INTERVAL = 5 * 60
+SERVICE_STATS_ROLLUP_LOCK = 'service_stats_rollup'
+service_stats_rollup = None
+service_stats_rollup_lock = threading.Lock()
+
 
 def check_private_keys(source_list):
     # Check format of private_key(if any) in sources
@@ -90,17 +103,52 @@ def get_service_stats(service_name, version=None, max_docs=500):
         except Exception:
             filters.append(f'response.service_version:{version}')
 
-    # Get default heuristic set
-    heuristics = {
-        h['heur_id']: 0
-        for h in STORAGE.heuristic.stream_search(
-            f'heur_id:{service_name.upper()}.*', fl='heur_id', as_obj=False, item_buffer_size=1000)}
-
-    # Get error type distribution
+    with APMAwareThreadPoolExecutor(SERVICE_STATS_MAX_WORKERS) as executor:
+        # Get default heuristic set
+        heuristics_future = executor.submit(
+            lambda: {h['heur_id']: 0 for h in STORAGE.heuristic.stream_search(
+                f'heur_id:{service_name.upper()}.*', fl='heur_id', as_obj=False, item_buffer_size=1000)})
+
+        # Get error type distribution
+        errors_future = executor.submit(STORAGE.error.facet, 'type', query=query, filters=list(filters))
+
+        res = STORAGE.result.search(query, filters=filters, fl='created', sort="created desc", rows=max_docs,
+                                    as_obj=False)
+        if len(res['items']) != 0:
+            # Add a filter to limit the stats to the last max_docs entries
+            filters.append(f"created:[{res['items'][-1]['created']} TO {res['items'][0]['created']}]")
+
+            score_future = executor.submit(STORAGE.result.stats, 'result.score', query=query, filters=filters)
+            heuristic_count_future = executor.submit(STORAGE.result.facet, 'result.sections.heuristic.heur_id',
+                                                     query=query, filters=filters)
+            extracted_future = executor.submit(STORAGE.result.stats, 'response.extracted.length', query=query,
+                                               filters=filters,
+                                               field_script="params._source.response.extracted.length")
+            supplementary_future = executor.submit(STORAGE.result.stats, 'response.supplementary.length',
+                                                   query=query, filters=filters,
+                                                   field_script="params._source.response.supplementary.length")
+
+            # Generate score stats
+            score_stats = {k: v or 0 for k, v in score_future.result().items()}
+            score_stats.pop('sum', None)
+
+            # Count number of results
+            result_count = score_stats.pop('count')
+
+            # Set score gap, min and max
+            gap = 500
+            min_score = floor(score_stats['min']/gap)*gap
+            max_score = floor(score_stats['max']/gap)*gap + gap
+
+            # Build score distribution
+            score_stats['distribution'] = STORAGE.result.histogram(
+                'result.score', start=min_score, end=max_score, gap=gap, mincount=0,
+                query=query, filters=filters)
+
+    heuristics = heuristics_future.result()
     errors = {k: 0 for k in ERROR_TYPES.keys()}
-    errors.update(STORAGE.error.facet('type', query=query, filters=filters))
+    errors.update(errors_future.result())
 
-    res = STORAGE.result.search(query, filters=filters, fl='created', sort="created desc", rows=max_docs, as_obj=False)
     if len(res['items']) == 0:
         # We have no document, quickly return empty stats
         data = {
@@ -122,40 +170,16 @@ def get_service_stats(service_name, version=None, max_docs=500):
             'service': {'name': service_name}
         }
     else:
-        # Otherwise add a filter to limit the stats to the last max_docs entries
-        filters.append(f"created:[{res['items'][-1]['created']} TO {res['items'][0]['created']}]")
-
-        # Generate score stats
-        score_stats = {k: v or 0 for k, v in STORAGE.result.stats('result.score', query=query, filters=filters).items()}
-        score_stats.pop('sum', None)
-
-        # Count number of results
-        result_count = score_stats.pop('count')
-
-        # Set score gap, min and max
-        gap = 500
-        min_score = floor(score_stats['min']/gap)*gap
-        max_score = floor(score_stats['max']/gap)*gap + gap
-
-        # Build score distribution
-        score_stats['distribution'] = STORAGE.result.histogram(
-            'result.score', start=min_score, end=max_score, gap=gap, mincount=0,
-            query=query, filters=filters)
-
         # Get heuristic count
-        heuristics.update(STORAGE.result.facet('result.sections.heuristic.heur_id', query=query, filters=filters))
+        heuristics.update(heuristic_count_future.result())
 
         # Get extracted files count
-        extracted = {k: v or 0 for k, v in STORAGE.result.stats(
-            'response.extracted.length', query=query, filters=filters,
-            field_script="params._source.response.extracted.length").items()}
+        extracted = {k: v or 0 for k, v in extracted_future.result().items()}
         extracted.pop('count')
         extracted.pop('sum')
 
         # Get supplementary files count
-        supplementary = {k: v or 0 for k, v in STORAGE.result.stats(
-            'response.supplementary.length', query=query, filters=filters,
-            field_script="params._source.response.supplementary.length").items()}
+        supplementary = {k: v or 0 for k, v in supplementary_future.result().items()}
         supplementary.pop('count')
         supplementary.pop('sum')
 
@@ -179,6 +203,68 @@ def get_service_stats(service_name, version=None, max_docs=500):
     return data
 
 
+def _service_stats_key(service_name, version, max_docs):
+    return CACHE.create_key('service_stats', service_name, version, max_docs)
+
+
+def get_cached_service_stats(service_name, version=None, max_docs=500):
+    """Get the stats of a service from the cache, computing them if they are not cached yet.
+
+    Without a version, the stats of the current version of the service are returned so they share the entries
+    precomputed by the rollup.
+    """
+    _start_service_stats_rollup()
+
+    if version is None:
+        service_delta = STORAGE.service_delta.get(service_name, as_obj=False)
+        if service_delta:
+            version = service_delta['version']
+
+    key = _service_stats_key(service_name, version, max_docs)
+    data = CACHE.get(key, reset=False)
+    if data is None:
+        data = get_service_stats(service_name, version=version, max_docs=max_docs)
+        CACHE.set(key, data, ttl=SERVICE_STATS_ROLLUP_INTERVAL)
+
+    return data
+
+
+def rollup_service_stats():
+    """Precompute the stats of the current version of all services so the stats endpoints answer from the cache"""
+    def _rollup(service):
+        data = get_service_stats(service['name'], version=service['version'])
+        # Keep the entries until the next rollup is done
+        CACHE.set(_service_stats_key(service['name'], service['version'], 500), data,
+                  ttl=SERVICE_STATS_ROLLUP_INTERVAL * 2)
+
+    with APMAwareThreadPoolExecutor(SERVICE_STATS_ROLLUP_WORKERS) as executor:
+        futures = [executor.submit(_rollup, service) for service in STORAGE.list_all_services(as_obj=False)]
+
+    for future in futures:
+        future.result()
+
+
+# noinspection PyBroadException
+def _service_stats_rollup_loop():
+    while True:
+        try:
+            # Only one worker does the rollup during each interval
+            if retry_call(redis.set, SERVICE_STATS_ROLLUP_LOCK, 1, nx=True, ex=SERVICE_STATS_ROLLUP_INTERVAL):
+                rollup_service_stats()
+        except Exception:
+            LOGGER.exception("Failed to rollup the service stats")
+        time.sleep(SERVICE_STATS_ROLLUP_INTERVAL)
+
+
+def _start_service_stats_rollup():
+    # Started lazily so only the workers serving the service stats run the rollup
+    global service_stats_rollup
+    with service_stats_rollup_lock:
+        if service_stats_rollup is None:
+            service_stats_rollup = threading.Thread(target=_service_stats_rollup_loop, daemon=True)
+            service_stats_rollup.start()
+
+
 def preprocess_sources(source_list):
     source_list = sanitize_source_names(source_list)
     source_list = check_private_keys(source_list)
@@ -379,25 +465,61 @@ def backup(**_):
     Result example:
     <SERVICE BACKUP>
     """
-    services = {'type': 'backup', 'server': config.ui.fqdn, 'data': {}}
+    return stream_file_chunks_response(_generate_service_backup(), name=f"{config.ui.fqdn}_service_backup.yml")
+
+
+def _generate_service_backup():
+    # All the documents are fetched with a few multigets and serialized one service at the time so the backup is
+    # sent to the client as it is built. The output loads to the same data as a dump of the whole backup.
+    yield yaml.dump({'server': config.ui.fqdn}, indent=2)
+    yield yaml.dump({'type': 'backup'}, indent=2)
+
+    versions = {}
+    for item in STORAGE.service.stream_search("id:*", fl="id,name", as_obj=False, item_buffer_size=1000):
+        versions.setdefault(item['name'], []).append(item['id'])
+
+    names = sorted(item['id'] for item in STORAGE.service_delta.stream_search(
+        "*:*", fl="id", as_obj=False, item_buffer_size=1000))
+    if not names:
+        yield yaml.dump({'data': {}}, indent=2)
+        return
+
+    yield "data:\n"
+    for x in range(0, len(names), SERVICE_BACKUP_BATCH_SIZE):
+        batch = names[x:x + SERVICE_BACKUP_BATCH_SIZE]
+        deltas = STORAGE.service_delta.multiget(batch, as_obj=False, error_on_missing=False)
+        version_docs = STORAGE.service.multiget([v for name in batch for v in versions.get(name, [])],
+                                                as_obj=False, error_on_missing=False)
+
+        for name in batch:
+            service_output = {
+                'config': deltas.get(name, None),
+                'versions': {v: version_docs[v] for v in versions.get(name, []) if v in version_docs}
+            }
+            out = yaml.dump({name: service_output}, indent=2)
+            yield "".join(f"  {line}" for line in out.splitlines(keepends=True))
 
-    for service in STORAGE.service_delta.stream_search("*:*", fl="id", as_obj=False, item_buffer_size=1000):
-        name = service['id']
-        service_output = {
-            'config': STORAGE.service_delta.get(name, as_obj=False),
-            'versions': {}
-        }
-        for service_version in STORAGE.service.stream_search(
-                f"name:{name}", fl="id", as_obj=False, item_buffer_size=1000):
-            version_id = service_version['id']
-            service_output['versions'][version_id] = STORAGE.service.get(version_id, as_obj=False)
 
-        services['data'][name] = service_output
+def restore_service_documents(backup_data):
+    """Save all the service versions and deltas of a backup with bulk requests, replacing the existing documents"""
+    version_plan = STORAGE.service.get_bulk_plan()
+    delta_plan = STORAGE.service_delta.get_bulk_plan()
+    for service_name, service in backup_data.items():
+        for v_id, v_data in service['versions'].items():
+            version_plan.add_delete_operation(v_id)
+            version_plan.add_insert_operation(v_id, v_data)
+        delta_plan.add_delete_operation(service_name)
+        delta_plan.add_insert_operation(service_name, service['config'])
 
-    out = yaml.dump(services, indent=2)
-    return make_file_response(
-        out, name=f"{config.ui.fqdn}_service_backup.yml", size=len(out),
-        content_type="application/json")
+    for collection, plan in [(STORAGE.service, version_plan), (STORAGE.service_delta, delta_plan)]:
+        if plan.empty:
+            continue
+
+        res = collection.bulk(plan)
+        if res['errors']:
+            errors = [op['error'] for item in res['items'] for op in item.values() if 'error' in op]
+            raise ValueError(f"Failed to restore the services: {errors[:5]}")
+        collection.commit()
 
 
 @service_api.route("/restore/", methods=["PUT", "POST"])
@@ -429,14 +551,13 @@ def restore(**_):
             return make_api_response(
                 "", err="This backup was not created on this server, restore operation cancelled.", status_code=400)
 
-        for service_name, service in backup['data'].items():
-            # Grab the old value for a service
-            old_service = STORAGE.get_service_with_delta(service_name, as_obj=False)
+        # Grab the old value of the services
+        old_services = {service_name: STORAGE.get_service_with_delta(service_name, as_obj=False)
+                        for service_name in backup['data'].keys()}
+
+        restore_service_documents(backup['data'])
 
-            # Restore the service
-            for v_id, v_data in service['versions'].items():
-                STORAGE.service.save(v_id, v_data)
-            STORAGE.service_delta.save(service_name, service['config'])
+        for service_name, old_service in old_services.items():
 
             # Notify components watching for service config changes
             event_sender.send(service_name, {
@@ -1082,6 +1203,7 @@ def service_statistics(service_name, **_):
 
         Arguments:
         version    =>   Version of the service to get stats for
+                        (Default: current version of the service)
         max_docs   =>   Maximum number of results to generate the stats on
                         (Default: 500)
 
@@ -1121,4 +1243,37 @@ def service_statistics(service_name, **_):
     """
     version = request.args.get('version', None)
     max_docs = int(request.args.get('max_docs', 500))
-    return make_api_response(get_service_stats(service_name, version=version, max_docs=max_docs))
+    return make_api_response(get_cached_service_stats(service_name, version=version, max_docs=max_docs))
+
+
+@service_api.route("/stats/", methods=["GET"])
+@api_login(audit=False, require_role=[ROLES.administration], count_toward_quota=False)
+def all_service_statistics(**_):
+    """
+        Get statistics for the current version of all services
+
+        Variables:
+        None
+
+        Arguments:
+        None
+
+        Data Block:
+        None
+
+        Result example:
+        {'ResultSample': {                  # Stats of the service, see /api/v4/service/stats/<service_name>/
+            'error': {...},
+            'file': {...},
+            'heuristic': {...},
+            'result': {...},
+            'service': {'name': 'ResultSample', 'version': '4.2.0.dev0'}},
+         ...
+        }
+    """
+    with APMAwareThreadPoolExecutor(SERVICE_STATS_ROLLUP_WORKERS) as executor:
+        futures = {service['name']: executor.submit(get_cached_service_stats, service['name'],
+                                                    version=service['version'])
+                   for service in STORAGE.list_all_services(as_obj=False)}
+
+    return make_api_response({name: future.result() for name, future in futures.items()})
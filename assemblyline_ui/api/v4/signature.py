@@ -1,4 +1,6 @@
+import json
 import re
+import time
 
 from flask import request
 from hashlib import sha256
@@ -11,7 +13,8 @@ from assemblyline.remote.datatypes.hash import Hash
 from assemblyline.remote.datatypes.lock import Lock
 from assemblyline.remote.datatypes.events import EventSender
 from assemblyline_core.signature_client import SignatureClient
-from assemblyline_ui.api.base import api_login, make_api_response, make_file_response, make_subapi_blueprint
+from assemblyline_ui.api.base import api_login, make_api_response, make_file_response, make_subapi_blueprint, \
+    stream_api_response
 from assemblyline_ui.config import LOGGER, STORAGE, config, CLASSIFICATION as Classification
 from assemblyline_ui.helper.signature import append_source_status
 
@@ -20,6 +23,9 @@ signature_api = make_subapi_blueprint(SUB_API, api_version=4)
 signature_api._doc = "Perform operations on signatures"
 
 DEFAULT_CACHE_TTL = 24 * 60 * 60  # 1 Day
+# Statistics are recomputed periodically without changing the signatures' last modified date
+STATS_CACHE_TTL = 5 * 60
+STATS_FIELDS = 'id,classification,name,source,type,stats'
 CLIENT = SignatureClient(STORAGE)
 
 
@@ -677,25 +683,55 @@ def signature_statistics(**kwargs):
     ]"""
     user = kwargs['user']
 
-    stats = []
-    for sig in STORAGE.signature.stream_search("id:*", access_control=user['access_control'], fl='id,*', as_obj=False):
-        stats.append({
-            'avg': sig.get('stats', {}).get('avg', 0),
+    access = user['access_control']
+    last_modified = STORAGE.get_signature_last_modified()
+    # The cachestore does not expire its entries on read, the key changes every STATS_CACHE_TTL seconds instead
+    period = int(time.time() // STATS_CACHE_TTL)
+    query_hash = sha256(f'stats.{access}.{last_modified}.{period}'.encode('utf-8')).hexdigest()
+
+    with forge.get_cachestore('signatures') as signature_cache:
+        try:
+            cached = signature_cache.get(query_hash)
+        except Exception:  # pylint: disable=W0702
+            LOGGER.exception('Failed to read cached signature stats:')
+            cached = None
+
+    if cached is not None:
+        return stream_api_response([cached.decode('utf-8')])
+
+    return stream_api_response(_generate_signature_stats(query_hash, access))
+
+
+# noinspection PyBroadException
+def _generate_signature_stats(query_hash, access):
+    # Only the fields needed for the stats are loaded and they are sent to the client as they are read
+    parts = []
+    for sig in STORAGE.signature.stream_search("id:*", access_control=access, fl=STATS_FIELDS,
+                                               item_buffer_size=1000, as_obj=False):
+        stats = sig.get('stats', {})
+        part = json.dumps({
+            'avg': stats.get('avg', 0),
             'classification': sig['classification'],
-            'count': sig.get('stats', {}).get('count', 0),
-            'first_hit': sig.get('stats', {}).get('first_hit', None),
+            'count': stats.get('count', 0),
+            'first_hit': stats.get('first_hit', None),
             'id': sig['id'],
-            'last_hit': sig.get('stats', {}).get('last_hit', None),
-            'max': sig.get('stats', {}).get('max', 0),
-            'min': sig.get('stats', {}).get('min', 0),
+            'last_hit': stats.get('last_hit', None),
+            'max': stats.get('max', 0),
+            'min': stats.get('min', 0),
             'name': sig['name'],
             'source': sig['source'],
-            'sum': sig.get('stats', {}).get('sum', 0),
+            'sum': stats.get('sum', 0),
             'type': sig['type'],
+        }, separators=(',', ':'))
+        parts.append(part)
+        yield part
 
-        })
-
-    return make_api_response(stats)
+    # Only complete stats are cached, as the items of the list separated by commas
+    try:
+        with forge.get_cachestore('signatures') as signature_cache:
+            signature_cache.save(query_hash, ','.join(parts).encode('utf-8'), ttl=STATS_CACHE_TTL)
+    except Exception:  # pylint: disable=W0702
+        LOGGER.exception('Failed to cache signature stats:')
 
 
 @signature_api.route("/update_available/", methods=["GET"])
@@ -7,12 +7,12 @@ from assemblyline.datastore.exceptions import MultiKeyError, SearchException
 from assemblyline.datastore.collection import Index
 from assemblyline.odm.models.user import ROLES
 from assemblyline_core.dispatching.client import DispatchClient
-from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
+from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint, stream_ai_response
 from assemblyline_ui.config import AI_AGENT, STORAGE, LOGGER, FILESTORE, config, \
     CLASSIFICATION as Classification, CACHE
-from assemblyline_ui.helper.ai.base import APIException, EmptyAIResponse
+from assemblyline_ui.helper.ai.base import APIException, EmptyAIResponse, result_events
 from assemblyline_ui.helper.result import cleanup_heuristic_sections, format_result
-from assemblyline_ui.helper.submission import get_or_create_summary
+from assemblyline_ui.helper.submission import get_or_create_file_results, get_or_create_summary
 
 
 SUB_API = 'submission'
@@ -108,7 +108,7 @@ def get_file_submission_results(sid, sha256, **kwargs):
             "errors": [],
             "attack_matrix": {},
             'heuristics': {},
-            "signatures": set()
+            "signatures": []
         }
 
         # Extra keys - This is a live mode optimisation
@@ -126,100 +126,31 @@ def get_file_submission_results(sid, sha256, **kwargs):
             except BadRequest:
                 pass
 
-        res_keys = list(set(res_keys))
-        err_keys = list(set(err_keys))
-
         # Get File, results and errors
         temp_file = STORAGE.file.get(sha256, as_obj=False)
         if not temp_file:
             output['file_info']['sha256'] = sha256
-            output['signatures'] = list(output['signatures'])
             output['missing'] = True
             return make_api_response(output, "The file you are trying to view is missing from the system", 404)
         if not Classification.is_accessible(user['classification'], temp_file['classification']):
             return make_api_response("", "You are not allowed to view the data of this file", 403)
         output['file_info'] = temp_file
-        max_c12n = output['file_info']['classification']
-
-        temp_results = list(STORAGE.get_multiple_results([x for x in res_keys if x.startswith(sha256)],
-                                                         cl_engine=Classification, as_obj=False).values())
-        results = []
-        for r in temp_results:
-            r = format_result(user['classification'], r, temp_file['classification'], build_hierarchy=True)
-            if r:
-                max_c12n = Classification.max_classification(max_c12n, r['classification'])
-                results.append(r)
-        output['results'] = results
 
-        try:
-            output['errors'] = STORAGE.error.multiget([x for x in err_keys if x.startswith(sha256)],
-                                                      as_obj=False, as_dictionary=False)
-        except MultiKeyError as e:
-            LOGGER.warning(f"Trying to get multiple errors but some are missing: {str(e.keys)}")
-            output['errors'] = e.partial_output
+        view = get_or_create_file_results(sid, sha256, res_keys, err_keys, user['classification'],
+                                          temp_file['classification'], data['state'] == "completed")
+        output['results'] = list(view['results'].values())
+        output['errors'] = list(view['errors'].values())
+        output['heuristics'] = view['heuristics']
+        output['attack_matrix'] = view['attack_matrix']
+        output['signatures'] = view['signatures']
+        output['tags'] = {t_type: [(k, v[0], v[1], v[2]) for k, v in values.items()]
+                          for t_type, values in view['tags'].items()}
 
         output['metadata'] = STORAGE.get_file_submission_meta(sha256, config.ui.statistics.submission,
                                                               user["access_control"])
 
-        done_heuristics = set()
-        for res in output['results']:
-            sorted_sections = sorted(res.get('result', {}).get('sections', []),
-                                     key=lambda i: i['heuristic']['score'] if i['heuristic'] is not None else 0,
-                                     reverse=True)
-            for sec in sorted_sections:
-                h_type = "info"
-                if sec.get('heuristic', False):
-                    # Get the heuristics data
-                    if sec['heuristic']['score'] >= config.submission.verdicts.malicious:
-                        h_type = "malicious"
-                    elif sec['heuristic']['score'] >= config.submission.verdicts.suspicious:
-                        h_type = "suspicious"
-                    elif sec['heuristic']['score'] >= config.submission.verdicts.info:
-                        h_type = "info"
-                    else:
-                        h_type = "safe"
-
-                    if sec['heuristic']['heur_id'] not in done_heuristics:
-                        item = (sec['heuristic']['heur_id'], sec['heuristic']['name'])
-                        output['heuristics'].setdefault(h_type, [])
-                        output['heuristics'][h_type].append(item)
-                        done_heuristics.add(sec['heuristic']['heur_id'])
-
-                    # Process Attack matrix
-                    for attack in sec['heuristic'].get('attack', []):
-                        attack_id = attack['attack_id']
-                        for cat in attack['categories']:
-                            output['attack_matrix'].setdefault(cat, [])
-                            item = (attack_id, attack['pattern'], h_type)
-                            if item not in output['attack_matrix'][cat]:
-                                output['attack_matrix'][cat].append(item)
-
-                    # Process Signatures
-                    for signature in sec['heuristic'].get('signature', []):
-                        sig = (signature['name'], h_type, signature.get('safe', False))
-                        if sig not in output['signatures']:
-                            output['signatures'].add(sig)
-
-                # Process tags
-                for t in sec['tags']:
-                    output["tags"].setdefault(t['type'], {})
-                    current_htype, _, _ = output["tags"][t['type']].get(t['value'], (None, None, None))
-                    tag_htype = h_type
-                    if current_htype:
-                        if 'malicious' in (current_htype, h_type):
-                            tag_htype = 'malicious'
-                        elif 'suspicious' in (current_htype, h_type):
-                            tag_htype = 'suspicious'
-                        else:
-                            tag_htype = 'info'
-                    output["tags"][t['type']][t['value']] = (tag_htype, t['safelisted'], sec['classification'])
-
-        for t_type in output["tags"]:
-            output["tags"][t_type] = [(k, v[0], v[1], v[2]) for k, v in output['tags'][t_type].items()]
-
-        output['signatures'] = list(output['signatures'])
-
-        output['classification'] = max_c12n
+        output['classification'] = Classification.max_classification(
+            temp_file['classification'], view['classification'])
         return make_api_response(output)
     else:
         return make_api_response("", "You are not allowed to view the data of this submission", 403)
@@ -500,6 +431,7 @@ def get_ai_summary(sid, **kwargs):
     no_cache       => Caching for the output of this API will be disabled
     with_trace     => Should the AI call return the full trace of the conversation?
     lang           => Which language do you want the AI to respond in?
+    stream         => Stream the summary as server-sent events while it is generated
 
     Data Block:
     None
@@ -510,6 +442,13 @@ def get_ai_summary(sid, **kwargs):
       "truncated": false
     }
 
+    Streamed result example:
+    event: token
+    data: {"content": < NEXT PART OF THE AI SUMMARY >}
+
+    event: done
+    data: {"content": < THE AI SUMMARY IN MARKDOWN FORMAT >, "truncated": false}
+
 
     """
     if not AI_AGENT.has_backends():
@@ -520,6 +459,7 @@ def get_ai_summary(sid, **kwargs):
     no_cache = request.args.get('no_cache', 'false').lower() in ['true', '']
     lang = request.args.get('lang', 'english')
     with_trace = request.args.get('with_trace', 'false').lower() in ['true', '']
+    stream = request.args.get('stream', 'false').lower() in ['true', '']
 
     index_type = None
     if archive_only:
@@ -540,6 +480,9 @@ def get_ai_summary(sid, **kwargs):
         # Get the summary from cache
         ai_summary = CACHE.get(cache_key)
 
+    if ai_summary and stream:
+        return stream_ai_response(result_events(ai_summary))
+
     if not ai_summary:
         data = STORAGE.get_ai_formatted_submission_data(
             sid, user_classification=user['classification'],
@@ -547,6 +490,13 @@ def get_ai_summary(sid, **kwargs):
         if data is None:
             return make_api_response("", "Submission ID %s does not exists." % sid, 404)
 
+        if stream:
+            if detailed:
+                events = AI_AGENT.detailed_al_submission(data, lang=lang, with_trace=with_trace, stream=True)
+            else:
+                events = AI_AGENT.summarized_al_submission(data, lang=lang, with_trace=with_trace, stream=True)
+            return stream_ai_response(events, on_result=lambda result: CACHE.set(cache_key, result))
+
         try:
             if detailed:
                 ai_summary = AI_AGENT.detailed_al_submission(data, lang=lang, with_trace=with_trace)
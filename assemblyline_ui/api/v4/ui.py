@@ -14,7 +14,9 @@ from assemblyline.odm.messages.submission import Submission
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
 from assemblyline_ui.config import TEMP_DIR, STORAGE, FILESTORE, config, CLASSIFICATION as Classification, \
-    IDENTIFY, metadata_validator
+    IDENTIFY, metadata_validator, redis
+from assemblyline_ui.helper.flowjs import assemble_chunks, check_chunk_bounds, clear_received_chunks, \
+    get_local_cache_path, is_chunk_received, mark_chunk_received
 from assemblyline_ui.helper.service import ui_to_submission_params
 from assemblyline_ui.helper.submission import submission_received
 from assemblyline_ui.helper.user import check_submission_quota, decrement_submission_quota
@@ -79,12 +81,24 @@ def flowjs_check_chunk(**kwargs):
                                      "flowCurrentChunkSize, flowChunkSize and flowTotalSize "
                                      "should always be present.", 412)
 
-    filename = get_cache_name(flow_identifier, flow_chunk_number)
-    with forge.get_cachestore("flowjs", config) as cache:
-        if cache.exists(filename):
-            return make_api_response({"exist": True})
-        else:
-            return make_api_response({"exist": False, "msg": "Chunk does not exist, please send it!"}, status_code=204)
+    try:
+        flow_chunk_number = int(flow_chunk_number)
+        flow_total_chunks = int(flow_total_chunks)
+        flow_chunk_size = int(flow_chunk_size)
+    except ValueError:
+        return make_api_response("", "flowChunkNumber, flowTotalChunks and flowChunkSize should be integers.", 400)
+
+    bounds_error = check_chunk_bounds(flow_chunk_number, flow_total_chunks, flow_chunk_size,
+                                      config.submission.max_file_size)
+    if bounds_error:
+        return make_api_response("", bounds_error, 400)
+
+    exists = is_chunk_received(redis, get_cache_name(flow_identifier), flow_chunk_number)
+
+    if exists:
+        return make_api_response({"exist": True})
+    else:
+        return make_api_response({"exist": False, "msg": "Chunk does not exist, please send it!"}, status_code=204)
 
 
 # noinspection PyBroadException, PyUnusedLocal
@@ -129,7 +143,6 @@ def flowjs_upload_chunk(**kwargs):
     flow_filename = safe_str(request.form.get("flowFilename", None))
     flow_relative_path = request.form.get("flowRelativePath", None)
     flow_total_chunks = request.form.get("flowTotalChunks", None)
-    completed = True
 
     if not flow_chunk_number or not flow_chunk_size or not flow_current_chunk_size or not flow_total_size \
             or not flow_identifier or not flow_filename or not flow_relative_path or not flow_total_chunks:
@@ -137,44 +150,34 @@ def flowjs_upload_chunk(**kwargs):
                                      "flowCurrentChunkSize, flowTotalSize, flowIdentifier, flowFilename, "
                                      "flowRelativePath and flowTotalChunks should always be present.", 412)
 
+    try:
+        flow_chunk_number = int(flow_chunk_number)
+        flow_total_chunks = int(flow_total_chunks)
+        flow_chunk_size = int(flow_chunk_size)
+    except ValueError:
+        return make_api_response("", "flowChunkNumber, flowTotalChunks and flowChunkSize should be integers.", 400)
+
+    bounds_error = check_chunk_bounds(flow_chunk_number, flow_total_chunks, flow_chunk_size,
+                                      config.submission.max_file_size)
+    if bounds_error:
+        return make_api_response("", bounds_error, 400)
+
+    ui_sid = get_cache_name(flow_identifier)
     filename = get_cache_name(flow_identifier, flow_chunk_number)
 
     with forge.get_cachestore("flowjs", config) as cache:
         file_obj = request.files['file']
         cache.save(filename, file_obj.stream.read())
 
-        # Test in reverse order to fail fast
-        for chunk in range(int(flow_total_chunks), 0, -1):
-            chunk_name = get_cache_name(flow_identifier, chunk)
-            if not cache.exists(chunk_name):
-                completed = False
-                break
-
-        if completed:
-            # Reconstruct the file
-            ui_sid = get_cache_name(flow_identifier)
-            target_file = os.path.join(TEMP_DIR, ui_sid)
-            try:
-                os.makedirs(TEMP_DIR)
-            except Exception:
-                pass
+        # Received chunks are tracked in a bitmap, only the request completing the upload reassembles the file
+        completed, assemble = mark_chunk_received(redis, ui_sid, flow_chunk_number, flow_total_chunks)
+        if assemble:
+            chunk_names = [get_cache_name(flow_identifier, chunk + 1) for chunk in range(flow_total_chunks)]
+            assemble_chunks(cache, chunk_names, ui_sid, TEMP_DIR)
 
-            try:
-                os.unlink(target_file)
-            except Exception:
-                pass
-
-            for chunk in range(int(flow_total_chunks)):
-                chunk_name = get_cache_name(flow_identifier, chunk+1)
-                with open(target_file, "ab") as t:
-                    t.write(cache.get(chunk_name))
+            for chunk_name in chunk_names:
                 cache.delete(chunk_name)
-
-            # Save the reconstructed file
-            with open(target_file, "rb") as t:
-                cache.save(ui_sid, t.read())
-
-            os.unlink(target_file)
+            clear_received_chunks(redis, ui_sid)
 
     return make_api_response({'success': True, 'completed': completed})
 
@@ -221,13 +224,16 @@ def start_ui_submission(ui_sid, **kwargs):
 
     submit_result = None
     submitted_file = None
+    target_dir = None
 
     try:
-        # Download the file from the cache
         with forge.get_cachestore("flowjs", config) as cache:
             ui_sid = get_cache_name(ui_sid)
             fname = ui_params.pop('filename', ui_sid)
-            if cache.exists(ui_sid):
+
+            # Files cached on the local filesystem are submitted in place, others are downloaded from the cache
+            submitted_file = get_local_cache_path(cache, ui_sid)
+            if submitted_file is None and cache.exists(ui_sid):
                 target_dir = os.path.join(TEMP_DIR, ui_sid)
                 os.makedirs(target_dir, exist_ok=True)
 
@@ -247,7 +253,9 @@ def start_ui_submission(ui_sid, **kwargs):
                     meta = get_metadata_only(submitted_file)
                     if meta.get('al', {}).get('type', 'unknown') == 'archive/bundle/al':
                         try:
-                            submission = import_bundle(submitted_file, allow_incomplete=True, identify=IDENTIFY)
+                            # A file submitted in place belongs to the cachestore, only downloaded copies are removed
+                            submission = import_bundle(submitted_file, allow_incomplete=True, identify=IDENTIFY,
+                                                       cleanup=target_dir is not None)
                         except Exception as e:
                             return make_api_response("", err=str(e), status_code=400)
                         return make_api_response({"started": True, "sid": submission['sid']})
@@ -310,10 +318,10 @@ def start_ui_submission(ui_sid, **kwargs):
             # We had an error during the submission, release the quotas for the user
             decrement_submission_quota(user)
 
-        # Remove file
-        if os.path.exists(submitted_file):
-            os.unlink(submitted_file)
+        # Remove the downloaded file and its directory
+        if target_dir is not None:
+            if submitted_file is not None and os.path.exists(submitted_file):
+                os.unlink(submitted_file)
 
-        # Remove dir
-        if os.path.exists(target_dir) and os.path.isdir(target_dir):
-            os.rmdir(target_dir)
+            if os.path.exists(target_dir) and os.path.isdir(target_dir):
+                os.rmdir(target_dir)
@@ -13,13 +13,15 @@ from assemblyline.odm.models.user import (ACL_MAP, ROLES, USER_ROLES, USER_TYPE_
 from assemblyline.odm.models.user_favorites import Favorite
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
 from assemblyline_ui.config import APPS_LIST, CLASSIFICATION, DAILY_QUOTA_TRACKER, LOGGER, STORAGE, UI_MESSAGING, \
-    VERSION, config, AI_AGENT, UI_METADATA_VALIDATION
+    VERSION, config, UI_METADATA_VALIDATION
+from assemblyline_ui.helper.ai import has_ai_backends
 from assemblyline_ui.helper.search import list_all_fields
 from assemblyline_ui.helper.service import simplify_service_spec, ui_to_submission_params
 from assemblyline_ui.helper.user import (
-    get_default_user_quotas, get_dynamic_classification, load_user_settings, save_user_account, save_user_settings,
-    API_PRIV_MAP)
+    get_default_user_quotas, get_dynamic_classification, load_user_settings, notify_user_change, save_user_account,
+    save_user_settings, API_PRIV_MAP)
 from assemblyline_ui.http_exceptions import AccessDeniedException, InvalidDataException
+from assemblyline_ui.security.apikey_auth import APIKEY_CACHE
 
 from .federated_lookup import filtered_tag_names
 
@@ -231,7 +233,7 @@ def who_am_i(**kwargs):
         },
         "ui": {
             "ai": {
-                "enabled": AI_AGENT.has_backends()
+                "enabled": has_ai_backends(config)
             },
             "alerting_meta": {
                 "important": config.ui.alerting_meta.important,
@@ -447,6 +449,9 @@ def remove_user_account(username, **_):
         favorites_deleted = STORAGE.user_favorites.delete(username)
         settings_deleted = STORAGE.user_settings.delete(username)
 
+        APIKEY_CACHE.invalidate(username)
+        notify_user_change(username)
+
         if not user_deleted or not avatar_deleted or not favorites_deleted or not settings_deleted:
             return make_api_response({"success": False})
 
@@ -529,6 +534,7 @@ def set_user_account(username, **kwargs):
             except Exception as e:
                 # We can't send confirmation email, Rollback user change and mark this a failure
                 STORAGE.user.save(username, get_default_user_quotas(old_user))
+                notify_user_change(username)
                 LOGGER.error(f"An error occured while sending confirmation emails: {str(e)}")
                 return make_api_response({"success": False}, "The system was unable to send confirmation emails. "
                                                              "Retry again later...", 404)
@@ -1052,6 +1058,9 @@ def agree_with_tos(username, **kwargs):
                                                              "to the administrators. Retry again later...", 400)
 
         STORAGE.user.save(username, user)
+        notify_user_change(username)
+        if config.ui.tos_lockout:
+            APIKEY_CACHE.invalidate(username)
 
         return make_api_response({"success": True})
 
@@ -11,6 +11,7 @@ from flask import session, request
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import make_api_response, api_login, make_subapi_blueprint
 from assemblyline_ui.config import STORAGE, config
+from assemblyline_ui.helper.user import notify_user_change
 
 SUB_API = 'webauthn'
 webauthn_api = make_subapi_blueprint(SUB_API, api_version=4)
@@ -130,7 +131,9 @@ def register_complete(name, **kwargs):
     security_tokens[name] = websafe_encode(auth_data.credential_data)
     user['security_tokens'] = security_tokens
 
-    return make_api_response({"success": STORAGE.user.save(uname, user)})
+    ret_val = STORAGE.user.save(uname, user)
+    notify_user_change(uname)
+    return make_api_response({"success": ret_val})
 
 
 @webauthn_api.route("/remove/<name>/", methods=["GET"])
@@ -161,4 +164,6 @@ def remove(name, **kwargs):
     security_tokens.pop(name, None)
     user['security_tokens'] = security_tokens
 
-    return make_api_response({'success': STORAGE.user.save(uname, user)})
+    ret_val = STORAGE.user.save(uname, user)
+    notify_user_change(uname)
+    return make_api_response({'success': ret_val})
@@ -6,7 +6,7 @@ from assemblyline.common.uid import get_random_id
 from assemblyline.odm.models.user import ROLES
 from assemblyline_ui.api.base import api_login, make_api_response, make_subapi_blueprint
 from assemblyline_ui.config import STORAGE, CLASSIFICATION, config
-from assemblyline.odm.models.alert import Event
+from assemblyline_ui.helper.workflow import get_run_status, queue_run, reset_high_water_mark
 from assemblyline.odm.models.workflow import Workflow
 
 SUB_API = 'workflow'
@@ -14,32 +14,6 @@ workflow_api = make_subapi_blueprint(SUB_API, api_version=4)
 workflow_api._doc = "Manage the different workflows of the system"
 
 
-def get_alert_update_ops(workflow: Workflow):
-    operations = []
-    if workflow.status:
-        operations.append((STORAGE.alert.UPDATE_SET, 'status', workflow.status))
-    if workflow.priority:
-        operations.append((STORAGE.alert.UPDATE_SET, 'priority', workflow.priority))
-    for label in workflow.labels:
-        operations.append((STORAGE.alert.UPDATE_APPEND_IF_MISSING, 'label', label))
-
-    if operations:
-        # Make sure operations get audited
-        operations.append((STORAGE.alert.UPDATE_APPEND,
-                           'events',
-                           Event({
-                               "entity_type": "workflow",
-                               "entity_id": workflow.workflow_id,
-                               "entity_name": workflow.name,
-                               "priority": workflow.priority,
-                               "status": workflow.status,
-                               "labels": workflow.labels or None,
-                           })
-                           ))
-
-    return operations
-
-
 # noinspection PyBroadException
 def verify_query(query):
     """Ensure that a workflow query can be executed."""
@@ -60,7 +34,7 @@ def add_workflow(**kwargs):
     None
 
     Arguments:
-    run_workflow      => Run workflow immediately on past alerts
+    run_workflow      => Run workflow on past alerts in the background
 
     Data Block:
     {
@@ -74,7 +48,9 @@ def add_workflow(**kwargs):
 
     Result example:
     {
-     "success": true             # Saving the user info succeded
+     "success": true,            # Saving the user info succeded
+     "workflow_id": "1234...",   # ID of the new workflow
+     "run_id": "5678..."         # ID of the run on past alerts, if requested
     }
     """
 
@@ -107,13 +83,13 @@ def add_workflow(**kwargs):
 
     success = STORAGE.workflow.save(workflow_data.workflow_id, workflow_data)
 
+    output = {"success": success, "workflow_id": workflow_data.workflow_id}
     run_workflow = request.args.get('run_workflow', 'false').lower() == 'true'
     if success and run_workflow:
-        # Process workflow against all alerts in the system matching the query
-        STORAGE.alert.update_by_query(query=workflow_data.query, operations=get_alert_update_ops(workflow_data))
+        # Backfill the workflow on all alerts in the system matching the query
+        output['run_id'] = queue_run([workflow_data.as_primitives()], kwargs['user']['uname'], full=True)['run_id']
 
-    return make_api_response({"success": success,
-                              "workflow_id": workflow_data.workflow_id})
+    return make_api_response(output)
 
 
 @workflow_api.route("/<workflow_id>/", methods=["POST"])
@@ -154,8 +130,11 @@ def edit_workflow(workflow_id, **kwargs):
         return make_api_response({"success": False}, err="Query contains an error", status_code=400)
 
     wf = STORAGE.workflow.get(workflow_id, as_obj=False)
+    changed = False
     if wf:
         uname = kwargs['user']['uname']
+        changed = any(wf.get(field, None) != data.get(field, wf.get(field, None))
+                      for field in ['query', 'labels', 'priority', 'status'])
         wf.update(data)
         wf.update({
             "edited_by": uname,
@@ -165,6 +144,10 @@ def edit_workflow(workflow_id, **kwargs):
 
     success = STORAGE.workflow.save(workflow_id, wf)
     if success:
+        if changed:
+            # Reset once saved so a run can't load the old workflow after the reset. Its next run has to process
+            # the past alerts again.
+            reset_high_water_mark(workflow_id)
         return make_api_response({"success": success})
     else:
         return make_api_response({"success": False},
@@ -287,6 +270,7 @@ def remove_workflow(workflow_id, **_):
     """
     wf = STORAGE.workflow.get(workflow_id)
     if wf:
+        reset_high_water_mark(workflow_id)
         return make_api_response({"success": STORAGE.workflow.delete(workflow_id)})
     else:
         return make_api_response({"success": False},
@@ -296,30 +280,72 @@ def remove_workflow(workflow_id, **_):
 
 @workflow_api.route("/<workflow_id>/run", methods=["GET"])
 @api_login(audit=False, allow_readonly=False, require_role=[ROLES.workflow_manage])
-def run_workflow(workflow_id, **_):
+def run_workflow(workflow_id, **kwargs):
     """
-    Run the specified workflow against all existing alerts that match the query
+    Run the specified workflow in the background against the alerts matching its query that it did not process yet
 
     Variables:
     workflow_id       => ID of the workflow to run
 
     Arguments:
-    None
+    full              => Process all the alerts again instead of the new ones
 
     Data Block:
     None
 
     Result example:
     {
-     "success": true  # Was the run successful?
+     "success": true,      # Was the run queued?
+     "run_id": "1234..."   # ID of the run to follow its progress
     }
     """
-    wf = STORAGE.workflow.get(workflow_id)
+    full = request.args.get('full', 'false').lower() in ['true', '']
+
+    wf = STORAGE.workflow.get(workflow_id, as_obj=False)
     if wf:
-        # Process workflow against all alerts in the system matching the query
-        ret_value = STORAGE.alert.update_by_query(query=wf['query'], operations=get_alert_update_ops(wf))
-        return make_api_response({"success": ret_value is not False})
+        status = queue_run([wf], kwargs['user']['uname'], full=full)
+        return make_api_response({"success": True, "run_id": status['run_id']})
     else:
         return make_api_response({"success": False},
                                  err="Workflow ID %s does not exist" % workflow_id,
                                  status_code=404)
+
+
+@workflow_api.route("/run/<run_id>/", methods=["GET"])
+@api_login(audit=False, allow_readonly=False, require_role=[ROLES.workflow_view])
+def get_workflow_run(run_id, **kwargs):
+    """
+    Get the progress of a workflow run. Progress updates are also sent to the workflow_runs socket.io namespace.
+
+    Variables:
+    run_id            => ID of the workflow run
+
+    Arguments:
+    None
+
+    Data Block:
+    None
+
+    Result example:
+    {
+     "run_id": "1234...",                          # ID of the run
+     "workflow_ids": ["5678..."],                  # Workflows applied by the run
+     "status": "running",                          # queued, running, completed or failed
+     "start_ts": "2024-01-01T00:00:00.000000Z",    # Reporting time of the first alert processed
+     "end_ts": "2024-01-02T00:00:00.000000Z",      # Reporting time of the last alert processed
+     "current_ts": "2024-01-01T12:00:00.000000Z",  # Alerts reported up to that time are processed
+     "progress": 0.5,                              # Processed fraction of the time range
+     "slices": 12,                                 # Number of slices of alerts processed
+     "updated": 12345,                             # Number of alerts updated
+     "errors": [],                                 # Workflows that could not be applied
+     ...
+    }
+    """
+    status = get_run_status(run_id)
+    if not status:
+        return make_api_response({}, err="Workflow run %s does not exist" % run_id, status_code=404)
+
+    if not CLASSIFICATION.is_accessible(kwargs['user']['classification'], status['classification']):
+        return make_api_response({}, err="You're not allowed to view workflow run: %s" % run_id, status_code=403)
+
+    return make_api_response(status)
@@ -39,6 +39,7 @@ from assemblyline_ui.api.v4.webauthn import webauthn_api
 from assemblyline_ui.api.v4.workflow import workflow_api
 from assemblyline_ui.error import errors
 from assemblyline_ui.healthz import healthz
+from assemblyline_ui.helper.ai import has_ai_backends
 
 from assemblyline_ui import config
 
@@ -96,7 +97,7 @@ app.register_blueprint(apiv4)
 app.register_blueprint(alert_api)
 if config.config.datastore.archive.enabled:
     app.register_blueprint(archive_api)
-if config.AI_AGENT.has_backends():
+if has_ai_backends(config.config):
     app.register_blueprint(assistant_api)
 app.register_blueprint(auth_api)
 app.register_blueprint(badlist_api)
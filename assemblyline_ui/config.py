@@ -21,6 +21,10 @@ from assemblyline.remote.datatypes.user_quota_tracker import UserQuotaTracker
 from assemblyline_ui.helper.ai import get_ai_agent
 from assemblyline_ui.helper.ai.base import AIAgentPool
 from assemblyline_ui.helper.discover import get_apps_list
+from assemblyline_ui.helper.external_lookup import ExternalLookupCache
+from assemblyline_ui.helper.fanout import FanOutEngine
+from assemblyline_ui.helper.lazy import LazyObject
+from assemblyline_ui.helper.quota import APIQuotaTracker
 
 config = forge.get_config()
 
@@ -45,6 +49,29 @@ VERSION = os.environ.get('ASSEMBLYLINE_VERSION', f"{FRAMEWORK_VERSION}.{SYSTEM_V
 
 BUNDLING_DIR = "/var/lib/assemblyline/bundling"
 
+SEARCH_STREAM_MAX_ROWS = int(os.environ.get('SEARCH_STREAM_MAX_ROWS', 1000000))
+# Similarity indexes live in the memory of every worker, about 4.5KB per indexed hash, and are not built for
+# collections larger than this, except for the file collection where only the most recently seen files are indexed.
+# Set to 0 to always search similar hashes in the datastore.
+SIMILARITY_INDEX_MAX_ITEMS = int(os.environ.get('SIMILARITY_INDEX_MAX_ITEMS', 20000))
+# External lookups cache TTLs in seconds, per source TTLs are given as: source_name=ttl,other_source=ttl
+EXTERNAL_LOOKUP_CACHE_TTL = int(os.environ.get('EXTERNAL_LOOKUP_CACHE_TTL', 15 * 60))
+EXTERNAL_LOOKUP_NOT_FOUND_TTL = int(os.environ.get('EXTERNAL_LOOKUP_NOT_FOUND_TTL', 5 * 60))
+EXTERNAL_LOOKUP_SOURCE_TTLS = {
+    name.strip(): int(ttl) for name, ttl in
+    (item.split('=', 1) for item in os.environ.get('EXTERNAL_LOOKUP_SOURCE_TTLS', '').split(',') if '=' in item)
+}
+# Lookups fan out to the sources on a thread pool shared by the requests of a worker
+LOOKUP_MAX_WORKERS = int(os.environ.get('LOOKUP_MAX_WORKERS', 32))
+LOOKUP_SOURCE_CONCURRENCY = int(os.environ.get('LOOKUP_SOURCE_CONCURRENCY', 8))
+# AI requests are also sent to the next backend when the first one did not start answering after the hedge delay
+AI_HEDGE_DELAY = float(os.environ.get('AI_HEDGE_DELAY', 10))
+AI_TIMEOUT = float(os.environ.get('AI_TIMEOUT', 120))
+AI_REQUEST_TIMEOUT = float(os.environ.get('AI_REQUEST_TIMEOUT', 60))
+# Ontology exports download the supplementary files of the results concurrently
+ONTOLOGY_EXPORT_MAX_WORKERS = int(os.environ.get('ONTOLOGY_EXPORT_MAX_WORKERS', 16))
+ONTOLOGY_EXPORT_MAX_SUBMISSIONS = int(os.environ.get('ONTOLOGY_EXPORT_MAX_SUBMISSIONS', 10000))
+
 TEMP_DIR = "/var/lib/assemblyline/flowjs/"
 TEMP_SUBMIT_DIR = "/var/lib/assemblyline/submit/"
 
@@ -70,6 +97,7 @@ ASYNC_SUBMISSION_TRACKER = UserQuotaTracker('async_submissions', timeout=24 * 60
 SUBMISSION_TRACKER = UserQuotaTracker('submissions', timeout=60 * 60,  # 60 minutes timeout
                                       redis=redis_persistent)
 DAILY_QUOTA_TRACKER = DailyQuotaTracker(redis=redis_persistent)
+API_QUOTA_TRACKER = APIQuotaTracker(QUOTA_TRACKER, DAILY_QUOTA_TRACKER)
 
 # UI queues
 KV_SESSION = Hash("flask_sessions", host=redis)
@@ -164,11 +192,19 @@ else:
     ARCHIVESTORE = None
 STORAGE: AssemblylineDatastore = forge.get_datastore(config=config, archive_access=True)
 CACHE: Cache = Cache(prefix="flask_cache", host=redis, ttl=24 * 60 * 60)
-AI_AGENT: AIAgentPool = get_ai_agent(config, LOGGER, STORAGE, CLASSIFICATION)
+EXTERNAL_LOOKUP_CACHE = ExternalLookupCache(
+    Cache(prefix="external_lookup", host=redis), Hash("external_lookup_stats", host=redis),
+    ttl=EXTERNAL_LOOKUP_CACHE_TTL, not_found_ttl=EXTERNAL_LOOKUP_NOT_FOUND_TTL, source_ttls=EXTERNAL_LOOKUP_SOURCE_TTLS)
+LOOKUP_ENGINE = FanOutEngine(max_workers=LOOKUP_MAX_WORKERS, source_concurrency=LOOKUP_SOURCE_CONCURRENCY)
+# The AI prompts, identify's rules and the archive manager are only loaded by the first request using them
+AI_AGENT: AIAgentPool = LazyObject(
+    "AI_AGENT", get_ai_agent, args=[config, LOGGER, STORAGE, CLASSIFICATION],
+    kwargs=dict(hedge_delay=AI_HEDGE_DELAY, timeout=AI_TIMEOUT, request_timeout=AI_REQUEST_TIMEOUT))
 metadata_validator = MetadataValidator(STORAGE)
-IDENTIFY: Identify = forge.get_identify(config=config, datastore=STORAGE, use_cache=True)
-ARCHIVE_MANAGER: ArchiveManager = ArchiveManager(
-    config=config, datastore=STORAGE, filestore=FILESTORE, identify=IDENTIFY)
+IDENTIFY: Identify = LazyObject("IDENTIFY", forge.get_identify,
+                                kwargs=dict(config=config, datastore=STORAGE, use_cache=True))
+ARCHIVE_MANAGER: ArchiveManager = LazyObject("ARCHIVE_MANAGER", ArchiveManager, kwargs=dict(
+    config=config, datastore=STORAGE, filestore=FILESTORE, identify=IDENTIFY))
 SERVICE_LIST = forge.CachedObject(STORAGE.list_all_services, kwargs=dict(as_obj=False, full=True))
 # End global
 #################################################################
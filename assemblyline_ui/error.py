@@ -5,10 +5,11 @@ from traceback import format_tb
 from werkzeug.exceptions import Forbidden, Unauthorized, BadRequest, NotFound
 
 from assemblyline_ui.api.base import make_api_response
-from assemblyline_ui.config import AUDIT, AUDIT_LOG, LOGGER, config, KV_SESSION
+from assemblyline_ui.config import AUDIT, AUDIT_LOG, LOGGER, config
 from assemblyline_ui.http_exceptions import AccessDeniedException, AuthenticationException, \
     InvalidDataException, NotFoundException
 from assemblyline_ui.logger import log_with_traceback
+from assemblyline_ui.security.authenticator import SESSION_STORE
 
 errors = Blueprint("errors", __name__)
 
@@ -40,7 +41,7 @@ def handle_401(e):
     }
     session_id = flsk_session.get('session_id', None)
     if session_id:
-        KV_SESSION.pop(session_id)
+        SESSION_STORE.drop(session_id)
     flsk_session.clear()
     res = make_api_response(data, msg, 401)
     res.set_cookie('XSRF-TOKEN', '', max_age=0)
@@ -60,7 +61,7 @@ def handle_403(e):
         ip = request.remote_addr
         session_id = flsk_session.get("session_id", None)
         if session_id:
-            session = KV_SESSION.get(session_id)
+            session = SESSION_STORE.get(session_id)
             if session:
                 uname = session.get("username", uname)
                 ip = session.get("ip", ip)
@@ -5,7 +5,7 @@ from assemblyline_ui.helper.ai.cohere import CohereAgent
 from assemblyline_ui.helper.ai.openai import OpenAIAgent
 
 
-def get_ai_agent(config: Config, logger: Logger, ds, classification):
+def get_ai_agent(config: Config, logger: Logger, ds, classification, **pool_options):
     backends = []
     if config.ui.ai.enabled:
         # Deprecation warning
@@ -18,7 +18,13 @@ def get_ai_agent(config: Config, logger: Logger, ds, classification):
         for api_connection in config.ui.ai_backends.api_connections:
             backends.append(_init_ai_agent(api_connection, config.ui.ai_backends.function_params, logger=logger))
 
-    return AIAgentPool(config, api_backends=backends, logger=logger, ds=ds, classification=classification)
+    return AIAgentPool(config, api_backends=backends, logger=logger, ds=ds, classification=classification,
+                       **pool_options)
+
+
+def has_ai_backends(config: Config) -> bool:
+    """Tell if any AI backend is configured without loading the AI agent"""
+    return config.ui.ai.enabled or (config.ui.ai_backends.enabled and len(config.ui.ai_backends.api_connections) != 0)
 
 
 def _init_ai_agent(config: AIConnection, function_params: AIFunctionParameters, logger):
@@ -1,8 +1,36 @@
+import concurrent.futures
+import copy
+import queue
+import threading
+import time
+
 from typing import List
 from assemblyline.common import forge
 from assemblyline.common.log import PrintLogger
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
 from assemblyline.odm.models.config import AIFunctionParameters, Config, AIConnection
 from assemblyline.odm.models.service import Service
+from assemblyline_ui.helper.fanout import CLOSED, HALF_OPEN, CircuitBreaker
+
+# Time in seconds a backend has to start answering before the request is also sent to the next healthiest backend,
+# backends that are usually slower are given HEDGE_LATENCY_FACTOR times their usual latency instead
+HEDGE_DELAY = 10
+HEDGE_LATENCY_FACTOR = 2
+# Maximum time in seconds the pool waits for an answer, streamed answers only have to start within that time
+POOL_TIMEOUT = 120
+# Maximum time in seconds a backend can stay silent while answering
+REQUEST_TIMEOUT = 60
+MAX_WORKERS = 32
+# Number of consecutive failures of a backend before it stops being queried for a while
+FAILURE_THRESHOLD = 3
+COOLDOWN = 60
+# Weight of the latest call in the health score and latency averages of a backend
+HEALTH_DECAY = 0.2
+
+# Types of the events of a streamed answer
+TOKEN = "token"
+DONE = "done"
+ERROR = "error"
 
 
 class APIException(Exception):
@@ -29,20 +57,33 @@ class AIAgent():
         self.indices_prompt = ""
         self.definition_prompt = ""
         self.extra_context = ""
+        self.timeout = REQUEST_TIMEOUT
 
     def _get_system_message(self, context: str, lang: str):
         return context.replace("$(EXTRA_CONTEXT)", self.extra_context).replace("$(LANG)", lang)
 
-    def continued_ai_conversation(self, messages):
+    def _call_ai_backend(self, data, action, with_trace=False):
+        raise UnimplementedException("Method not implemented yet")
+
+    def _stream_ai_backend(self, data, action, with_trace=False):
+        """Generator of the events of the answer of the backend, tokens as they are received then the result."""
         raise UnimplementedException("Method not implemented yet")
 
-    def detailed_al_submission(self, report, lang="english", with_trace=False):
+    def _send(self, data, action, with_trace=False, stream=False):
+        if stream:
+            return self._stream_ai_backend(data, action, with_trace=with_trace)
+        return self._call_ai_backend(data, action, with_trace=with_trace)
+
+    def continued_ai_conversation(self, messages, lang="english", stream=False):
         raise UnimplementedException("Method not implemented yet")
 
-    def summarized_al_submission(self, report, lang="english", with_trace=False):
+    def detailed_al_submission(self, report, lang="english", with_trace=False, stream=False):
         raise UnimplementedException("Method not implemented yet")
 
-    def summarize_code_snippet(self, code, lang="english", with_trace=False):
+    def summarized_al_submission(self, report, lang="english", with_trace=False, stream=False):
+        raise UnimplementedException("Method not implemented yet")
+
+    def summarize_code_snippet(self, code, lang="english", with_trace=False, stream=False):
         raise UnimplementedException("Method not implemented yet")
 
     def set_system_prompts(self, system_prompt, scoring_prompt, classification_prompt,
@@ -55,9 +96,71 @@ class AIAgent():
         self.definition_prompt = definition_prompt
 
 
+def result_events(result):
+    """Events of a streamed answer replaying an answer that was already received"""
+    if 'trace' in result:
+        content = result['trace'][-1]['content'] if result['trace'] else ""
+    else:
+        content = result['content']
+    return [{"type": TOKEN, "content": content}, {"type": DONE, "result": result}]
+
+
+class _BackendHealth(object):
+    def __init__(self, threshold: int, cooldown: int):
+        self.breaker = CircuitBreaker(threshold, cooldown)
+        # Moving average of the success of the calls, from 0 (always failing) to 1 (always answering)
+        self.score = 1.0
+        self.latency = None
+        self.first_token = None
+        self.calls = 0
+        self.failures = 0
+        self.hedged = 0
+
+    @staticmethod
+    def _average(current, value):
+        if current is None:
+            return value
+        return current + HEALTH_DECAY * (value - current)
+
+    def record_success(self, latency: float, first_token: float = None):
+        self.calls += 1
+        self.score = self._average(self.score, 1.0)
+        if first_token is None:
+            self.latency = self._average(self.latency, latency)
+        else:
+            self.first_token = self._average(self.first_token, first_token)
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.calls += 1
+        self.failures += 1
+        self.score = self._average(self.score, 0.0)
+        self.breaker.record_failure()
+
+    def as_dict(self):
+        return {
+            "score": self.score,
+            "latency": self.latency,
+            "first_token": self.first_token,
+            "calls": self.calls,
+            "failures": self.failures,
+            "hedged": self.hedged,
+            "circuit": self.breaker.state,
+        }
+
+
 class AIAgentPool():
+    """Send the AI requests to the healthiest of the configured backends.
+
+    A request still waiting for its answer after the hedge delay is also sent to the next backend and the first
+    answer wins. Backends failing too many times in a row are skipped until their cooldown is over.
+    """
+
     def __init__(self, config: Config, api_backends: List[AIAgent] = [],
-                 logger=None, ds=None, classification=None) -> None:
+                 logger=None, ds=None, classification=None, hedge_delay: float = HEDGE_DELAY,
+                 timeout: float = POOL_TIMEOUT, request_timeout: float = REQUEST_TIMEOUT,
+                 max_workers: int = MAX_WORKERS, failure_threshold: int = FAILURE_THRESHOLD,
+                 cooldown: int = COOLDOWN) -> None:
         # Load pool dependencies
         self.logger = logger or PrintLogger()
         self.config = config
@@ -83,65 +186,228 @@ class AIAgentPool():
 
         # Load backends
         self.api_backends: List[AIAgent] = api_backends
+        for backend in api_backends:
+            backend.timeout = request_timeout
+        self.health = [_BackendHealth(failure_threshold, cooldown) for _ in api_backends]
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
 
     def has_backends(self):
         return len(self.api_backends) != 0
 
-    def continued_ai_conversation(self, messages, lang="english"):
-        last_error = None
-        for backend in self.api_backends:
-            try:
-                return backend.continued_ai_conversation(messages=messages, lang=lang)
-            except APIException as e:
-                last_error = e
-                pass
-
-        if last_error:
-            raise last_error
-
-        raise EmptyAIResponse("Could not find any AI backend to answer the question")
-
-    def detailed_al_submission(self, report, lang="english", with_trace=False):
+    def continued_ai_conversation(self, messages, lang="english", stream=False):
+        return self._dispatch("continued_ai_conversation", stream, messages, lang=lang)
+
+    def detailed_al_submission(self, report, lang="english", with_trace=False, stream=False):
+        return self._dispatch("detailed_al_submission", stream, report, lang=lang, with_trace=with_trace)
+
+    def summarized_al_submission(self, report, lang="english", with_trace=False, stream=False):
+        return self._dispatch("summarized_al_submission", stream, report, lang=lang, with_trace=with_trace)
+
+    def summarize_code_snippet(self, code, lang="english", with_trace=False, stream=False):
+        return self._dispatch("summarize_code_snippet", stream, code, lang=lang, with_trace=with_trace)
+
+    def get_health(self):
+        return [dict(name=backend.config.model_name, **health.as_dict())
+                for backend, health in zip(self.api_backends, self.health)]
+
+    def _dispatch(self, method, stream, *args, **kwargs):
+        if stream:
+            return self._stream(method, *args, **kwargs)
+        return self._query(method, *args, **kwargs)
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = APMAwareThreadPoolExecutor(self.max_workers)
+            return self.executor
+
+    def _candidates(self):
+        """Index of the backends that can be queried, healthiest first then in the configured order"""
+        states = {CLOSED: 0, HALF_OPEN: 1}
+        candidates = [(states[health.breaker.state], -health.score, idx)
+                      for idx, health in enumerate(self.health) if health.breaker.state in states]
+        return [idx for _, _, idx in sorted(candidates)]
+
+    def _hedge_delay(self, idx, first_token=False):
+        latency = self.health[idx].first_token if first_token else self.health[idx].latency
+        if latency is None:
+            return self.hedge_delay
+        return max(self.hedge_delay, latency * HEDGE_LATENCY_FACTOR)
+
+    def _start(self, candidates, func, *args):
+        """Start the request on the next backend whose circuit breaker lets it through"""
+        while candidates:
+            idx = candidates.pop(0)
+            if self.health[idx].breaker.allow():
+                return idx, self._get_executor().submit(func, idx, *args)
+        return None, None
+
+    def _attempt(self, idx, method, args, kwargs):
+        health = self.health[idx]
+        start = time.monotonic()
+        try:
+            result = getattr(self.api_backends[idx], method)(*args, **kwargs)
+        except Exception:
+            health.record_failure()
+            raise
+        health.record_success(time.monotonic() - start)
+        return result
+
+    def _query(self, method, *args, **kwargs):
+        if not self.api_backends:
+            raise EmptyAIResponse("Could not find any AI backend to answer the question")
+
+        candidates = self._candidates()
+        deadline = time.monotonic() + self.timeout
+        next_hedge = 0
+        futures = {}
         last_error = None
-        for backend in self.api_backends:
-            try:
-                return backend.detailed_al_submission(report, lang=lang, with_trace=with_trace)
-            except APIException as e:
-                last_error = e
-                pass
+        while True:
+            now = time.monotonic()
+            if candidates and now >= next_hedge:
+                # Each backend gets its own copy of the request since they can modify it
+                idx, future = self._start(candidates, self._attempt, method, copy.deepcopy(args),
+                                          copy.deepcopy(kwargs))
+                if future is not None:
+                    if futures:
+                        self.health[idx].hedged += 1
+                    futures[future] = idx
+                    next_hedge = now + self._hedge_delay(idx)
+                continue
+
+            if not futures or now >= deadline:
+                break
+
+            wait_until = min(deadline, next_hedge) if candidates else deadline
+            done, _ = concurrent.futures.wait(futures, timeout=max(0.0, wait_until - now),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                idx = futures.pop(future)
+                try:
+                    return future.result()
+                except (APIException, EmptyAIResponse) as e:
+                    last_error = e
+                    # Fail over to the next backend right away
+                    next_hedge = 0
+
+        if futures:
+            raise APIException(f"The AI backends did not answer within {self.timeout} seconds")
 
         if last_error:
             raise last_error
 
-        raise EmptyAIResponse("Could not find any AI backend to answer the question")
+        raise APIException("All AI backends are temporarily unavailable after too many failures")
 
-    def summarized_al_submission(self, report, lang="english", with_trace=False):
-        last_error = None
-        for backend in self.api_backends:
+    def _stream_attempt(self, idx, method, args, kwargs, events: queue.Queue, cancelled: threading.Event):
+        health = self.health[idx]
+        start = time.monotonic()
+        first_token = None
+        try:
+            answer = getattr(self.api_backends[idx], method)(*args, stream=True, **kwargs)
             try:
-                return backend.summarized_al_submission(report, lang=lang, with_trace=with_trace)
-            except APIException as e:
-                last_error = e
-                pass
-
-        if last_error:
-            raise last_error
-
-        raise EmptyAIResponse("Could not find any AI backend to answer the question")
-
-    def summarize_code_snippet(self, code, lang="english", with_trace=False):
+                for event in answer:
+                    if cancelled.is_set():
+                        break
+                    if first_token is None:
+                        first_token = time.monotonic() - start
+                    events.put((idx, event))
+            finally:
+                answer.close()
+        except Exception as e:
+            health.record_failure()
+            events.put((idx, {"type": ERROR, "error": e}))
+            return
+
+        if first_token is None:
+            # Cancelled before it answered, this says nothing about the backend's health
+            health.breaker.release_trial()
+        else:
+            health.record_success(time.monotonic() - start, first_token=first_token)
+
+    def _stream(self, method, *args, **kwargs):
+        """Generator of the events of the answer of the first backend to start answering.
+
+        Once a backend sent its first token, the others are cancelled and there is no more failover. Errors of the
+        chosen backend are raised while streaming.
+        """
+        if not self.api_backends:
+            raise EmptyAIResponse("Could not find any AI backend to answer the question")
+
+        candidates = self._candidates()
+        deadline = time.monotonic() + self.timeout
+        next_hedge = 0
+        events = queue.Queue()
+        running = {}
+        winner = None
         last_error = None
-        for backend in self.api_backends:
-            try:
-                return backend.summarize_code_snippet(code, lang=lang, with_trace=with_trace)
-            except APIException as e:
-                last_error = e
-                pass
+        try:
+            while True:
+                now = time.monotonic()
+                if winner is None and candidates and now >= next_hedge:
+                    cancelled = threading.Event()
+                    idx, future = self._start(candidates, self._stream_attempt, method, copy.deepcopy(args),
+                                              copy.deepcopy(kwargs), events, cancelled)
+                    if future is not None:
+                        if running:
+                            self.health[idx].hedged += 1
+                        running[idx] = cancelled
+                        next_hedge = now + self._hedge_delay(idx, first_token=True)
+                    continue
+
+                if not running or (winner is None and now >= deadline):
+                    break
+
+                if winner is not None:
+                    wait_until = now + self.api_backends[winner].timeout
+                elif candidates:
+                    wait_until = min(deadline, next_hedge)
+                else:
+                    wait_until = deadline
+                try:
+                    idx, event = events.get(timeout=max(0.0, wait_until - now))
+                except queue.Empty:
+                    if winner is not None:
+                        raise APIException("The AI backend stopped answering")
+                    continue
+
+                if event["type"] == ERROR:
+                    running.pop(idx, None)
+                    if idx == winner:
+                        raise event["error"]
+                    if not isinstance(event["error"], (APIException, EmptyAIResponse)):
+                        self.logger.warning(f"Unexpected error from AI backend: {event['error']}")
+                    last_error = event["error"]
+                    # Fail over to the next backend right away
+                    next_hedge = 0
+                    continue
+
+                if winner is None:
+                    winner = idx
+                    for other, cancelled in running.items():
+                        if other != winner:
+                            cancelled.set()
+
+                if idx != winner:
+                    continue
+
+                yield event
+                if event["type"] == DONE:
+                    return
+        finally:
+            for cancelled in running.values():
+                cancelled.set()
+
+        if running:
+            raise APIException(f"The AI backends did not start answering within {self.timeout} seconds")
 
         if last_error:
             raise last_error
 
-        raise EmptyAIResponse("Could not find any AI backend to answer the question")
+        raise APIException("All AI backends are temporarily unavailable after too many failures")
 
     def _build_scoring_prompt(self):
         scoring = f"""Assemblyline uses a scoring mechanism where any scores below
@@ -1,6 +1,7 @@
 from assemblyline.common.str_utils import safe_str
 from assemblyline.odm.models.config import AIFunctionParameters, AIConnection
-from assemblyline_ui.helper.ai.base import AIAgent, APIException
+from assemblyline_ui.helper.ai.base import DONE, TOKEN, AIAgent, APIException, EmptyAIResponse
+import json
 import requests
 import yaml
 
@@ -33,10 +34,10 @@ class CohereAgent(AIAgent):
                              "Please do NOT use any information you know about Assemblyline unless it is " \
                              "provided to you."
 
-    def _call_ai_backend(self, data, action, with_trace=False):
+    def _post(self, data, action, stream=False):
         try:
             # Call API
-            resp = self.session.post(self.config.chat_url, json=data)
+            resp = self.session.post(self.config.chat_url, json=data, stream=stream, timeout=self.timeout)
         except Exception as e:
             message = f"An exception occured while trying to {action} with AI on " \
                       f"server {self.config.chat_url} with model {self.config.model_name}. [{e}]"
@@ -51,8 +52,9 @@ class CohereAgent(AIAgent):
             self.logger.warning(message)
             raise APIException(message)
 
-        # Get AI response
-        response_data = resp.json()
+        return resp
+
+    def _format_response(self, data, response_data, action, with_trace=False):
         content = response_data['text']
         reason = response_data['finish_reason']
 
@@ -71,6 +73,30 @@ class CohereAgent(AIAgent):
             return {'trace': trace, 'truncated': reason == 'MAX_TOKENS'}
         return {'content': content, 'truncated': reason == 'MAX_TOKENS'}
 
+    def _call_ai_backend(self, data, action, with_trace=False):
+        # Get AI response
+        return self._format_response(data, self._post(data, action).json(), action, with_trace=with_trace)
+
+    def _stream_ai_backend(self, data, action, with_trace=False):
+        response_data = None
+        with self._post(data, action, stream=True) as resp:
+            # One JSON event per line, the last one holds the complete response
+            for line in resp.iter_lines():
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event.get('event_type', None) == 'text-generation':
+                    yield {"type": TOKEN, "content": event['text']}
+                elif event.get('event_type', None) == 'stream-end':
+                    response_data = event['response']
+                    response_data['finish_reason'] = event.get('finish_reason', response_data.get('finish_reason'))
+                    break
+
+        if response_data is None:
+            raise EmptyAIResponse("There was no response returned by the AI")
+
+        yield {"type": DONE, "result": self._format_response(data, response_data, action, with_trace=with_trace)}
+
     def _openai_to_cohere_messages(self, messages: list):
         preamble = None
         message = None
@@ -83,7 +109,7 @@ class CohereAgent(AIAgent):
 
         return preamble, history, message
 
-    def continued_ai_conversation(self, messages, lang="english"):
+    def continued_ai_conversation(self, messages, lang="english", stream=False):
         # Get current values from openai message format
         preamble, history, message = self._openai_to_cohere_messages(messages)
         default_assistant_preamble = self._get_system_message(self.params.assistant.system_message, lang)
@@ -95,7 +121,7 @@ class CohereAgent(AIAgent):
             "message": message or "Hello!",
             "chat_history": history,
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
 
         if not preamble or preamble == default_assistant_preamble:
@@ -103,9 +129,9 @@ class CohereAgent(AIAgent):
 
         data.update(self.params.assistant.options)
 
-        return self._call_ai_backend(data, "answer the question", with_trace=True)
+        return self._send(data, "answer the question", with_trace=True, stream=stream)
 
-    def detailed_al_submission(self, report, lang="english", with_trace=False):
+    def detailed_al_submission(self, report, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         preamble = self._get_system_message(self.params.detailed_report.system_message, lang)
         content = [self.params.detailed_report.task, "## Assemblyline Report\n", f"```yaml\n{yaml.dump(report)}\n```"]
@@ -114,13 +140,13 @@ class CohereAgent(AIAgent):
             "preamble": preamble,
             "message": "\n".join(content),
             "model": self.config.model_name,
-            "stream": False,
+            "stream": stream,
         }
         data.update(self.params.detailed_report.options)
 
-        return self._call_ai_backend(data, "create detailed analysis of the AL report", with_trace=with_trace)
+        return self._send(data, "create detailed analysis of the AL report", with_trace=with_trace, stream=stream)
 
-    def summarized_al_submission(self, report, lang="english", with_trace=False):
+    def summarized_al_submission(self, report, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         preamble = self._get_system_message(self.params.executive_summary.system_message, lang)
         content = [self.params.executive_summary.task, "## Assemblyline Report\n", f"```yaml\n{yaml.dump(report)}\n```"]
@@ -129,13 +155,13 @@ class CohereAgent(AIAgent):
             "preamble": preamble,
             "message": "\n".join(content),
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.executive_summary.options)
 
-        return self._call_ai_backend(data, "summarize the AL report", with_trace=with_trace)
+        return self._send(data, "summarize the AL report", with_trace=with_trace, stream=stream)
 
-    def summarize_code_snippet(self, code, lang="english", with_trace=False):
+    def summarize_code_snippet(self, code, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         preamble = self._get_system_message(self.params.code.system_message, lang)
         content = [self.params.code.task, "## Code snippet\n", f"```\n{safe_str(code)}\n```"]
@@ -144,8 +170,8 @@ class CohereAgent(AIAgent):
             "preamble": preamble,
             "message": "\n".join(content),
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.code.options)
 
-        return self._call_ai_backend(data, "summarize code snippet", with_trace=with_trace)
+        return self._send(data, "summarize code snippet", with_trace=with_trace, stream=stream)
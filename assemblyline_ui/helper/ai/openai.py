@@ -1,6 +1,7 @@
 from assemblyline.common.str_utils import safe_str
 from assemblyline.odm.models.config import AIFunctionParameters, AIConnection
-from assemblyline_ui.helper.ai.base import AIAgent, APIException, EmptyAIResponse
+from assemblyline_ui.helper.ai.base import DONE, TOKEN, AIAgent, APIException, EmptyAIResponse
+import json
 import requests
 import yaml
 
@@ -20,10 +21,10 @@ class OpenAIAgent(AIAgent):
         self.params.executive_summary.options = {
             k: v for k, v in self.params.executive_summary.options.items() if k in ALLOWED_OPTIONS}
 
-    def _call_ai_backend(self, data, action, with_trace=False):
+    def _post(self, data, action, stream=False):
         try:
             # Call API
-            resp = self.session.post(self.config.chat_url, json=data)
+            resp = self.session.post(self.config.chat_url, json=data, stream=stream, timeout=self.timeout)
         except Exception as e:
             message = f"An exception occured while trying to {action} with AI on " \
                       f"server {self.config.chat_url} with model {self.config.model_name}. [{e}]"
@@ -38,20 +39,53 @@ class OpenAIAgent(AIAgent):
             self.logger.warning(message)
             raise APIException(message)
 
+        return resp
+
+    def _format_response(self, data, content, reason, with_trace=False):
+        if with_trace:
+            trace = data['messages']
+            trace.append({'role': 'assistant', 'content': content})
+            return {'trace': trace, 'truncated': reason == 'length'}
+        return {'content': content, 'truncated': reason == 'length'}
+
+    def _call_ai_backend(self, data, action, with_trace=False):
+        resp = self._post(data, action)
+
         # Get AI responses
         responses = resp.json()['choices']
         if responses:
             content = responses[0]['message']['content']
             reason = responses[0]['finish_reason']
-            if with_trace:
-                trace = data['messages']
-                trace.append({'role': 'assistant', 'content': content})
-                return {'trace': trace, 'truncated': reason == 'length'}
-            return {'content': content, 'truncated': reason == 'length'}
+            return self._format_response(data, content, reason, with_trace=with_trace)
 
         raise EmptyAIResponse("There was no response returned by the AI")
 
-    def continued_ai_conversation(self, messages, lang="english"):
+    def _stream_ai_backend(self, data, action, with_trace=False):
+        content = []
+        reason = None
+        with self._post(data, action, stream=True) as resp:
+            # Server-sent events, each holding the next tokens of the first choice
+            for line in resp.iter_lines():
+                line = line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                line = line[5:].strip()
+                if line == "[DONE]":
+                    break
+
+                for choice in json.loads(line).get('choices', [])[:1]:
+                    token = (choice.get('delta', None) or {}).get('content', None)
+                    if token:
+                        content.append(token)
+                        yield {"type": TOKEN, "content": token}
+                    reason = choice.get('finish_reason', None) or reason
+
+        if not content:
+            raise EmptyAIResponse("There was no response returned by the AI")
+
+        yield {"type": DONE, "result": self._format_response(data, "".join(content), reason, with_trace=with_trace)}
+
+    def continued_ai_conversation(self, messages, lang="english", stream=False):
         # If there are no system prompt, use the default one.
         if not messages[0]['content'] and messages[0]['role'] == 'system':
             system_message = self._get_system_message(self.params.assistant.system_message, lang)
@@ -65,13 +99,13 @@ class OpenAIAgent(AIAgent):
             "max_tokens": self.params.assistant.max_tokens,
             "messages": messages,
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.assistant.options)
 
-        return self._call_ai_backend(data, "answer the question", with_trace=True)
+        return self._send(data, "answer the question", with_trace=True, stream=stream)
 
-    def detailed_al_submission(self, report, lang="english", with_trace=False):
+    def detailed_al_submission(self, report, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         system_message = self._get_system_message(self.params.detailed_report.system_message, lang)
         content = [self.params.detailed_report.task, "## Assemblyline Report\n", f"```yaml\n{yaml.dump(report)}\n```"]
@@ -85,13 +119,13 @@ class OpenAIAgent(AIAgent):
                     "content": "\n".join(content)},
             ],
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.detailed_report.options)
 
-        return self._call_ai_backend(data, "create detailed analysis of the AL report", with_trace=with_trace)
+        return self._send(data, "create detailed analysis of the AL report", with_trace=with_trace, stream=stream)
 
-    def summarized_al_submission(self, report, lang="english", with_trace=False):
+    def summarized_al_submission(self, report, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         system_message = self._get_system_message(self.params.executive_summary.system_message, lang)
         content = [self.params.executive_summary.task, "## Assemblyline Report\n", f"```yaml\n{yaml.dump(report)}\n```"]
@@ -104,13 +138,13 @@ class OpenAIAgent(AIAgent):
                 {"role": "user", "content": "\n".join(content)},
             ],
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.executive_summary.options)
 
-        return self._call_ai_backend(data, "summarize the AL report", with_trace=with_trace)
+        return self._send(data, "summarize the AL report", with_trace=with_trace, stream=stream)
 
-    def summarize_code_snippet(self, code, lang="english", with_trace=False):
+    def summarize_code_snippet(self, code, lang="english", with_trace=False, stream=False):
         # Build chat completions request
         system_message = self._get_system_message(self.params.code.system_message, lang)
         content = [self.params.code.task, "## Code snippet\n", f"```\n{safe_str(code)}\n```"]
@@ -122,8 +156,8 @@ class OpenAIAgent(AIAgent):
                 {"role": "user", "content": "\n".join(content)}
             ],
             "model": self.config.model_name,
-            "stream": False
+            "stream": stream
         }
         data.update(self.params.code.options)
 
-        return self._call_ai_backend(data, "summarize code snippet", with_trace=with_trace)
+        return self._send(data, "summarize code snippet", with_trace=with_trace, stream=stream)
@@ -0,0 +1,259 @@
+import base64
+import binascii
+import gzip
+import io
+import json
+import os
+import queue
+import tarfile
+import threading
+import time
+from copy import copy
+
+from cart import is_cart
+
+from assemblyline.common.bundling import AlertNotFound, BundlingException, SubmissionNotFound, BUNDLE_MAGIC, \
+    BUNDLE_TYPE, get_errors, get_file_infos, get_results, recursive_flatten_tree
+from assemblyline.common.isotime import now_as_iso
+from assemblyline_ui.config import CLASSIFICATION as Classification, LOGGER, STORAGE, config
+from assemblyline_ui.helper.download import QueueWriter, StreamAborted, iter_cart_stream, open_file_stream
+
+# Same compression level as `tar czf`, the tarball is compressed again by the CaRT encoding
+BUNDLE_COMPRESSION_LEVEL = 6
+# Size of the blocks of the tarball handed to the CaRT encoder and number of blocks buffered between them
+TAR_BLOCK_SIZE = 64 * 1024
+TAR_QUEUE_SIZE = 16
+# Size of the blocks read from the request body when importing a bundle
+IMPORT_BLOCK_SIZE = 1024 * 1024
+# Characters ignored by the base64 decoder, like base64.b64decode without validation
+NON_BASE64 = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+
+
+def _add_bundle_metadata(document):
+    if 'bundle.source' not in document['metadata']:
+        document['metadata']['bundle.source'] = config.ui.fqdn
+    if 'bundle.created' not in document['metadata']:
+        document['metadata']['bundle.created'] = now_as_iso()
+    if Classification.enforce and 'bundle.classification' not in document['metadata']:
+        document['metadata']['bundle.classification'] = document['classification']
+
+
+def get_bundle_data(sid, use_alert=False, user_classification=None):
+    """Gather the documents saved in the results.json of a bundle and the files that go with it.
+
+    This is the same content create_bundle puts in a bundle, it can't be reused since it writes the bundle to disk as
+    it gathers it. Both share the helpers of assemblyline.common.bundling and the bundle tests compare their output.
+    Returns the documents, the hashes of the files and the ID of the submission.
+    """
+    try:
+        if use_alert:
+            alert = STORAGE.alert.get(sid, as_obj=False)
+            if alert is None:
+                raise AlertNotFound("Can't find alert %s, skipping." % sid)
+
+            sid = alert['sid']
+        else:
+            alert = None
+        submission = STORAGE.submission.get(sid, as_obj=False)
+        if submission is None and alert is None:
+            raise SubmissionNotFound("Can't find submission %s, skipping." % sid)
+
+        data = {}
+        sha256s = []
+        if submission:
+            # Create file information data
+            file_tree = STORAGE.get_or_create_file_tree(submission, config.submission.max_extraction_depth,
+                                                        user_classification=user_classification)['tree']
+            flatten_tree = list(set(recursive_flatten_tree(file_tree) +
+                                    [r[:64] for r in submission.get("results", [])]))
+            file_infos, _ = get_file_infos(copy(flatten_tree), STORAGE)
+
+            _add_bundle_metadata(submission)
+
+            results, supplementary = get_results(submission.get("results", []), file_infos, STORAGE,
+                                                 user_classification)
+            supp_info, _ = get_file_infos(copy(supplementary), STORAGE)
+            file_infos.update(supp_info)
+
+            data.update({
+                'submission': submission,
+                'files': {"list": flatten_tree, "tree": file_tree, "infos": file_infos},
+                'results': results,
+                'errors': get_errors(submission.get("errors", []), STORAGE)
+            })
+            sha256s = list(dict.fromkeys(flatten_tree + supplementary))
+
+        if alert:
+            _add_bundle_metadata(alert)
+            data['alert'] = alert
+
+        return data, sha256s, sid
+    except (SubmissionNotFound, AlertNotFound):
+        raise
+    except Exception as e:
+        raise BundlingException("Could not bundle submission '%s'. [%s: %s]" % (sid, type(e).__name__, str(e)))
+
+
+def write_bundle_tar(fileobj, data, sha256s, filestores):
+    """Write the tarball of a bundle to a file object, the files are copied from the filestores one at a time"""
+    now = time.time()
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=BUNDLE_COMPRESSION_LEVEL) as gz, \
+            tarfile.open(fileobj=gz, mode='w|') as tar:
+        for sha256 in sha256s:
+            reader = open_file_stream(sha256, filestores)
+            if reader is None:
+                # Missing files are left out of the bundle like create_bundle does
+                continue
+
+            with reader:
+                info = tarfile.TarInfo(sha256)
+                info.size = os.fstat(reader.fileno()).st_size
+                info.mtime = now
+                tar.addfile(info, reader)
+
+        results = json.dumps(data).encode()
+        info = tarfile.TarInfo("results.json")
+        info.size = len(results)
+        info.mtime = now
+        tar.addfile(info, io.BytesIO(results))
+
+
+class _TarQueueWriter(object):
+    """Write end of the queue the tarball is written to, the data is sent in blocks of TAR_BLOCK_SIZE"""
+
+    def __init__(self, writer: QueueWriter):
+        self.writer = writer
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= TAR_BLOCK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.writer.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+class _TarQueueReader(object):
+    """Read end of the queue the tarball is written to, raises the error of the writer instead of ending cleanly"""
+
+    def __init__(self, chunks: queue.Queue, aborted: threading.Event):
+        self.chunks = chunks
+        self.aborted = aborted
+        self.buffer = bytearray()
+        self.done = False
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.done = True
+            elif isinstance(chunk, Exception):
+                raise BundlingException(f"Could not write the bundle. [{type(chunk).__name__}: {chunk}]")
+            else:
+                self.buffer.extend(chunk)
+
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def close(self):
+        # Tells the writer to stop if the encoder did not read the whole tarball
+        self.aborted.set()
+
+
+def iter_bundle_stream(data, sha256s, sid, filestores):
+    """Create a bundle on the fly, yielding the chunks of the CaRTed bundle as they are encoded.
+
+    The tarball is written to a bounded queue by a background thread while the CaRT encoder reads the other end, so
+    the files are sent to the client as they are read from the filestore without being copied to disk first. The
+    queue is used instead of an OS pipe since blocking on a pipe would freeze the whole worker when the threads are
+    gevent greenlets.
+    """
+    chunks = queue.Queue(TAR_QUEUE_SIZE)
+    aborted = threading.Event()
+    reader = _TarQueueReader(chunks, aborted)
+    writer = QueueWriter(chunks, aborted)
+
+    # noinspection PyBroadException
+    def write():
+        try:
+            try:
+                fh = _TarQueueWriter(writer)
+                write_bundle_tar(fh, data, sha256s, filestores)
+                fh.flush()
+                writer.put(None)
+            except StreamAborted:
+                raise
+            except Exception as e:
+                LOGGER.exception(f"Failed to write the bundle of submission {sid}")
+                writer.put(e)
+        except StreamAborted:
+            # The client stopped reading and the encoder closed the reader
+            pass
+
+    threading.Thread(target=write, daemon=True).start()
+    yield from iter_cart_stream(reader, {'al': {"type": BUNDLE_TYPE}, 'name': f"{sid}.tgz"})
+
+
+class _Base64Writer(object):
+    """Decode base64 data written in chunks of any size into a file object"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.pending = b""
+
+    def write(self, data):
+        data = self.pending + data.translate(None, NON_BASE64)
+        size = len(data) - len(data) % 4
+        self.pending = data[size:]
+        if size:
+            self.fh.write(base64.b64decode(data[:size]))
+
+    def close(self):
+        if self.pending:
+            self.fh.write(base64.b64decode(self.pending))
+
+
+def save_bundle_body(body, path):
+    """Save a bundle received as a raw or base64 encoded request body to a file, one block at a time.
+
+    Bundles are either CaRT files or tarballs, anything else is decoded as base64 if it decodes to one of those and
+    saved as is otherwise. Returns the size of the body.
+    """
+    first = body.read(IMPORT_BLOCK_SIZE)
+    size = 0
+
+    is_base64 = False
+    if first[:3] != BUNDLE_MAGIC and not is_cart(first[:256]):
+        head = first[:4096].translate(None, NON_BASE64)
+        try:
+            decoded = base64.b64decode(head[:len(head) - len(head) % 4])
+            is_base64 = decoded[:3] == BUNDLE_MAGIC or is_cart(decoded[:256])
+        except binascii.Error:
+            pass
+
+    with open(path, 'wb') as fh:
+        writer = _Base64Writer(fh) if is_base64 else fh
+        block = first
+        while block:
+            size += len(block)
+            writer.write(block)
+            block = body.read(IMPORT_BLOCK_SIZE)
+
+        if is_base64:
+            try:
+                writer.close()
+            except binascii.Error as e:
+                raise BundlingException(f"Invalid base64 encoded bundle. [{e}]")
+
+    return size
@@ -0,0 +1,114 @@
+import os
+import queue
+import tempfile
+import threading
+
+from cart import is_cart, pack_stream
+
+from assemblyline.filestore import FileStore, FileStoreException
+
+# Number of encoded chunks buffered ahead of the client while streaming a CaRT file
+CART_QUEUE_SIZE = 16
+CART_QUEUE_TIMEOUT = 5
+
+
+class StreamAborted(Exception):
+    pass
+
+
+def open_file_stream(sha256, filestores: list[FileStore]):
+    """Open a readable file object on the content of a file from the first filestore that has it.
+
+    Files on local transports are read in place. For remote transports, the file is downloaded once to a temporary
+    file which is deleted as soon as it is closed. Returns None if the file is not found in any of the filestores.
+    """
+    for filestore in filestores:
+        for transport in filestore.local_transports:
+            try:
+                return open(transport.normalize(sha256), 'rb')
+            except OSError:
+                pass
+
+        fd, download_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            filestore.download(sha256, download_path)
+            return open(download_path, 'rb')
+        except FileStoreException:
+            pass
+        finally:
+            # The file stays readable through the opened file object until it is closed
+            os.unlink(download_path)
+
+    return None
+
+
+def is_cart_stream(reader):
+    reader.seek(0)
+    data = reader.read(64)
+    reader.seek(0)
+    return is_cart(data)
+
+
+class QueueWriter(object):
+    """Write end of a bounded queue that gives up once its consumer is gone"""
+
+    def __init__(self, chunks: queue.Queue, aborted: threading.Event):
+        self.chunks = chunks
+        self.aborted = aborted
+
+    def put(self, item):
+        # Give up if the consumer stopped reading instead of blocking forever on a full queue
+        while True:
+            if self.aborted.is_set():
+                raise StreamAborted()
+            try:
+                self.chunks.put(item, timeout=CART_QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self.put(data)
+        return len(data)
+
+
+def iter_cart_stream(reader, metadata):
+    """Encode a file object in the CaRT format on the fly, yielding the encoded chunks as they are produced.
+
+    The encoding runs in a background thread that is throttled by a bounded queue so only a handful of chunks are in
+    memory at any time. The reader is closed once the encoding is done or the consumer stops iterating.
+    """
+    chunks = queue.Queue(CART_QUEUE_SIZE)
+    aborted = threading.Event()
+
+    writer = QueueWriter(chunks, aborted)
+
+    # noinspection PyBroadException
+    def encode():
+        try:
+            try:
+                if reader.seekable():
+                    reader.seek(0)
+                pack_stream(reader, writer, metadata)
+                writer.put(None)
+            except StreamAborted:
+                raise
+            except Exception as e:
+                writer.put(e)
+        except StreamAborted:
+            pass
+        finally:
+            reader.close()
+
+    try:
+        threading.Thread(target=encode, daemon=True).start()
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            elif isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        aborted.set()
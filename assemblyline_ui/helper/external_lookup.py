@@ -0,0 +1,195 @@
+import json
+import threading
+
+from requests.adapters import HTTPAdapter
+
+from assemblyline.remote.datatypes import retry_call
+from assemblyline.remote.datatypes.cache import Cache
+from assemblyline.remote.datatypes.hash import Hash
+
+# Outcomes of a lookup, only found and not found answers are cached
+FOUND = "found"
+NOT_FOUND = "not_found"
+ERROR = "error"
+
+DEFAULT_TTL = 15 * 60
+NOT_FOUND_TTL = 5 * 60
+# Maximum number of keep-alive connections kept open to each source
+SESSION_POOL_SIZE = 32
+# Requests to the sources time out with their lookup, with a floor so very short timeouts can still get an answer
+MIN_REQUEST_TIMEOUT = 0.5
+
+# Number of cached answers read or written in a single round trip to redis
+CACHE_BATCH_SIZE = 500
+
+STATS_FIELDS = ["hits", "not_found_hits", "misses", "coalesced", "errors"]
+
+
+class ExternalSessionPool(object):
+    """Keep-alive HTTP sessions to the external sources, one per source and shared by all the threads of a worker"""
+
+    def __init__(self, session_factory, pool_size: int = SESSION_POOL_SIZE):
+        self.session_factory = session_factory
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        with self.lock:
+            session = self.sessions.get((source.name, source.url), None)
+            if session is None:
+                session = self.session_factory()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[(source.name, source.url)] = session
+            return session
+
+    def clear(self):
+        with self.lock:
+            self.sessions = {}
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.outcome = None
+        self.error = None
+
+
+class ExternalLookupCache(object):
+    """Cache of the answers of the external sources, shared by all the workers through redis.
+
+    The raw answers of the sources are cached before any user level access control is applied, callers must filter
+    the items for each user. Not found answers are cached for a shorter time and errors are never cached. Identical
+    lookups running at the same time in a worker are coalesced into a single request to the source.
+    """
+
+    def __init__(self, cache: Cache, stats: Hash, ttl: int = DEFAULT_TTL, not_found_ttl: int = NOT_FOUND_TTL,
+                 source_ttls: dict[str, int] = None):
+        self.cache = cache
+        self.stats = stats
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.source_ttls = source_ttls or {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get_ttl(self, source_name: str, status: str) -> int:
+        ttl = self.source_ttls.get(source_name, self.ttl)
+        if status == NOT_FOUND:
+            return min(ttl, self.not_found_ttl)
+        return ttl
+
+    def _count(self, source_name: str, field: str):
+        self.stats.increment(f"{source_name}.{field}")
+
+    def lookup(self, source_name: str, key_parts: tuple, fetch, timeout: float = None) -> tuple[str, dict]:
+        """Return the cached answer of a source or fetch it.
+
+        Fetch is called without arguments and returns a tuple of (status, result), the result has to be JSON
+        serializable. Lookups coalesced with a running one wait for it up to timeout seconds before querying the
+        source themselves.
+        """
+        key = self.cache.create_key(source_name, *key_parts)
+        entry = self.cache.get(key, reset=False)
+        if entry:
+            self._count(source_name, "hits" if entry["status"] == FOUND else "not_found_hits")
+            return entry["status"], entry["result"]
+
+        with self.lock:
+            flight = self.in_flight.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = _Flight()
+
+        if not leader:
+            self._count(source_name, "coalesced")
+            if flight.event.wait(timeout):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.outcome
+            return fetch()
+
+        self._count(source_name, "misses")
+        try:
+            status, result = flight.outcome = fetch()
+            ttl = self.get_ttl(source_name, status)
+            if status == ERROR:
+                self._count(source_name, "errors")
+            elif ttl > 0:
+                self.cache.set(key, {"status": status, "result": result}, ttl=ttl)
+            return status, result
+        except Exception as e:
+            self._count(source_name, "errors")
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.event.set()
+
+    def lookup_many(self, source_name: str, keys: dict, fetch_many) -> dict:
+        """Return the cached answers of a source for many lookups and fetch all the missing ones at once.
+
+        Keys maps an identifier of each lookup to its key parts. Fetch many is called with the list of the identifiers
+        of the lookups that are not cached and returns a dictionary of their (status, result). Lookups missing from
+        the answer of fetch many are left out.
+        """
+        cache_keys = {lookup_id: self.cache.create_key(source_name, *key_parts)
+                      for lookup_id, key_parts in keys.items()}
+        lookup_ids = list(cache_keys.keys())
+
+        output = {}
+        for x in range(0, len(lookup_ids), CACHE_BATCH_SIZE):
+            chunk = lookup_ids[x:x + CACHE_BATCH_SIZE]
+            entries = retry_call(self.cache.c.mget, [self.cache._get_key(cache_keys[lookup_id]) for lookup_id in chunk])
+            for lookup_id, entry in zip(chunk, entries):
+                if entry:
+                    entry = json.loads(entry)
+                    output[lookup_id] = (entry["status"], entry["result"])
+
+        hits = sum(1 for status, _ in output.values() if status == FOUND)
+        if hits:
+            self.stats.increment(f"{source_name}.hits", hits)
+        if len(output) - hits:
+            self.stats.increment(f"{source_name}.not_found_hits", len(output) - hits)
+
+        missing = [lookup_id for lookup_id in lookup_ids if lookup_id not in output]
+        if not missing:
+            return output
+        self.stats.increment(f"{source_name}.misses", len(missing))
+
+        fetched = fetch_many(missing)
+        errors = 0
+        pipeline = self.cache.c.pipeline(transaction=False)
+        for lookup_id, (status, result) in fetched.items():
+            ttl = self.get_ttl(source_name, status)
+            if status == ERROR:
+                errors += 1
+            elif ttl > 0:
+                entry = json.dumps({"status": status, "result": result})
+                pipeline.set(self.cache._get_key(cache_keys[lookup_id]), entry, ex=ttl)
+        retry_call(pipeline.execute)
+        if errors:
+            self.stats.increment(f"{source_name}.errors", errors)
+
+        output.update(fetched)
+        return output
+
+    def get_stats(self, source_names: list[str]) -> dict:
+        counters = self.stats.items()
+        output = {}
+        for name in source_names:
+            source_stats = {field: int(counters.get(f"{name}.{field}", 0)) for field in STATS_FIELDS}
+            lookups = source_stats["hits"] + source_stats["not_found_hits"] + source_stats["misses"]
+            source_stats["hit_ratio"] = \
+                (source_stats["hits"] + source_stats["not_found_hits"]) / lookups if lookups else 0.0
+            source_stats["ttl"] = self.get_ttl(name, FOUND)
+            source_stats["not_found_ttl"] = self.get_ttl(name, NOT_FOUND)
+            output[name] = source_stats
+        return output
+
+    def clear(self):
+        self.cache.clear()
+        self.stats.delete()
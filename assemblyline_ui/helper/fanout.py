@@ -0,0 +1,226 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
+
+LOGGER = logging.getLogger('assemblyline.ui')
+
+MAX_WORKERS = 32
+# Maximum number of lookups queued or running at the same time on a single source by a worker, more are rejected
+SOURCE_CONCURRENCY = 8
+# Number of consecutive failures or timeouts of a source before it stops being queried for a while
+FAILURE_THRESHOLD = 5
+COOLDOWN = 30
+
+CIRCUIT_OPEN_ERROR = "Source is temporarily unavailable after too many failures."
+BUSY_ERROR = "Too many concurrent lookups on this source."
+TIMEOUT_ERROR = "Source did not answer in time."
+FAILURE_ERROR = "Lookup failed."
+NOT_STARTED_ERROR = "Too many concurrent lookups, the lookup could not start in time."
+
+
+class SourceFailure(Exception):
+    """Raised by a lookup function when its source failed, the result is still returned for the lookup but the
+    failure counts against the source's circuit breaker."""
+
+    def __init__(self, result: dict):
+        super().__init__(result.get("error", FAILURE_ERROR))
+        self.result = result
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Stop querying a source after too many consecutive failures, a single trial lookup is let through once the
+    cooldown is over to find out if the source is back."""
+
+    def __init__(self, threshold: int = FAILURE_THRESHOLD, cooldown: int = COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release_trial(self):
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class _Source(object):
+    def __init__(self, concurrency: int, threshold: int, cooldown: int):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.breaker = CircuitBreaker(threshold, cooldown)
+        self.calls = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+
+class FanOutEngine(object):
+    """Run the lookups of a request on many sources on a bounded thread pool shared by all the requests of a worker.
+
+    Each lookup has to be done before the request's deadline. Lookups still queued at the deadline are cancelled and
+    the ones still running are reported as timed out, the lookup functions have to bound their own network calls to
+    the same deadline. Only the timeouts of lookups that were running count against their source, lookups that could
+    not start because the pool was busy don't. Lookups on a source that already has as many lookups as its
+    concurrency queued or running are rejected right away. Failed lookups are returned as errors alongside the
+    results of the other sources.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, source_concurrency: int = SOURCE_CONCURRENCY,
+                 failure_threshold: int = FAILURE_THRESHOLD, cooldown: int = COOLDOWN):
+        self.max_workers = max_workers
+        self.source_concurrency = source_concurrency
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.executor = None
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = APMAwareThreadPoolExecutor(self.max_workers)
+            return self.executor
+
+    def _get_source(self, name: str) -> _Source:
+        with self.lock:
+            source = self.sources.get(name, None)
+            if source is None:
+                source = self.sources[name] = _Source(self.source_concurrency, self.failure_threshold, self.cooldown)
+            return source
+
+    @staticmethod
+    def _call(source: _Source, name: str, func, deadline: float):
+        start = time.monotonic()
+        try:
+            result = func()
+            failed = False
+        except SourceFailure as e:
+            result = e.result
+            failed = True
+        except Exception:
+            LOGGER.exception(f"Lookup on {name} failed")
+            result = {"error": FAILURE_ERROR, "items": []}
+            failed = True
+        finally:
+            source.semaphore.release()
+            latency = time.monotonic() - start
+            source.calls += 1
+            source.total_latency += latency
+            source.max_latency = max(source.max_latency, latency)
+
+        # Late answers were already reported as timeouts
+        if time.monotonic() <= deadline:
+            if failed:
+                source.failures += 1
+                source.breaker.record_failure()
+            else:
+                source.breaker.record_success()
+        return result
+
+    def run(self, tasks: dict, timeout: float, source_names: dict = None) -> dict:
+        """Run the lookup functions of a dictionary of tasks and return their results on the same keys.
+
+        Source names maps the keys of the tasks to the source they query, if they differ, so the limits, circuit
+        breakers and metrics of a source are shared by all its lookups. Tasks returning None are left out.
+        """
+        source_names = source_names or {}
+        deadline = time.monotonic() + timeout
+        executor = self._get_executor()
+
+        results = {}
+        futures = {}
+        for key, func in tasks.items():
+            name = source_names.get(key, key)
+            source = self._get_source(name)
+            if not source.breaker.allow():
+                source.rejected += 1
+                results[key] = {"error": CIRCUIT_OPEN_ERROR, "items": []}
+                continue
+
+            # Taken before submitting so a busy source never holds threads of the shared pool
+            if not source.semaphore.acquire(blocking=False):
+                source.rejected += 1
+                source.breaker.release_trial()
+                results[key] = {"error": BUSY_ERROR, "items": []}
+                continue
+            futures[executor.submit(self._call, source, name, func, deadline)] = (key, source)
+
+        done, not_done = concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for future in done:
+            key, _ = futures[future]
+            result = future.result()
+            if result is not None:
+                results[key] = result
+
+        for future in not_done:
+            key, source = futures[future]
+            if future.cancel():
+                # The lookup never started because the pool was busy, it says nothing about the source
+                source.semaphore.release()
+                source.rejected += 1
+                source.breaker.release_trial()
+                results[key] = {"error": NOT_STARTED_ERROR, "items": []}
+                continue
+
+            # Running lookups are bounded by their own timeout
+            source.timeouts += 1
+            source.breaker.record_failure()
+            results[key] = {"error": TIMEOUT_ERROR, "items": []}
+
+        return results
+
+    def get_metrics(self, names: list[str]) -> dict:
+        output = {}
+        for name in names:
+            source = self._get_source(name)
+            output[name] = {
+                "calls": source.calls,
+                "timeouts": source.timeouts,
+                "failures": source.failures,
+                "rejected": source.rejected,
+                "avg_latency": source.total_latency / source.calls if source.calls else 0.0,
+                "max_latency": source.max_latency,
+                "circuit": source.breaker.state,
+            }
+        return output
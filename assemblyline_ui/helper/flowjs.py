@@ -0,0 +1,112 @@
+import os
+import shutil
+
+from assemblyline.cachestore import DEFAULT_CACHE_LEN, CacheStore
+from assemblyline.common.isotime import now_as_iso
+from assemblyline.common.uid import get_random_id
+from assemblyline.remote.datatypes import retry_call
+
+from assemblyline_ui.helper.download import open_file_stream
+
+# Chunks are kept in the cachestore with its default TTL, their tracking bitmap expires at the same time
+CHUNK_TRACKING_TTL = DEFAULT_CACHE_LEN
+
+
+def _chunks_key(ui_sid):
+    return f"flowjs-chunks-{ui_sid}"
+
+
+def check_chunk_bounds(chunk_number, total_chunks, chunk_size, max_file_size):
+    """Return an error message if a chunk can't be part of an upload of at most max_file_size bytes, None otherwise.
+
+    Chunk numbers are used as offsets in the tracking bitmap, they are bounded so a request can't grow it past the
+    size of a valid upload.
+    """
+    if chunk_size < 1:
+        return "flowChunkSize should be a positive integer."
+
+    max_chunks = max(1, -(-max_file_size // chunk_size))
+    if not 1 <= total_chunks <= max_chunks:
+        return f"flowTotalChunks should be between 1 and {max_chunks}."
+    if not 1 <= chunk_number <= total_chunks:
+        return "flowChunkNumber should be between 1 and flowTotalChunks."
+    return None
+
+
+def _mark(client, ui_sid, chunk_number):
+    pipe = client.pipeline(transaction=True)
+    pipe.setbit(_chunks_key(ui_sid), chunk_number - 1, 1)
+    pipe.bitcount(_chunks_key(ui_sid))
+    pipe.expire(_chunks_key(ui_sid), CHUNK_TRACKING_TTL)
+    return pipe.execute()
+
+
+def mark_chunk_received(client, ui_sid, chunk_number, total_chunks):
+    """Record a received chunk in the redis bitmap of an upload.
+
+    Returns a tuple of (completed, assemble). Completed tells if all chunks were received. Assemble is only true for
+    the request whose chunk completed the upload, so a single request reassembles the file.
+    """
+    previous, received, _ = retry_call(_mark, client, ui_sid, chunk_number)
+    completed = received >= total_chunks
+    return completed, completed and not previous
+
+
+def is_chunk_received(client, ui_sid, chunk_number):
+    return bool(retry_call(client.getbit, _chunks_key(ui_sid), chunk_number - 1))
+
+
+def clear_received_chunks(client, ui_sid):
+    retry_call(client.delete, _chunks_key(ui_sid))
+
+
+def _copy_chunks(cache: CacheStore, chunk_names, target_file):
+    with open(target_file, 'wb') as target:
+        for chunk_name in chunk_names:
+            reader = open_file_stream(f"{cache.component}_{chunk_name}", [cache.filestore])
+            if reader is None:
+                raise FileNotFoundError(f"Chunk {chunk_name} is missing from the cache")
+            with reader:
+                shutil.copyfileobj(reader, target)
+
+
+def assemble_chunks(cache: CacheStore, chunk_names, cache_key, temp_dir):
+    """Reassemble the chunks of an upload into a single cached file.
+
+    Chunks are copied one buffer at a time so the file is never loaded in memory. When the cachestore keeps its files
+    on the local filesystem, the file is assembled directly at its final location and is not copied again.
+    """
+    target_file = None
+    for transport in cache.filestore.local_transports:
+        target_file = transport.normalize(f"{cache.component}_{cache_key}")
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        break
+
+    if target_file is None:
+        os.makedirs(temp_dir, exist_ok=True)
+        target_file = os.path.join(temp_dir, cache_key)
+
+    partial_file = f"{target_file}.{get_random_id()}"
+    try:
+        _copy_chunks(cache, chunk_names, partial_file)
+        os.replace(partial_file, target_file)
+
+        # Register the file's expiry like CacheStore.upload does, local transports skip the copy since the file is
+        # already in place
+        cache.datastore.cached_file.save(f"{cache.component}_{cache_key}",
+                                         {'expiry_ts': now_as_iso(DEFAULT_CACHE_LEN), 'component': cache.component})
+        cache.filestore.upload(target_file, f"{cache.component}_{cache_key}", force=True)
+    finally:
+        if os.path.exists(partial_file):
+            os.unlink(partial_file)
+        if not cache.filestore.local_transports and os.path.exists(target_file):
+            os.unlink(target_file)
+
+
+def get_local_cache_path(cache: CacheStore, cache_key):
+    """Return the path of a cached file if the cachestore keeps it on the local filesystem, None otherwise"""
+    for transport in cache.filestore.local_transports:
+        path = transport.normalize(f"{cache.component}_{cache_key}")
+        if os.path.exists(path):
+            return path
+    return None
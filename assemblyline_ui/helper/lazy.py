@@ -0,0 +1,55 @@
+import threading
+import time
+
+import elasticapm
+
+# Time in seconds taken to create each lazy object of the worker, in the order they were created
+INIT_TIMES = {}
+
+
+class LazyObject:
+    """An object proxy that only creates its target the first time it is used.
+
+    Expensive global instances are wrapped so importing the configuration of a worker does not load them, the first
+    request that uses one pays for its creation instead.
+    """
+
+    def __init__(self, name, factory, args=None, kwargs=None):
+        """
+        Args:
+            name: Name under which the creation time of the object is reported.
+            factory: Factory that takes the arguments given in `args` and `kwargs` and produces the proxyed object.
+        """
+        self.__name = name
+        self.__factory = factory
+        self.__args = args or []
+        self.__kwargs = kwargs or {}
+        self.__target = None
+        self.__loaded = False
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        if not self.__loaded:
+            with self.__lock:
+                if not self.__loaded:
+                    start = time.time()
+                    with elasticapm.capture_span(name=f"LazyObject.load({self.__name})", span_type="lazy_object"):
+                        self.__target = self.__factory(*self.__args, **self.__kwargs)
+                    INIT_TIMES[self.__name] = time.time() - start
+                    self.__loaded = True
+        return self.__target
+
+    def __getattr__(self, key):
+        """Forward all attribute requests to the underlying object, creating it if needed."""
+        return getattr(self.__load(), key)
+
+    def __getitem__(self, item):
+        return self.__load()[item]
+
+    def lazy_load(self):
+        """Create the underlying object now if it was not used yet and return it."""
+        return self.__load()
+
+    @property
+    def lazy_loaded(self) -> bool:
+        return self.__loaded
@@ -0,0 +1,44 @@
+import json
+
+from assemblyline.remote.datatypes import retry_call
+
+START_MSG = "Start listening..."
+STOP_MSG = "All messages received, closing queue..."
+
+
+def _drain(client, queue_ids):
+    pipe = client.pipeline(transaction=True)
+    for queue_id in queue_ids:
+        pipe.lrange(queue_id, 0, -1)
+        pipe.delete(queue_id)
+    return pipe.execute()
+
+
+def drain_watch_queues(client, queue_ids):
+    """Pop all the messages currently waiting in the given watch queues in a single redis round-trip.
+
+    Returns a dictionary of the messages received for each of the watch queues.
+    """
+    if not queue_ids:
+        return {}
+
+    results = retry_call(_drain, client, queue_ids)
+    return {queue_id: [json.loads(msg) for msg in results[x * 2]] for x, queue_id in enumerate(queue_ids)}
+
+
+def parse_watch_message(msg):
+    """Convert a message from a dispatcher's watch queue to the message sent to the users"""
+    try:
+        status = msg['status']
+        if status == 'STOP':
+            return {'type': 'stop', 'err_msg': None, 'status_code': 200, 'msg': STOP_MSG}
+        elif status == 'START':
+            return {'type': 'start', 'err_msg': None, 'status_code': 200, 'msg': START_MSG}
+        elif status == 'OK':
+            return {'type': 'cachekey', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
+        elif status == 'FAIL':
+            return {'type': 'cachekeyerr', 'err_msg': None, 'status_code': 200, 'msg': msg['cache_key']}
+    except (KeyError, ValueError, TypeError):
+        pass
+
+    return {'type': 'error', 'err_msg': "Unknown message", 'status_code': 400, 'msg': msg}
@@ -0,0 +1,251 @@
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+
+from redis import Redis
+
+from assemblyline.common.dict_utils import flatten
+from assemblyline.common.isotime import now_as_iso
+from assemblyline.common.uid import get_random_id
+from assemblyline.datastore.collection import ESCollection
+from assemblyline.remote.datatypes import retry_call
+
+LOGGER = logging.getLogger('assemblyline.ui')
+
+# How often the filter fetches the items updated since its last refresh
+REFRESH_INTERVAL = 30
+# How often the filter is rebuilt from scratch to forget about deleted items
+REBUILD_INTERVAL = 60 * 60
+# A single worker rebuilds the filter shared through redis, another one takes over if it did not finish by then
+REBUILD_LOCK_TTL = 10 * 60
+# Items updated this many seconds before the last refresh are fetched again to account for the index refresh delay
+REFRESH_OVERLAP = 60
+MIN_CAPACITY = 100000
+ERROR_RATE = 0.001
+# Number of md5/sha1 hashes looked up per search query
+SEARCH_CHUNK_SIZE = 500
+# Maximum number of items that can be checked in a single bulk check
+BULK_CHECK_MAX_ITEMS = 100000
+
+HASH_RE = re.compile(r'^([0-9a-f]{32}|[0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+class BloomFilter(object):
+    def __init__(self, capacity: int, error_rate: float = ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.lower().encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @classmethod
+    def from_bytes(cls, capacity: int, count: int, bits: bytes, error_rate: float = ERROR_RATE):
+        bloom = cls(capacity, error_rate)
+        if len(bits) != len(bloom.bits):
+            raise ValueError(f"Expected {len(bloom.bits)} bytes for a capacity of {capacity}, got {len(bits)}")
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom
+
+
+class ListMembershipFilter(object):
+    """Bloom filter of the IDs and file hashes of the items of a badlist or safelist collection.
+
+    A negative answer means the item is definitely not listed, a positive one has to be confirmed in the datastore.
+    The filter is rebuilt from scratch every once in a while to forget about deleted items. A single worker does the
+    rebuild and shares the filter through redis, the other workers download it once it is published. Each worker then
+    keeps its copy up to date by periodically fetching the items updated since its last refresh. Updates are done in
+    a background thread, until a first filter is available or if it could not be built, every item is reported as
+    possibly listed so lookups fall back on the datastore.
+    """
+
+    def __init__(self, collection: ESCollection, redis: Redis, refresh_interval: int = REFRESH_INTERVAL,
+                 rebuild_interval: int = REBUILD_INTERVAL):
+        self.collection = collection
+        self.redis = redis
+        self.key = f"membership_filter.{collection.name}"
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.version = None
+        self.last_refresh = 0
+        self.refresh_from = None
+
+    def _load(self, bloom: BloomFilter, query: str):
+        for item in self.collection.stream_search(query, fl="id,hashes.md5,hashes.sha1", as_obj=False):
+            for key in [item['id']] + [v for k, v in flatten(item).items() if k.startswith('hashes.') and v]:
+                bloom.add(key)
+
+    def _rebuild(self):
+        refresh_from = now_as_iso(-REFRESH_OVERLAP)
+        total = self.collection.search("id:*", rows=0, track_total_hits=True, as_obj=False)['total']
+
+        # Each item can add up to 3 keys to the filter, leave room to grow until the next rebuild
+        bloom = BloomFilter(max(MIN_CAPACITY, total * 3 * 2))
+        self._load(bloom, "id:*")
+
+        version = get_random_id()
+        pipeline = self.redis.pipeline()
+        pipeline.delete(self.key)
+        pipeline.hset(self.key, mapping={
+            'version': version,
+            'built': time.time(),
+            'refresh_from': refresh_from,
+            'capacity': bloom.capacity,
+            'count': bloom.count,
+            'bits': bytes(bloom.bits),
+        })
+        pipeline.expire(self.key, self.rebuild_interval * 2)
+        retry_call(pipeline.execute)
+
+        self.bloom, self.version, self.refresh_from = bloom, version, refresh_from
+
+    def _download(self):
+        shared = retry_call(self.redis.hgetall, self.key)
+        bloom = BloomFilter.from_bytes(int(shared[b'capacity']), int(shared[b'count']), shared[b'bits'])
+        self.bloom, self.version = bloom, shared[b'version'].decode()
+        self.refresh_from = shared[b'refresh_from'].decode()
+
+    def _refresh(self):
+        refresh_from = now_as_iso(-REFRESH_OVERLAP)
+        self._load(self.bloom, f"updated:[{self.refresh_from} TO now]")
+        self.refresh_from = refresh_from
+
+    # noinspection PyBroadException
+    def _update(self):
+        now = time.time()
+        try:
+            version, built = retry_call(self.redis.hmget, self.key, ['version', 'built'])
+            if built is None or now - float(built) >= self.rebuild_interval or \
+                    (self.bloom is not None and self.bloom.count >= self.bloom.capacity):
+                # The other workers keep using their filter, or the datastore, until the new one is published
+                lock = f"{self.key}.lock"
+                if retry_call(self.redis.set, lock, 1, nx=True, ex=REBUILD_LOCK_TTL):
+                    try:
+                        self._rebuild()
+                    finally:
+                        retry_call(self.redis.delete, lock)
+                    return
+
+            if version is not None and version.decode() != self.version:
+                self._download()
+            elif self.bloom is not None:
+                self._refresh()
+        except Exception:
+            # Wait until the next refresh interval before trying again
+            LOGGER.exception(f"Failed to update the membership filter of the {self.collection.name} index")
+        finally:
+            self.last_refresh = now
+            self.lock.release()
+
+    def _ensure_fresh(self):
+        if time.time() - self.last_refresh < self.refresh_interval:
+            return
+
+        # Updates are done in the background, the current filter or the datastore are used in the meantime
+        if self.lock.acquire(blocking=False):
+            threading.Thread(target=self._update, daemon=True).start()
+
+    def add(self, *keys: str):
+        """Add keys to the filter right away, for items that were just added through this worker"""
+        bloom = self.bloom
+        if bloom is not None:
+            for key in keys:
+                bloom.add(key)
+
+    def might_contain(self, key: str) -> bool:
+        self._ensure_fresh()
+        bloom = self.bloom
+        return bloom is None or key in bloom
+
+
+def bulk_lookup(collection: ESCollection, membership_filter: ListMembershipFilter, keys: list[str]) -> dict:
+    """Get the listed items matching a list of keys in as few datastore requests as possible.
+
+    Keys are either item IDs or the md5/sha1 hashes of listed files, they must be lowercase hexadecimal strings.
+    Keys rejected by the membership filter are not looked up. Returns the items found indexed on the matching key.
+    """
+    candidates = [key for key in set(keys) if membership_filter.might_contain(key)]
+
+    output = {}
+    ids = [key for key in candidates if len(key) == 64]
+    if ids:
+        output.update(collection.multiget(ids, as_obj=False, error_on_missing=False))
+
+    for hash_type, hash_len in [('md5', 32), ('sha1', 40)]:
+        values = [key for key in candidates if len(key) == hash_len]
+        for x in range(0, len(values), SEARCH_CHUNK_SIZE):
+            query = f"hashes.{hash_type}:({' OR '.join(values[x:x + SEARCH_CHUNK_SIZE])})"
+            for item in collection.stream_search(query, as_obj=False):
+                item.pop('id', None)
+                output[item['hashes'][hash_type]] = item
+
+    return output
+
+
+def bulk_check(collection: ESCollection, membership_filter: ListMembershipFilter, classification, user_classification,
+               hashes: list = None, tags: list = None, signatures: list = None) -> dict:
+    """Check a list of hashes, tags and signature names against a badlist or safelist collection.
+
+    Raises a ValueError if the items to check are invalid. Returns the listed items the user has access to.
+    """
+    hashes = hashes or []
+    tags = tags or []
+    signatures = signatures or []
+    if not all(isinstance(x, list) for x in [hashes, tags, signatures]):
+        raise ValueError("Hashes, tags and signatures must be lists.")
+
+    if len(hashes) + len(tags) + len(signatures) > BULK_CHECK_MAX_ITEMS:
+        raise ValueError(f"Too many items to check, the maximum is {BULK_CHECK_MAX_ITEMS}.")
+
+    # Map the keys of the listed items to the items requested by the user
+    keys = {}
+    for qhash in hashes:
+        if not isinstance(qhash, str) or not HASH_RE.match(qhash.lower()):
+            raise ValueError(f"Invalid hash: {qhash}")
+        keys.setdefault(qhash.lower(), []).append(('hashes', qhash))
+
+    for tag in tags:
+        try:
+            tag_type, tag_value = tag['type'], tag['value']
+        except (KeyError, TypeError):
+            raise ValueError(f"Invalid tag, it should have a type and a value: {tag}")
+        qhash = hashlib.sha256(f"{tag_type}: {tag_value}".encode('utf8')).hexdigest()
+        keys.setdefault(qhash, []).append(('tags', (tag_type, tag_value)))
+
+    for signature_name in signatures:
+        qhash = hashlib.sha256(f"signature: {signature_name}".encode('utf8')).hexdigest()
+        keys.setdefault(qhash, []).append(('signatures', signature_name))
+
+    output = {'hashes': {}, 'tags': {}}
+    if signatures:
+        output['signatures'] = {}
+    for key, item in bulk_lookup(collection, membership_filter, list(keys.keys())).items():
+        if not classification.is_accessible(user_classification, item['classification']):
+            continue
+
+        for section, value in keys.get(key, []):
+            if section == 'tags':
+                output['tags'].setdefault(value[0], {})[value[1]] = item
+            else:
+                output[section][value] = item
+
+    return output
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from collections import deque
+
+from assemblyline.common.isotime import now_as_iso
+from assemblyline.remote.datatypes import retry_call
+from assemblyline.remote.datatypes.daily_quota_tracker import DailyQuotaTracker
+from assemblyline.remote.datatypes.user_quota_tracker import UserQuotaTracker
+
+QUOTA_OK = 1
+QUOTA_CONCURRENT_EXCEEDED = 0
+QUOTA_DAILY_EXCEEDED = 2
+
+# Same bookkeeping as the UserQuotaTracker begin script and the DailyQuotaTracker increment
+# but done in a single round-trip. The concurrent slot is only reserved if the daily quota allows the call.
+api_begin_script = """
+local concurrent_name = KEYS[1]
+local daily_name = KEYS[2]
+local max = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2] .. "000000")
+local daily_max = tonumber(ARGV[3])
+local daily_ttl = tonumber(ARGV[4])
+
+local t = redis.call('time')
+local key = tonumber(t[1] .. string.format("%06d", t[2]))
+
+if max ~= 0 then
+    redis.call('zremrangebyscore', concurrent_name, 0, key - timeout)
+    if redis.call('zcard', concurrent_name) >= max then
+        return {0, -1}
+    end
+end
+
+local daily = -1
+if daily_max ~= 0 then
+    daily = redis.call('incr', daily_name)
+    redis.call('expire', daily_name, daily_ttl, 'NX')
+    if daily > daily_max then
+        return {2, daily}
+    end
+end
+
+if max ~= 0 then
+    redis.call('zadd', concurrent_name, key, key)
+end
+return {1, daily}
+"""
+
+
+class APIQuotaTracker(object):
+    """Track the concurrent and daily API quotas of the users in one redis round-trip per request phase.
+
+    The keys used are the ones of the UserQuotaTracker and DailyQuotaTracker provided so both trackers can still be
+    used to read or reset the quotas. Each worker also keeps a local view of its own in-flight calls and of the users
+    that have exhausted their daily quota so it can reject obviously over-quota calls without talking to redis.
+    """
+
+    def __init__(self, concurrent_tracker: UserQuotaTracker, daily_tracker: DailyQuotaTracker):
+        self.concurrent_tracker = concurrent_tracker
+        self.daily_tracker = daily_tracker
+        self.c = concurrent_tracker.c
+        self.bs = self.c.register_script(api_begin_script)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.daily_exhausted = {}
+
+    def _local_check(self, user, max_quota, daily_quota):
+        day = now_as_iso()[:10]
+        with self.lock:
+            if daily_quota != 0 and self.daily_exhausted.get(user, None) == (day, daily_quota):
+                return QUOTA_DAILY_EXCEEDED
+
+            if max_quota != 0:
+                calls = self.in_flight.get(user, None)
+                if calls:
+                    expired = time.time() - self.concurrent_tracker.timeout
+                    while calls and calls[0] < expired:
+                        calls.popleft()
+                    if len(calls) >= max_quota:
+                        # This worker alone is already using all of the user's concurrent calls
+                        return QUOTA_CONCURRENT_EXCEEDED
+
+        return QUOTA_OK
+
+    def begin(self, user, max_quota, daily_quota):
+        """Reserve a concurrent API call slot for the user and count the call toward their daily quota.
+
+        A quota of 0 means unlimited. Returns a tuple of the quota status and of the daily count for the user,
+        the daily count is None if the call was not counted toward the daily quota.
+        """
+        status = self._local_check(user, max_quota, daily_quota)
+        if status == QUOTA_DAILY_EXCEEDED:
+            return status, daily_quota
+        elif status == QUOTA_CONCURRENT_EXCEEDED:
+            return status, None
+
+        status, daily_count = retry_call(self.bs, keys=[self.concurrent_tracker._queue_name(user),
+                                                        self.daily_tracker._counter_name(user, 'api')],
+                                         args=[max_quota, self.concurrent_tracker.timeout, daily_quota,
+                                               self.daily_tracker.ttl])
+        if daily_count == -1:
+            daily_count = None
+
+        with self.lock:
+            if status == QUOTA_DAILY_EXCEEDED:
+                self.daily_exhausted[user] = (now_as_iso()[:10], daily_quota)
+            elif status == QUOTA_OK and max_quota != 0:
+                self.in_flight.setdefault(user, deque()).append(time.time())
+
+        return status, daily_count
+
+    def end(self, user):
+        with self.lock:
+            calls = self.in_flight.get(user, None)
+            if calls:
+                calls.popleft()
+                if not calls:
+                    self.in_flight.pop(user)
+
+        self.concurrent_tracker.end(user)
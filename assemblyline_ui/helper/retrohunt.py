@@ -0,0 +1,246 @@
+import functools
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from assemblyline.common.dict_utils import flatten
+from assemblyline.common.threading import APMAwareThreadPoolExecutor
+from assemblyline.datastore.collection import ESCollection, Index
+
+# Maximum number of file IDs sent in a single datastore query
+KEY_SPACE_CHUNK_SIZE = 10000
+MAX_CONCURRENT_CHUNKS = 8
+# Number of hits kept in memory by each worker, about 110 bytes per hit. Jobs with more hits are not cached.
+HIT_CACHE_MAX_ITEMS = 1000000
+# Hits of finished jobs don't change, the hits of running jobs are reloaded more often
+HIT_CACHE_TTL = 10 * 60
+HIT_CACHE_RUNNING_TTL = 10
+STREAM_PAGE_SIZE = 1000
+
+
+class RetrohuntHitCache(object):
+    """LRU of the sha256 of the files hit by retrohunt jobs, local to the current worker.
+
+    Loading all the hits of a large job is expensive so they are loaded once and reused by the following pages,
+    facets and exports of the same job. The cache is bounded by the total number of hits it holds.
+    """
+
+    def __init__(self, hit_collection: ESCollection, max_items: int = HIT_CACHE_MAX_ITEMS):
+        self.hit_collection = hit_collection
+        self.max_items = max_items
+        self.items = 0
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, finished: bool) -> list[str]:
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is not None and entry[0] >= time.time() and entry[1] == finished:
+                self.cache.move_to_end(key)
+                return entry[2]
+
+        hits = sorted({item['sha256'] for item in self.hit_collection.stream_search(
+            f"search:{key}", fl='sha256', as_obj=False, index_type=Index.HOT_AND_ARCHIVE)})
+
+        ttl = HIT_CACHE_TTL if finished else HIT_CACHE_RUNNING_TTL
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.items -= len(old[2])
+
+            if len(hits) <= self.max_items:
+                self.cache[key] = (time.time() + ttl, finished, hits)
+                self.items += len(hits)
+                while self.items > self.max_items:
+                    _, (_, _, evicted) = self.cache.popitem(last=False)
+                    self.items -= len(evicted)
+
+        return hits
+
+
+def _chunks(key_space):
+    return [key_space[x:x + KEY_SPACE_CHUNK_SIZE] for x in range(0, len(key_space), KEY_SPACE_CHUNK_SIZE)]
+
+
+def _run_on_chunks(func, chunks, **kwargs):
+    with APMAwareThreadPoolExecutor(MAX_CONCURRENT_CHUNKS) as executor:
+        futures = [executor.submit(func, key_space=chunk, **kwargs) for chunk in chunks]
+    return [f.result() for f in futures]
+
+
+def _parse_sort(sort):
+    output = []
+    for part in (sort or "").split(','):
+        part = part.strip().split()
+        if part:
+            output.append((part[0], len(part) < 2 or part[1].lower() != 'desc'))
+    return output
+
+
+def _compare_items(sort_fields, a, b):
+    for field, ascending in sort_fields:
+        x, y = a[1].get(field, None), b[1].get(field, None)
+        if x == y:
+            continue
+
+        # Like elasticsearch, items missing the sort field are always last
+        if x is None:
+            return 1
+        if y is None:
+            return -1
+        if (x < y) == ascending:
+            return -1
+        return 1
+    return 0
+
+
+def _count_chunk(collection: ESCollection, key_space: list[str], query: str, index_type, **kwargs) -> int:
+    return collection.search(query, rows=0, key_space=key_space, index_type=index_type, track_total_hits=True,
+                             as_obj=False, **kwargs)['total']
+
+
+def _search_chunk(collection: ESCollection, key_space: list[str], query: str, rows: int, sort: str, fl: str,
+                  index_type, **kwargs) -> list[dict]:
+    return collection.search(query, offset=0, rows=rows, sort=sort, fl=fl, key_space=key_space,
+                             index_type=index_type, as_obj=False, **kwargs)['items']
+
+
+def _page_chunk(collection: ESCollection, key_space: list[str], query: str, sort: str, fl: str, index_type,
+                deep_paging_id: str = "*", **kwargs) -> dict:
+    return collection.search(query, rows=STREAM_PAGE_SIZE, sort=sort, fl=fl, key_space=key_space,
+                             index_type=index_type, deep_paging_id=deep_paging_id, as_obj=False, **kwargs)
+
+
+def _iter_chunk(page: dict, **kwargs):
+    """Yield the items of a deep paging page of a chunk then the items of the following pages, fetched lazily"""
+    while True:
+        yield from page['items']
+
+        deep_paging_id = page.get('next_deep_paging_id', None) if page['items'] else None
+        if not deep_paging_id:
+            return
+        page = _page_chunk(deep_paging_id=deep_paging_id, **kwargs)
+
+
+def _facet_chunk(collection: ESCollection, key_space: list[str], field: str, include: list = None,
+                 **kwargs) -> dict:
+    return collection.facet(field, key_space=key_space, size=collection.MAX_FACET_SIZE, include=include, **kwargs)
+
+
+def search_hits(collection: ESCollection, key_space: list[str], query: str = "*", offset: int = 0, rows: int = 10,
+                sort: str = None, fl: str = None, index_type=Index.HOT_AND_ARCHIVE, **kwargs) -> dict:
+    """Search the files of a key space of any size.
+
+    The files of each chunk of the key space are counted first so empty chunks are never searched. The key space is
+    sorted, so when the files are sorted by hash only the chunks that overlap the requested page are searched.
+    Otherwise the sorted files of the chunks are merged, paging through each chunk only as far as the merge goes.
+    Sorting on fields that are not in the returned fields is supported.
+    """
+    offset, rows = int(offset), int(rows)
+    if len(key_space) <= KEY_SPACE_CHUNK_SIZE:
+        return collection.search(query, offset=offset, rows=rows, sort=sort, fl=fl, key_space=key_space,
+                                 index_type=index_type, as_obj=False, **kwargs)
+
+    kwargs.pop('track_total_hits', None)
+    chunks = _chunks(key_space)
+    totals = _run_on_chunks(_count_chunk, chunks, collection=collection, query=query, index_type=index_type,
+                            **kwargs)
+    chunks = [(chunk, total) for chunk, total in zip(chunks, totals) if total]
+
+    sort_fields = _parse_sort(sort)
+    page = []
+    if not sort_fields or sort_fields == [('sha256', True)]:
+        start = 0
+        for chunk, total in chunks:
+            if len(page) >= rows:
+                break
+
+            if start + total > offset:
+                chunk_offset = max(offset - start, 0)
+                chunk_rows = min(rows - len(page), total - chunk_offset)
+                page.extend(collection.search(query, offset=chunk_offset, rows=chunk_rows, sort=sort, fl=fl,
+                                              key_space=chunk, index_type=index_type, as_obj=False,
+                                              **kwargs)['items'])
+            start += total
+    elif rows and offset < sum(totals):
+        extra_roots = set()
+        if fl:
+            fields = fl.split(',')
+            extra_fields = [field for field, _ in sort_fields if field not in fields and '*' not in fields]
+            extra_roots = {field.split('.', 1)[0] for field in extra_fields} - \
+                {field.split('.', 1)[0] for field in fields}
+            fl = ','.join(fields + extra_fields)
+
+        params = dict(collection=collection, query=query, sort=sort, fl=fl, index_type=index_type, **kwargs)
+        if offset + rows <= STREAM_PAGE_SIZE:
+            # The whole window fits in the first page of each chunk
+            sources = _run_on_chunks(_search_chunk, [chunk for chunk, _ in chunks], rows=offset + rows, **params)
+        else:
+            # The first pages are fetched concurrently, the following ones only when the merge reaches them
+            first_pages = _run_on_chunks(_page_chunk, [chunk for chunk, _ in chunks], **params)
+            sources = [_iter_chunk(first, key_space=chunk, **params)
+                       for first, (chunk, _) in zip(first_pages, chunks)]
+
+        key = functools.cmp_to_key(functools.partial(_compare_items, sort_fields))
+        merged = heapq.merge(*[((item, flatten(item)) for item in source) for source in sources], key=key)
+
+        # Remove the fields that were only fetched for sorting
+        for item, _ in itertools.islice(merged, offset, offset + rows):
+            for root in extra_roots:
+                item.pop(root, None)
+            page.append(item)
+
+    return {
+        'offset': offset,
+        'rows': rows,
+        'total': sum(totals),
+        'items': page
+    }
+
+
+def facet_hits(collection: ESCollection, key_space: list[str], field: str, mincount: int = 1, size: int = 10,
+               index_type=Index.HOT_AND_ARCHIVE, **kwargs) -> dict:
+    """Facet the files of a key space of any size.
+
+    Each chunk of the key space is faceted on its top values first. The counts of the values found in any chunk are
+    then completed in the chunks where they did not make the top values. Like the shard size of elasticsearch, a value
+    that is outside of the top values of every chunk is not counted.
+    """
+    mincount = int(mincount)
+    if len(key_space) <= KEY_SPACE_CHUNK_SIZE:
+        return collection.facet(field, key_space=key_space, mincount=mincount, index_type=index_type, size=size,
+                                **kwargs)
+
+    chunks = _chunks(key_space)
+    results = _run_on_chunks(_facet_chunk, chunks, collection=collection, field=field, index_type=index_type,
+                             **kwargs)
+    output = {}
+    for res in results:
+        for value, count in res.items():
+            output[value] = output.get(value, 0) + count
+
+    # Chunks with fewer values than the facet size returned all of their values
+    for chunk, res in zip(chunks, results):
+        if len(res) < collection.MAX_FACET_SIZE:
+            continue
+
+        missing = [value for value in output if value not in res]
+        includes = [missing[x:x + collection.MAX_FACET_SIZE] for x in range(0, len(missing), collection.MAX_FACET_SIZE)]
+        for include in includes:
+            for value, count in _facet_chunk(collection, chunk, field, include=include, index_type=index_type,
+                                             **kwargs).items():
+                output[value] = output.get(value, 0) + count
+
+    return {value: count for value, count in sorted(output.items(), key=lambda x: x[1], reverse=True)[:size]
+            if count >= mincount}
+
+
+def stream_hits(collection: ESCollection, key_space: list[str], query: str = "*", fl: str = None,
+                index_type=Index.HOT_AND_ARCHIVE, **kwargs):
+    """Yield all the files of a key space of any size, one chunk of the key space at the time"""
+    for chunk in _chunks(key_space):
+        params = dict(collection=collection, key_space=chunk, query=query, sort=None, fl=fl, index_type=index_type,
+                      **kwargs)
+        yield from _iter_chunk(_page_chunk(**params), **params)
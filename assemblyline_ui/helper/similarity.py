@@ -0,0 +1,438 @@
+import heapq
+import logging
+import re
+import threading
+import time
+
+from assemblyline.common.dict_utils import flatten, unflatten
+from assemblyline.common.isotime import now_as_iso
+from assemblyline.datastore.collection import ESCollection
+from assemblyline.datastore.exceptions import MultiKeyError
+
+LOGGER = logging.getLogger('assemblyline.ui')
+
+# How often the index fetches the items updated since its last refresh
+REFRESH_INTERVAL = 60
+# How often the index is rebuilt from scratch to forget about deleted items
+REBUILD_INTERVAL = 6 * 60 * 60
+# Items updated this many seconds before the last refresh are fetched again to account for the index refresh delay
+REFRESH_OVERLAP = 60
+# Number of items fetched per page when only the most recent items of a collection are indexed
+LOAD_PAGE_SIZE = 1000
+
+# Default thresholds: TLSH is a distance (lower is closer), SSDEEP is a similarity score from 0 to 100
+TLSH_DEFAULT_THRESHOLD = 50
+SSDEEP_DEFAULT_THRESHOLD = 50
+
+#################################################################
+# TLSH
+
+TLSH_RE = re.compile(r'^(T1)?[0-9A-F]{70}$')
+
+
+def _bit_pairs_diff(x, y):
+    diff = 0
+    for _ in range(4):
+        d = abs((x & 3) - (y & 3))
+        diff += 6 if d == 3 else d
+        x >>= 2
+        y >>= 2
+    return diff
+
+
+# Distance between two bytes of a TLSH body, indexed on (byte1 << 8) | byte2
+TLSH_BODY_DIFF = bytes(_bit_pairs_diff(x, y) for x in range(256) for y in range(256))
+
+
+def _swap_nibbles(x):
+    return ((x & 0x0F) << 4) | ((x & 0xF0) >> 4)
+
+
+def _mod_diff(x, y, r):
+    dl = abs(x - y)
+    return min(dl, r - dl)
+
+
+def parse_tlsh(value: str):
+    """Parse a TLSH hash into a tuple of (checksum, lvalue, q1ratio, q2ratio, body). Raises ValueError if invalid."""
+    value = value.upper()
+    if not TLSH_RE.match(value):
+        raise ValueError(f"Invalid TLSH hash: {value}")
+
+    raw = bytes.fromhex(value[-70:])
+    q_ratios = _swap_nibbles(raw[2])
+    return raw[0], _swap_nibbles(raw[1]), q_ratios & 0x0F, q_ratios >> 4, raw[3:]
+
+
+def _tlsh_header_distance(a, b):
+    diff = 0
+
+    l_diff = _mod_diff(a[1], b[1], 256)
+    diff += l_diff if l_diff <= 1 else l_diff * 12
+
+    for x in [2, 3]:
+        q_diff = _mod_diff(a[x], b[x], 16)
+        diff += q_diff if q_diff <= 1 else (q_diff - 1) * 12
+
+    if a[0] != b[0]:
+        diff += 1
+
+    return diff
+
+
+def tlsh_distance(a, b):
+    """Compute the distance between two parsed TLSH hashes, the same way TLSH's totalDiff does"""
+    return _tlsh_header_distance(a, b) + sum(TLSH_BODY_DIFF[(x << 8) | y] for x, y in zip(a[4], b[4]))
+
+
+class TLSHIndex(object):
+    """Index of TLSH hashes bucketed on their length value.
+
+    Two hashes with length values more than one step apart are at least 12 points apart per step, so only the buckets
+    close enough to the queried hash's length value need to be scanned for a given threshold.
+    """
+
+    def __init__(self):
+        self.buckets = [[] for _ in range(256)]
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, value):
+        if key in self.keys:
+            return
+        try:
+            parsed = parse_tlsh(value)
+        except ValueError:
+            return
+        self.keys.add(key)
+        self.buckets[parsed[1]].append((key, parsed))
+
+    def search(self, value, threshold=TLSH_DEFAULT_THRESHOLD, rows=10):
+        """Return the closest (key, distance) pairs within the threshold, closest first"""
+        query = parse_tlsh(value)
+        max_step = max(1, threshold // 12)
+
+        # Length values wrap around, large thresholds would otherwise scan the same buckets more than once
+        buckets = {(query[1] + step) % 256 for step in range(-min(max_step, 128), min(max_step, 128) + 1)}
+
+        results = []
+        for bucket in buckets:
+            for key, parsed in self.buckets[bucket]:
+                distance = _tlsh_header_distance(query, parsed)
+                if distance > threshold:
+                    continue
+                distance += sum(TLSH_BODY_DIFF[(x << 8) | y] for x, y in zip(query[4], parsed[4]))
+                if distance <= threshold:
+                    results.append((distance, key))
+
+        return [(key, distance) for distance, key in heapq.nsmallest(rows, results)]
+
+
+#################################################################
+# SSDEEP
+
+SSDEEP_RE = re.compile(r'^(\d+):([^:]*):([^:,]*)')
+SSDEEP_REPEATS_RE = re.compile(r'(.)\1{3,}')
+SPAMSUM_LENGTH = 64
+ROLLING_WINDOW = 7
+MIN_BLOCKSIZE = 3
+
+
+def parse_ssdeep(value: str):
+    """Parse an ssdeep hash into a tuple of (blocksize, chunk, double_chunk). Raises ValueError if invalid.
+
+    Sequences of more than three identical characters are reduced to three like ssdeep does before comparing.
+    """
+    match = SSDEEP_RE.match(value)
+    if not match:
+        raise ValueError(f"Invalid SSDEEP hash: {value}")
+    return (int(match.group(1)), SSDEEP_REPEATS_RE.sub(r'\1\1\1', match.group(2)),
+            SSDEEP_REPEATS_RE.sub(r'\1\1\1', match.group(3)))
+
+
+def _ngrams(chunk):
+    return {chunk[x:x + ROLLING_WINDOW] for x in range(len(chunk) - ROLLING_WINDOW + 1)}
+
+
+def _edit_distance(s1, s2):
+    # Levenshtein distance with insert/remove cost of 1 and replace cost of 2 like ssdeep's edit_distn
+    previous = list(range(len(s2) + 1))
+    for x, c1 in enumerate(s1, start=1):
+        current = [x]
+        for y, c2 in enumerate(s2, start=1):
+            current.append(min(previous[y] + 1, current[y - 1] + 1, previous[y - 1] + (0 if c1 == c2 else 2)))
+        previous = current
+    return previous[-1]
+
+
+def _score_strings(s1, s2, block_size):
+    if len(s1) > SPAMSUM_LENGTH or len(s2) > SPAMSUM_LENGTH:
+        return 0
+
+    if not _ngrams(s1) & _ngrams(s2):
+        return 0
+
+    score = _edit_distance(s1, s2)
+    score = (score * SPAMSUM_LENGTH) // (len(s1) + len(s2))
+    score = (100 * score) // SPAMSUM_LENGTH
+    if score >= 100:
+        return 0
+
+    score = 100 - score
+    if block_size >= (99 + ROLLING_WINDOW) // ROLLING_WINDOW * MIN_BLOCKSIZE:
+        return score
+
+    return min(score, block_size // MIN_BLOCKSIZE * min(len(s1), len(s2)))
+
+
+def ssdeep_compare(a, b):
+    """Compute the similarity score (0-100) of two parsed ssdeep hashes, the same way ssdeep's fuzzy_compare does"""
+    bs1, s1b1, s1b2 = a
+    bs2, s2b1, s2b2 = b
+
+    if bs1 == bs2 and s1b1 == s2b1:
+        return 100
+
+    if bs1 == bs2:
+        return max(_score_strings(s1b1, s2b1, bs1), _score_strings(s1b2, s2b2, bs1 * 2))
+    elif bs1 == bs2 * 2:
+        return _score_strings(s1b1, s2b2, bs1)
+    elif bs2 == bs1 * 2:
+        return _score_strings(s1b2, s2b1, bs2)
+    return 0
+
+
+class SSDeepIndex(object):
+    """Index of ssdeep hashes on the 7-grams of their chunks.
+
+    ssdeep only gives a non-zero score to chunks of compatible block sizes sharing at least one 7 characters long
+    substring. Each chunk is indexed on its block size and 7-grams so the candidates found include all the hashes
+    that can have a non-zero score.
+
+    Most 7-grams belong to a single hash, so to save memory the grams are indexed on their hash and a gram with a
+    single hash stores its key directly instead of a list. Colliding grams only add candidates that are then scored.
+    """
+
+    def __init__(self):
+        self.ngrams = {}
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def _gram_keys(block_size, chunk, double_chunk):
+        return {hash((block_size, gram)) for gram in _ngrams(chunk)} | \
+            {hash((block_size * 2, gram)) for gram in _ngrams(double_chunk)}
+
+    def add(self, key, value):
+        if key in self.hashes:
+            return
+        try:
+            parsed = parse_ssdeep(value)
+        except ValueError:
+            return
+        self.hashes[key] = parsed
+
+        for gram_key in self._gram_keys(*parsed):
+            postings = self.ngrams.get(gram_key, None)
+            if postings is None:
+                self.ngrams[gram_key] = key
+            elif isinstance(postings, list):
+                postings.append(key)
+            else:
+                self.ngrams[gram_key] = [postings, key]
+
+    def search(self, value, threshold=SSDEEP_DEFAULT_THRESHOLD, rows=10):
+        """Return the most similar (key, score) pairs at or above the threshold, most similar first"""
+        query = parse_ssdeep(value)
+
+        candidates = set()
+        for gram_key in self._gram_keys(*query):
+            postings = self.ngrams.get(gram_key, None)
+            if isinstance(postings, list):
+                candidates.update(postings)
+            elif postings is not None:
+                candidates.add(postings)
+
+        results = []
+        for key in candidates:
+            score = ssdeep_compare(query, self.hashes[key])
+            if score >= threshold:
+                results.append((score, key))
+
+        return [(key, score) for score, key in heapq.nlargest(rows, results)]
+
+
+#################################################################
+# Collection index
+
+class SimilarityIndex(object):
+    """Per-worker in-memory TLSH and ssdeep similarity index of the items of a collection.
+
+    Every worker holds its own copy of the index, about 4.5KB per hash, so it is only meant for collections of a few
+    tens of thousands of hashes. Larger collections, or a max_items of 0, are searched in the datastore instead. With
+    recent_only, larger collections have their max_items most recent items indexed instead and indexed_from holds the
+    date of the oldest indexed item so the callers can search the older items in the datastore.
+
+    The index is built in the background and kept up to date by periodically fetching the items updated since its
+    last refresh. It is rebuilt from scratch every once in a while to forget about deleted items. The search methods
+    return None while the index is not ready or if the collection is too big to be indexed so the callers can fall
+    back on datastore queries.
+    """
+
+    def __init__(self, collection: ESCollection, tlsh_field: str, ssdeep_field: str, date_field: str,
+                 max_items: int, recent_only: bool = False, refresh_interval: int = REFRESH_INTERVAL,
+                 rebuild_interval: int = REBUILD_INTERVAL):
+        self.collection = collection
+        self.tlsh_field = tlsh_field
+        self.ssdeep_field = ssdeep_field
+        self.date_field = date_field
+        self.max_items = max_items
+        self.recent_only = recent_only
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.lock = threading.Lock()
+        self.tlsh = None
+        self.ssdeep = None
+        self.last_refresh = 0
+        self.last_rebuild = 0
+        self.refresh_from = None
+        self.indexed_from = None
+        self.oversized = False
+
+    def _add(self, tlsh_index: TLSHIndex, ssdeep_index: SSDeepIndex, item: dict):
+        if item.get(self.tlsh_field, None):
+            tlsh_index.add(item['id'], item[self.tlsh_field])
+        if item.get(self.ssdeep_field, None):
+            ssdeep_index.add(item['id'], item[self.ssdeep_field])
+
+    def _load(self, tlsh_index: TLSHIndex, ssdeep_index: SSDeepIndex, query: str):
+        for item in self.collection.stream_search(query, fl=f"id,{self.tlsh_field},{self.ssdeep_field}",
+                                                  as_obj=False):
+            self._add(tlsh_index, ssdeep_index, flatten(item))
+
+    def _load_recent(self, tlsh_index: TLSHIndex, ssdeep_index: SSDeepIndex) -> str:
+        """Load the max_items most recent items and return the date of the oldest one"""
+        oldest = None
+        loaded = 0
+        deep_paging_id = "*"
+        while deep_paging_id and loaded < self.max_items:
+            res = self.collection.search(self._query(), rows=min(LOAD_PAGE_SIZE, self.max_items - loaded),
+                                         sort=f"{self.date_field} desc", deep_paging_id=deep_paging_id,
+                                         fl=f"id,{self.tlsh_field},{self.ssdeep_field},{self.date_field}",
+                                         as_obj=False)
+            for item in res['items']:
+                item = flatten(item)
+                self._add(tlsh_index, ssdeep_index, item)
+                oldest = item.get(self.date_field, oldest)
+
+            loaded += len(res['items'])
+            deep_paging_id = res.get('next_deep_paging_id', None) if res['items'] else None
+        return oldest
+
+    def _query(self):
+        return f"{self.tlsh_field}:* OR {self.ssdeep_field}:*"
+
+    def _rebuild(self):
+        refresh_from = now_as_iso(-REFRESH_OVERLAP)
+        total = self.collection.search(self._query(), rows=0, track_total_hits=True, as_obj=False)['total']
+        tlsh_index, ssdeep_index = TLSHIndex(), SSDeepIndex()
+        if total <= self.max_items:
+            self._load(tlsh_index, ssdeep_index, self._query())
+            indexed_from = None
+        elif self.recent_only:
+            indexed_from = self._load_recent(tlsh_index, ssdeep_index)
+        else:
+            LOGGER.warning(f"Too many items in the {self.collection.name} index to build its similarity index "
+                           f"({total} > {self.max_items}), similarity searches will use the datastore.")
+            self.tlsh = self.ssdeep = None
+            self.oversized = True
+            return
+
+        self.tlsh, self.ssdeep, self.indexed_from = tlsh_index, ssdeep_index, indexed_from
+        self.oversized = False
+        self.refresh_from = refresh_from
+        since = f" of the items since {indexed_from}" if indexed_from else ""
+        LOGGER.info(f"Similarity index of the {self.collection.name} index built: "
+                    f"{len(tlsh_index)} TLSH and {len(ssdeep_index)} SSDEEP hashes{since}")
+
+    def _refresh(self):
+        refresh_from = now_as_iso(-REFRESH_OVERLAP)
+        self._load(self.tlsh, self.ssdeep, f"({self._query()}) AND {self.date_field}:[{self.refresh_from} TO now]")
+        self.refresh_from = refresh_from
+
+    # noinspection PyBroadException
+    def _update(self):
+        try:
+            now = time.time()
+            if self.oversized and now - self.last_rebuild < self.rebuild_interval:
+                # The collection is only counted again at the next rebuild
+                return
+            if self.tlsh is None or now - self.last_rebuild >= self.rebuild_interval:
+                self.last_rebuild = now
+                self._rebuild()
+            elif self.refresh_from is not None:
+                self._refresh()
+        except Exception:
+            LOGGER.exception(f"Failed to update the similarity index of the {self.collection.name} index")
+        finally:
+            self.last_refresh = time.time()
+            self.lock.release()
+
+    def _ensure_fresh(self):
+        if self.max_items <= 0 or time.time() - self.last_refresh < self.refresh_interval:
+            return
+
+        # Updates are done in the background, the current index is used in the meantime
+        if self.lock.acquire(blocking=False):
+            threading.Thread(target=self._update, daemon=True).start()
+
+    def search_tlsh(self, value, threshold=TLSH_DEFAULT_THRESHOLD, rows=10):
+        """Return the closest (key, distance) pairs or None if the index is not available. Raises ValueError."""
+        self._ensure_fresh()
+        index = self.tlsh
+        if index is None:
+            return None
+        return index.search(value, threshold=threshold, rows=rows)
+
+    def search_ssdeep(self, value, threshold=SSDEEP_DEFAULT_THRESHOLD, rows=10):
+        """Return the most similar (key, score) pairs or None if the index is not available. Raises ValueError."""
+        self._ensure_fresh()
+        index = self.ssdeep
+        if index is None:
+            return None
+        return index.search(value, threshold=threshold, rows=rows)
+
+
+def get_similar_items(collection: ESCollection, matches: list, classification, user_classification: str,
+                      match_field: str, fl: str = "*") -> list:
+    """Get the items of a list of (id, distance or score) matches the user has access to, in the order of the matches.
+
+    The distance or score of each match is added to its item under match_field. The items are fetched by ID since the
+    IDs can be raw hashes that are not valid in a search query.
+    """
+    if not matches:
+        return []
+
+    try:
+        items = collection.multiget([key for key, _ in matches], as_dictionary=True, as_obj=False)
+    except MultiKeyError as e:
+        items = e.partial_output
+
+    fields = None if '*' in fl.split(',') else fl.split(',')
+    output = []
+    for key, value in matches:
+        item = items.get(key, None)
+        if item is None or not classification.is_accessible(user_classification, item['classification']):
+            continue
+
+        if fields is not None:
+            flat = flatten(item)
+            item = unflatten({k: v for k, v in flat.items()
+                              if any(k == field or k.startswith(f"{field}.") for field in fields)})
+        item[match_field] = value
+        output.append(item)
+    return output
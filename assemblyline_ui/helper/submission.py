@@ -9,6 +9,7 @@ import tempfile
 from typing import List
 from urllib.parse import urlparse
 
+from assemblyline.common import forge
 from assemblyline.common.file import make_uri_file
 from assemblyline.common.isotime import now_as_iso
 from assemblyline.common.str_utils import safe_str
@@ -16,11 +17,20 @@ from assemblyline.common.iprange import is_ip_reserved
 from assemblyline.odm.models.config import HASH_PATTERN_MAP
 from assemblyline.odm.messages.submission import SubmissionMessage
 from assemblyline.odm.models.user import ROLES
-from assemblyline_ui.config import STORAGE, CLASSIFICATION, SUBMISSION_TRAFFIC, config, FILESTORE, ARCHIVESTORE
+from assemblyline.datastore.exceptions import MultiKeyError
+from assemblyline.remote.datatypes.hash import ExpiringHash
+from assemblyline_ui.config import STORAGE, CLASSIFICATION, SUBMISSION_TRAFFIC, config, FILESTORE, ARCHIVESTORE, \
+    CACHE, LOGGER, redis
+from assemblyline_ui.helper.result import format_result
 
 # Baseline fetch methods
 FETCH_METHODS = set(list(HASH_PATTERN_MAP.keys()) + ['url'])
 
+# Cache duration of the per-file result views
+FILE_RESULTS_LIVE_TTL = 60 * 5  # 5 Minutes
+FILE_RESULTS_COMPLETED_TTL = config.datastore.cache_dtl * 24 * 60 * 60
+FILE_RESULTS_AGGREGATES = ["attack_matrix", "classification", "heuristics", "signatures", "tags"]
+
 # Update our fetch methods based on what's in our configuration
 [FETCH_METHODS.update(set(x.hash_types)) for x in config.submission.file_sources]
 
@@ -308,6 +318,191 @@ def get_or_create_summary(sid, results, user_classification, completed):
     }
 
 
+def _get_heuristic_type(score):
+    if score >= config.submission.verdicts.malicious:
+        return "malicious"
+    elif score >= config.submission.verdicts.suspicious:
+        return "suspicious"
+    elif score >= config.submission.verdicts.info:
+        return "info"
+    return "safe"
+
+
+def _aggregate_file_results(view, results):
+    done_heuristics = set(item[0] for items in view['heuristics'].values() for item in items)
+    signatures = set(tuple(sig) for sig in view['signatures'])
+
+    for res in results:
+        view['classification'] = CLASSIFICATION.max_classification(view['classification'], res['classification'])
+        sorted_sections = sorted(res.get('result', {}).get('sections', []),
+                                 key=lambda i: i['heuristic']['score'] if i['heuristic'] is not None else 0,
+                                 reverse=True)
+        for sec in sorted_sections:
+            h_type = "info"
+            if sec.get('heuristic', False):
+                h_type = _get_heuristic_type(sec['heuristic']['score'])
+
+                if sec['heuristic']['heur_id'] not in done_heuristics:
+                    view['heuristics'].setdefault(h_type, [])
+                    view['heuristics'][h_type].append([sec['heuristic']['heur_id'], sec['heuristic']['name']])
+                    done_heuristics.add(sec['heuristic']['heur_id'])
+
+                # Process Attack matrix
+                for attack in sec['heuristic'].get('attack', []):
+                    attack_id = attack['attack_id']
+                    for cat in attack['categories']:
+                        view['attack_matrix'].setdefault(cat, [])
+                        item = [attack_id, attack['pattern'], h_type]
+                        if item not in view['attack_matrix'][cat]:
+                            view['attack_matrix'][cat].append(item)
+
+                # Process Signatures
+                for signature in sec['heuristic'].get('signature', []):
+                    signatures.add((signature['name'], h_type, signature.get('safe', False)))
+
+            # Process tags
+            for t in sec['tags']:
+                view["tags"].setdefault(t['type'], {})
+                current_htype, _, _ = view["tags"][t['type']].get(t['value'], (None, None, None))
+                tag_htype = h_type
+                if current_htype:
+                    if 'malicious' in (current_htype, h_type):
+                        tag_htype = 'malicious'
+                    elif 'suspicious' in (current_htype, h_type):
+                        tag_htype = 'suspicious'
+                    else:
+                        tag_htype = 'info'
+                view["tags"][t['type']][t['value']] = [tag_htype, t['safelisted'], sec['classification']]
+
+    view['signatures'] = [list(sig) for sig in signatures]
+
+
+def _new_file_results_view(completed):
+    return {
+        "attack_matrix": {},
+        "classification": CLASSIFICATION.UNRESTRICTED,
+        "completed": completed,
+        "errors": {},
+        "heuristics": {},
+        "results": {},
+        "signatures": [],
+        "skipped_results": [],
+        "tags": {}
+    }
+
+
+def _load_live_file_results(live):
+    """Rebuild a view from the redis hash of a running submission, one field per result and error.
+
+    Concurrent calls each write the aggregates of their own view with the keys of the results they cover, so the
+    results missed by the aggregates that were last written are aggregated again.
+    """
+    view = _new_file_results_view(False)
+    aggregated = set()
+    for field, value in live.items().items():
+        if field == "aggregates":
+            aggregated = set(value.pop('result_keys', []))
+            view.update(value)
+            continue
+
+        kind, _, key = field.partition('.')
+        if kind == "result":
+            view['results'][key] = value
+        elif kind == "skipped":
+            view['skipped_results'].append(key)
+        elif kind == "error":
+            view['errors'][key] = value
+
+    _aggregate_file_results(view, [r for key, r in view['results'].items() if key not in aggregated])
+    return view
+
+
+# noinspection PyBroadException
+def get_or_create_file_results(sid, sha256, result_keys, error_keys, user_classification, file_classification,
+                               completed):
+    """Get the formatted results, errors and their aggregated heuristics, attack matrix, signatures and tags
+    of a file in a submission as seen by a given user classification.
+
+    Only the result and error keys that were not previously seen are fetched and applied to the view. Views of
+    running submissions are kept in a redis hash for a short time, each call only writes the results and errors it
+    added. Views of completed submissions are saved to the cachestore for the same duration as the submission
+    summaries.
+    """
+    user_classification = CLASSIFICATION.normalize_classification(user_classification, long_format=False)
+    file_classification = CLASSIFICATION.normalize_classification(file_classification, long_format=False)
+    cache_key = CACHE.create_key(sid, sha256, user_classification, file_classification,
+                                 config.submission.verdicts.malicious, config.submission.verdicts.suspicious,
+                                 config.submission.verdicts.info, "file_results")
+
+    result_keys = set(k for k in result_keys if k.startswith(sha256))
+    error_keys = set(k for k in error_keys if k.startswith(sha256))
+
+    view = None
+    if completed:
+        try:
+            with forge.get_cachestore('file_results', config=config, datastore=STORAGE) as cache:
+                cached = cache.get(cache_key)
+            if cached:
+                view = json.loads(cached)
+        except Exception:
+            LOGGER.exception('Failed to read cached file results:')
+
+    live = ExpiringHash(f"file_results-{cache_key}", ttl=FILE_RESULTS_LIVE_TTL, host=redis)
+    changes = {}
+    if view is None:
+        view = _load_live_file_results(live)
+        if completed:
+            # Live mode may have added keys that are not part of the final submission, rebuild the aggregates from
+            # the results we already have that are still part of it
+            old_view = view
+            view = _new_file_results_view(completed)
+            view['results'] = {k: v for k, v in old_view['results'].items() if k in result_keys}
+            view['skipped_results'] = [k for k in old_view['skipped_results'] if k in result_keys]
+            view['errors'] = {k: v for k, v in old_view['errors'].items() if k in error_keys}
+            _aggregate_file_results(view, view['results'].values())
+            changes['completed'] = True
+
+    # Only fetch what was not already applied to the view
+    new_result_keys = list(result_keys.difference(view['results'].keys()).difference(view['skipped_results']))
+    new_error_keys = list(error_keys.difference(view['errors'].keys()))
+
+    if new_result_keys:
+        new_results = []
+        for key, r in STORAGE.get_multiple_results(new_result_keys, cl_engine=CLASSIFICATION, as_obj=False).items():
+            r = format_result(user_classification, r, file_classification, build_hierarchy=True)
+            if r:
+                view['results'][key] = r
+                new_results.append(r)
+                changes[f"result.{key}"] = r
+            else:
+                view['skipped_results'].append(key)
+                changes[f"skipped.{key}"] = True
+        _aggregate_file_results(view, new_results)
+
+    if new_error_keys:
+        try:
+            errors = STORAGE.error.multiget(new_error_keys, as_obj=False, as_dictionary=True)
+        except MultiKeyError as e:
+            LOGGER.warning(f"Trying to get multiple errors but some are missing: {str(e.keys)}")
+            errors = e.partial_output
+        view['errors'].update(errors)
+        changes.update({f"error.{key}": error for key, error in errors.items()})
+
+    if changes and completed:
+        try:
+            with forge.get_cachestore('file_results', config=config, datastore=STORAGE) as cache:
+                cache.save(cache_key, json.dumps(view).encode('utf-8'), ttl=FILE_RESULTS_COMPLETED_TTL, force=True)
+            live.delete()
+        except Exception:
+            LOGGER.exception('Failed to cache file results:')
+    elif changes:
+        changes['aggregates'] = {k: view[k] for k in FILE_RESULTS_AGGREGATES}
+        changes['aggregates']['result_keys'] = list(view['results'].keys())
+        live.multi_set(changes)
+
+    return view
+
+
 def submission_received(submission):
     SUBMISSION_TRAFFIC.publish(SubmissionMessage({
         'msg': submission,
@@ -1,3 +1,8 @@
+import threading
+import time
+
+from collections import OrderedDict
+from copy import deepcopy
 from typing import Optional
 
 from flask import session as flsk_session
@@ -5,10 +10,12 @@ from flask import session as flsk_session
 from assemblyline.common.str_utils import safe_str
 from assemblyline.odm.models.user import User, load_roles, ROLES
 from assemblyline.odm.models.user_settings import UserSettings
+from assemblyline.remote.datatypes.events import EventSender, EventWatcher
 from assemblyline_ui.config import ASYNC_SUBMISSION_TRACKER, DAILY_QUOTA_TRACKER, LOGGER, STORAGE, SUBMISSION_TRACKER, \
     config, CLASSIFICATION as Classification, SERVICE_LIST
 from assemblyline_ui.helper.service import get_default_service_spec, get_default_service_list, simplify_services
 from assemblyline_ui.http_exceptions import AccessDeniedException, InvalidDataException, AuthenticationException
+from assemblyline_ui.security.apikey_auth import APIKEY_CACHE
 
 ACCOUNT_USER_MODIFIABLE = ["name", "avatar", "password"]
 
@@ -22,6 +29,115 @@ API_PRIV_MAP = {
 if config.auth.allow_extended_apikeys:
     API_PRIV_MAP["EXTENDED"] = ["R", "W", "E"]
 
+USER_CACHE_SIZE = 1000
+USER_CACHE_TTL = 60 * 5  # 5 Minutes, safety net in case a change notification is missed
+
+user_event_sender = EventSender('changes.users',
+                                host=config.core.redis.nonpersistent.host,
+                                port=config.core.redis.nonpersistent.port)
+
+
+class UserContextCache(object):
+    """Bounded LRU of the user contexts computed by the login function, local to the current worker.
+
+    Entries are keyed on the username and the roles limit and remember the version of the user document they were
+    computed from. Once an entry expires, it is reused if the version of the user document did not change. Changes
+    to a user are broadcasted on the 'changes.users' channel so every worker drops the stale entries of that user.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _start_watcher(self):
+        # Started lazily so the watcher thread belongs to the worker process and not to its parent
+        if self.watcher is None:
+            with self.lock:
+                if self.watcher is None:
+                    self.watcher = EventWatcher(host=config.core.redis.nonpersistent.host,
+                                                port=config.core.redis.nonpersistent.port)
+                    self.watcher.register('changes.users.*', self._on_user_change)
+                    self.watcher.start()
+
+    def _on_user_change(self, data):
+        if data is None:
+            # We've reconnected to redis, changes might have been missed while we were disconnected
+            self.clear()
+        else:
+            self.drop(data['uname'])
+
+    def get_generation(self, uname):
+        with self.lock:
+            return self.generations.get(uname, 0)
+
+    def get(self, uname, roles_limit):
+        self._start_watcher()
+        key = (uname, None if roles_limit is None else tuple(sorted(roles_limit)))
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is None:
+                return None
+
+            expire_at, _, user = entry
+            if expire_at < time.time():
+                # Kept so it can be revalidated against the version of the user document
+                return None
+
+            self.cache.move_to_end(key)
+
+        # Callers are free to modify the user they receive
+        return deepcopy(user)
+
+    def revalidate(self, uname, roles_limit, version, generation):
+        """Renew an expired entry computed from the given version of the user document, return None if there is none"""
+        key = (uname, None if roles_limit is None else tuple(sorted(roles_limit)))
+        with self.lock:
+            entry = self.cache.get(key, None)
+            if entry is None or entry[1] != version or self.generations.get(uname, 0) != generation:
+                return None
+
+            self.cache[key] = (time.time() + self.ttl, version, entry[2])
+            self.cache.move_to_end(key)
+
+        return deepcopy(entry[2])
+
+    def set(self, uname, roles_limit, version, user, generation):
+        key = (uname, None if roles_limit is None else tuple(sorted(roles_limit)))
+        with self.lock:
+            # The user changed while we were computing its context, don't cache a stale copy
+            if self.generations.get(uname, 0) != generation:
+                return
+
+            self.cache[key] = (time.time() + self.ttl, version, deepcopy(user))
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def drop(self, uname):
+        with self.lock:
+            self.generations[uname] = self.generations.get(uname, 0) + 1
+            for key in [k for k in self.cache.keys() if k[0] == uname]:
+                self.cache.pop(key)
+
+    def clear(self):
+        with self.lock:
+            for uname in set(k[0] for k in self.cache.keys()):
+                self.generations[uname] = self.generations.get(uname, 0) + 1
+            self.cache.clear()
+
+
+USER_CACHE = UserContextCache()
+
+
+def notify_user_change(uname):
+    """Drop the cached contexts of a user in this worker and tell all the other workers to do the same"""
+    USER_CACHE.drop(uname)
+    user_event_sender.send(uname, {'uname': uname})
+
 
 ###########################
 # User Functions
@@ -148,8 +264,19 @@ def decrement_submission_quota(user):
 
 
 def login(uname, roles_limit, user=None):
-    if user is None:
-        user = STORAGE.user.get(uname, as_obj=False)
+    # Impersonated users are provided by the caller and are never cached
+    cacheable = user is None
+    if cacheable:
+        cached_user = USER_CACHE.get(uname, roles_limit)
+        if cached_user is not None:
+            return cached_user
+
+        generation = USER_CACHE.get_generation(uname)
+        user, version = STORAGE.user.get(uname, as_obj=False, version=True)
+        if user:
+            cached_user = USER_CACHE.revalidate(uname, roles_limit, version, generation)
+            if cached_user is not None:
+                return cached_user
 
     if not user:
         raise AuthenticationException("User %s does not exists" % uname)
@@ -180,6 +307,9 @@ def login(uname, roles_limit, user=None):
         if roles_limit is None or r in roles_limit
     ]
 
+    if cacheable:
+        USER_CACHE.set(uname, roles_limit, version, user, generation)
+
     return user
 
 
@@ -235,7 +365,13 @@ def save_user_account(username, data, user):
     else:
         STORAGE.user_avatar.save(username, avatar)
 
-    return STORAGE.user.save(username, data)
+    ret_val = STORAGE.user.save(username, data)
+
+    # Roles or status of the user might have changed, previously verified API keys need to be re-validated. This is
+    # done after the save so a concurrent request can't cache the key again from the previous user document.
+    APIKEY_CACHE.invalidate(username)
+    notify_user_change(username)
+    return ret_val
 
 
 def get_dynamic_classification(current_c12n, user_info):
@@ -0,0 +1,344 @@
+import functools
+import json
+import threading
+import time
+
+from assemblyline.common.isotime import epoch_to_iso, iso_to_epoch, now_as_iso
+from assemblyline.common.uid import get_random_id
+from assemblyline.odm.models.alert import Event
+from assemblyline.remote.datatypes import retry_call
+from assemblyline.remote.datatypes.cache import Cache
+from assemblyline.remote.datatypes.hash import Hash
+from assemblyline.remote.datatypes.queues.comms import CommsQueue
+
+from assemblyline_ui.config import CLASSIFICATION, LOGGER, STORAGE, redis, redis_persistent
+
+# Each slice of a run covers this many alerts, every workflow of the run is applied to a slice before the next one
+SLICE_SIZE = 5000
+# Pause in seconds between slices so a large backfill does not starve the alert index
+SLICE_DELAY = 0.5
+# Alerts reported during the last seconds might not be searchable yet, they are left to the next run
+SETTLE_DELAY = 30
+# Only one worker runs the workflows at a time, the lock expires if the worker dies during a run
+EXECUTOR_LOCK = "workflow_executor_lock"
+EXECUTOR_LOCK_TTL = 120
+POLL_INTERVAL = 5
+# Status of the runs is kept for a day after they are queued
+RUN_STATUS_TTL = 24 * 60 * 60
+
+# The lock holds the random token of the worker that took it, only that worker can refresh or release it
+lock_refresh_script = """
+local lock = KEYS[1]
+if redis.call('get', lock) == ARGV[1] then
+    return redis.call('expire', lock, ARGV[2])
+end
+return 0
+"""
+
+lock_release_script = """
+local lock = KEYS[1]
+if redis.call('get', lock) == ARGV[1] then
+    return redis.call('del', lock)
+end
+return 0
+"""
+
+# Resetting a high water mark bumps the generation of the workflow, a pass only moves the high water mark of a
+# workflow whose generation did not change since the pass started
+reset_high_water_mark_script = """
+redis.call('hincrby', KEYS[2], ARGV[1], 1)
+return redis.call('hdel', KEYS[1], ARGV[1])
+"""
+
+set_high_water_mark_script = """
+if (redis.call('hget', KEYS[2], ARGV[1]) or '0') == ARGV[2] then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class ExecutorLockLost(Exception):
+    pass
+
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Runs that are not finished, the executor resumes them where they stopped if their worker died
+ACTIVE_RUNS = Hash("workflow_active_runs", host=redis_persistent)
+# Every alert reported up to the high water mark of a workflow was already processed by it
+HIGH_WATER_MARKS = Hash("workflow_high_water_marks", host=redis_persistent)
+HIGH_WATER_MARK_GENERATIONS = Hash("workflow_high_water_mark_generations", host=redis_persistent)
+RUN_STATUS = Cache(prefix="workflow_run", host=redis_persistent)
+RUN_TRAFFIC = CommsQueue('workflow_runs', host=redis)
+
+executor = None
+executor_lock = threading.Lock()
+executor_lock_token = None
+_lock_refresh = redis.register_script(lock_refresh_script)
+_lock_release = redis.register_script(lock_release_script)
+_reset_high_water_mark = redis_persistent.register_script(reset_high_water_mark_script)
+_set_high_water_mark = redis_persistent.register_script(set_high_water_mark_script)
+
+
+def get_alert_update_ops(workflow: dict):
+    operations = []
+    if workflow['status']:
+        operations.append((STORAGE.alert.UPDATE_SET, 'status', workflow['status']))
+    if workflow['priority']:
+        operations.append((STORAGE.alert.UPDATE_SET, 'priority', workflow['priority']))
+    for label in workflow['labels']:
+        operations.append((STORAGE.alert.UPDATE_APPEND_IF_MISSING, 'label', label))
+
+    if operations:
+        # Make sure operations get audited
+        operations.append((STORAGE.alert.UPDATE_APPEND,
+                           'events',
+                           Event({
+                               "entity_type": "workflow",
+                               "entity_id": workflow['workflow_id'],
+                               "entity_name": workflow['name'],
+                               "priority": workflow['priority'],
+                               "status": workflow['status'],
+                               "labels": workflow['labels'] or None,
+                           })
+                           ))
+
+    return operations
+
+
+def reset_high_water_mark(workflow_id: str):
+    """Make the next run of a workflow process all the alerts again"""
+    retry_call(_reset_high_water_mark, keys=[HIGH_WATER_MARKS.name, HIGH_WATER_MARK_GENERATIONS.name],
+               args=[workflow_id])
+
+
+def get_run_status(run_id: str):
+    _start_executor()
+    return RUN_STATUS.get(run_id, reset=False)
+
+
+def _save_status(status: dict):
+    status['last_update'] = now_as_iso()
+    RUN_STATUS.set(status['run_id'], status, ttl=RUN_STATUS_TTL)
+    if status['status'] in [QUEUED, RUNNING]:
+        ACTIVE_RUNS.set(status['run_id'], status['created'])
+    else:
+        ACTIVE_RUNS.pop(status['run_id'])
+    RUN_TRAFFIC.publish({"msg_type": "workflow_run", "msg": status})
+
+
+def queue_run(workflows: list[dict], creator: str, full: bool = False) -> dict:
+    """Queue a run of workflows on the alerts they did not process yet, or on all the alerts if full is set.
+
+    The run is done in the background by the workflow executor of one of the workers, its status can be polled with
+    get_run_status or watched through the workflow_runs socket.io namespace.
+    """
+    if full:
+        for workflow in workflows:
+            reset_high_water_mark(workflow['workflow_id'])
+
+    status = {
+        "run_id": get_random_id(),
+        "workflow_ids": [workflow['workflow_id'] for workflow in workflows],
+        "classification": functools.reduce(CLASSIFICATION.max_classification,
+                                           [workflow['classification'] for workflow in workflows],
+                                           CLASSIFICATION.UNRESTRICTED),
+        "creator": creator,
+        "status": QUEUED,
+        "created": now_as_iso(),
+        "started": None,
+        "finished": None,
+        "start_ts": None,
+        "end_ts": None,
+        "current_ts": None,
+        "progress": 0.0,
+        "slices": 0,
+        "updated": 0,
+        "errors": [],
+    }
+    _save_status(status)
+    _start_executor()
+    return status
+
+
+def _range_filter(lower, upper):
+    if lower is None:
+        return f"reporting_ts:[* TO {upper}]"
+    return f"reporting_ts:{{{lower} TO {upper}]"
+
+
+def _next_slice_end(lower, end_ts):
+    """Reporting time of the last alert of the slice starting after lower"""
+    res = STORAGE.alert.search("id:*", filters=[_range_filter(lower, end_ts)], offset=SLICE_SIZE - 1, rows=1,
+                               sort="reporting_ts asc", fl="reporting_ts", as_obj=False, track_total_hits=False)
+    if res['items']:
+        return res['items'][0]['reporting_ts']
+    return end_ts
+
+
+def _oldest_alert_ts(end_ts):
+    res = STORAGE.alert.search("id:*", filters=[_range_filter(None, end_ts)], rows=1, sort="reporting_ts asc",
+                               fl="reporting_ts", as_obj=False, track_total_hits=False)
+    if res['items']:
+        return res['items'][0]['reporting_ts']
+    return None
+
+
+def _is_after(first, second):
+    if first is None:
+        return False
+    if second is None:
+        return True
+    return iso_to_epoch(first) > iso_to_epoch(second)
+
+
+def _refresh_lock():
+    # Another worker may have taken over the runs if the lock expired, it must not apply them a second time
+    if not retry_call(_lock_refresh, keys=[EXECUTOR_LOCK], args=[executor_lock_token, EXECUTOR_LOCK_TTL]):
+        raise ExecutorLockLost("The workflow executor lock expired before it could be refreshed")
+
+
+def _finish(runs, state):
+    for status in runs:
+        status['status'] = state
+        status['finished'] = now_as_iso()
+        if state == COMPLETED:
+            status['progress'] = 1.0
+        _save_status(status)
+
+
+def execute_runs(runs: list[dict]):
+    """Process the new alerts of the workflows of many runs in a single pass.
+
+    The alerts are processed oldest first in slices, all the workflows are applied to a slice before moving on to
+    the next one. The high water mark of each workflow is saved after every slice so an interrupted run is resumed
+    where it stopped.
+    """
+    # Read before the workflows and their high water marks so an edit or a reset in between is always noticed
+    generations = {}
+    for status in runs:
+        for workflow_id in status['workflow_ids']:
+            if workflow_id not in generations:
+                generations[workflow_id] = HIGH_WATER_MARK_GENERATIONS.get(workflow_id) or 0
+
+    workflows = {workflow_id: STORAGE.workflow.get(workflow_id, as_obj=False) for workflow_id in generations}
+    workflows = {workflow_id: workflow for workflow_id, workflow in workflows.items()
+                 if workflow and get_alert_update_ops(workflow)}
+
+    end_ts = epoch_to_iso(time.time() - SETTLE_DELAY)
+    marks = {workflow_id: HIGH_WATER_MARKS.get(workflow_id) for workflow_id in workflows}
+    lower = None if not marks or None in marks.values() else min(marks.values(), key=iso_to_epoch)
+    first_ts = lower or _oldest_alert_ts(end_ts)
+    if not workflows or first_ts is None or not _is_after(end_ts, lower):
+        _finish(runs, COMPLETED)
+        return
+
+    for status in runs:
+        status.update({"status": RUNNING, "started": status['started'] or now_as_iso(), "start_ts": first_ts,
+                       "end_ts": end_ts, "current_ts": lower or first_ts})
+        _save_status(status)
+
+    hits = {workflow_id: 0 for workflow_id in workflows}
+    failed = set()
+    reset = set()
+    errors = []
+    while True:
+        upper = _next_slice_end(lower, end_ts)
+        for workflow_id, workflow in workflows.items():
+            if workflow_id in failed or workflow_id in reset or not _is_after(upper, marks[workflow_id]):
+                continue
+
+            slice_lower = marks[workflow_id] if _is_after(marks[workflow_id], lower) else lower
+            _refresh_lock()
+            count = STORAGE.alert.update_by_query(workflow['query'], get_alert_update_ops(workflow),
+                                                  filters=[_range_filter(slice_lower, upper)])
+            if count is False:
+                # The workflow stays at its high water mark and is retried by its next run
+                failed.add(workflow_id)
+                errors.append(f"Failed to apply workflow {workflow['name']} on the alerts reported after "
+                              f"{slice_lower or 'the first alert'}")
+                continue
+
+            hits[workflow_id] += count
+            if not retry_call(_set_high_water_mark, keys=[HIGH_WATER_MARKS.name, HIGH_WATER_MARK_GENERATIONS.name],
+                              args=[workflow_id, generations[workflow_id], json.dumps(upper)]):
+                # The workflow was edited or fully rerun during the pass, its next run starts over
+                reset.add(workflow_id)
+                continue
+            marks[workflow_id] = upper
+
+        span = iso_to_epoch(end_ts) - iso_to_epoch(first_ts)
+        progress = (iso_to_epoch(upper) - iso_to_epoch(first_ts)) / span if span > 0 else 1.0
+        for status in runs:
+            status['current_ts'] = upper
+            status['progress'] = min(1.0, progress)
+            status['slices'] += 1
+            status['updated'] = sum(hits.get(workflow_id, 0) for workflow_id in status['workflow_ids'])
+            status['errors'] = errors
+            _save_status(status)
+
+        if not _is_after(end_ts, upper):
+            break
+        lower = upper
+        time.sleep(SLICE_DELAY)
+
+    seen = now_as_iso()
+    for workflow_id, count in hits.items():
+        if count:
+            operations = [
+                (STORAGE.workflow.UPDATE_INC, 'hit_count', count),
+                (STORAGE.workflow.UPDATE_SET, 'last_seen', seen),
+            ]
+            if not workflows[workflow_id].get('first_seen', None):
+                operations.append((STORAGE.workflow.UPDATE_SET, 'first_seen', seen))
+            STORAGE.workflow.update(workflow_id, operations)
+
+    _finish(runs, FAILED if errors else COMPLETED)
+
+
+# noinspection PyBroadException
+def _executor_loop():
+    global executor_lock_token
+    while True:
+        try:
+            # A single worker runs the workflows, runs queued while it is busy are grouped in its next pass
+            executor_lock_token = get_random_id()
+            if retry_call(redis.set, EXECUTOR_LOCK, executor_lock_token, nx=True, ex=EXECUTOR_LOCK_TTL):
+                try:
+                    run_ids = [run_id for run_id, _ in sorted(ACTIVE_RUNS.items().items(), key=lambda x: x[1])]
+                    runs = [status for status in (RUN_STATUS.get(run_id, reset=False) for run_id in run_ids)
+                            if status]
+                    for run_id in set(run_ids) - {status['run_id'] for status in runs}:
+                        # The status of the run expired
+                        ACTIVE_RUNS.pop(run_id)
+
+                    if runs:
+                        try:
+                            execute_runs(runs)
+                        except ExecutorLockLost as e:
+                            # The runs are left to the worker that now holds the lock
+                            LOGGER.warning(f"Workflow runs interrupted: {e}")
+                        except Exception as e:
+                            LOGGER.exception("Failed to run the workflows")
+                            for status in runs:
+                                status['errors'].append(str(e))
+                            _finish(runs, FAILED)
+                finally:
+                    retry_call(_lock_release, keys=[EXECUTOR_LOCK], args=[executor_lock_token])
+        except Exception:
+            LOGGER.exception("Workflow executor failure")
+        time.sleep(POLL_INTERVAL)
+
+
+def _start_executor():
+    # Started lazily so only the workers handling workflows poll for runs
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = threading.Thread(target=_executor_loop, daemon=True)
+            executor.start()
@@ -0,0 +1,114 @@
+"""
+Report what a UI worker spends its startup time on.
+
+The module is imported in a fresh interpreter with python's import time tracing, the slowest modules are listed with
+their own import time and the time including their imports. With --init, the lazy global instances of the
+configuration and the hash search datasources are then created and their creation time is reported as well.
+
+Usage: python -m assemblyline_ui.profile_startup [--init] [--top N] [module]
+  ex: python -m assemblyline_ui.profile_startup --init --top 30 assemblyline_ui.app
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+DEFAULT_MODULE = "assemblyline_ui.app"
+DEFAULT_TOP = 25
+REPORT_PREFIX = "STARTUP_REPORT:"
+
+# Runs in the profiled interpreter, prints its report as a single JSON line
+CHILD_SCRIPT = """
+import importlib
+import json
+import resource
+import sys
+import time
+
+start = time.time()
+importlib.import_module(sys.argv[1])
+report = {"import_time": time.time() - start, "init_times": {}}
+report["import_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if sys.argv[2] == "init":
+    from assemblyline_ui import config
+    from assemblyline_ui.helper.lazy import INIT_TIMES, LazyObject
+    for value in list(vars(config).values()):
+        if isinstance(value, LazyObject):
+            value.lazy_load()
+    report["init_times"].update(INIT_TIMES)
+
+    from assemblyline_ui.api.v4 import hash_search
+    start = time.time()
+    hash_search.get_datasources()
+    report["init_times"]["hash_search datasources"] = time.time() - start
+
+report["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print("%s" + json.dumps(report))
+""" % REPORT_PREFIX
+
+
+def parse_import_times(trace: str) -> list[tuple[str, float, float]]:
+    """Parse the output of `python -X importtime` into a list of (module, self time, cumulative time) in seconds"""
+    output = []
+    for line in trace.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            self_us, cumulative_us, module = line[len("import time:"):].split("|")
+            output.append((module.strip(), int(self_us) / 1000000, int(cumulative_us) / 1000000))
+        except ValueError:
+            # Header line
+            continue
+    return output
+
+
+def profile(module: str = DEFAULT_MODULE, init: bool = False) -> dict:
+    """Import a module in a fresh interpreter and return its startup report.
+
+    The report contains the total import time in seconds, the import time of each module, the creation time of the
+    lazy global instances when they are initialized and the peak RSS in kilobytes after the import and at the end.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT, module, "init" if init else ""],
+                          capture_output=True, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith(REPORT_PREFIX):
+            report = json.loads(line[len(REPORT_PREFIX):])
+            break
+    else:
+        raise RuntimeError(f"Could not import {module}:\n{proc.stderr[-4000:]}")
+
+    report["modules"] = parse_import_times(proc.stderr)
+    return report
+
+
+def print_report(report: dict, top: int = DEFAULT_TOP):
+    print(f"Imported in {report['import_time']:.3f}s, peak RSS {report['import_rss'] / 1024:.1f}MB")
+
+    print(f"\nSlowest {top} modules (including their imports):")
+    for name, self_time, cumulative in sorted(report["modules"], key=lambda x: x[2], reverse=True)[:top]:
+        print(f"  {cumulative:8.3f}s  {self_time:8.3f}s  {name}")
+
+    print(f"\nSlowest {top} modules (excluding their imports):")
+    for name, self_time, cumulative in sorted(report["modules"], key=lambda x: x[1], reverse=True)[:top]:
+        print(f"  {self_time:8.3f}s  {name}")
+
+    if report["init_times"]:
+        print("\nGlobal instances:")
+        for name, elapsed in sorted(report["init_times"].items(), key=lambda x: x[1], reverse=True):
+            print(f"  {elapsed:8.3f}s  {name}")
+        print(f"\nPeak RSS once initialized {report['rss'] / 1024:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import and initialization time of the UI modules")
+    parser.add_argument("module", nargs="?", default=DEFAULT_MODULE, help="Module to import")
+    parser.add_argument("--init", action="store_true", help="Also create the lazy global instances")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="Number of modules listed")
+    args = parser.parse_args()
+
+    print_report(profile(args.module, init=args.init), top=args.top)
+
+
+if __name__ == '__main__':
+    main()
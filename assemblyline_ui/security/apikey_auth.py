@@ -1,10 +1,67 @@
+import hashlib
+import hmac
+import time
+
 import elasticapm
 
 from assemblyline.odm.models.user import load_roles_form_acls, ROLES, load_roles
-from assemblyline_ui.config import config
+from assemblyline.remote.datatypes.hash import ExpiringHash, Hash
+from assemblyline_ui.config import config, redis, SECRET_KEY
 from assemblyline.common.security import verify_password
 from assemblyline_ui.http_exceptions import AuthenticationException
 
+APIKEY_CACHE_TTL = 60 * 5  # 5 Minutes
+
+
+class APIKeyCache(object):
+    """Cache of successfully verified API keys shared across all UI workers.
+
+    The secret part of the key is never stored, only a keyed digest of (username, key name, secret). A cache hit
+    therefore skips both the user lookup in the datastore and the bcrypt verification of the key.
+    """
+
+    def __init__(self, host=None, ttl=APIKEY_CACHE_TTL):
+        self.host = host
+        self.ttl = ttl
+        self.stats = Hash("apikey_cache_stats", host=host)
+
+    def _get_hash(self, username) -> ExpiringHash:
+        return ExpiringHash(f"apikey_cache_{username}", ttl=self.ttl, host=self.host)
+
+    @staticmethod
+    def _get_digest(username, name, secret):
+        return hmac.new(SECRET_KEY.encode(), f"{username}:{name}:{secret}".encode(), hashlib.sha256).hexdigest()
+
+    def get(self, username, name, secret):
+        entry = self._get_hash(username).get(name)
+        if entry and entry['expire_at'] > time.time() and \
+                hmac.compare_digest(entry['digest'], self._get_digest(username, name, secret)):
+            self.stats.increment('hits')
+            return entry['roles_limit']
+
+        self.stats.increment('misses')
+        return None
+
+    def add(self, username, name, secret, roles_limit):
+        self._get_hash(username).set(name, {
+            'digest': self._get_digest(username, name, secret),
+            'expire_at': time.time() + self.ttl,
+            'roles_limit': list(roles_limit)
+        })
+
+    def invalidate(self, username, name=None):
+        if name is None:
+            self._get_hash(username).delete()
+        else:
+            self._get_hash(username).pop(name)
+
+    def get_stats(self):
+        stats = self.stats.items()
+        return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0)}
+
+
+APIKEY_CACHE = APIKeyCache(host=redis)
+
 
 @elasticapm.capture_span(span_type='authentication')
 def validate_apikey(username, apikey, storage):
@@ -14,23 +71,30 @@ def validate_apikey(username, apikey, storage):
         raise AuthenticationException("APIKey login is disabled")
 
     if config.auth.allow_apikeys and apikey:
+        try:
+            name, apikey_password = apikey.split(":", 1)
+        except ValueError:
+            raise AuthenticationException("Invalid user or APIKey")
+
+        # Previously verified keys skip the datastore lookup and the bcrypt check
+        apikey_roles_limit = APIKEY_CACHE.get(username, name, apikey_password)
+        if apikey_roles_limit is not None:
+            return username, apikey_roles_limit
+
         user_data = storage.user.get(username)
         if user_data:
             if ROLES.apikey_access not in load_roles(user_data.type, user_data.roles):
                 raise AuthenticationException("This user is not allow to user API Keys")
 
-            try:
-                name, apikey_password = apikey.split(":", 1)
-                key = user_data.apikeys.get(name, None)
+            key = user_data.apikeys.get(name, None)
 
-                if key is not None:
-                    if verify_password(apikey_password, key.password):
-                        # Load user and API key roles
-                        apikey_roles_limit = load_roles_form_acls(key.acl, key.roles)
+            if key is not None:
+                if verify_password(apikey_password, key.password):
+                    # Load user and API key roles
+                    apikey_roles_limit = load_roles_form_acls(key.acl, key.roles)
+                    APIKEY_CACHE.add(username, name, apikey_password, apikey_roles_limit)
 
-                        return username, apikey_roles_limit
-            except ValueError:
-                pass
+                    return username, apikey_roles_limit
 
         raise AuthenticationException("Invalid user or APIKey")
 
@@ -1,10 +1,13 @@
 import base64
+import threading
+import time
 import zlib
 from assemblyline.odm.models.user import USER_ROLES
 
 from flask import abort, request, current_app, session as flsk_session
 
 from assemblyline.common.isotime import now
+from assemblyline.remote.datatypes.events import EventSender, EventWatcher
 from assemblyline.remote.datatypes.queues.named import NamedQueue
 from assemblyline_ui.config import AUDIT, AUDIT_LOG, AUDIT_KW_TARGET, KV_SESSION
 from assemblyline_ui.config import config
@@ -23,10 +26,102 @@ nonpersistent_config = {
 }
 
 
+# Only write the session back to redis once this ratio of its duration has elapsed since the last refresh
+SESSION_REFRESH_RATIO = 0.1
+# How long a worker can trust the copy of a session it loaded from redis
+SESSION_LOCAL_CACHE_TTL = 5
+SESSION_LOCAL_CACHE_SIZE = 10000
+
+session_event_sender = EventSender('changes.sessions',
+                                   host=config.core.redis.nonpersistent.host,
+                                   port=config.core.redis.nonpersistent.port)
+
+
 class InvalidRole(Exception):
     pass
 
 
+class SessionStore(object):
+    """Access to the user sessions saved in redis with a short-lived local cache of the decoded sessions.
+
+    Sliding the expiry of a session only writes it back to redis when it has drifted by more than
+    SESSION_REFRESH_RATIO of the session duration instead of on every request. Dropped sessions are broadcasted on
+    the 'changes.sessions' channel so every worker forgets its local copy right away.
+    """
+
+    def __init__(self, kv_session, local_ttl=SESSION_LOCAL_CACHE_TTL, local_size=SESSION_LOCAL_CACHE_SIZE,
+                 refresh_ratio=SESSION_REFRESH_RATIO):
+        self.kv_session = kv_session
+        self.local_ttl = local_ttl
+        self.local_size = local_size
+        self.refresh_ratio = refresh_ratio
+        self.local = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _start_watcher(self):
+        # Started lazily so the watcher thread belongs to the worker process and not to its parent
+        if self.watcher is None:
+            with self.lock:
+                if self.watcher is None:
+                    self.watcher = EventWatcher(host=config.core.redis.nonpersistent.host,
+                                                port=config.core.redis.nonpersistent.port)
+                    self.watcher.register('changes.sessions.*', self._on_session_drop)
+                    self.watcher.start()
+
+    def _on_session_drop(self, data):
+        if data is None:
+            # We've reconnected to redis, drops might have been missed while we were disconnected
+            with self.lock:
+                self.local.clear()
+        else:
+            self.drop_local(data['session_id'])
+
+    def get(self, session_id):
+        self._start_watcher()
+        with self.lock:
+            entry = self.local.get(session_id, None)
+        if entry is not None and entry[0] > time.time() and entry[1].get('expire_at', 0) >= now():
+            return dict(entry[1])
+
+        session = self.kv_session.get(session_id)
+        if session:
+            self._cache(session_id, session)
+        else:
+            self.drop_local(session_id)
+        return session
+
+    def refresh(self, session_id, session, cur_time):
+        duration = session.get('duration', 3600)
+        new_expiry = cur_time + duration
+        if new_expiry - session.get('expire_at', 0) >= duration * self.refresh_ratio:
+            session['expire_at'] = new_expiry
+            self.kv_session.set(session_id, session)
+            self._cache(session_id, session)
+
+    def drop(self, session_id):
+        """Remove a session from redis and from the local cache of every worker"""
+        self.kv_session.pop(session_id)
+        self.drop_local(session_id)
+        session_event_sender.send(session_id, {'session_id': session_id})
+
+    def drop_local(self, session_id):
+        with self.lock:
+            self.local.pop(session_id, None)
+
+    def _cache(self, session_id, session):
+        with self.lock:
+            if len(self.local) >= self.local_size:
+                cur_time = time.time()
+                self.local = {k: v for k, v in self.local.items() if v[0] > cur_time}
+                if len(self.local) >= self.local_size:
+                    self.local.clear()
+            self.local[session_id] = (time.time() + self.local_ttl, dict(session))
+
+
+SESSION_STORE = SessionStore(KV_SESSION)
+
+
 class BaseSecurityRenderer(object):
     def __init__(self, require_role=None, audit=True, allow_readonly=True):
         if require_role is None:
@@ -120,19 +215,17 @@ class BaseSecurityRenderer(object):
                 current_app.logger.debug('session_id cookie not found')
                 abort(401, "Session not found")
 
-        session = KV_SESSION.get(session_id)
+        session = SESSION_STORE.get(session_id)
 
         if not session:
             current_app.logger.debug(f'[{session_id}] session_id not found in redis')
             abort(401, "Session expired")
-        else:
-            cur_time = now()
-            if session.get('expire_at', 0) < cur_time:
-                current_app.logger.debug(f'[{session_id}] session has expired '
-                                         f'{session.get("expire_at", 0)} < {cur_time}')
-                abort(401, "Session expired")
-            else:
-                session['expire_at'] = cur_time + session.get('duration', 3600)
+
+        cur_time = now()
+        if session.get('expire_at', 0) < cur_time:
+            current_app.logger.debug(f'[{session_id}] session has expired '
+                                     f'{session.get("expire_at", 0)} < {cur_time}')
+            abort(401, "Session expired")
 
         if config.ui.validate_session_ip and \
                 request.headers.get("X-Forwarded-For", request.remote_addr) != session.get('ip', None):
@@ -146,7 +239,7 @@ class BaseSecurityRenderer(object):
                                      f'{request.headers.get("User-Agent", None)} != {session.get("user_agent", None)}')
             abort(401, "Invalid user agent for this session")
 
-        KV_SESSION.set(session_id, session)
+        SESSION_STORE.refresh(session_id, session, cur_time)
 
         self.extra_session_checks(session)
 
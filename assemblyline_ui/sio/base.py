@@ -8,6 +8,7 @@ from flask_socketio import Namespace, disconnect
 
 from assemblyline.common import forge
 from assemblyline.remote.datatypes.hash import Hash
+from assemblyline.remote.datatypes.queues.comms import CommsQueue
 
 classification = forge.get_classification()
 config = forge.get_config()
@@ -18,6 +19,9 @@ KV_SESSION = Hash("flask_sessions",
                   port=config.core.redis.nonpersistent.port)
 LOGGER = logging.getLogger('assemblyline.ui.socketio')
 
+AUDIT = config.ui.audit
+AUDIT_LOG = logging.getLogger('assemblyline.ui.audit')
+
 
 class AuthenticationFailure(Exception):
     pass
@@ -73,6 +77,94 @@ class SecureNamespace(Namespace):
         pass
 
 
+class BroadcastNamespace(SecureNamespace):
+    """Relay the messages of a CommsQueue to the monitoring users allowed to see them.
+
+    Each worker only has one subscriber to the queue and decodes every message once. The monitoring users are grouped
+    in rooms keyed on their classification so the access check and the emit are done once per group of users instead
+    of once per user.
+    """
+    queue_name = None
+    item_name = None
+    id_field = None
+    audit_method = None
+
+    def __init__(self, namespace=None):
+        self.background_task = None
+        self.monitors = {}
+        self.rooms = {}
+        super().__init__(namespace=namespace)
+
+    def _extra_cleanup(self, sid):
+        with self.connections_lock:
+            room = self.monitors.pop(sid, None)
+            if room is not None:
+                users = self.rooms[room]['users']
+                users.pop(sid, None)
+                if not users:
+                    self.rooms.pop(room, None)
+
+    @staticmethod
+    def get_room(user_info):
+        return f"classification:{user_info['classification']}"
+
+    def add_monitor(self, user_info):
+        """Register a user in its classification room and make sure the subscriber is running"""
+        room = self.get_room(user_info)
+        with self.connections_lock:
+            self.monitors[user_info['sid']] = room
+            self.rooms.setdefault(room, {'classification': user_info['classification'], 'users': {}})
+            self.rooms[room]['users'][user_info['sid']] = user_info
+            if self.background_task is None:
+                self.background_task = self.socketio.start_background_task(target=self.broadcast_messages)
+
+    def send_message(self, msg, rooms):
+        item = msg['msg']
+        msg_type = msg['msg_type']
+        item_id = item[self.id_field]
+        item_classification = item.get('classification', classification.UNRESTRICTED)
+        for room, user_classification, users in rooms:
+            if not classification.is_accessible(user_classification, item_classification):
+                continue
+
+            self.socketio.emit(msg_type, item, room=room, namespace=self.namespace)
+            LOGGER.info(f"SocketIO:{self.namespace} - {room} - Sending {msg_type} event for {self.item_name} "
+                        f"matching ID: {item_id} to {len(users)} user(s)")
+
+            if AUDIT:
+                for user_info in users:
+                    AUDIT_LOG.info(f"{user_info['uname']} [{user_info['classification']}]"
+                                   f" :: {self.audit_method}({self.id_field}={item_id})")
+
+    # noinspection PyBroadException
+    def broadcast_messages(self):
+        q = CommsQueue(self.queue_name, private=True)
+        try:
+            for msg in q.listen():
+                with self.connections_lock:
+                    if not self.rooms:
+                        break
+                    rooms = [(room, info['classification'], list(info['users'].values()))
+                             for room, info in self.rooms.items()]
+
+                try:
+                    self.send_message(msg, rooms)
+                except Exception:
+                    LOGGER.exception(f"SocketIO:{self.namespace} - Failed to relay message: {msg}")
+        except Exception:
+            LOGGER.exception(f"SocketIO:{self.namespace}")
+        finally:
+            q.close()
+            with self.connections_lock:
+                self.background_task = None
+                if self.rooms:
+                    # Users started monitoring while the subscriber was shutting down
+                    self.background_task = self.socketio.start_background_task(target=self.broadcast_messages)
+                else:
+                    LOGGER.info(f"SocketIO:{self.namespace} - No more users connected to {self.item_name} "
+                                "monitoring, exiting thread...")
+
+
 def get_request_id(request_p):
     if hasattr(request_p, "sid"):
         return request_p.sid
@@ -1,79 +1,145 @@
+import json
+import time
 
 from flask_socketio import join_room
 
+from assemblyline_ui.helper.live import drain_watch_queues, parse_watch_message
 from assemblyline_ui.sio.base import SecureNamespace, LOGGER, authenticated_only
-from assemblyline.remote.datatypes.queues.named import NamedQueue
+from assemblyline.remote.datatypes import get_client, retry_call
+
+# Number of seconds without messages before considering the dispatcher is not responding
+START_TIMEOUT = 30
+PROCESSING_TIMEOUT = 300
+
+# Maximum number of seconds the reader waits for new messages before checking for new watch queues
+READ_TIMEOUT = 1
 
 
 class LiveSubmissionNamespace(SecureNamespace):
+    """Relay the messages of the dispatchers' watch queues to the users watching live submissions.
+
+    A single reader per worker waits on all the watch queues at once and drains every queue that received messages
+    in one round-trip. Clients that set the 'batch' flag when they start listening receive all the result and error
+    keys read at the same time in a single 'cachekeys' or 'cachekeyerrs' event.
+    """
+
     def __init__(self, namespace=None):
         self.watch_queues = {}
+        self.watch_info = {}
+        self.background_task = None
+        self.client = get_client(None, None, True)
         super().__init__(namespace=namespace)
 
     def _extra_cleanup(self, sid):
         for watch_queue in list(self.watch_queues.keys()):
             if self.watch_queues[watch_queue] == sid:
                 self.watch_queues.pop(watch_queue, None)
+                self.watch_info.pop(watch_queue, None)
 
-    def watch_message_queue(self, queue_id, user_info):
-        queue = NamedQueue(queue_id, private=True)
-        max_retry = 30
-        retry = 0
-        while queue_id in self.watch_queues:
-            msg = queue.pop(timeout=1)
-            if msg is None:
-                retry += 1
-                if retry >= max_retry:
-                    self.socketio.emit('error', {'status_code': 503,
-                                                 'msg': "Dispatcher does not seem to be responding..."},
-                                       room=queue_id, namespace=self.namespace)
-                    LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
-                                f"Max retry reach for queue: {queue_id}")
-                    break
-                continue
+    def _stop_watching(self, queue_id, user_info):
+        with self.connections_lock:
+            self.watch_queues.pop(queue_id, None)
+            self.watch_info.pop(queue_id, None)
 
-            retry = 0
-            try:
-                status = msg['status']
-                key = msg.get('cache_key', None)
-            except (KeyError, ValueError, TypeError):
-                LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - Unexpected message received for "
-                            f"queue {queue_id}: {msg}")
+        self.socketio.close_room(queue_id)
+
+        LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
+                    f"Watch queue terminated for queue: {queue_id}")
+
+    def _emit_keys(self, queue_id, user_info, event, keys, batch):
+        if not keys:
+            return
+
+        if batch:
+            self.socketio.emit(f"{event}s", {'status_code': 200, 'msg': keys}, room=queue_id, namespace=self.namespace)
+        else:
+            for key in keys:
+                self.socketio.emit(event, {'status_code': 200, 'msg': key}, room=queue_id, namespace=self.namespace)
+
+        LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - Sending {len(keys)} {event} event(s) "
+                    f"for queue: {queue_id}")
+
+    def process_messages(self, queue_id, messages, now):
+        info = self.watch_info.get(queue_id, None)
+        if info is None:
+            return
+        user_info = info['user_info']
+
+        if not messages:
+            timeout = PROCESSING_TIMEOUT if info['started'] else START_TIMEOUT
+            if now - info['last_message'] >= timeout:
+                self.socketio.emit('error', {'status_code': 503,
+                                             'msg': "Dispatcher does not seem to be responding..."},
+                                   room=queue_id, namespace=self.namespace)
+                LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
+                            f"Max retry reach for queue: {queue_id}")
+                self._stop_watching(queue_id, user_info)
+            return
+
+        info['last_message'] = now
+        keys = {'cachekey': [], 'cachekeyerr': []}
+        for msg in messages:
+            response = parse_watch_message(msg)
+            msg_type = response['type']
+            if msg_type in keys:
+                keys[msg_type].append(response['msg'])
                 continue
 
-            if status == 'START':
-                self.socketio.emit('start', {'status_code': 200, 'msg': "Start listening..."},
+            # Keep the events ordered, the keys received so far are sent before the start/stop events
+            for event, event_keys in keys.items():
+                self._emit_keys(queue_id, user_info, event, event_keys, info['batch'])
+                event_keys.clear()
+
+            if msg_type == 'start':
+                self.socketio.emit('start', {'status_code': 200, 'msg': response['msg']},
                                    room=queue_id, namespace=self.namespace)
                 LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
                             f"Stating processing message on queue: {queue_id}")
-                max_retry = 300
+                info['started'] = True
 
-            elif status == 'STOP':
-                self.socketio.emit('stop', {'status_code': 200,
-                                            'msg': "All messages received, closing queue..."},
+            elif msg_type == 'stop':
+                self.socketio.emit('stop', {'status_code': 200, 'msg': response['msg']},
                                    room=queue_id, namespace=self.namespace)
                 LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
                             f"Stopping monitoring queue: {queue_id}")
-                break
-            elif status == 'OK':
-                self.socketio.emit('cachekey', {'status_code': 200, 'msg': key},
-                                   room=queue_id, namespace=self.namespace)
-                LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - Sending result key: {key}")
-            elif status == 'FAIL':
-                self.socketio.emit('cachekeyerr', {'status_code': 200, 'msg': key},
-                                   room=queue_id, namespace=self.namespace)
-                LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - Sending error key: {key}")
+                self._stop_watching(queue_id, user_info)
+                return
+
             else:
                 LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - Unexpected message received for "
                             f"queue {queue_id}: {msg}")
 
-        with self.connections_lock:
-            self.watch_queues.pop(queue_id, None)
+        for event, event_keys in keys.items():
+            self._emit_keys(queue_id, user_info, event, event_keys, info['batch'])
 
-        self.socketio.close_room(queue_id)
+    # noinspection PyBroadException
+    def watch_message_queues(self):
+        while True:
+            with self.connections_lock:
+                queue_ids = list(self.watch_queues.keys())
+                if not queue_ids:
+                    self.background_task = None
+                    break
 
-        LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
-                    f"Watch queue thread terminated for queue: {queue_id}")
+            try:
+                # Wait for any of the watch queues to receive a message then read all the others in one go
+                first = retry_call(self.client.blpop, queue_ids, READ_TIMEOUT)
+                messages = drain_watch_queues(self.client, queue_ids)
+                if first:
+                    messages[first[0].decode('utf-8')].insert(0, json.loads(first[1]))
+            except Exception:
+                LOGGER.exception(f"SocketIO:{self.namespace} - Failed to read the watch queues")
+                time.sleep(READ_TIMEOUT)
+                continue
+
+            now = time.time()
+            for queue_id in queue_ids:
+                try:
+                    self.process_messages(queue_id, messages[queue_id], now)
+                except Exception:
+                    LOGGER.exception(f"SocketIO:{self.namespace} - Failed to process messages for queue: {queue_id}")
+
+        LOGGER.info(f"SocketIO:{self.namespace} - No more watch queues to monitor, exiting thread...")
 
     @authenticated_only
     def on_listen(self, data, user_info):
@@ -82,8 +148,11 @@ class LiveSubmissionNamespace(SecureNamespace):
         LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - "
                     f"Listening event received for queue: {queue_id}")
 
+        join_room(queue_id)
+
         with self.connections_lock:
             self.watch_queues[queue_id] = user_info['sid']
-        self.socketio.start_background_task(target=self.watch_message_queue, queue_id=queue_id, user_info=user_info)
-
-        join_room(queue_id)
+            self.watch_info[queue_id] = {'user_info': user_info, 'batch': bool(data.get('batch', False)),
+                                         'started': False, 'last_message': time.time()}
+            if self.background_task is None:
+                self.background_task = self.socketio.start_background_task(target=self.watch_message_queues)
@@ -0,0 +1,19 @@
+from flask_socketio import emit, join_room
+
+from assemblyline_ui.sio.base import LOGGER, BroadcastNamespace, authenticated_only
+
+
+class WorkflowRunMonitoringNamespace(BroadcastNamespace):
+    queue_name = 'workflow_runs'
+    item_name = 'workflow run'
+    id_field = 'run_id'
+    audit_method = 'WorkflowRunMonitoringNamespace.get_workflow_run'
+
+    @authenticated_only
+    def on_monitor(self, data, user_info):
+        LOGGER.info(f"SocketIO:{self.namespace} - {user_info['display']} - User as started monitoring workflow runs...")
+
+        join_room(self.get_room(user_info))
+        self.add_monitor(user_info)
+
+        emit('monitoring', data, room=user_info['sid'], namespace=self.namespace)
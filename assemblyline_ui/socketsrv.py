@@ -18,6 +18,7 @@ from assemblyline_ui.sio.live_submission import LiveSubmissionNamespace
 from assemblyline_ui.sio.status import SystemStatusNamespace
 from assemblyline_ui.sio.submission import SubmissionMonitoringNamespace
 from assemblyline_ui.sio.retrohunt import RetrohuntNamespace
+from assemblyline_ui.sio.workflow import WorkflowRunMonitoringNamespace
 
 CERT_BUNDLE = (
     os.environ.get('SIO_CLIENT_CERT_PATH', '/etc/assemblyline/ssl/sio/tls.crt'),
@@ -52,6 +53,7 @@ socketio.on_namespace(LiveSubmissionNamespace('/live_submission'))
 socketio.on_namespace(SubmissionMonitoringNamespace('/submissions'))
 socketio.on_namespace(RetrohuntNamespace('/retrohunt'))
 socketio.on_namespace(SystemStatusNamespace('/status'))
+socketio.on_namespace(WorkflowRunMonitoringNamespace('/workflow_runs'))
 
 
 if __name__ == '__main__':
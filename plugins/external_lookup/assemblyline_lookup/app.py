@@ -1,9 +1,9 @@
 """Lookup through Assemblyline.
 
 """
-import concurrent.futures
 import json
 import os
+import time
 
 from urllib import parse as ul
 
@@ -22,6 +22,13 @@ MAX_LIMIT = int(os.environ.get("MAX_LIMIT", 100))
 MAX_TIMEOUT = float(os.environ.get("MAX_TIMEOUT", 3))
 CLASSIFICATION = os.environ.get("CLASSIFICATION", "TLP:CLEAR")
 URL_BASE = os.environ.get("QUERY_URL", "https://assemblyline-ui")
+# Maximum number of tags in a batch lookup and number of tag values searched by a single query
+BATCH_MAX_TAGS = int(os.environ.get("BATCH_MAX_TAGS", 1000))
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", 100))
+# digests are not tags and cannot be searched for from result index
+FILE_INDEX_DIGESTS = ("md5", "sha1", "ssdeep", "tlsh")
+# Fields of the result index needed to build the lookup results
+RESULT_FIELDS = "id,classification,type,sha256,response.service_name,result.score"
 
 # verify can be boolean or path to CA file
 verify = str(os.environ.get("VERIFY", "true")).lower()
@@ -66,37 +73,42 @@ def get_tag_names() -> Response:
     return make_api_response({tname: CLASSIFICATION for tname in sorted(TAG_MAPPING)})
 
 
+def escape(tag: str) -> str:
+    """Escape a tag value to search it as a phrase."""
+    return tag.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def get_field(tag_name: str) -> str:
+    """Return the field of the tag in the result or file index."""
+    if tag_name not in ("md5", "sha1", "sha256", "ssdeep", "tlsh"):
+        return f"result.sections.tags.{tag_name}"
+    return tag_name
+
+
 def build_query(tag_name: str, tag: str):
     """Build the tag query string."""
-    qry = f'{tag_name}:"{tag}"'
-    if tag_name not in ("md5", "sha1", "sha256", "ssdeep", "tlsh"):
-        qry = f"result.sections.tags.{qry}"
-    return qry
+    return f'{get_field(tag_name)}:"{escape(tag)}"'
 
 
-def lookup_tag(tag_name: str, tag: str, limit: int = 25, timeout: float = 3.0):
-    """Lookup the tag in Assemblyline.
+def build_batch_query(tag_name: str, tags: list[str]):
+    """Build the query string matching any of the values of a tag."""
+    values = " OR ".join(f'"{escape(tag)}"' for tag in tags)
+    return f"{get_field(tag_name)}:({values})"
 
-    Tag values submitted must be URL encoded.
 
-    Complete data from the lookup is returned unmodified.
-    """
+def search(session, index: str, query: str, rows: int, timeout: float, fl: str = None):
+    """Search an index of Assemblyline, return the search results or an error response."""
     if not API_KEY:
         return make_api_response(None, "No API Key is provided. An API Key is required.", 422)
 
-    session = requests.Session()
     headers = {
         "Content-Type": "application/json",
     }
-    search_base = f"{URL_BASE}/api/v4/search"
-    qry = build_query(tag_name=tag_name, tag=tag)
-    # digests are not tags and cannot be searched for from result index
-    url = f"{search_base}/result/"
-    if tag_name in ("md5", "sha1", "ssdeep", "tlsh"):
-        url = f"{search_base}/file/"
-
-    params = {"query": qry, "rows": min(limit, MAX_LIMIT)}
-    rsp = session.post(url, data=params, headers=headers, verify=VERIFY, timeout=timeout)
+    params = {"query": query, "rows": rows}
+    if fl:
+        params["fl"] = fl
+    rsp = session.post(f"{URL_BASE}/api/v4/search/{index}/", data=params, headers=headers, verify=VERIFY,
+                       timeout=timeout)
     rsp_json = rsp.json()
 
     if rsp.status_code != 200:
@@ -105,6 +117,85 @@ def lookup_tag(tag_name: str, tag: str, limit: int = 25, timeout: float = 3.0):
     return rsp_json["api_response"]
 
 
+def lookup_tag(tag_name: str, tag: str, limit: int = 25, timeout: float = 3.0, session=None):
+    """Lookup the tag in Assemblyline.
+
+    Tag values submitted must be URL encoded.
+
+    Complete data from the lookup is returned unmodified.
+    """
+    index = "file" if tag_name in FILE_INDEX_DIGESTS else "result"
+    return search(session or requests.Session(), index, build_query(tag_name=tag_name, tag=tag),
+                  min(limit, MAX_LIMIT), timeout)
+
+
+def search_values(session, index: str, tag_name: str, values: list[str], get_keys, limit: int, deadline: float,
+                  fl: str = None):
+    """Search many values of a tag at once, return the items found for each value or an error response.
+
+    get_keys returns the values of the tag found in an item. The hits of all the values share the rows of a single
+    search, when they don't all fit the values that could be missing hits are searched again on their own so a value
+    is never reported as not found from a truncated page.
+    """
+    output = {value: [] for value in values}
+    data = search(session, index, build_batch_query(tag_name, values), limit * len(values),
+                  max(0.1, deadline - time.monotonic()), fl=fl)
+    if isinstance(data, Response):
+        return data
+
+    for item in data["items"]:
+        for value in set(get_keys(item)):
+            if value in output and len(output[value]) < limit:
+                output[value].append(item)
+
+    if data["total"] > len(data["items"]):
+        for value in values:
+            if len(output[value]) < limit:
+                data = search(session, index, build_query(tag_name, value), limit,
+                              max(0.1, deadline - time.monotonic()), fl=fl)
+                if isinstance(data, Response):
+                    return data
+                output[value] = data["items"]
+    return output
+
+
+def get_result_sha256(item: dict) -> list[str]:
+    """Return the sha256 of the file of a result, as a list of the searched values."""
+    return [item["id"].split(".", 1)[0]]
+
+
+def lookup_results(session, sha256s: list[str], limit: int, timeout: float, fl: str = None):
+    """Lookup the results of many files at once, return the results of each file or an error response."""
+    output = {}
+    deadline = time.monotonic() + timeout
+    for x in range(0, len(sha256s), BATCH_CHUNK_SIZE):
+        data = search_values(session, "result", "sha256", sha256s[x:x + BATCH_CHUNK_SIZE], get_result_sha256, limit,
+                             deadline, fl=fl)
+        if isinstance(data, Response):
+            return data
+        output.update(data)
+    return output
+
+
+def format_result(item: dict, enrich: bool) -> dict:
+    """Format a result found in Assemblyline."""
+    sha256, _ = item["id"].split(".", 1)
+    r = {
+            "count": 1,
+            "link":  f"{URL_BASE}/file/detail/{sha256}",
+            "classification": item["classification"],
+            "description": f"Filetype: {item['type']}. Service: {item['response']['service_name']}.",
+            "confirmed": False,
+            "malicious": True if item["result"]["score"] > 999 else False,
+        }
+
+    if enrich:
+        # Future: Any additional info to query that would be useful? Would require a new request though.
+        r["enrichment"] = []
+
+    return r
+
+
 @app.route("/details/<tag_name>/<tag>/", methods=["GET"])
 def tag_details(tag_name: str, tag: str) -> Response:
     """Get detailed lookup results from Assemblyline
@@ -160,7 +251,8 @@ def tag_details(tag_name: str, tag: str) -> Response:
     except Exception:
         max_timeout = MAX_TIMEOUT
 
-    data = lookup_tag(tag_name=tag_name, tag=tag, limit=limit, timeout=max_timeout)
+    session = requests.Session()
+    data = lookup_tag(tag_name=tag_name, tag=tag, limit=limit, timeout=max_timeout, session=session)
     if isinstance(data, Response):
         return data
     if not data["total"] or not data["items"]:
@@ -168,38 +260,131 @@ def tag_details(tag_name: str, tag: str) -> Response:
     items = data["items"]
 
     # digests are not tags and cannot be searched for from the result index
-    # we must do separate queries to this index using the sha256
-    if tag_name in ("md5", "sha1", "ssdeep", "tlsh"):
+    # we must query the results of the files found using their sha256
+    if tag_name in FILE_INDEX_DIGESTS:
         # de-dupe any possible results
-        sha256s = {item["sha256"] for item in items}
-        with concurrent.futures.ThreadPoolExecutor(min(32, os.cpu_count() + 4)) as executor:
-            future_lookups = [executor.submit(lookup_tag, tag_name="sha256", tag=sha256) for sha256 in sha256s]
-            # replace the `file index` result items with the new `result index` items
-            items = []
-            for future in concurrent.futures.as_completed(future_lookups):
-                data = future.result(timeout=max_timeout)
-                # TODO: how to handle errors? Just filter out for now.
-                items.extend(i for i in data["items"] if not isinstance(i, Response))
-
-    results = []
-    for item in items:
-        sha256, _ = item["id"].split(".", 1)
-        r = {
-                "count": 1,
-                "link":  f"{URL_BASE}/file/detail/{sha256}",
-                "classification": item["classification"],
-                "description": f"Filetype: {item['type']}. Service: {item['response']['service_name']}.",
-                "confirmed": False,
-                "malicious": True if item["result"]["score"] > 999 else False,
-            }
-
-        if enrich:
-            # Future: Any additional info to query that would be useful? Would require a new request though.
-            r["enrichment"] = []
-
-        results.append(r)
-
-    return make_api_response(results)
+        sha256s = sorted({item["sha256"] for item in items})
+        results = lookup_results(session, sha256s, limit=25, timeout=max_timeout)
+        # TODO: how to handle errors? Just filter out for now.
+        if isinstance(results, Response):
+            results = {}
+        # replace the `file index` result items with the new `result index` items
+        items = [item for sha256 in sha256s for item in results.get(sha256, [])]
+
+    return make_api_response([format_result(item, enrich) for item in items])
+
+
+def get_values(item, path: list[str]):
+    """Return the values of a field in a search result, going through lists of objects."""
+    if isinstance(item, list):
+        return [value for i in item for value in get_values(i, path)]
+    if not path:
+        return [item]
+    if not isinstance(item, dict) or path[0] not in item:
+        return []
+    return get_values(item[path[0]], path[1:])
+
+
+@app.route("/details/batch/", methods=["POST"])
+def batch_tag_details() -> Response:
+    """Get detailed lookup results from Assemblyline for many tags at once
+
+    Values of the same tag are searched together instead of one request per tag.
+
+    Data Block:
+    {
+        "tags": [                              # List of tags to look up, values are not URL encoded
+            {"tag_name": <tag name>, "tag": <tag value>},
+            ...,
+        ]
+    }
+
+    Query Params:
+    max_timeout => Maximum execution time for the call in seconds
+    limit       => Maximum number of items to return for each tag
+    nodata      => If specified, do not return the enrichment data
+
+    Returns:
+    # List of the results of each tag, in the order they were given:
+    [
+        {
+            "tag_name": <tag name>,
+            "tag": <tag value>,
+            "error": "",                           # Error for this tag, empty if the lookup succeeded
+            "items": [...],                        # Same items as the details of a single tag, empty if not found
+        },
+        ...,
+    ]
+    """
+    tags = (request.get_json(silent=True) or {}).get("tags")
+    if not isinstance(tags, list) or \
+            not all(isinstance(t, dict) and isinstance(t.get("tag_name"), str) and isinstance(t.get("tag"), str)
+                    for t in tags):
+        return make_api_response(None, "A list of tags, with a tag_name and a tag each, is required.", 400)
+    if len(tags) > BATCH_MAX_TAGS:
+        return make_api_response(None, f"Too many tags, the maximum is {BATCH_MAX_TAGS}.", 413)
+
+    enrich = not request.args.get("nodata", "false").lower() in ("true", "1")
+    limit = min(request.args.get("limit", 100, type=int), int(MAX_LIMIT))
+    max_timeout = request.args.get("max_timeout", MAX_TIMEOUT)
+    # noinspection PyBroadException
+    try:
+        max_timeout = float(max_timeout)
+    except Exception:
+        max_timeout = MAX_TIMEOUT
+    deadline = time.monotonic() + max_timeout
+
+    output = [{"tag_name": t["tag_name"], "tag": t["tag"], "error": "", "items": []} for t in tags]
+    # positions of each tag value in the output, grouped by tag name
+    positions = {}
+    for x, t in enumerate(tags):
+        if t["tag_name"] not in TAG_MAPPING:
+            output[x]["error"] = f"Invalid tag name: {t['tag_name']}"
+            continue
+        positions.setdefault(t["tag_name"], {}).setdefault(t["tag"], []).append(x)
+
+    session = requests.Session()
+    items = {x: [] for x in range(len(tags))}
+    file_hits = {}
+    for tag_name, values in positions.items():
+        field = get_field(tag_name)
+        index, fl = "result", f"{RESULT_FIELDS},{field}"
+        if tag_name in FILE_INDEX_DIGESTS:
+            index, fl = "file", f"sha256,{field}"
+
+        values = list(values.items())
+        for y in range(0, len(values), BATCH_CHUNK_SIZE):
+            chunk = dict(values[y:y + BATCH_CHUNK_SIZE])
+            data = search_values(session, index, tag_name, list(chunk),
+                                 lambda item: get_values(item, field.split(".")), limit, deadline, fl=fl)
+            if isinstance(data, Response):
+                for x in (x for xs in chunk.values() for x in xs):
+                    output[x]["error"] = data.json["api_error_message"]
+                continue
+
+            for value, value_items in data.items():
+                for x in chunk[value]:
+                    if index == "file":
+                        for item in value_items:
+                            file_hits.setdefault(item["sha256"], []).append(x)
+                    else:
+                        items[x].extend(value_items)
+
+    # the results of the files found by digest are searched all at once
+    if file_hits:
+        results = lookup_results(session, sorted(file_hits), limit, max(0.1, deadline - time.monotonic()),
+                                 fl=RESULT_FIELDS)
+        for sha256, xs in file_hits.items():
+            for x in xs:
+                if isinstance(results, Response):
+                    output[x]["error"] = results.json["api_error_message"]
+                    continue
+                items[x].extend(results.get(sha256, [])[:limit - len(items[x])])
+
+    for x, tag_items in items.items():
+        output[x]["items"] = [format_result(item, enrich) for item in tag_items]
+
+    return make_api_response(output)
 
 
 def main():
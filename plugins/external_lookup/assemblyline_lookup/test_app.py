@@ -304,3 +304,156 @@ def test_detailed_hash_lookup(test_client, mocker, mock_lookup_success):
 
     assert rsp.status_code == 200
     assert rsp.json == expected
+
+
+def test_batch_details(test_client, mocker, mock_lookup_success):
+    """Test the batch lookup of tags and hashes, with one query per tag name."""
+    # result of the lookup of the results of the files found by hash
+    r = {
+        "api_error_message": "",
+        "api_response": {
+            "items": [{
+                "classification": "TLP:CLEAR",
+                "id": f"{'b' * 64}.service.version.id",
+                "result": {
+                    "score": 10,
+                },
+                "response": {
+                    "service_name": "Extract",
+                },
+                "type": "executable/windows/pe32",
+            }],
+            "offset": 0,
+            "rows": 1,
+            "total": 1,
+        },
+        "api_server_version": f"{FRAMEWORK_VERSION}.{SYSTEM_VERSION}.0.0",
+        "api_status_code": 200,
+    }
+    mock_results = mocker.MagicMock(spec=requests.Response)
+    mock_results.status_code = 200
+    mock_results.json.return_value = r
+
+    # result found for a domain, then a file found by md5
+    r_domain = {
+        "api_error_message": "",
+        "api_response": {
+            "items": [{
+                "classification": "TLP:CLEAR",
+                "id": f"{'a' * 64}.service.version.id",
+                "result": {
+                    "score": 1000,
+                    "sections": [{"tags": {"network": {"static": {"domain": ["bad.domain"]}}}}],
+                },
+                "response": {
+                    "service_name": "ConfigExtractor",
+                },
+                "type": "executable/windows/pe32",
+            }],
+            "offset": 0,
+            "rows": 1,
+            "total": 1,
+        },
+        "api_server_version": f"{FRAMEWORK_VERSION}.{SYSTEM_VERSION}.0.0",
+        "api_status_code": 200,
+    }
+    mock_domain = mocker.MagicMock(spec=requests.Response)
+    mock_domain.status_code = 200
+    mock_domain.json.return_value = r_domain
+
+    mock_lookup_success(
+        items=[{"classification": "TLP:CLEAR", "md5": "c" * 32, "sha256": "b" * 64}],
+        side_effect=[mock_domain, mocker.DEFAULT, mock_results],
+    )
+
+    tags = [
+        {"tag_name": "network.static.domain", "tag": "bad.domain"},
+        {"tag_name": "network.static.domain", "tag": "good.domain"},
+        {"tag_name": "md5", "tag": "c" * 32},
+        {"tag_name": "abc", "tag": "abc"},
+    ]
+    rsp = test_client.post("/details/batch/", json={"tags": tags}, query_string={"nodata": True})
+    assert rsp.status_code == 200
+
+    # one search per tag name and one search for the results of the files found
+    calls = requests.Session.return_value.post.call_args_list
+    assert len(calls) == 3
+    assert calls[0].kwargs["data"]["query"] == \
+        'result.sections.tags.network.static.domain:("bad.domain" OR "good.domain")'
+    assert calls[1].kwargs["data"]["query"] == f'md5:("{"c" * 32}")'
+    assert calls[2].kwargs["data"]["query"] == f'sha256:("{"b" * 64}")'
+
+    assert rsp.json["api_response"] == [
+        {
+            "tag_name": "network.static.domain",
+            "tag": "bad.domain",
+            "error": "",
+            "items": [{
+                "classification": "TLP:CLEAR",
+                "confirmed": False,
+                "malicious": True,
+                "description": "Filetype: executable/windows/pe32. Service: ConfigExtractor.",
+                "link": f"{server.URL_BASE}/file/detail/{'a' * 64}",
+                "count": 1,
+            }],
+        },
+        {"tag_name": "network.static.domain", "tag": "good.domain", "error": "", "items": []},
+        {
+            "tag_name": "md5",
+            "tag": "c" * 32,
+            "error": "",
+            "items": [{
+                "classification": "TLP:CLEAR",
+                "confirmed": False,
+                "malicious": False,
+                "description": "Filetype: executable/windows/pe32. Service: Extract.",
+                "link": f"{server.URL_BASE}/file/detail/{'b' * 64}",
+                "count": 1,
+            }],
+        },
+        {"tag_name": "abc", "tag": "abc", "error": "Invalid tag name: abc", "items": []},
+    ]
+
+
+def test_batch_details_truncated(test_client, mocker, mock_lookup_success):
+    """Test that values missing from a truncated batch search are searched again on their own."""
+    def result(domain, sha256):
+        return {
+            "classification": "TLP:CLEAR",
+            "id": f"{sha256}.service.version.id",
+            "result": {
+                "score": 1000,
+                "sections": [{"tags": {"network": {"static": {"domain": [domain]}}}}],
+            },
+            "response": {
+                "service_name": "ConfigExtractor",
+            },
+            "type": "executable/windows/pe32",
+        }
+
+    # the batch search finds more results than it returns, the second value only shows up once searched alone
+    mock_lookup_success(items=[result("bad.domain", "a" * 64)], total=3)
+    mock_single = mocker.MagicMock(spec=requests.Response)
+    mock_single.status_code = 200
+    mock_single.json.return_value = {
+        "api_error_message": "",
+        "api_response": {"items": [result("other.domain", "b" * 64)], "offset": 0, "rows": 1, "total": 1},
+        "api_status_code": 200,
+    }
+    mock_post = requests.Session.return_value.post
+    mock_post.side_effect = [mocker.DEFAULT, mock_single]
+
+    tags = [
+        {"tag_name": "network.static.domain", "tag": "bad.domain"},
+        {"tag_name": "network.static.domain", "tag": "other.domain"},
+    ]
+    rsp = test_client.post("/details/batch/", json={"tags": tags}, query_string={"nodata": True, "limit": 1})
+    assert rsp.status_code == 200
+
+    calls = mock_post.call_args_list
+    assert len(calls) == 2
+    assert calls[1].kwargs["data"]["query"] == 'result.sections.tags.network.static.domain:"other.domain"'
+
+    data = rsp.json["api_response"]
+    assert [item["link"] for item in data[0]["items"]] == [f"{server.URL_BASE}/file/detail/{'a' * 64}"]
+    assert [item["link"] for item in data[1]["items"]] == [f"{server.URL_BASE}/file/detail/{'b' * 64}"]
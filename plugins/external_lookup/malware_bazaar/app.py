@@ -1,8 +1,10 @@
 """Lookup through Malware Bazaar.
 
 """
+import concurrent.futures
 import json
 import os
+import time
 
 from urllib import parse as ul
 
@@ -19,6 +21,9 @@ MAX_TIMEOUT = float(os.environ.get("MAX_TIMEOUT", 3))
 CLASSIFICATION = os.environ.get("CLASSIFICATION", "TLP:CLEAR")  # Classification of this service
 API_URL = os.environ.get("API_URL", "https://mb-api.abuse.ch/api/v1")  # override in case of mirror
 FRONTEND_URL = os.environ.get("FRONTEND_URL", "https://bazaar.abuse.ch/browse.php")  # override in case of mirror
+# Maximum number of tags in a batch lookup and number of tags looked up at the same time
+BATCH_MAX_TAGS = int(os.environ.get("BATCH_MAX_TAGS", 1000))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
 
 # verify can be boolean or path to CA file
 verify = str(os.environ.get("MB_VERIFY", "true")).lower()
@@ -58,7 +63,7 @@ def get_tag_names() -> Response:
     return make_api_response({tname: CLASSIFICATION for tname in sorted(TAG_MAPPING)})
 
 
-def lookup_tag(tag_name: str, tag: str, limit: int, timeout: float):
+def lookup_tag(tag_name: str, tag: str, limit: int, timeout: float, session=None):
     """Lookup the tag in Malware bazaar.
 
     Tag values submitted must be URL encoded.
@@ -71,7 +76,7 @@ def lookup_tag(tag_name: str, tag: str, limit: int, timeout: float):
     if search_key == "hash" and len(tag) not in (32, 40, 64):
         return make_api_response(None, "Invalid hash provided. Require md5, sha1 or sha256", 422)
 
-    session = requests.Session()
+    session = session or requests.Session()
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
     }
@@ -176,6 +181,11 @@ def tag_details(tag_name: str, tag: str) -> Response:
     if isinstance(data, Response):
         return data
 
+    return make_api_response([build_details(tn, tag, data, enrich)])
+
+
+def build_details(tn: str, tag: str, data: list, enrich: bool) -> dict:
+    """Build the lookup result of a tag from the data returned by Malware Bazaar."""
     r = {
         "classification": CLASSIFICATION,
         "link": f"{FRONTEND_URL}?search={tn}%3A{tag}",
@@ -316,7 +326,98 @@ def tag_details(tag_name: str, tag: str) -> Response:
                     enrichment.append(_row("related_files", h, tag))
             r["enrichment"] = enrichment
 
-    return make_api_response([r])
+    return r
+
+
+def batch_lookup(session, tag_name: str, tag: str, limit: int, deadline: float, enrich: bool) -> dict:
+    """Lookup a single tag of a batch and return its result entry."""
+    output = {"tag_name": tag_name, "tag": tag, "error": "", "items": []}
+    tn = TAG_MAPPING.get(tag_name)
+    if tn is None:
+        output["error"] = f"Tag name `{tag_name}` is invalid. Valid tags are: {', '.join(TAG_MAPPING.keys())}"
+        return output
+
+    # lookups run outside of the request, error responses still need an application context
+    with app.app_context():
+        data = lookup_tag(tag_name=tn, tag=tag, limit=limit, timeout=max(0.1, deadline - time.monotonic()),
+                          session=session)
+        if isinstance(data, Response):
+            # not found is not an error, the tag simply has no items
+            if data.status_code != 404:
+                output["error"] = data.json["api_error_message"]
+            return output
+
+        output["items"] = [build_details(tn, tag, data, enrich)]
+    return output
+
+
+@app.route("/details/batch/", methods=["POST"])
+def batch_tag_details() -> Response:
+    """Get detailed lookup results from Malware Bazaar for many tags at once
+
+    Malware Bazaar has no bulk API, the tags are looked up concurrently over a single keep-alive session.
+
+    Data Block:
+    {
+        "tags": [                              # List of tags to look up, values are not URL encoded
+            {"tag_name": <tag name>, "tag": <tag value>},
+            ...,
+        ]
+    }
+
+    Query Params:
+    max_timeout => Maximum execution time for the call in seconds
+    limit       => Maximum number of items to return for each tag
+    nodata      => If specified, do not return the enrichment data
+
+    Returns:
+    # List of the results of each tag, in the order they were given:
+    [
+        {
+            "tag_name": <tag name>,
+            "tag": <tag value>,
+            "error": "",                           # Error for this tag, empty if the lookup succeeded
+            "items": [...],                        # Same items as the details of a single tag, empty if not found
+        },
+        ...,
+    ]
+    """
+    tags = (request.get_json(silent=True) or {}).get("tags")
+    if not isinstance(tags, list) or \
+            not all(isinstance(t, dict) and isinstance(t.get("tag_name"), str) and isinstance(t.get("tag"), str)
+                    for t in tags):
+        return make_api_response(None, "A list of tags, with a tag_name and a tag each, is required.", 400)
+    if len(tags) > BATCH_MAX_TAGS:
+        return make_api_response(None, f"Too many tags, the maximum is {BATCH_MAX_TAGS}.", 413)
+
+    enrich = not request.args.get("nodata", "false").lower() in ("true", "1")
+    limit = min(int(request.args.get("limit", "100")), int(MAX_LIMIT))
+    max_timeout = request.args.get("max_timeout", MAX_TIMEOUT)
+    # noinspection PyBroadException
+    try:
+        max_timeout = float(max_timeout)
+    except Exception:
+        max_timeout = 3.0
+    deadline = time.monotonic() + max_timeout
+
+    session = requests.Session()
+    executor = concurrent.futures.ThreadPoolExecutor(max(1, BATCH_CONCURRENCY))
+    futures = [
+        executor.submit(batch_lookup, session, t["tag_name"], t["tag"], limit, deadline, enrich) for t in tags
+    ]
+    concurrent.futures.wait(futures, timeout=max_timeout)
+    # lookups that did not start in time are dropped
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    output = []
+    for t, future in zip(tags, futures):
+        if not future.done() or future.cancelled():
+            output.append({"tag_name": t["tag_name"], "tag": t["tag"], "error": "Lookup timed out.", "items": []})
+        elif future.exception() is not None:
+            output.append({"tag_name": t["tag_name"], "tag": t["tag"], "error": str(future.exception()), "items": []})
+        else:
+            output.append(future.result())
+    return make_api_response(output)
 
 
 def main():
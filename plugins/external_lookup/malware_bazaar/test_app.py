@@ -169,6 +169,54 @@ def test_hash_dne(test_client, mocker):
     assert rsp.json == expected
 
 
+def test_batch_details(test_client, mock_lookup_exists, mocker):
+    """Validate the batch lookup of hashes that exist, do not exist and an invalid tag name."""
+    digest = "7de2c1bf58bce09eecc70476747d88a26163c3d6bb1d85235c24a558d1f16754"
+    mock_lookup_exists(sha256_hash=digest)
+    not_found = mocker.MagicMock()
+    not_found.status_code = 200
+    not_found.json.return_value = {"query_status": "hash_not_found"}
+    found = requests.Session.return_value.post.return_value
+
+    def post(url, data, **kwargs):
+        return found if data["hash"] == digest else not_found
+
+    requests.Session.return_value.post.side_effect = post
+
+    tags = [
+        {"tag_name": "sha256", "tag": digest},
+        {"tag_name": "md5", "tag": "a" * 32},
+        {"tag_name": "abc", "tag": "abc"},
+    ]
+    rsp = test_client.post("/details/batch/", json={"tags": tags}, query_string={"nodata": True})
+    assert rsp.status_code == 200
+    data = rsp.json["api_response"]
+
+    assert data[0] == {
+        "tag_name": "sha256",
+        "tag": digest,
+        "error": "",
+        "items": [
+            {
+                "classification": "TLP:CLEAR",
+                "link": f"https://bazaar.abuse.ch/browse.php?search=sha256%3A{digest}",
+                "count": 1,
+                "malicious": True,
+                "confirmed": False,
+                "description": "4 security vendors flagged this file as malicious. "
+                               "The file has been identified as: AZORult",
+            }
+        ],
+    }
+    assert data[1] == {"tag_name": "md5", "tag": "a" * 32, "error": "", "items": []}
+    assert data[2]["items"] == []
+    assert data[2]["error"].startswith("Tag name `abc` is invalid.")
+
+    # invalid batches
+    rsp = test_client.post("/details/batch/", json={"tags": "abc"})
+    assert rsp.status_code == 400
+
+
 def test_error_conditions(test_client, mocker):
     """Validate error handling."""
 
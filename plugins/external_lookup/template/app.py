@@ -103,6 +103,52 @@ def tag_details(tag_name: str, tag: str) -> Response:
     raise NotImplementedError("Not Implemented.")
 
 
+@app.route("/details/batch/", methods=["POST"])
+def batch_tag_details() -> Response:
+    """Define how to search for detailed results of many tags at once.
+
+    Implementing this endpoint is optional. Where the external system offers a bulk API, it should be used to look up
+    all the tags in as few requests as possible.
+
+    Data Block:
+    {
+        "tags": [                              # List of tags to look up, values are not URL encoded
+            {"tag_name": <tag name>, "tag": <tag value>},
+            ...,
+        ]
+    }
+
+    Query Params:
+    max_timeout => Maximum execution time for the call in seconds
+    limit       => Maximum number of items to return for each tag
+    nodata      => If specified, do not return the enrichment data
+
+    Returns:
+    # List of the results of each tag, in the order they were given:
+    [
+        {
+            "tag_name": <tag name>,
+            "tag": <tag value>,
+            "error": "",                           # Error for this tag, empty if the lookup succeeded
+            "items": [...],                        # Same items as the details of a single tag, empty if not found
+        },
+        ...,
+    ]
+    """
+    tags = (request.get_json(silent=True) or {}).get("tags")
+    if not isinstance(tags, list):
+        return make_api_response(None, "A list of tags, with a tag_name and a tag each, is required.", 400)
+
+    max_timeout = request.args.get("max_timeout", MAX_TIMEOUT)
+    # noinspection PyBroadException
+    try:
+        max_timeout = float(max_timeout)
+    except Exception:
+        max_timeout = MAX_TIMEOUT
+
+    raise NotImplementedError("Not Implemented.")
+
+
 def main():
     app.run(host="0.0.0.0", port=8000, debug=False)
 
@@ -161,6 +161,50 @@ def test_tag_found(test_client, mock_lookup_exists):
     assert rsp.json == expected
 
 
+def test_batch_details(test_client, mock_lookup_exists, mocker):
+    """Validate the batch lookup of tags that exist, do not exist and an invalid tag name."""
+    mock_lookup_exists()
+    not_found = mocker.MagicMock()
+    not_found.status_code = 404
+    found = requests.Session.return_value.get.return_value
+
+    def get(url, **kwargs):
+        return not_found if url.endswith("/domains/good.domain") else found
+
+    requests.Session.return_value.get.side_effect = get
+
+    tags = [
+        {"tag_name": "network.dynamic.ip", "tag": "127.0.0.1"},
+        {"tag_name": "network.static.domain", "tag": "good.domain"},
+        {"tag_name": "abc", "tag": "abc"},
+    ]
+    rsp = test_client.post("/details/batch/", json={"tags": tags}, query_string={"nodata": True})
+    assert rsp.status_code == 200
+    assert rsp.json["api_response"] == [
+        {
+            "tag_name": "network.dynamic.ip",
+            "tag": "127.0.0.1",
+            "error": "",
+            "items": [
+                {
+                    "classification": "TLP:CLEAR",
+                    "link": "https://www.virustotal.com/gui/search/127.0.0.1",
+                    "count": 1,
+                    "confirmed": False,
+                    "malicious": True,
+                    "description": "3 security vendors flagged this as malicious.",
+                }
+            ],
+        },
+        {"tag_name": "network.static.domain", "tag": "good.domain", "error": "", "items": []},
+        {"tag_name": "abc", "tag": "abc", "error": "Invalid tag name: abc", "items": []},
+    ]
+
+    # invalid batches
+    rsp = test_client.post("/details/batch/", json={"tags": [{"tag_name": "abc"}]})
+    assert rsp.status_code == 400
+
+
 def test_tag_dne(test_client, mocker):
     """Validate respone for various tags that do not exists."""
     digest = "a" * 32
@@ -0,0 +1,63 @@
+"""
+Measure the latency added to each API call by the quota accounting.
+
+Compares the legacy accounting (QUOTA_TRACKER.begin, DAILY_QUOTA_TRACKER.increment_api then QUOTA_TRACKER.end,
+one redis round-trip each) with the APIQuotaTracker used by api_login (one round-trip to begin, one to end).
+Calls are made from multiple threads to simulate a loaded UI worker.
+
+Usage: python test/benchmarks/api_quota.py [num_requests] [num_threads]
+"""
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from assemblyline.odm.randomizer import get_random_hash
+from assemblyline_ui.config import API_QUOTA_TRACKER, DAILY_QUOTA_TRACKER, QUOTA_TRACKER
+
+CONCURRENT_QUOTA = 1000
+DAILY_QUOTA = 10000000
+
+
+def legacy_request(user):
+    start = time.time()
+    QUOTA_TRACKER.begin(user, CONCURRENT_QUOTA)
+    DAILY_QUOTA_TRACKER.increment_api(user)
+    QUOTA_TRACKER.end(user)
+    return time.time() - start
+
+
+def pipelined_request(user):
+    start = time.time()
+    API_QUOTA_TRACKER.begin(user, CONCURRENT_QUOTA, DAILY_QUOTA)
+    API_QUOTA_TRACKER.end(user)
+    return time.time() - start
+
+
+def run(name, func, num_requests, num_threads):
+    user = f"benchmark_{get_random_hash(8)}"
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(num_threads) as executor:
+            latencies = sorted(executor.map(func, [user] * num_requests))
+        elapsed = time.time() - start
+    finally:
+        QUOTA_TRACKER.reset(user)
+        DAILY_QUOTA_TRACKER.reset_api(user)
+
+    print(f"{name:<10} {num_requests} requests in {elapsed:.3f}s - "
+          f"avg: {sum(latencies) / num_requests * 1000:.3f}ms, "
+          f"p50: {latencies[int(num_requests * 0.5)] * 1000:.3f}ms, "
+          f"p99: {latencies[int(num_requests * 0.99)] * 1000:.3f}ms")
+
+
+def main():
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    run("legacy", legacy_request, num_requests, num_threads)
+    run("pipelined", pipelined_request, num_requests, num_threads)
+
+
+if __name__ == "__main__":
+    main()
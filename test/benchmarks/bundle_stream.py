@@ -0,0 +1,168 @@
+"""
+Measure the time, memory and disk space used to create and import a large bundle.
+
+Files of random and repetitive content are written to a temporary local filestore until the bundle reaches the
+requested size. The bundle is then created the way create_bundle does it, by downloading the files to a working
+directory, compressing them with tar and CaRTing the tarball to disk, and by streaming it with iter_bundle_stream.
+The import compares loading the whole base64 encoded request body in memory with saving it block by block.
+
+Each mode runs in its own process so the peak RSS reported is the one of the mode alone.
+
+Usage: python test/benchmarks/bundle_stream.py [size_mb] [file_size_mb]
+  ex: python test/benchmarks/bundle_stream.py 2048 64
+"""
+import base64
+import hashlib
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cart import pack_stream
+
+from assemblyline.common.bundling import BUNDLE_TYPE
+from assemblyline.filestore import FileStore
+from assemblyline_ui.helper.bundling import iter_bundle_stream, save_bundle_body
+
+READ_SIZE = 64 * 1024
+
+
+def create_files(filestore, size_mb, file_size_mb):
+    sha256s = []
+    for i in range(max(1, size_mb // file_size_mb)):
+        if i % 2:
+            data = os.urandom(file_size_mb * 1024 * 1024)
+        else:
+            data = (os.urandom(1024) * 1024 * file_size_mb)
+        sha256 = hashlib.sha256(data).hexdigest()
+        filestore.put(sha256, data)
+        sha256s.append(sha256)
+    return sha256s
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def bundle_on_disk(filestore, sha256s, work_dir):
+    """Same steps as create_bundle followed by the download of the bundle"""
+    current_working_dir = os.path.join(work_dir, "bundle")
+    os.makedirs(current_working_dir)
+    for sha256 in sha256s:
+        filestore.download(sha256, os.path.join(current_working_dir, sha256))
+    with open(os.path.join(current_working_dir, "results.json"), "w") as fh:
+        fh.write("{}")
+
+    tgz_file = os.path.join(work_dir, "bundle.tgz")
+    subprocess.check_call(["tar", "czf", tgz_file] + os.listdir(current_working_dir), cwd=current_working_dir)
+    target_file = os.path.join(work_dir, "bundle.cart")
+    with open(target_file, 'wb') as oh, open(tgz_file, 'rb') as ih:
+        pack_stream(ih, oh, {'al': {"type": BUNDLE_TYPE}, 'name': "benchmark.tgz"})
+    peak_disk = disk_usage(work_dir)
+
+    first_byte = None
+    size = 0
+    with open(target_file, 'rb') as fh:
+        while data := fh.read(READ_SIZE):
+            first_byte = first_byte or time.time()
+            size += len(data)
+
+    shutil.rmtree(current_working_dir)
+    os.unlink(tgz_file)
+    os.unlink(target_file)
+    return first_byte, size, peak_disk
+
+
+def bundle_streamed(filestore, sha256s, _):
+    first_byte = None
+    size = 0
+    for chunk in iter_bundle_stream({}, sha256s, "benchmark", [filestore]):
+        first_byte = first_byte or time.time()
+        size += len(chunk)
+    return first_byte, size, 0
+
+
+def import_in_memory(body_path, work_dir):
+    """Same steps as the import API did before saving the bundle to disk"""
+    with open(body_path, 'rb') as fh:
+        data = fh.read()
+    target = os.path.join(work_dir, "import.bundle")
+    with open(target, 'wb') as fh:
+        fh.write(base64.b64decode(data))
+    os.unlink(target)
+    return None, len(data), 0
+
+
+def import_streamed(body_path, work_dir):
+    target = os.path.join(work_dir, "import.bundle")
+    with open(body_path, 'rb') as fh:
+        size = save_bundle_body(fh, target)
+    os.unlink(target)
+    return None, size, 0
+
+
+def measure(func, args, output):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    first_byte, size, peak_disk = func(*args)
+    output.put({
+        "elapsed": time.time() - start,
+        "first_byte": first_byte - start if first_byte else None,
+        "size": size,
+        "peak_disk": peak_disk,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss,
+    })
+
+
+def run(name, func, *args):
+    output = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=measure, args=(func, args, output))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        # The in memory import of a large bundle can be killed by the OOM killer
+        print(f"{name:<18} - failed with exit code {proc.exitcode}")
+        return None
+    report = output.get()
+
+    first_byte = f", first byte {report['first_byte']:.2f}s" if report['first_byte'] is not None else ""
+    print(f"{name:<18} - {report['elapsed']:.2f}s{first_byte}, {report['size'] / 1024 / 1024:.0f}MB, "
+          f"peak RSS +{report['rss'] / 1024:.0f}MB, temporary disk {report['peak_disk'] / 1024 / 1024:.0f}MB")
+    return report
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    file_size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        filestore = FileStore(f"file://{os.path.join(work_dir, 'filestore')}")
+        sha256s = create_files(filestore, size_mb, file_size_mb)
+        print(f"Bundling {len(sha256s)} files of {file_size_mb}MB")
+
+        run("Create on disk", bundle_on_disk, filestore, sha256s, work_dir)
+        run("Create streamed", bundle_streamed, filestore, sha256s, work_dir)
+
+        # Import the base64 encoding of a bundle of the same size
+        bundle_path = os.path.join(work_dir, "body.cart")
+        with open(bundle_path, 'wb') as oh:
+            for chunk in iter_bundle_stream({}, sha256s, "benchmark", [filestore]):
+                oh.write(chunk)
+        body_path = os.path.join(work_dir, "body.b64")
+        with open(bundle_path, 'rb') as ih, open(body_path, 'wb') as oh:
+            base64.encode(ih, oh)
+        os.unlink(bundle_path)
+
+        run("Import in memory", import_in_memory, body_path, work_dir)
+        run("Import streamed", import_streamed, body_path, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measure how long the service backup and restore take depending on the number of services and versions.
+
+Compares the legacy implementation (one get per service delta and per service version, the whole YAML document
+dumped at once and one save per document on restore) with the multiget based streaming backup and the bulk
+restore. Benchmark services are created in the datastore and removed once done.
+
+Usage: python test/benchmarks/service_backup.py [num_services] [num_versions]
+  ex: python test/benchmarks/service_backup.py 60 20
+"""
+import sys
+import time
+
+import yaml
+
+from assemblyline.odm.models.service import Service
+from assemblyline.odm.models.service_delta import ServiceDelta
+from assemblyline.odm.randomizer import random_model_obj
+from assemblyline_ui.api.v4.service import _generate_service_backup, restore_service_documents
+from assemblyline_ui.config import STORAGE, config
+
+PREFIX = "BenchmarkService"
+
+
+def create_services(num_services, num_versions):
+    for x in range(num_services):
+        name = f"{PREFIX}{x}"
+        for y in range(num_versions):
+            service = random_model_obj(Service)
+            service.name = name
+            service.version = f"4.5.0.{y}"
+            STORAGE.service.save(f"{name}_{service.version}", service)
+
+        delta = random_model_obj(ServiceDelta).as_primitives()
+        delta.update({'name': name, 'version': f"4.5.0.{num_versions - 1}"})
+        STORAGE.service_delta.save(name, delta)
+
+    STORAGE.service.commit()
+    STORAGE.service_delta.commit()
+
+
+def delete_services():
+    STORAGE.service.delete_by_query(f"name:{PREFIX}*")
+    STORAGE.service_delta.delete_by_query(f"id:{PREFIX}*")
+
+
+def legacy_backup():
+    services = {'type': 'backup', 'server': config.ui.fqdn, 'data': {}}
+
+    for service in STORAGE.service_delta.stream_search("*:*", fl="id", as_obj=False, item_buffer_size=1000):
+        name = service['id']
+        service_output = {
+            'config': STORAGE.service_delta.get(name, as_obj=False),
+            'versions': {}
+        }
+        for service_version in STORAGE.service.stream_search(
+                f"name:{name}", fl="id", as_obj=False, item_buffer_size=1000):
+            version_id = service_version['id']
+            service_output['versions'][version_id] = STORAGE.service.get(version_id, as_obj=False)
+
+        services['data'][name] = service_output
+
+    return yaml.dump(services, indent=2)
+
+
+def streaming_backup():
+    return "".join(_generate_service_backup())
+
+
+def legacy_restore(data):
+    for service_name, service in data.items():
+        for v_id, v_data in service['versions'].items():
+            STORAGE.service.save(v_id, v_data)
+        STORAGE.service_delta.save(service_name, service['config'])
+
+
+def timed(func, *args):
+    start = time.time()
+    output = func(*args)
+    return time.time() - start, output
+
+
+def main():
+    num_services = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    num_versions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    delete_services()
+    create_services(num_services, num_versions)
+    try:
+        legacy_time, legacy_output = timed(legacy_backup)
+        streaming_time, streaming_output = timed(streaming_backup)
+        assert yaml.safe_load(legacy_output) == yaml.safe_load(streaming_output)
+        print(f"backup  - {num_services} services x {num_versions} versions - legacy: {legacy_time:.3f}s, "
+              f"streaming: {streaming_time:.3f}s ({legacy_time / streaming_time:.1f}x)")
+
+        data = {k: v for k, v in yaml.safe_load(streaming_output)['data'].items() if k.startswith(PREFIX)}
+        legacy_time, _ = timed(legacy_restore, data)
+        bulk_time, _ = timed(restore_service_documents, data)
+        print(f"restore - {num_services} services x {num_versions} versions - legacy: {legacy_time:.3f}s, "
+              f"bulk: {bulk_time:.3f}s ({legacy_time / bulk_time:.1f}x)")
+    finally:
+        delete_services()
+
+
+if __name__ == "__main__":
+    main()
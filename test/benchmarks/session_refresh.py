@@ -0,0 +1,78 @@
+"""
+Count the redis operations done to validate a user session on each API request.
+
+Compares the legacy behaviour (load the session and save it back on every request) with the SessionStore
+used by BaseSecurityRenderer.get_logged_in_user.
+
+Usage: python test/benchmarks/session_refresh.py [num_requests] [session_duration]
+"""
+import sys
+import time
+
+from collections import Counter
+
+from assemblyline.common.isotime import now
+from assemblyline.odm.randomizer import get_random_hash
+from assemblyline_ui.config import KV_SESSION
+from assemblyline_ui.security.authenticator import SessionStore
+
+
+class CountingHash(object):
+    """Wrap a redis Hash and count the calls made to it, each call being one redis round-trip"""
+
+    def __init__(self, hash_obj):
+        self.hash_obj = hash_obj
+        self.ops = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.hash_obj, name)
+
+        def wrapper(*args, **kwargs):
+            self.ops[name] += 1
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
+def legacy_request(kv_session, session_id):
+    session = kv_session.get(session_id)
+    session['expire_at'] = now() + session.get('duration', 3600)
+    kv_session.set(session_id, session)
+
+
+def store_request(store, session_id):
+    session = store.get(session_id)
+    store.refresh(session_id, session, now())
+
+
+def run(name, kv_session, func, target, session_id, num_requests):
+    start = time.time()
+    for _ in range(num_requests):
+        func(target, session_id)
+    elapsed = time.time() - start
+
+    total_ops = sum(kv_session.ops.values())
+    print(f"{name:<10} {num_requests} requests in {elapsed:.3f}s "
+          f"({elapsed / num_requests * 1000:.3f}ms/request) - "
+          f"{total_ops} redis ops ({total_ops / num_requests:.3f}/request) {dict(kv_session.ops)}")
+
+
+def main():
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 3600
+
+    session_id = f"benchmark_{get_random_hash(16)}"
+    KV_SESSION.set(session_id, {'duration': duration, 'expire_at': now() + duration, 'username': 'benchmark',
+                                'roles_limit': None, 'xsrf_token': get_random_hash(16)})
+    try:
+        legacy_hash = CountingHash(KV_SESSION)
+        run("legacy", legacy_hash, legacy_request, legacy_hash, session_id, num_requests)
+
+        store_hash = CountingHash(KV_SESSION)
+        run("store", store_hash, store_request, SessionStore(store_hash), session_id, num_requests)
+    finally:
+        KV_SESSION.pop(session_id)
+
+
+if __name__ == "__main__":
+    main()
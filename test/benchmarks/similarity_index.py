@@ -0,0 +1,108 @@
+"""
+Measure the build time and query latency of the in-memory TLSH and SSDEEP similarity indexes.
+
+A synthetic corpus of random hashes is generated with a few near-duplicates of the queried hashes mixed in. Each
+query is answered by the index and, for a sample of the queries, by a brute force scan of the whole corpus to make
+sure the index returns the exact same results.
+
+Usage: python test/benchmarks/similarity_index.py [corpus_size] [num_queries]
+  ex: python test/benchmarks/similarity_index.py 1000000 100
+"""
+import random
+import sys
+import time
+
+from assemblyline_ui.helper.similarity import SSDeepIndex, TLSHIndex, parse_ssdeep, parse_tlsh, ssdeep_compare, \
+    tlsh_distance
+
+TLSH_THRESHOLD = 50
+SSDEEP_THRESHOLD = 50
+BRUTE_FORCE_QUERIES = 3
+HEX = "0123456789ABCDEF"
+B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+BLOCK_SIZES = [3 * 2 ** x for x in range(20)]
+
+
+def random_tlsh(rand):
+    return "T1" + "".join(rand.choice(HEX) for _ in range(70))
+
+
+def random_ssdeep(rand):
+    chunk = "".join(rand.choice(B64) for _ in range(rand.randint(20, 64)))
+    double_chunk = "".join(rand.choice(B64) for _ in range(rand.randint(10, 32)))
+    return f"{rand.choice(BLOCK_SIZES)}:{chunk}:{double_chunk}"
+
+
+def mutate_tlsh(rand, value):
+    body = list(value)
+    for _ in range(3):
+        body[rand.randrange(8, len(body))] = rand.choice(HEX)
+    return "".join(body)
+
+
+def mutate_ssdeep(rand, value):
+    block_size, chunk, double_chunk = value.split(":")
+    pos = rand.randrange(len(chunk))
+    return f"{block_size}:{chunk[:pos]}{rand.choice(B64)}{chunk[pos + 1:]}:{double_chunk}"
+
+
+def run(name, index, hashes, queries, search, brute_force):
+    start = time.time()
+    for key, value in enumerate(hashes):
+        index.add(str(key), value)
+    print(f"{name:<6} - indexed {len(hashes)} hashes in {time.time() - start:.1f}s")
+
+    start = time.time()
+    found = 0
+    for query in queries:
+        found += len(search(index, query))
+    elapsed = time.time() - start
+    print(f"{name:<6} - {len(queries)} queries in {elapsed:.3f}s ({elapsed / len(queries) * 1000:.2f}ms/query, "
+          f"{found / len(queries):.1f} matches/query)")
+
+    for query in queries[:BRUTE_FORCE_QUERIES]:
+        start = time.time()
+        expected = brute_force(hashes, query)
+        elapsed = time.time() - start
+        assert sorted(search(index, query)) == sorted(expected), f"Index results differ for {query}"
+        print(f"{name:<6} - brute force scan in {elapsed:.3f}s, same {len(expected)} matches as the index")
+
+
+def search_tlsh(index, query):
+    return index.search(query, threshold=TLSH_THRESHOLD, rows=len(index))
+
+
+def brute_force_tlsh(hashes, query):
+    parsed = parse_tlsh(query)
+    return [(str(key), distance) for key, distance in
+            ((key, tlsh_distance(parsed, parse_tlsh(value))) for key, value in enumerate(hashes))
+            if distance <= TLSH_THRESHOLD]
+
+
+def search_ssdeep(index, query):
+    return index.search(query, threshold=SSDEEP_THRESHOLD, rows=len(index))
+
+
+def brute_force_ssdeep(hashes, query):
+    parsed = parse_ssdeep(query)
+    return [(str(key), score) for key, score in
+            ((key, ssdeep_compare(parsed, parse_ssdeep(value))) for key, value in enumerate(hashes))
+            if score >= SSDEEP_THRESHOLD]
+
+
+def main():
+    corpus_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rand = random.Random(0)
+
+    tlsh_hashes = [random_tlsh(rand) for _ in range(corpus_size)]
+    tlsh_hashes.extend(mutate_tlsh(rand, value) for value in tlsh_hashes[:num_queries])
+    run("TLSH", TLSHIndex(), tlsh_hashes, tlsh_hashes[:num_queries], search_tlsh, brute_force_tlsh)
+
+    ssdeep_hashes = [random_ssdeep(rand) for _ in range(corpus_size)]
+    ssdeep_hashes.extend(mutate_ssdeep(rand, value) for value in ssdeep_hashes[:num_queries])
+    run("SSDEEP", SSDeepIndex(), ssdeep_hashes, ssdeep_hashes[:num_queries], search_ssdeep, brute_force_ssdeep)
+
+
+if __name__ == "__main__":
+    main()
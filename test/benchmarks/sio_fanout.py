@@ -0,0 +1,140 @@
+"""
+Measure how many alert messages per second a socketio worker can relay depending on the number of connected clients.
+
+Compares the legacy behaviour (one private CommsQueue subscription per connected client, each decoding every
+message and checking its classification) with the shared subscriber of the BroadcastNamespace which decodes each
+message once and emits it once per classification room. Emits are counted instead of being sent to real clients.
+
+Usage: python test/benchmarks/sio_fanout.py [num_messages] [client_counts]
+  ex: python test/benchmarks/sio_fanout.py 1000 1,10,100,300
+"""
+import sys
+import threading
+import time
+
+from assemblyline.common.uid import get_random_id
+from assemblyline.remote.datatypes.queues.comms import CommsQueue
+from assemblyline_ui.sio.base import BroadcastNamespace, classification
+
+CLASSIFICATIONS = sorted({classification.UNRESTRICTED, classification.RESTRICTED})
+
+
+class CountingSocketIO(object):
+    """Stand-in for the SocketIO server which counts the messages that would be sent to each client"""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.delivered = 0
+
+    @staticmethod
+    def start_background_task(target, **kwargs):
+        thread = threading.Thread(target=target, kwargs=kwargs, daemon=True)
+        thread.start()
+        return thread
+
+    def emit(self, _event, _data, room=None, **_):
+        with self.namespace.connections_lock:
+            self.delivered += len(self.namespace.rooms.get(room, {}).get('users', {}))
+
+
+class BenchmarkNamespace(BroadcastNamespace):
+    item_name = 'alert'
+    id_field = 'alert_id'
+    audit_method = 'BenchmarkNamespace.get_alert'
+
+
+def make_users(num_clients):
+    return [{'uname': f"user_{x}", 'display': f"user_{x}", 'sid': get_random_id(), 'ip': '127.0.0.1',
+             'classification': CLASSIFICATIONS[x % len(CLASSIFICATIONS)]} for x in range(num_clients)]
+
+
+def make_messages(num_messages):
+    return [{'msg_type': 'AlertCreated',
+             'msg': {'alert_id': get_random_id(), 'classification': CLASSIFICATIONS[x % len(CLASSIFICATIONS)]}}
+            for x in range(num_messages)]
+
+
+def expected_deliveries(users, messages):
+    return sum(1 for user in users for msg in messages
+               if classification.is_accessible(user['classification'], msg['msg']['classification']))
+
+
+def wait_for(get_count, expected, timeout=120):
+    start = time.time()
+    while get_count() < expected and time.time() - start < timeout:
+        time.sleep(0.01)
+
+
+def start_legacy(queue_name, users, num_messages):
+    counter_lock = threading.Lock()
+    delivered = [0]
+
+    def monitor(user_info):
+        q = CommsQueue(queue_name, private=True)
+        try:
+            for received, msg in enumerate(q.listen(), start=1):
+                if classification.is_accessible(user_info['classification'],
+                                                msg['msg'].get('classification', classification.UNRESTRICTED)):
+                    with counter_lock:
+                        delivered[0] += 1
+                if received == num_messages:
+                    break
+        finally:
+            q.close()
+
+    for user in users:
+        threading.Thread(target=monitor, args=(user,), daemon=True).start()
+
+    return lambda: delivered[0], lambda: None
+
+
+def start_shared(queue_name, users, _):
+    namespace = BenchmarkNamespace('/benchmark')
+    namespace.queue_name = queue_name
+    namespace.socketio = CountingSocketIO(namespace)
+    for user in users:
+        namespace.add_monitor(user)
+
+    def cleanup():
+        for user_info in users:
+            namespace._extra_cleanup(user_info['sid'])
+
+    return lambda: namespace.socketio.delivered, cleanup
+
+
+def run(name, func, num_clients, messages):
+    queue_name = f"benchmark_{get_random_id()}"
+    users = make_users(num_clients)
+    expected = expected_deliveries(users, messages)
+    get_delivered, cleanup = func(queue_name, users, len(messages))
+
+    # Give the subscribers a chance to connect before publishing
+    time.sleep(1)
+
+    publisher = CommsQueue(queue_name)
+    start = time.time()
+    for msg in messages:
+        publisher.publish(msg)
+    wait_for(get_delivered, expected)
+    elapsed = time.time() - start
+
+    print(f"{name:<8} {num_clients:>5} clients - {len(messages)} messages in {elapsed:.3f}s "
+          f"({len(messages) / elapsed:.1f} msg/s, {get_delivered()}/{expected} deliveries)")
+
+    # Wake up the shared subscriber so it notices there is no one left to send messages to
+    cleanup()
+    publisher.publish(messages[0])
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    client_counts = [int(x) for x in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 10, 100, 300]
+
+    messages = make_messages(num_messages)
+    for num_clients in client_counts:
+        run("legacy", start_legacy, num_clients, messages)
+        run("shared", start_shared, num_clients, messages)
+
+
+if __name__ == "__main__":
+    main()
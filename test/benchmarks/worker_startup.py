@@ -0,0 +1,43 @@
+"""
+Measure the boot time and memory footprint of a UI worker.
+
+Each run imports the application in a fresh interpreter, like a newly forked gunicorn worker, and reports the import
+time and peak RSS. The same is then measured once the lazy global instances (AI agent, identify, archive manager and
+hash search datasources) have been created, which is the cost moved from the worker's boot to the first requests
+that use them.
+
+Usage: python test/benchmarks/worker_startup.py [num_runs] [module]
+  ex: python test/benchmarks/worker_startup.py 5 assemblyline_ui.app
+"""
+import statistics
+import sys
+
+from assemblyline_ui.profile_startup import DEFAULT_MODULE, profile
+
+
+def run(name, module, num_runs, init):
+    reports = [profile(module, init=init) for _ in range(num_runs)]
+    import_times = [report["import_time"] for report in reports]
+    init_times = [sum(report["init_times"].values()) for report in reports]
+    rss = [report["rss"] / 1024 for report in reports]
+
+    print(f"{name:<12} - boot {statistics.median(import_times):.3f}s (min {min(import_times):.3f}s, "
+          f"max {max(import_times):.3f}s), init {statistics.median(init_times):.3f}s, "
+          f"peak RSS {statistics.median(rss):.1f}MB")
+    return reports
+
+
+def main():
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    module = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_MODULE
+
+    run("Boot", module, num_runs, init=False)
+    reports = run("Initialized", module, num_runs, init=True)
+
+    for name in sorted(reports[0]["init_times"]):
+        times = [report["init_times"][name] for report in reports]
+        print(f"  {name:<24} - {statistics.median(times):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import json
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from assemblyline_ui.app import app
+from assemblyline_ui.api.base import stream_ai_response
+from assemblyline_ui.helper.ai.base import DONE, TOKEN, AIAgent, AIAgentPool, APIException
+from assemblyline_ui.helper.fanout import CLOSED, HALF_OPEN, OPEN
+
+
+class FakeBackend(AIAgent):
+    """Backend answering with its own name after a delay, or failing with the given error"""
+
+    def __init__(self, name, delay=0.0, error=None):
+        super().__init__(SimpleNamespace(model_name=name), None)
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def _answer(self, data):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {"content": f"{self.config.model_name}: {data}", "truncated": False}
+
+    def _call_ai_backend(self, data, action, with_trace=False):
+        return self._answer(data)
+
+    def _stream_ai_backend(self, data, action, with_trace=False):
+        result = self._answer(data)
+        for token in result['content'].split(' '):
+            yield {"type": TOKEN, "content": token}
+        yield {"type": DONE, "result": result}
+
+    def summarize_code_snippet(self, code, lang="english", with_trace=False, stream=False):
+        return self._send(code, "code", with_trace=with_trace, stream=stream)
+
+
+class FakeDatastore(object):
+    def list_all_services(self):
+        return []
+
+    def get_collection(self, _):
+        return SimpleNamespace(fields=lambda include_description=True: {})
+
+
+def make_pool(config, backends, **kwargs):
+    return AIAgentPool(config, api_backends=backends, ds=FakeDatastore(),
+                       classification=SimpleNamespace(description={}), **kwargs)
+
+
+def test_ai_pool_hedge_winner(config):
+    slow, fast = FakeBackend("slow", delay=1), FakeBackend("fast")
+    pool = make_pool(config, [slow, fast], hedge_delay=0.1)
+
+    start = time.time()
+    assert pool.summarize_code_snippet("code")['content'] == "fast: code"
+    assert time.time() - start < 1
+    assert slow.calls == 1 and fast.calls == 1
+    assert pool.health[1].hedged == 1
+
+    # The slow backend answering late does not replace the answer of the winner
+    time.sleep(1)
+    assert pool.health[0].breaker.state == CLOSED
+
+
+def test_ai_pool_stream_hedge_winner(config):
+    slow, fast = FakeBackend("slow", delay=1), FakeBackend("fast")
+    pool = make_pool(config, [slow, fast], hedge_delay=0.1)
+
+    events = list(pool.summarize_code_snippet("code", stream=True))
+    assert [event['content'] for event in events if event['type'] == TOKEN] == ["fast:", "code"]
+    assert events[-1] == {"type": DONE, "result": {"content": "fast: code", "truncated": False}}
+
+    # The cancelled loser is not counted as a failure
+    time.sleep(1)
+    assert pool.health[0].failures == 0
+
+
+def test_ai_pool_failover_and_cooldown(config):
+    failing = FakeBackend("failing", error=APIException("backend down"))
+    pool = make_pool(config, [failing], failure_threshold=1, cooldown=0.5)
+
+    with pytest.raises(APIException, match="backend down"):
+        pool.summarize_code_snippet("code")
+    assert pool.health[0].breaker.state == OPEN
+
+    # An open breaker stops the requests to the backend
+    with pytest.raises(APIException, match="temporarily unavailable"):
+        pool.summarize_code_snippet("code")
+    assert failing.calls == 1
+
+    # Once the cooldown is over a trial request goes through and closes the breaker
+    time.sleep(0.5)
+    assert pool.health[0].breaker.state == HALF_OPEN
+    failing.error = None
+    assert pool.summarize_code_snippet("code")['content'] == "failing: code"
+    assert pool.health[0].breaker.state == CLOSED
+    assert failing.calls == 2
+
+
+def test_ai_pool_failover_to_next_backend(config):
+    failing, healthy = FakeBackend("failing", error=APIException("backend down")), FakeBackend("healthy")
+    pool = make_pool(config, [failing, healthy], hedge_delay=10, failure_threshold=1, cooldown=60)
+
+    # The failure is retried on the next backend right away instead of waiting for the hedge delay
+    start = time.time()
+    assert pool.summarize_code_snippet("code")['content'] == "healthy: code"
+    assert time.time() - start < 10
+    assert pool.health[0].breaker.state == OPEN
+
+    # The healthy backend is the only one queried while the breaker of the other one is open
+    assert pool.summarize_code_snippet("code")['content'] == "healthy: code"
+    assert failing.calls == 1
+
+
+def parse_events(data):
+    events = []
+    for block in data.split("\n\n"):
+        if block:
+            name, payload = block.split("\n")
+            assert name.startswith("event: ") and payload.startswith("data: ")
+            events.append((name[7:], json.loads(payload[6:])))
+    return events
+
+
+def test_stream_ai_response():
+    results = []
+    events = [
+        {"type": TOKEN, "content": "Hello"},
+        {"type": TOKEN, "content": " world"},
+        {"type": DONE, "result": {"content": "Hello world", "truncated": False}},
+    ]
+    with app.test_request_context():
+        rsp = stream_ai_response(iter(events), on_result=results.append)
+        assert rsp.mimetype == "text/event-stream"
+        assert rsp.headers["Cache-Control"] == "no-cache"
+        data = rsp.get_data(as_text=True)
+
+    assert data.endswith("\n\n")
+    assert parse_events(data) == [
+        ("token", {"content": "Hello"}),
+        ("token", {"content": " world"}),
+        ("done", {"content": "Hello world", "truncated": False}),
+    ]
+    assert results == [{"content": "Hello world", "truncated": False}]
+
+
+def test_stream_ai_response_error():
+    def events():
+        yield {"type": TOKEN, "content": "Hello"}
+        raise APIException("The AI backend stopped answering")
+
+    results = []
+    with app.test_request_context():
+        data = stream_ai_response(events(), on_result=results.append).get_data(as_text=True)
+
+    # The headers are already sent, the error is reported as an event of the stream
+    assert parse_events(data) == [
+        ("token", {"content": "Hello"}),
+        ("error", {"api_error_message": "The AI backend stopped answering"}),
+    ]
+    assert results == []
@@ -1,11 +1,18 @@
 
+import time
+
 import pytest
+import requests
 
 from assemblyline.common.security import get_totp_token
 from assemblyline.odm.models.user import ACL_MAP
 from assemblyline.odm.randomizer import get_random_hash
 from assemblyline.odm.random_data import create_users, wipe_users
 
+from assemblyline.common.isotime import now
+from assemblyline_ui.config import KV_SESSION
+from assemblyline_ui.security.authenticator import SessionStore
+
 from conftest import get_api_data, APIError
 
 
@@ -85,6 +92,31 @@ def test_api_keys(datastore, login_session):
     assert resp.get('success', False) is True
 
 
+# noinspection PyUnusedLocal
+def test_apikey_cache(datastore, login_session):
+    _, session, host = login_session
+    key_name = f'apikey_{get_random_hash(6)}'
+
+    resp = get_api_data(session, f"{host}/api/v4/auth/apikey/{key_name}/READ/", method="PUT")
+    apikey = resp.get('apikey', None)
+    assert apikey is not None
+
+    # First call verifies the key, the second one should be served from the cache
+    apikey_session = requests.Session()
+    apikey_session.headers.update({'X-USER': 'admin', 'X-APIKEY': apikey})
+    get_api_data(apikey_session, f"{host}/api/v4/user/whoami/")
+    stats = get_api_data(session, f"{host}/api/v4/auth/apikey_cache/")
+    get_api_data(apikey_session, f"{host}/api/v4/user/whoami/")
+    new_stats = get_api_data(session, f"{host}/api/v4/auth/apikey_cache/")
+    assert new_stats['hits'] > stats['hits']
+
+    # Deleting the key invalidates the cache
+    resp = get_api_data(session, f"{host}/api/v4/auth/apikey/{key_name}/", method="DELETE")
+    assert resp.get('success', False) is True
+    with pytest.raises(APIError):
+        get_api_data(apikey_session, f"{host}/api/v4/user/whoami/")
+
+
 # noinspection PyUnusedLocal
 def test_otp(datastore, login_session):
     _, session, host = login_session
@@ -100,3 +132,21 @@ def test_otp(datastore, login_session):
 
     resp = get_api_data(session, f"{host}/api/v4/auth/disable_otp/")
     assert resp.get('success', False) is True
+
+
+def test_session_drop_broadcast():
+    session_id = get_random_hash(64)
+    KV_SESSION.set(session_id, {'username': 'admin', 'duration': 3600, 'expire_at': now(3600)})
+
+    # Two stores stand for two workers, the second one has the session in its local cache
+    store_a = SessionStore(KV_SESSION)
+    store_b = SessionStore(KV_SESSION)
+    assert store_a.get(session_id) is not None
+    assert store_b.get(session_id) is not None
+
+    # Logging out through the first store is seen by the second one before its local cache expires
+    store_a.drop(session_id)
+    start = time.time()
+    while store_b.get(session_id) is not None and time.time() - start < 2:
+        time.sleep(0.1)
+    assert store_b.get(session_id) is None
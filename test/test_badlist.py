@@ -301,6 +301,36 @@ def test_badlist_exist(datastore, login_session):
     assert resp == datastore.badlist.get(hash, as_obj=False)
 
 
+def test_badlist_check_many(datastore, login_session):
+    _, session, host = login_session
+
+    file_items = datastore.badlist.search("type:file", fl='id', rows=5, as_obj=False)['items']
+    tag_items = datastore.badlist.search("type:tag", fl='tag', rows=5, as_obj=False)['items']
+    missing_hash = "f" + get_random_hash(63)
+
+    tags = [{"type": x['tag']['type'], "value": x['tag']['value']} for x in tag_items]
+    tags.append({"type": "network.static.ip", "value": "127.0.0.256"})
+    data = {
+        "hashes": [x['id'] for x in file_items] + [missing_hash],
+        "tags": tags
+    }
+    resp = get_api_data(session, f"{host}/api/v4/badlist/check/", method="POST", data=json.dumps(data))
+
+    assert set(resp['hashes'].keys()) == {x['id'] for x in file_items}
+    for qhash, item in resp['hashes'].items():
+        assert item == datastore.badlist.get(qhash, as_obj=False)
+
+    for x in tag_items:
+        assert x['tag']['value'] in resp['tags'][x['tag']['type']]
+    assert "127.0.0.256" not in resp['tags'].get("network.static.ip", {})
+
+    with pytest.raises(APIError) as invalid_exc:
+        get_api_data(session, f"{host}/api/v4/badlist/check/", method="POST",
+                     data=json.dumps({"hashes": [get_random_hash(12)]}))
+
+    assert 'Invalid hash' in invalid_exc.value.args[0]
+
+
 # noinspection PyUnusedLocal
 def test_badlist_invalid(datastore, login_session):
     _, session, host = login_session
@@ -342,6 +372,18 @@ def test_badlist_similar_tlsh(datastore, login_session):
     assert len(resp) > 0
 
 
+# noinspection PyUnusedLocal
+def test_badlist_similar_tlsh_threshold(datastore, login_session):
+    _, session, host = login_session
+
+    hash = random.choice(datastore.badlist.search("type:file AND hashes.tlsh:*", fl='hashes.tlsh',
+                         rows=100, as_obj=False)['items'])['hashes']['tlsh']
+
+    resp = get_api_data(session, f"{host}/api/v4/badlist/tlsh/{hash}/", params={'threshold': 0, 'rows': 5})
+    assert 0 < len(resp) <= 5
+    assert all(item['hashes']['tlsh'] == hash for item in resp)
+
+
 def test_badlist_delete_hash(datastore, login_session):
     _, session, host = login_session
 
@@ -1,11 +1,16 @@
 
+import base64
+import io
+import json
 import pytest
 import random
+import tarfile
 
-from cart import is_cart
+from cart import is_cart, unpack_stream
 from conftest import get_api_data
 
 from assemblyline.common.bundling import create_bundle
+from assemblyline_ui.helper.bundling import get_bundle_data
 from assemblyline.odm.random_data import create_users, wipe_users, create_submission, wipe_submissions
 from assemblyline.odm.models.alert import Alert
 from assemblyline.odm.randomizer import random_model_obj
@@ -37,6 +42,29 @@ def test_alert_create_bundle(datastore, login_session):
     assert is_cart(resp[:256])
 
 
+# noinspection PyUnusedLocal
+def test_bundle_data_matches_create_bundle(datastore):
+    # The streamed bundles must hold the same content as the ones made by create_bundle
+    sid = datastore.alert.get(ALERT_ID, as_obj=False)['sid']
+    bundle_file = create_bundle(sid, working_dir='/tmp/bundle')
+    tgz = io.BytesIO()
+    with open(bundle_file, 'rb') as fh:
+        unpack_stream(fh, tgz)
+    tgz.seek(0)
+    with tarfile.open(fileobj=tgz) as tar:
+        names = set(tar.getnames()) - {"results.json"}
+        expected = json.load(tar.extractfile("results.json"))
+
+    data, sha256s, bundle_sid = get_bundle_data(sid)
+    data = json.loads(json.dumps(data))
+    for bundle_data in [expected, data]:
+        bundle_data['submission']['metadata'].pop('bundle.created', None)
+
+    assert bundle_sid == sid
+    assert data == expected
+    assert names.issubset(sha256s)
+
+
 # noinspection PyUnusedLocal
 def test_alert_import_bundle(datastore, login_session, filestore):
     _, session, host = login_session
@@ -101,3 +129,30 @@ def test_submission_import_bundle(datastore, login_session, filestore):
 
         ds.submission.commit()
         assert submission == random.choice(ds.submission.search('id:*', rows=100, as_obj=False)['items'])
+
+
+# noinspection PyUnusedLocal
+def test_submission_bundle_round_trip(datastore, login_session, filestore):
+    _, session, host = login_session
+    ds = datastore
+
+    # Download a streamed bundle of the submission
+    submission = random.choice(ds.submission.search('id:*', rows=100, as_obj=False)['items'])
+    bundle = get_api_data(session, f"{host}/api/v4/bundle/{submission['sid']}/", raw=True)
+    assert is_cart(bundle[:256])
+
+    # Delete associated submission
+    ds.delete_submission_tree(submission['sid'], transport=filestore)
+    ds.error.commit()
+    ds.file.commit()
+    ds.result.commit()
+    ds.submission.commit()
+
+    # Import it back base64 encoded
+    resp = get_api_data(session, f"{host}/api/v4/bundle/", method="POST", data=base64.encodebytes(bundle))
+    assert resp['success']
+
+    ds.submission.commit()
+    new_submission = ds.submission.get_if_exists(submission['sid'], as_obj=False)
+    assert new_submission['sid'] == submission['sid']
+    assert 'bundle.source' in new_submission['metadata']
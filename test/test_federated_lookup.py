@@ -1,12 +1,14 @@
 import pytest
+import time
 
 from urllib import parse as ul
 from requests import Response
 
 from assemblyline.odm.random_data import create_users, wipe_users
 from assemblyline_ui.app import app
-from assemblyline_ui.config import config, CLASSIFICATION
+from assemblyline_ui.config import config, CLASSIFICATION, EXTERNAL_LOOKUP_CACHE
 from assemblyline_ui.api.v4 import federated_lookup
+from assemblyline_ui.helper.fanout import TIMEOUT_ERROR
 
 
 @pytest.fixture()
@@ -300,6 +302,9 @@ def mock_get(mocker):
     """Return a mocker for the `get` method."""
     mock_session = mocker.patch("assemblyline_ui.api.v4.federated_lookup.Session", autospec=True)
     mock_get = mock_session.return_value.get
+    # start from new sessions and an empty lookup cache so every test queries the mocked sources
+    federated_lookup.SESSIONS.clear()
+    EXTERNAL_LOOKUP_CACHE.clear()
     return mock_get
 
 
@@ -519,6 +524,77 @@ def test_lookup_tag_multi_source_single_hit(
     assert data == expected
 
 
+def test_lookup_tag_cached(
+    datastore, user_login_session, mock_get, mock_mb_hash_response, digest_sha256, mock_404_response
+):
+    """Lookup the same tag twice.
+
+    Given an external lookup for both Malware Bazaar and Virustoal is configured
+        And a given hash exists only in Malware Bazaar
+
+    When a user requests a lookup of a given hash twice
+
+    Then the second lookup should be answered from the cache, including the not found answer
+    """
+    _, client = user_login_session
+
+    mock_get.side_effect = [
+        mock_mb_hash_response,
+        mock_404_response,
+    ]
+
+    first = client.get(f"/api/v4/federated_lookup/enrich/sha256/{digest_sha256}/")
+    second = client.get(f"/api/v4/federated_lookup/enrich/sha256/{digest_sha256}/")
+
+    # Only the first lookup should query the sources
+    assert mock_get.call_count == 2
+    assert second.status_code == 200
+    assert second.json["api_response"] == first.json["api_response"]
+    assert second.json["api_response"]["virustotal"] == {"error": "Not Found", "items": []}
+
+    rsp = client.get("/api/v4/federated_lookup/stats/")
+    assert rsp.status_code == 200
+    stats = rsp.json["api_response"]
+    assert stats["malware_bazaar"]["hits"] == 1
+    assert stats["malware_bazaar"]["misses"] == 1
+    assert stats["virustotal"]["not_found_hits"] == 1
+    assert stats["virustotal"]["misses"] == 1
+
+
+def test_lookup_tag_source_timeout(
+    datastore, user_login_session, mock_get, mock_mb_hash_response, mock_vt_hash_response, digest_sha256
+):
+    """Lookup a valid tag type when one of the sources is too slow.
+
+    Given an external lookup for both Malware Bazaar and Virustoal is configured
+        And Virustotal takes longer than the maximum timeout to answer
+
+    When a user requests a lookup of a given hash
+
+    Then the user should receive the results of Malware Bazaar without waiting for Virustotal
+        And Virustotal should be reported as timed out
+    """
+    _, client = user_login_session
+
+    def slow_get(url, **kwargs):
+        if url.startswith("http://lookup_vt"):
+            time.sleep(2)
+            return mock_vt_hash_response
+        return mock_mb_hash_response
+
+    mock_get.side_effect = slow_get
+
+    start = time.time()
+    rsp = client.get(f"/api/v4/federated_lookup/enrich/sha256/{digest_sha256}/?max_timeout=0.5")
+    assert time.time() - start < 2
+
+    assert rsp.status_code == 200
+    data = rsp.json["api_response"]
+    assert data["virustotal"] == {"error": TIMEOUT_ERROR, "items": []}
+    assert data["malware_bazaar"]["error"] == ""
+    assert len(data["malware_bazaar"]["items"]) == 1
+
+
 def test_lookup_tag_multi_source_invalid_single(
     datastore, user_login_session, mock_get, mock_mb_imphash_response, imphash, mock_400_response
 ):
@@ -842,6 +918,91 @@ def test_access_control_tag_max_classification(datastore, admin_login_session, m
     assert data == expected
 
 
+def test_enrich_submission(datastore, user_login_session, mock_get, mocker):
+    """Enrich all the tags of a submission.
+
+    Given external lookups for both Malware Bazaar and Virustoal are configured
+        And a submission has tags supported by each source and a safelisted tag
+
+    When a user requests the enrichment of the submission
+
+    Then each source should receive a single batch lookup of the tags it supports
+        And the second enrichment should be answered from the cache
+    """
+    _, client = user_login_session
+
+    mock_storage = mocker.patch.object(federated_lookup, "STORAGE")
+    mock_storage.submission.get.return_value = {
+        "classification": CLASSIFICATION.UNRESTRICTED,
+        "results": [],
+        "state": "completed",
+    }
+    tags = [
+        ("file.pe.imports.imphash", "b" * 32, False),
+        ("network.static.domain", "bad.domain", False),
+        ("network.static.domain", "bad.domain", False),
+        ("network.static.domain", "good.domain", True),
+    ]
+    mocker.patch.object(federated_lookup, "get_or_create_summary", return_value={"tags": [
+        {"type": t, "value": v, "safelisted": safelisted, "classification": CLASSIFICATION.UNRESTRICTED}
+        for t, v, safelisted in tags
+    ]})
+
+    item = {
+        "classification": CLASSIFICATION.UNRESTRICTED,
+        "count": 1,
+        "confirmed": False,
+        "description": "description",
+        "link": "https://link",
+        "malicious": True,
+    }
+
+    def post(url, json=None, **kwargs):
+        rsp = mocker.MagicMock(spec=Response)
+        rsp.status_code = 200
+        rsp.json.return_value = {
+            "api_error_message": "",
+            "api_response": [
+                {**t, "error": "", "items": [item] if t["tag_name"] == "file.pe.imports.imphash" else []}
+                for t in json["tags"]
+            ],
+            "api_status_code": 200,
+        }
+        return rsp
+
+    mock_post = federated_lookup.Session.return_value.post
+    mock_post.side_effect = post
+
+    rsp = client.get("/api/v4/federated_lookup/submission/abc/")
+    assert rsp.status_code == 200
+    data = rsp.json["api_response"]
+
+    # A single batch query for each source, no single tag lookups
+    assert mock_post.call_count == 2
+    assert mock_get.call_count == 0
+    sent = {call.args[0]: call.kwargs["json"]["tags"] for call in mock_post.call_args_list}
+    assert sent == {
+        "http://lookup_mb:8000/details/batch/": [{"tag_name": "file.pe.imports.imphash", "tag": "b" * 32}],
+        "http://lookup_vt:8001/details/batch/": [{"tag_name": "network.static.domain", "tag": "bad.domain"}],
+    }
+
+    assert data == {
+        "malware_bazaar": {
+            "error": "",
+            "items": [{"tag_name": "file.pe.imports.imphash", "tag": "b" * 32, "error": "", "items": [item]}],
+        },
+        "virustotal": {
+            "error": "",
+            "items": [{"tag_name": "network.static.domain", "tag": "bad.domain", "error": "Not Found", "items": []}],
+        },
+    }
+
+    # Answers are cached, including not found ones
+    rsp = client.get("/api/v4/federated_lookup/submission/abc/")
+    assert mock_post.call_count == 2
+    assert rsp.json["api_response"] == data
+
+
 def test_get_tag_names(datastore, ext_config, user_login_session, mock_get):
     """Lookup the valid tag names from all sources.
 
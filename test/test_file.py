@@ -77,6 +77,22 @@ def test_download_raw(datastore, login_session):
     assert resp.decode() == rand_hash
 
 
+# noinspection PyUnusedLocal
+def test_download_raw_range(datastore, login_session):
+    _, session, host = login_session
+
+    rand_hash = random.choice(file_res_list)[:64]
+    resp = session.get(f"{host}/api/v4/file/download/{rand_hash}/?encoding=raw",
+                       headers={'Range': 'bytes=10-19'}, verify=False)
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == f"bytes 10-19/{len(rand_hash)}"
+    assert resp.content.decode() == rand_hash[10:20]
+
+    resp = session.get(f"{host}/api/v4/file/download/{rand_hash}/?encoding=raw",
+                       headers={'Range': 'bytes=1000-'}, verify=False)
+    assert resp.status_code == 416
+
+
 # noinspection PyUnusedLocal
 def test_ascii(datastore, login_session):
     _, session, host = login_session
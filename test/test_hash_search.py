@@ -11,7 +11,7 @@ from assemblyline.odm.models.file import File
 from assemblyline.odm.randomizer import random_model_obj
 from assemblyline.odm.random_data import create_users, wipe_users
 from assemblyline_ui.app import app
-from assemblyline_ui.config import CLASSIFICATION
+from assemblyline_ui.config import CLASSIFICATION, EXTERNAL_LOOKUP_CACHE
 from assemblyline_ui.api.v4 import hash_search, federated_lookup
 
 NUM_ITEMS = 10
@@ -228,6 +228,9 @@ def mock_get(mocker):
     """Return a mocker for the `get` method."""
     mock_session = mocker.patch("assemblyline_ui.api.v4.hash_search.Session", autospec=True)
     mock_get = mock_session.return_value.get
+    # start from new sessions and an empty lookup cache so every test queries the mocked sources
+    hash_search.SESSIONS.clear()
+    EXTERNAL_LOOKUP_CACHE.clear()
     return mock_get
 
 
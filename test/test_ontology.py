@@ -66,3 +66,17 @@ def test_get_ontology_for_submission(datastore, login_session):
     res = [json.loads(line) for line in data.splitlines()]
     assert len(res) != 0
     assert any([record['file']['sha256'] == test_submission.files[0].sha256 for record in res])
+
+
+def test_get_ontology_for_submissions(datastore, login_session):
+    _, session, host = login_session
+
+    data = get_api_data(session, f"{host}/api/v4/ontology/submissions/",
+                        params={"query": f"sid:{test_submission.sid}"}, raw=True)
+    res = [json.loads(line) for line in data.splitlines()]
+    assert len(res) != 0
+    assert all([record['submission']['sid'] == test_submission.sid for record in res])
+
+    data = get_api_data(session, f"{host}/api/v4/ontology/submissions/", method="POST",
+                        data=json.dumps({"sid": [test_submission.sid]}), raw=True)
+    assert len(data.splitlines()) == len(res)
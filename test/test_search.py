@@ -1,9 +1,10 @@
 
+import json
 import pytest
 
 from assemblyline.common.uid import get_random_id
 from assemblyline.odm.models.heuristic import Heuristic
-from conftest import get_api_data
+from conftest import get_api_data, APIError
 
 from assemblyline.odm.models.alert import Alert
 from assemblyline.odm.models.badlist import Badlist
@@ -93,6 +94,38 @@ def datastore(datastore_connection):
         wipe_users(ds)
 
 
+# noinspection PyUnusedLocal
+def test_analytics_search(datastore, login_session):
+    _, session, host = login_session
+
+    data = {
+        "query": "id:*",
+        "facets": [{"field": "id"}],
+        "histograms": [{"field": "ts"}, {"field": "al.score"}],
+        "stats": [{"field": "al.score"}]
+    }
+    resp = get_api_data(session, f"{host}/api/v4/search/analytics/alert/", data=json.dumps(data), method="POST")
+    assert len(resp['facets']['id']) == TEST_SIZE
+    for k, v in resp['histograms']['ts'].items():
+        assert k.startswith("2") and k.endswith("Z") and isinstance(v, int)
+    for k, v in resp['histograms']['al.score'].items():
+        assert isinstance(int(k), int) and isinstance(v, int)
+    assert resp['stats']['al.score']['count'] == TEST_SIZE
+
+    # Same request should be served from the cache
+    assert get_api_data(session, f"{host}/api/v4/search/analytics/alert/", data=json.dumps(data),
+                        method="POST") == resp
+
+    # Analysis of the same field need distinct names
+    data = {"histograms": [{"field": "ts", "gap": "+1h"}, {"field": "ts", "gap": "+1d"}]}
+    with pytest.raises(APIError, match="used more than once"):
+        get_api_data(session, f"{host}/api/v4/search/analytics/alert/", data=json.dumps(data), method="POST")
+
+    data['histograms'][1]['name'] = "ts_daily"
+    resp = get_api_data(session, f"{host}/api/v4/search/analytics/alert/", data=json.dumps(data), method="POST")
+    assert set(resp['histograms'].keys()) == {"ts", "ts_daily"}
+
+
 # noinspection PyUnusedLocal
 def test_deep_search(datastore, login_session):
     _, session, host = login_session
@@ -225,3 +258,20 @@ def test_stats_search(datastore, login_session):
         assert list(resp.keys()) == ['avg', 'count', 'max', 'min', 'sum']
         for v in resp.values():
             assert isinstance(v, int) or isinstance(v, float)
+
+
+# noinspection PyUnusedLocal
+def test_search_stream(datastore, login_session):
+    _, session, host = login_session
+
+    for collection in collections:
+        resp = get_api_data(session, f"{host}/api/v4/search/{collection}/",
+                            params={"query": "id:*", "stream": True, "fl": "id"}, raw=True)
+        items = [json.loads(line) for line in resp.decode().splitlines()]
+        assert len(items) >= TEST_SIZE
+        for item in items:
+            assert list(item.keys()) == ['id']
+
+        resp = get_api_data(session, f"{host}/api/v4/search/{collection}/",
+                            params={"query": "id:*", "stream": True, "rows": 3}, raw=True)
+        assert len(resp.decode().splitlines()) == 3
@@ -145,6 +145,31 @@ def test_get_all_services(datastore, login_session):
         assert svc['name'] in svc_list
 
 
+# noinspection PyUnusedLocal
+def test_get_service_stats(datastore, login_session):
+    _, session, host = login_session
+
+    service = random.choice(list(TEMP_SERVICES.keys()))
+    resp = get_api_data(session, f"{host}/api/v4/service/stats/{service}/")
+    assert resp['service']['name'] == service
+    # Without a version, the stats are the ones of the current version of the service
+    assert resp['service']['version'] == datastore.service_delta.get(service).version
+    assert sorted(resp.keys()) == ['error', 'file', 'heuristic', 'result', 'service']
+
+    # The second call is answered from the cache
+    assert get_api_data(session, f"{host}/api/v4/service/stats/{service}/") == resp
+
+
+# noinspection PyUnusedLocal
+def test_get_all_service_stats(datastore, login_session):
+    _, session, host = login_session
+
+    resp = get_api_data(session, f"{host}/api/v4/service/stats/")
+    assert sorted(resp.keys()) == sorted(list(TEMP_SERVICES.keys()))
+    for name, stats in resp.items():
+        assert stats['service']['name'] == name
+
+
 # noinspection PyUnusedLocal
 def test_delete_service(datastore, login_session):
     global TEMP_SERVICES
@@ -306,6 +306,16 @@ def test_signature_stats(datastore, login_session):
                                                  'last_hit', 'max', 'min', 'name', 'source', 'sum', 'type']
 
 
+# noinspection PyUnusedLocal
+def test_signature_stats_cached(datastore, login_session):
+    _, session, host = login_session
+
+    # The second call is served from the cache and must return the same stats
+    first = get_api_data(session, f"{host}/api/v4/signature/stats/")
+    second = get_api_data(session, f"{host}/api/v4/signature/stats/")
+    assert sorted(first, key=lambda x: x['id']) == sorted(second, key=lambda x: x['id'])
+
+
 # noinspection PyUnusedLocal
 def test_update_available(datastore, login_session):
     _, session, host = login_session
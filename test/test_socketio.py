@@ -159,6 +159,60 @@ def test_live_namespace(datastore, sio):
         sio.disconnect()
 
 
+# noinspection PyUnusedLocal
+def test_live_namespace_batch(datastore, sio):
+    wq_data = {'wq_id': get_random_id(), 'batch': True}
+    wq = NamedQueue(wq_data['wq_id'], private=True)
+
+    cachekeys = [get_random_id() for _ in range(10)]
+    cachekeyerrs = [get_random_id() for _ in range(3)]
+
+    test_res_array = []
+    received_keys = []
+    received_errors = []
+
+    @sio.on('start', namespace='/live_submission')
+    def on_start(data):
+        test_res_array.append(('on_start', data['status_code'] == 200))
+
+    @sio.on('stop', namespace='/live_submission')
+    def on_stop(data):
+        test_res_array.append(('on_stop', data['status_code'] == 200))
+
+    @sio.on('cachekeys', namespace='/live_submission')
+    def on_cachekeys(data):
+        received_keys.extend(data['msg'])
+
+    @sio.on('cachekeyerrs', namespace='/live_submission')
+    def on_cachekeyerrs(data):
+        received_errors.extend(data['msg'])
+
+    try:
+        sio.emit('listen', wq_data, namespace='/live_submission')
+        sio.sleep(1)
+
+        wq.push({"status": "START"})
+        wq.push(*[{"status": "OK", "cache_key": key} for key in cachekeys])
+        wq.push(*[{"status": "FAIL", "cache_key": key} for key in cachekeyerrs])
+        wq.push({"status": "STOP"})
+
+        start_time = time.time()
+
+        while len(test_res_array) < 2 and time.time() - start_time < 5:
+            sio.sleep(0.1)
+
+        assert len(test_res_array) == 2
+        assert received_keys == cachekeys
+        assert received_errors == cachekeyerrs
+
+        for test, result in test_res_array:
+            if not result:
+                pytest.fail(f"{test} failed.")
+
+    finally:
+        sio.disconnect()
+
+
 # noinspection PyUnusedLocal
 def test_status_namspace(datastore, sio):
     status_queue = CommsQueue('status', private=True)
@@ -53,6 +53,22 @@ def test_get_submission_file_result(datastore, login_session):
     assert len(resp['results']) == len([x for x in submission.results if x.startswith(sha256)])
 
 
+# noinspection PyUnusedLocal
+def test_get_submission_file_result_cached(datastore, login_session):
+    _, session, host = login_session
+
+    sid = random.choice(datastore.submission.search("id:*", fl='id', rows=NUM_SUBMISSIONS, as_obj=False)['items'])['id']
+    submission = datastore.submission.get(sid)
+    sha256 = random.choice(submission.results)[:64]
+
+    # The second call is served from the cached view and must match the first one
+    resp = get_api_data(session, f"{host}/api/v4/submission/{sid}/file/{sha256}/")
+    cached_resp = get_api_data(session, f"{host}/api/v4/submission/{sid}/file/{sha256}/")
+    for key in ['attack_matrix', 'classification', 'errors', 'heuristics', 'results', 'tags']:
+        assert resp[key] == cached_resp[key]
+    assert sorted(resp['signatures']) == sorted(cached_resp['signatures'])
+
+
 # noinspection PyUnusedLocal
 def test_get_submission(datastore, login_session):
     _, session, host = login_session
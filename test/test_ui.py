@@ -87,3 +87,32 @@ def test_ui_submission(datastore, login_session):
     assert submission.files[0].name == 'test.txt'
     assert submission.sid == resp['sid']
     assert submission.state == 'submitted'
+
+
+# noinspection PyUnusedLocal
+def test_ui_chunk_bounds(datastore, login_session):
+    _, session, host = login_session
+
+    params = {
+        'flowChunkNumber': '3',
+        'flowChunkSize': '10',
+        'flowTotalSize': '20',
+        'flowFilename': 'test.txt',
+        'flowTotalChunks': '2',
+        'flowIdentifier': get_random_id(),
+        'flowCurrentChunkSize': '10'
+    }
+
+    # The chunk number is past the number of chunks
+    with pytest.raises(APIError, match="flowChunkNumber should be between"):
+        get_api_data(session, f"{host}/api/v4/ui/flowjs/", params=params)
+
+    # The number of chunks is larger than any upload allowed
+    params.update({'flowChunkNumber': '1', 'flowChunkSize': '1', 'flowTotalChunks': f'{2**32}'})
+    with pytest.raises(APIError, match="flowTotalChunks should be between"):
+        get_api_data(session, f"{host}/api/v4/ui/flowjs/", params=params)
+
+    params.update({'flowRelativePath': '/tmp/test/test.txt', 'flowChunkNumber': f'{2**32}'})
+    with pytest.raises(APIError, match="should be between"):
+        get_api_data(session, f"{host}/api/v4/ui/flowjs/", method="POST", data=params, headers={},
+                     files={'file': BytesIO(b"a")})
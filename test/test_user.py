@@ -238,6 +238,27 @@ def test_set_user(datastore, login_session):
         assert u[k] == new_user[k]
 
 
+# noinspection PyUnusedLocal
+def test_set_user_invalidates_login_cache(datastore, login_session):
+    _, session, host = login_session
+
+    # Load the current user so its context ends up in the login cache
+    resp = get_api_data(session, f"{host}/api/v4/user/whoami/")
+    original_name = resp['name']
+
+    u = datastore.user.get('admin', as_obj=False)
+    u['name'] = f"{original_name} (renamed)"
+    try:
+        resp = get_api_data(session, f"{host}/api/v4/user/admin/", method="POST", data=json.dumps(u))
+        assert resp['success']
+
+        resp = get_api_data(session, f"{host}/api/v4/user/whoami/")
+        assert resp['name'] == u['name']
+    finally:
+        u['name'] = original_name
+        get_api_data(session, f"{host}/api/v4/user/admin/", method="POST", data=json.dumps(u))
+
+
 # noinspection PyUnusedLocal
 def test_set_user_avatar(datastore, login_session):
     _, session, host = login_session
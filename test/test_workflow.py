@@ -1,6 +1,7 @@
 import json
 import pytest
 import random
+import time
 
 from conftest import APIError, get_api_data
 
@@ -120,3 +121,27 @@ def test_set_workflow(datastore, login_session):
     new_workflow = datastore.workflow.get(workflow_id, as_obj=False)
     new_workflow['last_edit'] = workflow_data['last_edit']
     assert workflow_data == new_workflow
+
+
+# noinspection PyUnusedLocal
+def test_run_workflow(datastore, login_session):
+    _, session, host = login_session
+
+    workflow_id = random.choice(workflow_list)
+    resp = get_api_data(session, f"{host}/api/v4/workflow/{workflow_id}/run")
+    assert resp['success']
+    run_id = resp['run_id']
+
+    # The run is done in the background, wait for it to finish
+    start = time.time()
+    status = get_api_data(session, f"{host}/api/v4/workflow/run/{run_id}/")
+    while status['status'] in ['queued', 'running'] and time.time() - start < 60:
+        time.sleep(1)
+        status = get_api_data(session, f"{host}/api/v4/workflow/run/{run_id}/")
+
+    assert status['run_id'] == run_id
+    assert status['workflow_ids'] == [workflow_id]
+    assert status['status'] == 'completed'
+
+    with pytest.raises(APIError):
+        get_api_data(session, f"{host}/api/v4/workflow/run/this_run_does_not_exist/")